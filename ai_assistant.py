@@ -8,6 +8,9 @@ import os
 import json
 import logging
 from datetime import datetime, timezone
+
+import outbound_http
+
 logger = logging.getLogger(__name__)
 
 try:
@@ -41,9 +44,9 @@ class AIAssistant:
         if env_key:
             return env_key
         try:
-            from app import ParametresEntreprise, app
+            from app import get_parametres_entreprise, app
             with app.app_context():
-                parametres = ParametresEntreprise.query.first()
+                parametres = get_parametres_entreprise()
                 if parametres and parametres.groq_api_key:
                     return parametres.groq_api_key.strip()
         except Exception as e:
@@ -58,7 +61,8 @@ class AIAssistant:
         logger.info("✅ GROQ_API_KEY détectée")
         if GROQ_AVAILABLE and Groq and self.api_key:
             try:
-                self.client = Groq(api_key=self.api_key)
+                # Pas de nouvelle tentative interne : le disjoncteur d'outbound_http s'en charge
+                self.client = Groq(api_key=self.api_key, max_retries=0)
                 logger.info("✅ Groq initialisé avec succès")
             except Exception as e:
                 logger.error(f"❌ Erreur initialisation Groq: {e}")
@@ -96,13 +100,15 @@ class AIAssistant:
         if not self.client:
             return False, "Init échouée"
         try:
-            self.client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=[{"role": "user", "content": "ping"}],
-                temperature=0,
-                max_tokens=1,
-                top_p=1
-            )
+            with outbound_http.call('groq') as timeout:
+                self.client.chat.completions.create(
+                    model="llama-3.3-70b-versatile",
+                    messages=[{"role": "user", "content": "ping"}],
+                    temperature=0,
+                    max_tokens=1,
+                    top_p=1,
+                    timeout=timeout
+                )
             self._mark_ok()
             return True, "Connexion OK"
         except Exception as e:
@@ -114,9 +120,9 @@ class AIAssistant:
         """Récupère le nom de l'entreprise depuis la base de données"""
         try:
             # Import local pour éviter les dépendances circulaires
-            from app import ParametresEntreprise, db, app
+            from app import get_parametres_entreprise, app
             with app.app_context():
-                parametres = ParametresEntreprise.query.first()
+                parametres = get_parametres_entreprise()
                 if parametres and parametres.nom_entreprise:
                     return parametres.nom_entreprise
         except Exception as e:
@@ -201,13 +207,20 @@ IMPORTANT :
             logger.info(f"📨 Envoi à Groq (historique: {len(self.conversation_history[conversation_id])} messages)")
             
             # Appeler l'API Groq
-            response = self.client.chat.completions.create(
-                model="llama-3.3-70b-versatile",  # Nouveau modèle (remplace llama-3.1)
-                messages=self.conversation_history[conversation_id],
-                temperature=0.7,
-                max_tokens=500,
-                top_p=0.9
-            )
+            try:
+                with outbound_http.call('groq') as timeout:
+                    response = self.client.chat.completions.create(
+                        model="llama-3.3-70b-versatile",  # Nouveau modèle (remplace llama-3.1)
+                        messages=self.conversation_history[conversation_id],
+                        temperature=0.7,
+                        max_tokens=500,
+                        top_p=0.9,
+                        timeout=timeout
+                    )
+            except Exception:
+                # Message non traité : ne pas le laisser dans l'historique envoyé au prochain appel
+                self.conversation_history[conversation_id].pop()
+                raise
             
             # Extraire la réponse
             assistant_message = response.choices[0].message.content
@@ -428,10 +428,21 @@ def forecast_load():
 def optimize_logistics():
     try:
         data = request.get_json(silent=True) or {}
-        date_debut = datetime.strptime(data.get('date_debut'), '%Y-%m-%d').date()
-        date_fin = datetime.strptime(data.get('date_fin'), '%Y-%m-%d').date()
+        if data.get('date'):
+            # Un seul jour : tournées de livraison / reprise par véhicule
+            jour = datetime.strptime(data.get('date'), '%Y-%m-%d').date()
+            date_debut = date_fin = jour
+        else:
+            date_debut = datetime.strptime(data.get('date_debut'), '%Y-%m-%d').date()
+            date_fin = datetime.strptime(data.get('date_fin'), '%Y-%m-%d').date()
+        if date_fin < date_debut or (date_fin - date_debut).days > 13:
+            return jsonify({'success': False, 'error': 'Période invalide (14 jours maximum)'}), 400
         suggestions = smart_assistant.optimize_logistics(date_debut, date_fin)
-        return jsonify({'success': True, 'suggestions': suggestions})
+        tournees = [
+            smart_assistant.plan_delivery_routes(date_debut + timedelta(days=n))
+            for n in range((date_fin - date_debut).days + 1)
+        ]
+        return jsonify({'success': True, 'suggestions': suggestions, 'tournees': tournees})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
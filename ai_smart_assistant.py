@@ -7,6 +7,7 @@ Fonctionnalités pratiques sans analyse de sentiment
 import os
 import json
 import logging
+import time
 from datetime import datetime, timedelta, date
 from collections import Counter
 import statistics
@@ -109,27 +110,35 @@ class SmartAssistant:
         Suggère le meilleur prestataire disponible selon critères
         """
         try:
-            from app import DJ, Prestation
+            from app import DJ, Prestation, db, get_staff_conflicts
             
             with self.app.app_context():
                 djs = DJ.query.all()
+                dj_ids = [dj.id for dj in djs]
+                
+                # Disponibilité de tous les prestataires en une requête (périodes indexées)
+                debut_jour = datetime.combine(date_prestation, datetime.min.time())
+                occupes = get_staff_conflicts(
+                    'dj', dj_ids, debut_jour, debut_jour + timedelta(days=1),
+                    statuts=('planifiee', 'confirmee', 'en_cours', 'terminee')
+                )
+                
+                # Expérience (prestations terminées) groupée par prestataire
+                experience = dict(
+                    db.session.query(Prestation.dj_id, db.func.count(Prestation.id))
+                    .filter(Prestation.statut == 'terminee', Prestation.dj_id.in_(dj_ids))
+                    .group_by(Prestation.dj_id)
+                    .all()
+                ) if dj_ids else {}
                 
                 # Scorer chaque prestataire
                 scores = {}
                 for dj in djs:
                     if dj.user and not dj.user.actif:
                         continue
-                    score = 0
-                    
-                    # Vérifier disponibilité
-                    prestations = Prestation.query.filter(
-                        Prestation.dj_id == dj.id,
-                        Prestation.date_debut == date_prestation,
-                        Prestation.statut != 'annulee'
-                    ).all()
-                    
-                    if prestations:
+                    if dj.id in occupes:
                         continue  # Prestataire non disponible
+                    score = 0
                     
                     # Points pour spécialité musicale
                     if dj.specialite_musicale and style_musical:
@@ -137,11 +146,7 @@ class SmartAssistant:
                             score += 50
                     
                     # Points pour expérience (nombre de prestations)
-                    nb_prestations = Prestation.query.filter_by(
-                        dj_id=dj.id,
-                        statut='terminee'
-                    ).count()
-                    score += min(nb_prestations, 30)  # Max 30 points
+                    score += min(experience.get(dj.id, 0), 30)  # Max 30 points
                     
                     # Points pour évaluation moyenne (si disponible)
                     if hasattr(dj, 'evaluation_moyenne') and dj.evaluation_moyenne:
@@ -459,7 +464,7 @@ class SmartAssistant:
         Optimise le planning pour maximiser l'utilisation du matériel
         """
         try:
-            from app import Prestation
+            from app import Prestation, get_staff_double_bookings
             import logging
             logger = logging.getLogger(__name__)
 
@@ -488,6 +493,18 @@ class SmartAssistant:
                             'message': f'Seulement {len(prests)} prestation ce jour. Possibilité d\'en ajouter une autre ?'
                         })
                 
+                # Doubles réservations DJ/technicien détectées côté SQL
+                debut_fenetre = datetime.combine(date_debut, datetime.min.time())
+                fin_fenetre = datetime.combine(date_fin, datetime.min.time()) + timedelta(days=1)
+                for staff_type, label in (('dj', 'DJ'), ('technicien', 'Technicien')):
+                    for conflit in get_staff_double_bookings(staff_type, debut_fenetre, fin_fenetre):
+                        suggestions.append({
+                            'type': 'conflit',
+                            'date': conflit['date'],
+                            'message': f"{label} #{conflit['staff_id']} réservé deux fois : "
+                                       f"{conflit['client_a']} et {conflit['client_b']}"
+                        })
+                
                 return suggestions
                 
         except Exception as e:
@@ -717,6 +734,148 @@ class SmartAssistant:
             logger.error(f"❌ Erreur optimisation logistique: {e}")
         return suggestions
 
+    def plan_delivery_routes(self, jour):
+        """
+        Tournées du jour : livraisons du matériel des prestations qui commencent
+        et reprises de celles qui se terminent, au départ du local qui détient
+        le matériel.
+
+        Les coordonnées stockées et la matrice de distances en cache sont
+        utilisées : aucun géocodage ni appel au moteur de routage n'est lancé
+        ici, les trajets absents du cache sont estimés.
+        """
+        import numpy as np
+        import route_optimizer
+        from app import (
+            db, Local, Materiel, MaterielPresta, Prestation,
+            coordonnees_stockees, matrice_distances
+        )
+
+        debut_calcul = time.monotonic()
+        config = self.app.config
+        plan = {'date': jour.isoformat(), 'vehicules': [], 'non_planifies': [],
+                'distance_km': 0.0, 'duree_min': 0.0}
+        with self.app.app_context():
+            debut_jour = datetime.combine(jour, datetime.min.time())
+            statuts = ['planifiee', 'confirmee', 'en_cours']
+            prestations = Prestation.query.filter(
+                Prestation.statut.in_(statuts),
+                db.or_(
+                    Prestation.date_debut == jour,
+                    db.and_(Prestation.fin_dt >= debut_jour, Prestation.fin_dt < debut_jour + timedelta(days=1))
+                )
+            ).all()
+            if not prestations:
+                return plan
+
+            # Quantités par prestation et par local d'origine, en une requête
+            quantites = {}
+            for prestation_id, local_id, quantite in db.session.query(
+                MaterielPresta.prestation_id, Materiel.local_id, db.func.sum(MaterielPresta.quantite)
+            ).join(Materiel, Materiel.id == MaterielPresta.materiel_id).filter(
+                MaterielPresta.prestation_id.in_([p.id for p in prestations])
+            ).group_by(MaterielPresta.prestation_id, Materiel.local_id).all():
+                quantites.setdefault(prestation_id, {})[local_id] = int(quantite or 0)
+            locaux = {
+                local.id: local for local in Local.query.filter(
+                    Local.id.in_({l for par_local in quantites.values() for l in par_local})
+                ).all()
+            } if quantites else {}
+
+            # Points : dépôts puis arrêts (une livraison et/ou une reprise par prestation et par local)
+            points, depots, arrets = [], {}, []
+            for prestation in prestations:
+                par_local = {l: q for l, q in quantites.get(prestation.id, {}).items() if q}
+                if not par_local:
+                    continue
+                coords_lieu = coordonnees_stockees(prestation)
+                if coords_lieu is None:
+                    plan['non_planifies'].append({'prestation_id': prestation.id, 'raison': 'Lieu non géocodé'})
+                    continue
+                types = []
+                if prestation.date_debut == jour:
+                    types.append('livraison')
+                if prestation.fin_dt and debut_jour <= prestation.fin_dt < debut_jour + timedelta(days=1):
+                    types.append('reprise')
+                # Chaque local livre et reprend sa propre part du matériel
+                for local_id, quantite in par_local.items():
+                    coords_local = coordonnees_stockees(locaux.get(local_id))
+                    if coords_local is None:
+                        plan['non_planifies'].append({
+                            'prestation_id': prestation.id, 'local_id': local_id, 'raison': 'Local sans coordonnées'
+                        })
+                        continue
+                    if local_id not in depots:
+                        depots[local_id] = len(points)
+                        points.append(coords_local)
+                    for type_arret in types:
+                        arrets.append({
+                            'index': len(points),
+                            'local_id': local_id,
+                            'type': type_arret,
+                            'prestation_id': prestation.id,
+                            'client': prestation.client,
+                            'lieu': prestation.lieu,
+                            'heure': (prestation.heure_debut if type_arret == 'livraison' else prestation.heure_fin).strftime('%H:%M'),
+                            'quantite': quantite,
+                        })
+                        points.append(coords_lieu)
+            if not arrets:
+                return plan
+
+            groupes = {}
+            for arret in arrets:
+                # Livraisons et reprises ne partagent pas un même chargement
+                groupes.setdefault((arret['local_id'], arret['type']), []).append(arret)
+
+            tournees = []
+            temps_calcul = config.get('LOGISTIQUE_TEMPS_CALCUL_MS', 300) / 1000.0
+            duree_arret = config.get('LOGISTIQUE_DUREE_ARRET_MIN', 15)
+            for rang, ((local_id, type_arret), etapes_groupe) in enumerate(groupes.items()):
+                # Matrice limitée au dépôt et aux arrêts du groupe (indice 0 : dépôt)
+                coords = [points[depots[local_id]]] + [points[etape['index']] for etape in etapes_groupe]
+                matrice = matrice_distances(coords, coords, moteur=False)
+                couts = np.array([[cellule[1] for cellule in ligne] for ligne in matrice], dtype=np.float64)
+                demandes = [0] + [etape['quantite'] for etape in etapes_groupe]
+                temps_restant = max(0.0, temps_calcul - (time.monotonic() - debut_calcul))
+                resultat = route_optimizer.optimize_routes(
+                    couts, {0: range(1, len(coords))}, demandes,
+                    capacite=config.get('LOGISTIQUE_CAPACITE_VEHICULE'),
+                    # Temps restant réparti entre les groupes encore à traiter
+                    time_limit=temps_restant / (len(groupes) - rang)
+                )
+                for tour in resultat.get(0, []):
+                    etapes = [etapes_groupe[i - 1] for i in tour[1:-1]]
+                    arcs = list(zip(tour[:-1], tour[1:]))
+                    tournees.append({
+                        'local_id': local_id,
+                        'type': type_arret,
+                        'arrets': [{k: v for k, v in etape.items() if k not in ('index', 'local_id')} for etape in etapes],
+                        'chargement': int(sum(etape['quantite'] for etape in etapes)),
+                        'distance_km': round(sum(matrice[a][b][0] for a, b in arcs), 1),
+                        'duree_min': round(route_optimizer.tour_cost(tour, couts) + len(etapes) * duree_arret),
+                        'estimation': any(matrice[a][b][2] == 'estimation' for a, b in arcs),
+                    })
+
+            vehicules = config.get('LOGISTIQUE_VEHICULES_PAR_LOCAL', 2)
+            for local_id in depots:
+                du_local = [t for t in tournees if t['local_id'] == local_id]
+                affectation = route_optimizer.assign_vehicles([t['duree_min'] for t in du_local], vehicules)
+                for numero, indices in enumerate(affectation, start=1):
+                    tours = [du_local[i] for i in indices]
+                    plan['vehicules'].append({
+                        'local_id': local_id,
+                        'local': locaux[local_id].nom,
+                        'vehicule': numero,
+                        'tournees': tours,
+                        'distance_km': round(sum(t['distance_km'] for t in tours), 1),
+                        'duree_min': sum(t['duree_min'] for t in tours),
+                    })
+            plan['distance_km'] = round(sum(v['distance_km'] for v in plan['vehicules']), 1)
+            plan['duree_min'] = sum(v['duree_min'] for v in plan['vehicules'])
+        plan['calcul_ms'] = round((time.monotonic() - debut_calcul) * 1000)
+        return plan
+
     # ==================== ANALYSE CONVERSIONS ====================
 
     def analyze_conversions(self, start_date=None, end_date=None):
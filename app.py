@@ -11,23 +11,30 @@ import smtplib
 import csv
 import logging
 import threading
+import contextvars
 import uuid
 import math
+import hashlib
+import hmac
+import queue
 import ssl
 import urllib.request
 import urllib.parse
 import atexit
 import base64
+import unicodedata
 from logging.handlers import RotatingFileHandler
 import secrets
 import time as time_module
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 from contextlib import contextmanager
 from datetime import datetime, date, timedelta, time, timezone
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, g, make_response, send_from_directory, send_file, has_request_context, abort
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, g, make_response, send_from_directory, send_file, has_request_context, has_app_context, abort, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import and_, or_, event, inspect as sa_inspect, select, text
-from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload, selectinload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from functools import wraps
@@ -35,6 +42,7 @@ import json
 import html
 import io
 from html.parser import HTMLParser
+from types import SimpleNamespace
 from decimal import Decimal
 try:
     from PIL import Image
@@ -60,7 +68,11 @@ from lazy_imports import (
     get_financial_reports,
     lazy_importer
 )
-from plf_storage import write_plf_from_sqlite, decrypt_plf_to_sqlite, temp_sqlite_path, ensure_dir
+from plf_storage import DEFAULT_CHUNK_SIZE, update_plf_from_sqlite, decrypt_plf_to_sqlite, temp_sqlite_path, ensure_dir
+import outbound_http
+from sync_merge import REGLE_PLUS_RECENT, REGLE_RECALCUL, champs_modifies, fusionner
+from sync_scheduler import SyncScheduler
+from sync_transport import NDJSON, PushRejected, SyncTransport, compress, decode_ndjson, decompress
 
 # Imports des modules IA et automatisations (v3.0)
 from ai_smart_assistant import smart_assistant, init_smart_assistant
@@ -174,6 +186,7 @@ CSRF_EXEMPT_ENDPOINTS = {
     'chat_reset',
     'api_signer_devis',
     'rate_prestation',
+    'api_sync_push',
 }
 
 RATE_LIMITS = {
@@ -240,7 +253,7 @@ def get_public_api_token(parametres=None):
         return token.strip()
     if not parametres:
         try:
-            parametres = ParametresEntreprise.query.first()
+            parametres = get_parametres_entreprise()
         except Exception:
             parametres = None
     if not parametres and app.config.get('DB_READY'):
@@ -308,22 +321,29 @@ ensure_dir(PLF_TEMP_FOLDER)
 
 # Identifiant unique de l'appareil (pour la synchronisation offline)
 DEVICE_ID_PATH = os.path.join(INSTANCE_FOLDER, 'device_id.txt')
+_device_id = None
 
 def get_device_id():
-    """Retourne un ID unique persistant pour la machine."""
+    """Retourne un ID unique persistant pour la machine (lu une fois par processus)."""
+    global _device_id
+    if _device_id:
+        return _device_id
     try:
         if os.path.exists(DEVICE_ID_PATH):
             with open(DEVICE_ID_PATH, 'r', encoding='utf-8') as f:
                 device_id = f.read().strip()
                 if device_id:
+                    _device_id = device_id
                     return device_id
         device_id = uuid.uuid4().hex
         with open(DEVICE_ID_PATH, 'w', encoding='utf-8') as f:
             f.write(device_id)
+        _device_id = device_id
         return device_id
     except Exception:
         # Fallback en mémoire si l'écriture échoue
-        return uuid.uuid4().hex
+        _device_id = uuid.uuid4().hex
+        return _device_id
 
 DB_READY_DEFAULT = True
 # Désactiver la sélection multi-bases (mode mono-base forcé)
@@ -350,6 +370,7 @@ app.config['PLF_ACTIVE_PATH'] = None
 app.config['PLF_TEMP_PATH'] = None
 app.config['PLF_DIRTY'] = False
 app.config['PLF_AUTOSAVE_SECONDS'] = 30
+app.config['PLF_CHUNK_SIZE'] = int(os.environ.get('PLF_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
 app.config['PLF_PASSWORD'] = None
 
 # Configuration de la session pour maintenir la connexion
@@ -367,17 +388,92 @@ if not app.config['API_KEY']:
 # Configuration géocodage / cartes
 app.config['ADDRESS_VALIDATION_ENABLED'] = os.environ.get('ADDRESS_VALIDATION_ENABLED', '1') == '1'
 app.config['GEOCODING_PROVIDER_ENV'] = os.environ.get('GEOCODING_PROVIDER')
-app.config['GEOCODING_PROVIDER'] = app.config['GEOCODING_PROVIDER_ENV'] or 'nominatim'  # nominatim | google
+app.config['GEOCODING_PROVIDER'] = app.config['GEOCODING_PROVIDER_ENV'] or 'nominatim'  # nominatim | google | stub
 app.config['GEOCODING_TIMEOUT'] = float(os.environ.get('GEOCODING_TIMEOUT', '6'))
 app.config['GOOGLE_MAPS_API_KEY'] = os.environ.get('GOOGLE_MAPS_API_KEY')
 app.config['USE_OSRM_DISTANCE'] = os.environ.get('USE_OSRM_DISTANCE', '1') == '1'
+# Matrice de distances : moteur (osrm | stub), TTL des trajets (s), facteur de détour par défaut
+app.config['DISTANCE_ROUTER'] = os.environ.get('DISTANCE_ROUTER', 'osrm')
+app.config['OSRM_URL'] = os.environ.get('OSRM_URL', 'https://router.project-osrm.org')
+app.config['DISTANCE_CACHE_TTL'] = int(os.environ.get('DISTANCE_CACHE_TTL', str(180 * 24 * 3600)))
+app.config['DISTANCE_FALLBACK_TTL'] = int(os.environ.get('DISTANCE_FALLBACK_TTL', '600'))
+app.config['DISTANCE_DETOUR_FACTOR'] = float(os.environ.get('DISTANCE_DETOUR_FACTOR', '1.3'))
+app.config['DISTANCE_DETOUR_MIN_SAMPLES'] = int(os.environ.get('DISTANCE_DETOUR_MIN_SAMPLES', '20'))
+app.config['DISTANCE_ESTIMATION_KMH'] = float(os.environ.get('DISTANCE_ESTIMATION_KMH', '70'))
+app.config['DISTANCE_COORD_DECIMALS'] = int(os.environ.get('DISTANCE_COORD_DECIMALS', '4'))
+app.config['DISTANCE_TABLE_MAX'] = int(os.environ.get('DISTANCE_TABLE_MAX', '100'))
+app.config['DISTANCE_MEMORY_SIZE'] = int(os.environ.get('DISTANCE_MEMORY_SIZE', '4096'))
+# Tournées logistiques : véhicules par local, capacité (unités de matériel, 0 = illimitée),
+# durée d'un arrêt (min) et temps de calcul maximal de l'optimisation (ms)
+app.config['LOGISTIQUE_VEHICULES_PAR_LOCAL'] = int(os.environ.get('LOGISTIQUE_VEHICULES_PAR_LOCAL', '2'))
+app.config['LOGISTIQUE_CAPACITE_VEHICULE'] = int(os.environ.get('LOGISTIQUE_CAPACITE_VEHICULE', '40'))
+app.config['LOGISTIQUE_DUREE_ARRET_MIN'] = int(os.environ.get('LOGISTIQUE_DUREE_ARRET_MIN', '15'))
+app.config['LOGISTIQUE_TEMPS_CALCUL_MS'] = int(os.environ.get('LOGISTIQUE_TEMPS_CALCUL_MS', '300'))
+
+# Appels sortants : budget total par requête HTTP (s) et politiques par service,
+# surchargeables par OUTBOUND_<SERVICE>_TIMEOUT / _MAX_CONCURRENT / _FAILURE_THRESHOLD / _RESET_TIMEOUT
+app.config['OUTBOUND_REQUEST_BUDGET'] = float(os.environ.get('OUTBOUND_REQUEST_BUDGET', '15'))
+outbound_http.configure('geocoding', timeout=app.config['GEOCODING_TIMEOUT'])
+outbound_http.configure('routing', timeout=app.config['GEOCODING_TIMEOUT'])
+for _service_sortant in outbound_http.DEFAULT_POLICIES:
+    _prefixe = f"OUTBOUND_{_service_sortant.upper()}_"
+    outbound_http.configure(_service_sortant, **{
+        cle: type(valeur)(os.environ[_prefixe + cle.upper()])
+        for cle, valeur in outbound_http.DEFAULT_POLICIES[_service_sortant].items()
+        if os.environ.get(_prefixe + cle.upper())
+    })
+# Cache de géocodage : TTL en secondes (résultats / adresses introuvables), taille max table et mémoire
+app.config['GEOCODE_CACHE_TTL'] = int(os.environ.get('GEOCODE_CACHE_TTL', str(90 * 24 * 3600)))
+app.config['GEOCODE_NEGATIVE_TTL'] = int(os.environ.get('GEOCODE_NEGATIVE_TTL', str(24 * 3600)))
+app.config['GEOCODE_CACHE_MAX'] = int(os.environ.get('GEOCODE_CACHE_MAX', '20000'))
+app.config['GEOCODE_MEMORY_SIZE'] = int(os.environ.get('GEOCODE_MEMORY_SIZE', '1024'))
+# Géocodage différé des adresses (secondes entre deux passes / avant de réessayer une erreur)
+app.config['GEOCODE_JOB_INTERVAL'] = float(os.environ.get('GEOCODE_JOB_INTERVAL', '300'))
+app.config['GEOCODE_JOB_RETRY'] = int(os.environ.get('GEOCODE_JOB_RETRY', '3600'))
+
+# Cache des disponibilités matériel (0 = désactivé). Le TTL borne l'obsolescence
+# face aux écritures d'autres processus (ex. daemon de synchronisation).
+app.config['DISPO_CACHE_SIZE'] = int(os.environ.get('DISPO_CACHE_SIZE', '4096'))
+app.config['DISPO_CACHE_TTL'] = float(os.environ.get('DISPO_CACHE_TTL', '60'))
+app.config['PARAMETRES_CACHE_TTL'] = float(os.environ.get('PARAMETRES_CACHE_TTL', '300'))
+
+# Threads du serveur Waitress (run_production.py). Chaque flux SSE ouvert en occupe
+# un : les flux sont plafonnés au quart des threads par défaut, et jamais au-delà
+# de la moitié, pour laisser les autres requêtes être servies.
+app.config['SERVER_THREADS'] = int(os.environ.get('SERVER_THREADS', '8'))
+app.config['DISPO_STREAM_MAX_CLIENTS'] = int(os.environ.get(
+    'DISPO_STREAM_MAX_CLIENTS', str(max(1, app.config['SERVER_THREADS'] // 4))
+))
+app.config['DISPO_STREAM_HEARTBEAT'] = float(os.environ.get('DISPO_STREAM_HEARTBEAT', '15'))
+app.config['DISPO_STREAM_RESYNC'] = float(os.environ.get('DISPO_STREAM_RESYNC', '300'))
 
 # Synchronisation offline (préparation sync serveur)
 app.config['SYNC_ALLOW_INSECURE'] = os.environ.get('SYNC_ALLOW_INSECURE') == '1'
 app.config['SYNC_ENABLED_DEFAULT'] = False
 app.config['SYNC_INTERVAL_DEFAULT'] = 20
+# Ordonnanceur : anti-rebond après un commit, relève espacée jusqu'à SYNC_IDLE_MAX_SECONDS sans activité,
+# repli exponentiel (avec gigue) après un échec
+app.config['SYNC_DEBOUNCE_SECONDS'] = float(os.environ.get('SYNC_DEBOUNCE_SECONDS', '1.0'))
+app.config['SYNC_DEBOUNCE_MAX_SECONDS'] = float(os.environ.get('SYNC_DEBOUNCE_MAX_SECONDS', '5.0'))
+app.config['SYNC_IDLE_MAX_SECONDS'] = float(os.environ.get('SYNC_IDLE_MAX_SECONDS', '300'))
+app.config['SYNC_BACKOFF_BASE_SECONDS'] = float(os.environ.get('SYNC_BACKOFF_BASE_SECONDS', '5'))
+app.config['SYNC_BACKOFF_MAX_SECONDS'] = float(os.environ.get('SYNC_BACKOFF_MAX_SECONDS', '600'))
 app.config['SYNC_SERVER_MODE'] = os.environ.get('SYNC_SERVER_MODE') == '1'
 app.config['SYNC_SERVER_TOKEN'] = os.environ.get('SYNC_SERVER_TOKEN')
+# Transport sync : compression (zstd, gzip, none), bornes et cibles de la taille de lot adaptative
+app.config['SYNC_COMPRESSION'] = os.environ.get('SYNC_COMPRESSION', 'zstd')
+app.config['SYNC_BATCH_MIN'] = int(os.environ.get('SYNC_BATCH_MIN', '20'))
+app.config['SYNC_BATCH_MAX'] = int(os.environ.get('SYNC_BATCH_MAX', '2000'))
+app.config['SYNC_TARGET_LATENCY'] = float(os.environ.get('SYNC_TARGET_LATENCY', '2.0'))
+app.config['SYNC_MAX_BATCH_BYTES'] = int(os.environ.get('SYNC_MAX_BATCH_BYTES', str(2 * 1024 * 1024)))
+app.config['SYNC_MAX_BATCHES_PER_CYCLE'] = int(os.environ.get('SYNC_MAX_BATCHES_PER_CYCLE', '20'))
+# Pull des changements du serveur central : taille de page demandée (client) et maximale (serveur)
+app.config['SYNC_PULL_PAGE_SIZE'] = int(os.environ.get('SYNC_PULL_PAGE_SIZE', '500'))
+app.config['SYNC_PULL_MAX_PAGE_SIZE'] = int(os.environ.get('SYNC_PULL_MAX_PAGE_SIZE', '5000'))
+# Rétention du journal sync (jours) et fenêtre quotidienne du VACUUM complet (heure locale)
+app.config['SYNC_RETENTION_DAYS'] = int(os.environ.get('SYNC_RETENTION_DAYS', '30'))
+app.config['SYNC_TOMBSTONE_RETENTION_DAYS'] = int(os.environ.get('SYNC_TOMBSTONE_RETENTION_DAYS', '180'))
+app.config['SYNC_MAINTENANCE_WINDOW'] = os.environ.get('SYNC_MAINTENANCE_WINDOW', '02:00-05:00')
 
 # Configuration de la pagination
 ITEMS_PER_PAGE = 20  # Nombre d'éléments par page par défaut
@@ -673,7 +769,7 @@ def _get_materiel_logistique_buffers(parametres=None):
     retour_apres = DEFAULT_MATERIEL_RETOUR_APRES_HEURES
     try:
         if parametres is None:
-            parametres = getattr(g, 'parametres', None) or ParametresEntreprise.query.first()
+            parametres = get_parametres_entreprise()
         if parametres:
             if getattr(parametres, 'materiel_sortie_avant_heures', None) is not None:
                 sortie_avant = float(parametres.materiel_sortie_avant_heures)
@@ -737,7 +833,7 @@ def _client_lookup_key(email, telephone, nom):
         return ('nom', nom.lower())
     return None
 
-def get_or_create_client(nom, email=None, telephone=None, categories=None, notes=None):
+def get_or_create_client(nom, email=None, telephone=None, categories=None, notes=None, adresse=None):
     """Crée ou retrouve un client (dédoublonnage par email/tel/nom)."""
     nom_clean = normalize_whitespace(nom)
     email_clean = normalize_email(email)
@@ -765,6 +861,10 @@ def get_or_create_client(nom, email=None, telephone=None, categories=None, notes
         db.session.add(client)
         db.session.flush()
 
+    adresse_clean = normalize_whitespace(adresse)
+    if adresse_clean and adresse_clean != client.adresse:
+        client.adresse = adresse_clean
+
     if email_clean or telephone_clean:
         contact_filters = []
         if email_clean:
@@ -893,57 +993,391 @@ def _get_rating_stats_for_technicien(technicien_id):
     ).scalar() or 0
     return (round(float(avg), 2) if avg is not None else None), count
 
-def check_staff_availability(staff_type, staff_id, date_debut, date_fin, heure_debut, heure_fin, exclude_prestation_id=None):
-    """Vérifie la disponibilité d'un prestataire (DJ ou technicien) pour une période."""
-    if not staff_id:
-        return True, "Aucun prestataire sélectionné"
-
-    start_dt, end_dt = _build_datetime_range(date_debut, date_fin, heure_debut, heure_fin)
-    if not start_dt or not end_dt:
-        return True, "Dates/horaires incomplets"
+STAFF_STATUTS_BLOQUANTS = ('planifiee', 'confirmee')
 
-    query = Prestation.query.filter(Prestation.statut.in_(['planifiee', 'confirmee']))
+def _colonne_staff(staff_type):
     if staff_type == 'dj':
-        query = query.filter(Prestation.dj_id == staff_id)
-    elif staff_type == 'technicien':
-        query = query.filter(Prestation.technicien_id == staff_id)
-    else:
-        return True, "Type de prestataire inconnu"
+        return Prestation.dj_id
+    if staff_type == 'technicien':
+        return Prestation.technicien_id
+    return None
+
+def charger_periodes_staff(staff_type, staff_ids, start_dt, end_dt, exclude_prestation_id=None,
+                           statuts=STAFF_STATUTS_BLOQUANTS):
+    """
+    Charge en une requête indexée les prestations qui chevauchent [start_dt, end_dt[
+    pour un ensemble de prestataires.
 
+    Returns:
+        dict: {staff_id: [Row(staff_id, id, client, date_debut, debut_dt, fin_dt)]} triés par début
+    """
+    colonne = _colonne_staff(staff_type)
+    ids = [staff_id for staff_id in set(staff_ids or ()) if staff_id]
+    if colonne is None or not ids or not start_dt or not end_dt:
+        return {}
+    stmt = select(
+        colonne.label('staff_id'), Prestation.id, Prestation.client,
+        Prestation.date_debut, Prestation.debut_dt, Prestation.fin_dt
+    ).where(
+        Prestation.debut_dt < end_dt,
+        Prestation.fin_dt > start_dt
+    ).order_by(Prestation.debut_dt)
+    if len(ids) <= BULK_IN_CLAUSE_MAX:
+        stmt = stmt.where(colonne.in_(ids))
+    else:
+        stmt = stmt.where(colonne.isnot(None))
+    if statuts is not None:
+        stmt = stmt.where(Prestation.statut.in_(list(statuts)))
     if exclude_prestation_id:
-        query = query.filter(Prestation.id != exclude_prestation_id)
+        stmt = stmt.where(Prestation.id != exclude_prestation_id)
+    periodes = defaultdict(list)
+    wanted = set(ids)
+    for row in db.session.execute(stmt):
+        if row.staff_id in wanted:
+            periodes[row.staff_id].append(row)
+    return dict(periodes)
+
+def get_staff_conflicts(staff_type, staff_ids, start_dt, end_dt, exclude_prestation_id=None,
+                        statuts=STAFF_STATUTS_BLOQUANTS):
+    """
+    Détecte en une requête indexée les prestations qui chevauchent [start_dt, end_dt[
+    pour un ensemble de prestataires.
 
-    conflits = query.all()
-    for conflit in conflits:
-        conflit_start, conflit_end = _build_datetime_range(
-            conflit.date_debut, conflit.date_fin, conflit.heure_debut, conflit.heure_fin
-        )
-        if not conflit_start or not conflit_end:
-            continue
-        if not (conflit_end <= start_dt or conflit_start >= end_dt):
-            label = "DJ" if staff_type == 'dj' else "technicien"
-            return False, f"{label} indisponible (conflit avec {conflit.client} le {conflit.date_debut.strftime('%d/%m/%Y')})"
+    Returns:
+        dict: {staff_id: premier conflit (Row id, client, date_debut, debut_dt)} pour les
+        prestataires occupés uniquement
+    """
+    periodes = charger_periodes_staff(staff_type, staff_ids, start_dt, end_dt, exclude_prestation_id, statuts)
+    return {staff_id: rows[0] for staff_id, rows in periodes.items() if rows}
 
-    return True, "Disponible"
+def get_staff_double_bookings(staff_type, start_dt, end_dt, statuts=STAFF_STATUTS_BLOQUANTS):
+    """
+    Liste en une requête (auto-jointure sur les périodes indexées) les paires de
+    prestations qui se chevauchent pour un même prestataire dans [start_dt, end_dt[.
 
-# ==================== GÉOCODAGE & DISTANCES ====================
+    Returns:
+        list: [{staff_id, prestation_a, prestation_b, client_a, client_b, date}]
+    """
+    colonne = _colonne_staff(staff_type)
+    if colonne is None or not start_dt or not end_dt:
+        return []
+    p = Prestation.__table__
+    a = p.alias('a')
+    b = p.alias('b')
+    col_a = a.c[colonne.key]
+    col_b = b.c[colonne.key]
+    stmt = select(
+        col_a.label('staff_id'), a.c.id.label('prestation_a'), b.c.id.label('prestation_b'),
+        a.c.client.label('client_a'), b.c.client.label('client_b'), a.c.date_debut
+    ).select_from(a.join(b, and_(
+        col_a == col_b,
+        a.c.id < b.c.id,
+        a.c.debut_dt < b.c.fin_dt,
+        b.c.debut_dt < a.c.fin_dt
+    ))).where(
+        col_a.isnot(None),
+        a.c.debut_dt < end_dt,
+        a.c.fin_dt > start_dt
+    ).order_by(a.c.debut_dt)
+    if statuts is not None:
+        stmt = stmt.where(a.c.statut.in_(list(statuts)), b.c.statut.in_(list(statuts)))
+    return [
+        {
+            'staff_id': row.staff_id,
+            'prestation_a': row.prestation_a,
+            'prestation_b': row.prestation_b,
+            'client_a': row.client_a,
+            'client_b': row.client_b,
+            'date': row.date_debut
+        }
+        for row in db.session.execute(stmt)
+    ]
 
-_geocode_cache = {}
-_GEOCODE_CACHE_TTL = 24 * 3600  # 24h
+def check_staff_availability_batch(staff_type, staff_ids, date_debut, date_fin, heure_debut, heure_fin,
+                                   exclude_prestation_id=None):
+    """
+    Vérifie la disponibilité de plusieurs prestataires (DJ ou techniciens) en une requête.
 
-def _cache_get(address):
-    entry = _geocode_cache.get(address)
-    if not entry:
-        return None
-    if time_module.time() - entry['ts'] > _GEOCODE_CACHE_TTL:
-        _geocode_cache.pop(address, None)
-        return None
-    return entry['data']
+    Returns:
+        dict: {staff_id: (disponible, message)}
+    """
+    staff_ids = [staff_id for staff_id in staff_ids if staff_id]
+    if _colonne_staff(staff_type) is None:
+        return {staff_id: (True, "Type de prestataire inconnu") for staff_id in staff_ids}
+    start_dt, end_dt = _build_datetime_range(date_debut, date_fin, heure_debut, heure_fin)
+    if not start_dt or not end_dt:
+        return {staff_id: (True, "Dates/horaires incomplets") for staff_id in staff_ids}
+
+    conflits = get_staff_conflicts(staff_type, staff_ids, start_dt, end_dt, exclude_prestation_id)
+    label = "DJ" if staff_type == 'dj' else "technicien"
+    resultats = {}
+    for staff_id in staff_ids:
+        conflit = conflits.get(staff_id)
+        if conflit:
+            resultats[staff_id] = (
+                False,
+                f"{label} indisponible (conflit avec {conflit.client} le {conflit.date_debut.strftime('%d/%m/%Y')})"
+            )
+        else:
+            resultats[staff_id] = (True, "Disponible")
+    return resultats
+
+def check_staff_availability(staff_type, staff_id, date_debut, date_fin, heure_debut, heure_fin, exclude_prestation_id=None):
+    """Vérifie la disponibilité d'un prestataire (DJ ou technicien) pour une période."""
+    if not staff_id:
+        return True, "Aucun prestataire sélectionné"
+    return check_staff_availability_batch(
+        staff_type, [staff_id], date_debut, date_fin, heure_debut, heure_fin, exclude_prestation_id
+    )[staff_id]
+
+# ==================== GÉOCODAGE & DISTANCES ====================
 
-def _cache_set(address, data):
-    if len(_geocode_cache) > 500:
+# Cache de géocodage à deux niveaux : LRU mémoire devant la table geocode_cache
+# (partagée entre workers, survit aux redémarrages). Les adresses introuvables
+# sont aussi mémorisées (TTL plus court) ; les erreurs réseau ne le sont jamais.
+GEOCODE_ERREUR_RESEAU = "Impossible de vérifier l'adresse (réseau/API)"
+_geocode_cache = OrderedDict()
+_geocode_cache_lock = threading.Lock()
+_geocode_cache_stats = {'memoire': 0, 'base': 0, 'fournisseur': 0}
+# Écritures en attente du prochain commit de session (sous _geocode_cache_lock) :
+# aucune transaction d'écriture n'est ouverte pendant un appel au fournisseur.
+_geocode_ecritures = OrderedDict()
+_geocode_utilisations = {}
+
+def _cle_geocodage(address):
+    """Clé normalisée : minuscules, sans accents ni ponctuation, espaces compactés."""
+    texte = unicodedata.normalize('NFKD', normalize_whitespace(address).lower())
+    texte = ''.join(c for c in texte if not unicodedata.combining(c))
+    return re.sub(r'[^a-z0-9]+', ' ', texte).strip()[:255]
+
+def _geocode_memoire_get(cle):
+    with _geocode_cache_lock:
+        entree = _geocode_cache.get(cle)
+        if entree is None:
+            return None
+        if time_module.time() > entree[0]:
+            _geocode_cache.pop(cle, None)
+            return None
+        _geocode_cache.move_to_end(cle)
+        return entree[1]
+
+def _geocode_memoire_set(cle, resultat, expire_ts):
+    with _geocode_cache_lock:
+        _geocode_cache[cle] = (expire_ts, resultat)
+        _geocode_cache.move_to_end(cle)
+        while len(_geocode_cache) > app.config.get('GEOCODE_MEMORY_SIZE', 1024):
+            _geocode_cache.popitem(last=False)
+
+def _resultat_depuis_entree(entree):
+    if not entree.trouve:
+        return None, entree.erreur or "Adresse introuvable"
+    return {
+        'lat': entree.lat,
+        'lng': entree.lng,
+        'formatted': entree.formatted,
+        'provider': entree.provider
+    }, None
+
+def _geocode_base_get(cle):
+    # Lecture par la session de l'appelant ; les compteurs d'utilisation sont différés au prochain commit
+    now = utcnow()
+    with _geocode_cache_lock:
+        valeurs = _geocode_ecritures.get(cle)
+    if valeurs is not None and valeurs['expires_at'] > now:
+        return SimpleNamespace(cle=cle, **valeurs)
+    table = GeocodeCache.__table__
+    try:
+        entree = db.session.execute(
+            select(table).where(table.c.cle == cle, table.c.expires_at > now)
+        ).first()
+    except Exception as e:
+        logger.warning(f"Lecture cache géocodage impossible: {e}")
+        return None
+    if entree is not None:
+        with _geocode_cache_lock:
+            hits, _ = _geocode_utilisations.get(cle, (0, None))
+            _geocode_utilisations[cle] = (hits + 1, now)
+    return entree
+
+def _geocode_base_set(cle, address, geo, erreur):
+    """Met l'entrée en attente ; elle est écrite par le prochain commit de la session."""
+    now = utcnow()
+    ttl = app.config.get('GEOCODE_CACHE_TTL' if geo else 'GEOCODE_NEGATIVE_TTL', 0)
+    valeurs = {
+        'adresse': address[:500],
+        'trouve': bool(geo),
+        'lat': geo['lat'] if geo else None,
+        'lng': geo['lng'] if geo else None,
+        'formatted': (geo['formatted'] if geo else None),
+        'provider': geo['provider'] if geo else None,
+        'erreur': None if geo else (erreur or '')[:255],
+        'created_at': now,
+        'expires_at': now + timedelta(seconds=ttl),
+        'last_used_at': now,
+    }
+    with _geocode_cache_lock:
+        _geocode_ecritures[cle] = valeurs
+        _geocode_ecritures.move_to_end(cle)
+        while len(_geocode_ecritures) > app.config.get('GEOCODE_MEMORY_SIZE', 1024):
+            _geocode_ecritures.popitem(last=False)
+    return valeurs['expires_at']
+
+@event.listens_for(db.session, "before_commit")
+def _ecrire_cache_geocodage(session):
+    """Écrit les entrées et compteurs de géocodage en attente dans la transaction qui se termine."""
+    if session.get_nested_transaction() is not None:
+        return
+    with _geocode_cache_lock:
+        if not _geocode_ecritures and not _geocode_utilisations:
+            return
+        ecritures = list(_geocode_ecritures.items())
+        utilisations = list(_geocode_utilisations.items())
+        _geocode_ecritures.clear()
+        _geocode_utilisations.clear()
+    table = GeocodeCache.__table__
+    try:
+        connection = session.connection()
+        if ecritures:
+            insertion = sqlite_insert(table)
+            connection.execute(
+                insertion.on_conflict_do_update(
+                    index_elements=[table.c.cle],
+                    set_={nom: insertion.excluded[nom] for nom in ecritures[0][1]}
+                ),
+                [dict(valeurs, cle=cle, hits=0) for cle, valeurs in ecritures]
+            )
+            _evincer_cache_geocodage(connection)
+        if utilisations:
+            connection.execute(
+                table.update().where(table.c.cle == db.bindparam('b_cle')).values(
+                    hits=table.c.hits + db.bindparam('b_hits'),
+                    last_used_at=db.bindparam('b_date')
+                ),
+                [{'b_cle': cle, 'b_hits': hits, 'b_date': date_utilisation}
+                 for cle, (hits, date_utilisation) in utilisations]
+            )
+    except Exception as e:
+        logger.warning(f"Écriture cache géocodage impossible: {e}")
+
+def _evincer_cache_geocodage(connection):
+    """Supprime les entrées expirées puis les moins récemment utilisées au-delà de la limite."""
+    table = GeocodeCache.__table__
+    connection.execute(table.delete().where(table.c.expires_at <= utcnow()))
+    maximum = app.config.get('GEOCODE_CACHE_MAX', 20000)
+    excedent = connection.execute(select(db.func.count(table.c.id))).scalar() - maximum
+    if excedent > 0:
+        anciens = select(table.c.id).order_by(table.c.last_used_at, table.c.id).limit(excedent)
+        connection.execute(table.delete().where(table.c.id.in_(anciens.scalar_subquery())))
+
+def vider_cache_geocodage(memoire_seulement=False):
+    """Vide le cache de géocodage (mémoire, et table sauf si memoire_seulement)."""
+    with _geocode_cache_lock:
         _geocode_cache.clear()
-    _geocode_cache[address] = {'ts': time_module.time(), 'data': data}
+        if not memoire_seulement:
+            _geocode_ecritures.clear()
+            _geocode_utilisations.clear()
+    if not memoire_seulement:
+        GeocodeCache.query.delete()
+        db.session.commit()
+
+def get_cache_geocodage_stats():
+    """Nombre de résolutions servies par la mémoire, la base et le fournisseur."""
+    with _geocode_cache_lock:
+        return dict(_geocode_cache_stats, taille_memoire=len(_geocode_cache))
+
+# ---- Fournisseurs ----
+# Un fournisseur reçoit (adresse, contact_email, timeout) et retourne
+# (geo, erreur, definitif) : definitif=True si l'adresse est réellement introuvable
+# (résultat négatif mis en cache), False pour une erreur transitoire.
+
+def _ouvrir_url_geocodage(req, timeout):
+    ctx = None
+    if certifi:
+        try:
+            ctx = ssl.create_default_context(cafile=certifi.where())
+        except Exception:
+            ctx = None
+    if ctx is None:
+        try:
+            ctx = ssl.create_default_context()
+        except Exception:
+            ctx = None
+    try:
+        return urllib.request.urlopen(req, timeout=timeout, context=ctx)
+    except Exception as e:
+        if 'CERTIFICATE_VERIFY_FAILED' in str(e):
+            logger.warning("Certificat SSL manquant, fallback sur contexte non vérifié pour le géocodage.")
+            ctx = ssl._create_unverified_context()
+            return urllib.request.urlopen(req, timeout=timeout, context=ctx)
+        raise
+
+def _geocoder_google(address, contact_email, timeout):
+    params = {
+        'address': address,
+        'key': get_google_maps_api_key()
+    }
+    url = "https://maps.googleapis.com/maps/api/geocode/json?" + urllib.parse.urlencode(params)
+    with _ouvrir_url_geocodage(urllib.request.Request(url), timeout) as resp:
+        data = json.loads(resp.read().decode('utf-8'))
+    if data.get('status') == 'ZERO_RESULTS':
+        return None, "Adresse introuvable", True
+    if data.get('status') != 'OK' or not data.get('results'):
+        return None, data.get('status') or "Adresse introuvable", False
+    result = data['results'][0]
+    loc = result['geometry']['location']
+    return {
+        'lat': float(loc['lat']),
+        'lng': float(loc['lng']),
+        'formatted': result.get('formatted_address') or address,
+        'provider': 'google'
+    }, None, True
+
+def _geocoder_nominatim(address, contact_email, timeout):
+    params = {
+        'format': 'json',
+        'limit': 1,
+        'q': address
+    }
+    url = "https://nominatim.openstreetmap.org/search?" + urllib.parse.urlencode(params)
+    user_agent = f"Planify/2.12 ({contact_email or 'support@planify.local'})"
+    req = urllib.request.Request(url, headers={'User-Agent': user_agent})
+    with _ouvrir_url_geocodage(req, timeout) as resp:
+        data = json.loads(resp.read().decode('utf-8'))
+    if not data:
+        return None, "Adresse introuvable", True
+    result = data[0]
+    return {
+        'lat': float(result.get('lat')),
+        'lng': float(result.get('lon')),
+        'formatted': result.get('display_name') or address,
+        'provider': 'nominatim'
+    }, None, True
+
+def _geocoder_stub(address, contact_email, timeout):
+    """Fournisseur hors-ligne déterministe (tests, démo) : coordonnées dérivées de l'adresse."""
+    cle = _cle_geocodage(address)
+    if not cle or 'introuvable' in cle:
+        return None, "Adresse introuvable", True
+    empreinte = int(hashlib.sha256(cle.encode('utf-8')).hexdigest()[:12], 16)
+    # Boîte englobant la France métropolitaine
+    lat = 42.5 + (empreinte % 10**6) / 10**6 * 8.5
+    lng = -4.5 + (empreinte // 10**6 % 10**6) / 10**6 * 12.5
+    return {
+        'lat': round(lat, 6),
+        'lng': round(lng, 6),
+        'formatted': normalize_whitespace(address),
+        'provider': 'stub'
+    }, None, True
+
+GEOCODING_PROVIDERS = {
+    'nominatim': _geocoder_nominatim,
+    'google': _geocoder_google,
+    'stub': _geocoder_stub,
+}
+
+def register_geocoding_provider(nom, fournisseur):
+    """Enregistre un fournisseur de géocodage (sélectionnable via GEOCODING_PROVIDER)."""
+    GEOCODING_PROVIDERS[nom] = fournisseur
 
 def build_full_address(adresse, code_postal=None, ville=None):
     parts = [adresse, code_postal, ville]
@@ -955,87 +1389,41 @@ def geocode_address(address, provider=None, contact_email=None):
     if not address:
         return None, "Adresse vide"
 
-    cached = _cache_get(address)
-    if cached:
-        return cached, None
+    cle = _cle_geocodage(address)
+    cached = _geocode_memoire_get(cle)
+    if cached is not None:
+        with _geocode_cache_lock:
+            _geocode_cache_stats['memoire'] += 1
+        return cached
+    entree = _geocode_base_get(cle)
+    if entree is not None:
+        with _geocode_cache_lock:
+            _geocode_cache_stats['base'] += 1
+        resultat = _resultat_depuis_entree(entree)
+        _geocode_memoire_set(cle, resultat, time_module.time() + (entree.expires_at - utcnow()).total_seconds())
+        return resultat
 
     provider = provider or app.config.get('GEOCODING_PROVIDER', 'nominatim')
     if provider == 'nominatim' and app.config.get('GEOCODING_PROVIDER_ENV') is None:
         if get_google_maps_api_key():
             provider = 'google'
-    timeout = app.config.get('GEOCODING_TIMEOUT', 6)
-
-    def _open_with_context(req):
-        ctx = None
-        if certifi:
-            try:
-                ctx = ssl.create_default_context(cafile=certifi.where())
-            except Exception:
-                ctx = None
-        if ctx is None:
-            try:
-                ctx = ssl.create_default_context()
-            except Exception:
-                ctx = None
-        try:
-            return urllib.request.urlopen(req, timeout=timeout, context=ctx)
-        except Exception as e:
-            if 'CERTIFICATE_VERIFY_FAILED' in str(e):
-                logger.warning("Certificat SSL manquant, fallback sur contexte non vérifié pour le géocodage.")
-                ctx = ssl._create_unverified_context()
-                return urllib.request.urlopen(req, timeout=timeout, context=ctx)
-            raise
+    if provider == 'google' and not get_google_maps_api_key():
+        provider = 'nominatim'
+    fournisseur = GEOCODING_PROVIDERS.get(provider, _geocoder_nominatim)
 
     try:
-        if provider == 'google' and get_google_maps_api_key():
-            api_key = get_google_maps_api_key()
-            params = {
-                'address': address,
-                'key': api_key
-            }
-            url = "https://maps.googleapis.com/maps/api/geocode/json?" + urllib.parse.urlencode(params)
-            req = urllib.request.Request(url)
-        else:
-            params = {
-                'format': 'json',
-                'limit': 1,
-                'q': address
-            }
-            url = "https://nominatim.openstreetmap.org/search?" + urllib.parse.urlencode(params)
-            user_agent = f"Planify/2.12 ({contact_email or 'support@planify.local'})"
-            req = urllib.request.Request(url, headers={'User-Agent': user_agent})
-
-        with _open_with_context(req) as resp:
-            payload = resp.read().decode('utf-8')
-        data = json.loads(payload)
-
-        if provider == 'google' and app.config.get('GOOGLE_MAPS_API_KEY'):
-            if data.get('status') != 'OK' or not data.get('results'):
-                return None, data.get('status') or "Adresse introuvable"
-            result = data['results'][0]
-            loc = result['geometry']['location']
-            geo = {
-                'lat': float(loc['lat']),
-                'lng': float(loc['lng']),
-                'formatted': result.get('formatted_address') or address,
-                'provider': 'google'
-            }
-        else:
-            if not data:
-                return None, "Adresse introuvable"
-            result = data[0]
-            geo = {
-                'lat': float(result.get('lat')),
-                'lng': float(result.get('lon')),
-                'formatted': result.get('display_name') or address,
-                'provider': 'nominatim'
-            }
-
-        _cache_set(address, geo)
-        return geo, None
+        with outbound_http.call('geocoding') as timeout:
+            with _geocode_cache_lock:
+                _geocode_cache_stats['fournisseur'] += 1
+            geo, erreur, definitif = fournisseur(address, contact_email, timeout)
     except Exception as e:
         logger.warning(f"Erreur geocodage: {e}")
-        return None, "Impossible de vérifier l'adresse (réseau/API)"
+        return None, GEOCODE_ERREUR_RESEAU
+
+    if geo or definitif:
+        expire = _geocode_base_set(cle, address, geo, erreur)
+        _geocode_memoire_set(cle, (geo, erreur), time_module.time() + (expire - utcnow()).total_seconds())
+    return geo, erreur
 
 def haversine_km(lat1, lon1, lat2, lon2):
     """Distance à vol d'oiseau en km."""
@@ -1048,57 +1436,325 @@ def haversine_km(lat1, lon1, lat2, lon2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return r * c
 
-def route_distance_km(lat1, lon1, lat2, lon2):
-    """Distance routière via OSRM (fallback sur vol d'oiseau)."""
+# ---- Matrice de distances ----
+# Distance et durée routières mémorisées par couple origine/destination arrondi
+# (LRU mémoire devant la table distance_matrix). Les couples manquants sont
+# demandés en un seul appel "table" au moteur de routage ; s'il est indisponible,
+# on estime par vol d'oiseau × facteur de détour calibré sur les trajets connus.
+_distance_cache = OrderedDict()
+_distance_cache_lock = threading.Lock()
+_distance_cache_stats = {'memoire': 0, 'base': 0, 'moteur': 0, 'estimation': 0}
+_distance_ecritures = OrderedDict()  # couples en attente du prochain commit de session
+_facteur_detour_cache = {'valeur': None, 'expire': 0.0}
+
+def _cle_point(lat, lng):
+    decimales = app.config.get('DISTANCE_COORD_DECIMALS', 4)
+    return f"{round(float(lat), decimales):.{decimales}f},{round(float(lng), decimales):.{decimales}f}"
+
+def _point_depuis_cle(cle):
+    lat, lng = cle.split(',')
+    return float(lat), float(lng)
+
+def _distance_memoire_get(couple):
+    with _distance_cache_lock:
+        entree = _distance_cache.get(couple)
+        if entree is None:
+            return None
+        if time_module.time() > entree[0]:
+            _distance_cache.pop(couple, None)
+            return None
+        _distance_cache.move_to_end(couple)
+        return entree[1]
+
+def _distance_memoire_set(couple, valeur, ttl):
+    with _distance_cache_lock:
+        _distance_cache[couple] = (time_module.time() + ttl, valeur)
+        _distance_cache.move_to_end(couple)
+        while len(_distance_cache) > app.config.get('DISTANCE_MEMORY_SIZE', 4096):
+            _distance_cache.popitem(last=False)
+
+def _routeur_osrm(sources, destinations, timeout):
+    """Appel OSRM /table : matrice [source][destination] de (km, minutes) ou None."""
+    points = list(sources) + list(destinations)
+    coords = ";".join(f"{lng},{lat}" for lat, lng in points)
+    params = urllib.parse.urlencode({
+        'sources': ";".join(str(i) for i in range(len(sources))),
+        'destinations': ";".join(str(len(sources) + i) for i in range(len(destinations))),
+        'annotations': 'distance,duration',
+    })
+    base = app.config.get('OSRM_URL', 'https://router.project-osrm.org').rstrip('/')
+    req = urllib.request.Request(f"{base}/table/v1/driving/{coords}?{params}", headers={'User-Agent': 'Planify/2.12'})
+    with _ouvrir_url_geocodage(req, timeout) as resp:
+        data = json.loads(resp.read().decode('utf-8'))
+    if data.get('code') != 'Ok':
+        raise ValueError(f"OSRM: {data.get('code')}")
+    distances = data.get('distances') or []
+    durees = data.get('durations') or []
+    matrice = []
+    for i in range(len(sources)):
+        ligne = []
+        for j in range(len(destinations)):
+            distance_m = distances[i][j] if i < len(distances) and j < len(distances[i]) else None
+            duree_s = durees[i][j] if i < len(durees) and j < len(durees[i]) else None
+            ligne.append((distance_m / 1000.0, (duree_s or 0) / 60.0) if distance_m is not None else None)
+        matrice.append(ligne)
+    return matrice
+
+def _routeur_stub(sources, destinations, timeout):
+    """Routeur hors-ligne déterministe (tests, démo) : détour fixe de 25 %, 70 km/h."""
+    matrice = []
+    for lat1, lng1 in sources:
+        ligne = []
+        for lat2, lng2 in destinations:
+            km = haversine_km(lat1, lng1, lat2, lng2) * 1.25
+            ligne.append((km, km / 70.0 * 60.0))
+        matrice.append(ligne)
+    return matrice
+
+DISTANCE_ROUTERS = {
+    'osrm': _routeur_osrm,
+    'stub': _routeur_stub,
+}
+
+def register_distance_router(nom, routeur):
+    """Enregistre un moteur de routage (sélectionnable via DISTANCE_ROUTER)."""
+    DISTANCE_ROUTERS[nom] = routeur
+
+def _routeur_actif():
     if not app.config.get('USE_OSRM_DISTANCE'):
         return None
+    return DISTANCE_ROUTERS.get(app.config.get('DISTANCE_ROUTER') or 'osrm')
+
+def facteur_detour():
+    """Rapport route / vol d'oiseau observé sur les trajets mémorisés (défaut si trop peu d'échantillons)."""
+    if time_module.time() < _facteur_detour_cache['expire']:
+        return _facteur_detour_cache['valeur']
+    valeur = app.config.get('DISTANCE_DETOUR_FACTOR', 1.3)
+    table = DistanceCache.__table__
     try:
-        coords = f"{lon1},{lat1};{lon2},{lat2}"
-        url = f"https://router.project-osrm.org/route/v1/driving/{coords}?overview=false"
-        req = urllib.request.Request(url, headers={'User-Agent': 'Planify/2.12'})
-        timeout = app.config.get('GEOCODING_TIMEOUT', 6)
-        def _open_route(req):
-            ctx = None
-            if certifi:
-                try:
-                    ctx = ssl.create_default_context(cafile=certifi.where())
-                except Exception:
-                    ctx = None
-            if ctx is None:
-                try:
-                    ctx = ssl.create_default_context()
-                except Exception:
-                    ctx = None
-            try:
-                return urllib.request.urlopen(req, timeout=timeout, context=ctx)
-            except Exception as e:
-                if 'CERTIFICATE_VERIFY_FAILED' in str(e):
-                    logger.warning("Certificat SSL manquant, fallback non vérifié pour OSRM.")
-                    ctx = ssl._create_unverified_context()
-                    return urllib.request.urlopen(req, timeout=timeout, context=ctx)
-                raise
-        with _open_route(req) as resp:
-            payload = resp.read().decode('utf-8')
-        data = json.loads(payload)
-        if data.get('code') != 'Ok':
-            return None
-        routes = data.get('routes') or []
-        if not routes:
-            return None
-        distance_m = routes[0].get('distance')
-        if distance_m is None:
-            return None
-        return distance_m / 1000.0
+        nombre, route, air = db.session.execute(
+            select(db.func.count(table.c.id), db.func.sum(table.c.distance_km), db.func.sum(table.c.distance_air_km))
+            .where(table.c.distance_air_km > 1)
+        ).one()
+        if nombre >= app.config.get('DISTANCE_DETOUR_MIN_SAMPLES', 20) and air:
+            valeur = min(2.5, max(1.0, route / air))
     except Exception as e:
-        logger.warning(f"Erreur OSRM distance: {e}")
-        return None
+        logger.warning(f"Calibration facteur de détour impossible: {e}")
+    _facteur_detour_cache.update(valeur=valeur, expire=time_module.time() + 3600)
+    return valeur
+
+def _distances_en_base(couples):
+    # Lecture par la session de l'appelant ; les couples encore en attente d'écriture sont servis d'abord
+    now = utcnow()
+    trouves = {}
+    with _distance_cache_lock:
+        for couple in couples:
+            ligne = _distance_ecritures.get(couple)
+            if ligne is not None and ligne['expires_at'] > now:
+                trouves[couple] = ((ligne['distance_km'], ligne['duree_min'], 'route'), ligne['expires_at'])
+    restants = [couple for couple in couples if couple not in trouves]
+    if not restants:
+        return trouves
+    table = DistanceCache.__table__
+    origines = sorted({o for o, _ in restants})
+    destinations = sorted({d for _, d in restants})
+    try:
+        for start in range(0, len(origines), BULK_IN_CLAUSE_MAX):
+            stmt = select(
+                table.c.origine, table.c.destination, table.c.distance_km, table.c.duree_min, table.c.expires_at
+            ).where(
+                table.c.origine.in_(origines[start:start + BULK_IN_CLAUSE_MAX]),
+                table.c.expires_at > now
+            )
+            if len(destinations) <= BULK_IN_CLAUSE_MAX:
+                stmt = stmt.where(table.c.destination.in_(destinations))
+            for row in db.session.execute(stmt).all():
+                couple = (row.origine, row.destination)
+                if couple in couples:
+                    trouves[couple] = ((row.distance_km, row.duree_min, 'route'), row.expires_at)
+    except Exception as e:
+        logger.warning(f"Lecture matrice de distances impossible: {e}")
+    return trouves
+
+def _enregistrer_distances(resultats):
+    """Met les distances calculées en attente ; elles sont écrites par le prochain commit de la session."""
+    now = utcnow()
+    expire = now + timedelta(seconds=app.config.get('DISTANCE_CACHE_TTL', 0))
+    with _distance_cache_lock:
+        for (origine, destination), (km, minutes, _) in resultats.items():
+            lat1, lng1 = _point_depuis_cle(origine)
+            lat2, lng2 = _point_depuis_cle(destination)
+            _distance_ecritures[(origine, destination)] = {
+                'origine': origine, 'destination': destination,
+                'distance_km': km, 'duree_min': minutes,
+                'distance_air_km': haversine_km(lat1, lng1, lat2, lng2),
+                'created_at': now, 'expires_at': expire,
+            }
+            _distance_ecritures.move_to_end((origine, destination))
+        while len(_distance_ecritures) > app.config.get('DISTANCE_MEMORY_SIZE', 4096):
+            _distance_ecritures.popitem(last=False)
+    return expire
+
+@event.listens_for(db.session, "before_commit")
+def _ecrire_cache_distances(session):
+    """Écrit les distances en attente dans la transaction qui se termine."""
+    if session.get_nested_transaction() is not None:
+        return
+    with _distance_cache_lock:
+        if not _distance_ecritures:
+            return
+        lignes = list(_distance_ecritures.values())
+        _distance_ecritures.clear()
+    table = DistanceCache.__table__
+    try:
+        # Entrées expirées ou écrites entre-temps par un autre worker : remplacées
+        insertion = sqlite_insert(table)
+        session.connection().execute(
+            insertion.on_conflict_do_update(
+                index_elements=[table.c.origine, table.c.destination],
+                set_={nom: insertion.excluded[nom] for nom in lignes[0] if nom not in ('origine', 'destination')}
+            ),
+            lignes
+        )
+    except Exception as e:
+        logger.warning(f"Écriture matrice de distances impossible: {e}")
+
+def matrice_distances(origines, destinations, moteur=True):
+    """
+    Distances routières entre chaque origine et chaque destination.
+
+    Args:
+        origines, destinations: listes de (lat, lng)
+        moteur: si False, seules la mémoire et la table sont consultées ; les
+            couples manquants sont estimés sans interroger le moteur de routage
+
+    Returns:
+        list: matrice [i][j] de (distance_km, duree_min, source), source valant
+        'route' (moteur de routage, éventuellement mémorisé) ou 'estimation'
+    """
+    cles_o = [_cle_point(lat, lng) for lat, lng in origines]
+    cles_d = [_cle_point(lat, lng) for lat, lng in destinations]
+    resultats = {}
+    manquants = set()
+    for couple in {(o, d) for o in cles_o for d in cles_d}:
+        if couple[0] == couple[1]:
+            resultats[couple] = (0.0, 0.0, 'route')
+            continue
+        valeur = _distance_memoire_get(couple)
+        if valeur is None:
+            manquants.add(couple)
+        else:
+            with _distance_cache_lock:
+                _distance_cache_stats['memoire'] += 1
+            resultats[couple] = valeur
+
+    if manquants:
+        for couple, (valeur, expire) in _distances_en_base(manquants).items():
+            with _distance_cache_lock:
+                _distance_cache_stats['base'] += 1
+            resultats[couple] = valeur
+            _distance_memoire_set(couple, valeur, (expire - utcnow()).total_seconds())
+            manquants.discard(couple)
+
+    routeur = _routeur_actif() if moteur else None
+    if manquants and routeur:
+        sources = sorted({o for o, _ in manquants})
+        cibles = sorted({d for _, d in manquants})
+        pas = max(1, app.config.get('DISTANCE_TABLE_MAX', 100) // 2)
+        calcules = {}
+        try:
+            for i in range(0, len(sources), pas):
+                for j in range(0, len(cibles), pas):
+                    bloc_o, bloc_d = sources[i:i + pas], cibles[j:j + pas]
+                    with outbound_http.call('routing') as timeout:
+                        with _distance_cache_lock:
+                            _distance_cache_stats['moteur'] += 1
+                        matrice = routeur(
+                            [_point_depuis_cle(c) for c in bloc_o],
+                            [_point_depuis_cle(c) for c in bloc_d],
+                            timeout
+                        )
+                    for a, origine in enumerate(bloc_o):
+                        for b, destination in enumerate(bloc_d):
+                            cellule = matrice[a][b]
+                            if (origine, destination) in manquants and cellule is not None:
+                                calcules[(origine, destination)] = (cellule[0], cellule[1], 'route')
+        except Exception as e:
+            logger.warning(f"Erreur moteur de routage: {e}")
+        if calcules:
+            expire = _enregistrer_distances(calcules)
+            for couple, valeur in calcules.items():
+                resultats[couple] = valeur
+                _distance_memoire_set(couple, valeur, (expire - utcnow()).total_seconds())
+            manquants -= set(calcules)
+
+    if manquants:
+        facteur = facteur_detour()
+        vitesse = app.config.get('DISTANCE_ESTIMATION_KMH', 70.0)
+        for couple in manquants:
+            with _distance_cache_lock:
+                _distance_cache_stats['estimation'] += 1
+            (lat1, lng1), (lat2, lng2) = _point_depuis_cle(couple[0]), _point_depuis_cle(couple[1])
+            km = haversine_km(lat1, lng1, lat2, lng2) * facteur
+            resultats[couple] = (km, km / vitesse * 60.0, 'estimation')
+            if moteur:
+                # Estimation gardée peu de temps : le moteur sera réinterrogé
+                _distance_memoire_set(couple, resultats[couple], app.config.get('DISTANCE_FALLBACK_TTL', 600))
+
+    return [[resultats[(o, d)] for d in cles_d] for o in cles_o]
+
+def vider_cache_distances(memoire_seulement=False):
+    """Vide la matrice de distances (mémoire, et table sauf si memoire_seulement)."""
+    with _distance_cache_lock:
+        _distance_cache.clear()
+        if not memoire_seulement:
+            _distance_ecritures.clear()
+    _facteur_detour_cache.update(valeur=None, expire=0.0)
+    if not memoire_seulement:
+        DistanceCache.query.delete()
+        db.session.commit()
+
+def get_cache_distances_stats():
+    """Couples servis par la mémoire, la base, le moteur de routage ou estimés."""
+    with _distance_cache_lock:
+        return dict(_distance_cache_stats, taille_memoire=len(_distance_cache))
+
+def route_distance_km(lat1, lon1, lat2, lon2):
+    """Distance routière (matrice de distances), None si seule une estimation est possible."""
+    km, _, source = matrice_distances([(lat1, lon1)], [(lat2, lon2)])[0][0]
+    return km if source == 'route' else None
 
 def compute_distance_km(lat1, lon1, lat2, lon2):
-    """Distance routière si possible, sinon vol d'oiseau."""
-    route_km = route_distance_km(lat1, lon1, lat2, lon2)
-    if route_km is not None:
-        return round(route_km, 2), 'route'
-    return round(haversine_km(lat1, lon1, lat2, lon2), 2), 'air'
+    """Distance routière si possible, sinon vol d'oiseau × facteur de détour."""
+    km, _, source = matrice_distances([(lat1, lon1)], [(lat2, lon2)])[0][0]
+    return round(km, 2), source
+
+def distances_locaux(lat, lng, local_ids=None):
+    """
+    Distance estimée (vol d'oiseau × facteur de détour) de chaque local géocodé au point donné.
+
+    Les coordonnées stockées de tous les locaux sont lues en une requête et les
+    distances calculées en une seule opération vectorisée.
+
+    Returns:
+        dict: {local_id: distance_km} (locaux sans coordonnées absents)
+    """
+    from geo_ranking import haversine_km_array
+
+    query = db.session.query(Local.id, Local.adresse_lat, Local.adresse_lng).filter(
+        Local.adresse_lat.isnot(None), Local.adresse_lng.isnot(None)
+    )
+    if local_ids is not None:
+        local_ids = list(local_ids)
+        if not local_ids:
+            return {}
+        query = query.filter(Local.id.in_(local_ids))
+    lignes = query.all()
+    if not lignes:
+        return {}
+    distances = haversine_km_array(lat, lng, [l.adresse_lat for l in lignes], [l.adresse_lng for l in lignes])
+    distances = distances * facteur_detour()
+    return {ligne.id: round(float(km), 2) for ligne, km in zip(lignes, distances)}
 
 def compute_indemnite_km(distance_km, parametres):
     if distance_km is None:
@@ -1119,7 +1775,7 @@ def get_google_maps_api_key():
     if key:
         return key
     try:
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         if parametres and parametres.google_maps_api_key:
             return parametres.google_maps_api_key.strip()
     except Exception:
@@ -1230,6 +1886,17 @@ def valider_formulaire_client(form_data):
     
     return len(erreurs) == 0, erreurs
 
+@app.before_request
+def _ouvrir_budget_appels_sortants():
+    # Échéance commune à tous les appels externes de la requête (géocodage, IA, Stripe...)
+    g._budget_sortant = outbound_http.start_budget(app.config.get('OUTBOUND_REQUEST_BUDGET'))
+
+@app.teardown_request
+def _fermer_budget_appels_sortants(exc=None):
+    token = g.pop('_budget_sortant', None)
+    if token is not None:
+        outbound_http.end_budget(token)
+
 # Middleware de sécurité global - tous les utilisateurs doivent être connectés
 @app.before_request
 def require_login():
@@ -1242,7 +1909,8 @@ def require_login():
         'chat_recommendations', 'chat_reset', 'page_signature_devis', 'api_signer_devis',
         'scanner_api.scan_material', 'scanner_api.get_material_by_code',
         'stripe_bp.pay_invoice', 'stripe_bp.pay_quote', 'stripe_bp.payment_success',
-        'stripe_bp.payment_cancel', 'stripe_bp.stripe_webhook', 'rate_prestation'
+        'stripe_bp.payment_cancel', 'stripe_bp.stripe_webhook', 'rate_prestation',
+        'api_sync_push', 'api_sync_pull'
     ]
 
     # Vérifier si la route actuelle est publique
@@ -1310,7 +1978,7 @@ def require_login():
     
     # Initialiser le lazy importer avec les paramètres d'entreprise
     if not hasattr(g, 'parametres_loaded'):
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         if parametres:
             lazy_importer.set_parametres(parametres)
         g.parametres_loaded = True
@@ -1404,6 +2072,10 @@ class Local(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nom = db.Column(db.String(100), nullable=False)
     adresse = db.Column(db.String(200), nullable=False)
+    adresse_lat = db.Column(db.Float)
+    adresse_lng = db.Column(db.Float)
+    adresse_geocode_statut = db.Column(db.String(20))  # a_faire, ok, introuvable, erreur
+    adresse_geocoded_at = db.Column(db.DateTime)
     materiels = db.relationship('Materiel', backref='local', lazy=True)
 
 class AuditLog(db.Model):
@@ -1803,6 +2475,92 @@ class ParametresEntreprise(db.Model):
     def __repr__(self):
         return f'<ParametresEntreprise {self.nom_entreprise}>'
 
+# ==================== PARAMÈTRES ENTREPRISE (CACHE) ====================
+
+# Valeurs de colonnes de la ligne unique, partagées par le processus. Invalidées au
+# commit d'une modification de ParametresEntreprise ; le TTL couvre les écritures
+# d'autres processus.
+_parametres_cache = {'charge': False, 'valeurs': None, 'expire': 0.0, 'version': 0}
+_parametres_cache_lock = threading.Lock()
+
+def invalider_cache_parametres():
+    """Oublie les paramètres en cache (processus et requête courante)."""
+    with _parametres_cache_lock:
+        _parametres_cache.update(charge=False, valeurs=None, expire=0.0)
+        _parametres_cache['version'] += 1
+    if has_app_context():
+        g.pop('parametres', None)
+
+def _instance_parametres(valeurs):
+    """Instance persistante rattachée à la session, sans requête SQL."""
+    parametres = sa_inspect(ParametresEntreprise).class_manager.new_instance()
+    for key, value in valeurs.items():
+        set_committed_value(parametres, key, value)
+    make_transient_to_detached(parametres)
+    return db.session.merge(parametres, load=False)
+
+def get_parametres_entreprise():
+    """
+    Paramètres entreprise (ligne unique), chargés une fois par processus.
+
+    L'instance retournée est rattachée à la session courante et peut être modifiée
+    puis commitée normalement. Elle est mémorisée dans g pour la durée du contexte.
+    """
+    if has_app_context() and 'parametres' in g:
+        return g.parametres
+    with _parametres_cache_lock:
+        charge = _parametres_cache['charge'] and time_module.monotonic() < _parametres_cache['expire']
+        valeurs = _parametres_cache['valeurs']
+        version = _parametres_cache['version']
+    if charge:
+        parametres = _instance_parametres(valeurs) if valeurs else None
+    else:
+        parametres = ParametresEntreprise.query.first()
+        valeurs = None
+        if parametres:
+            valeurs = {
+                attr.key: getattr(parametres, attr.key)
+                for attr in sa_inspect(ParametresEntreprise).column_attrs
+            }
+        with _parametres_cache_lock:
+            # Une invalidation survenue pendant la lecture rend ces valeurs douteuses
+            if _parametres_cache['version'] == version:
+                _parametres_cache.update(
+                    charge=True,
+                    valeurs=valeurs,
+                    expire=time_module.monotonic() + app.config.get('PARAMETRES_CACHE_TTL', 300)
+                )
+    if has_app_context():
+        g.parametres = parametres
+    return parametres
+
+@event.listens_for(db.session, "after_flush")
+def _parametres_modifies_apres_flush(session, flush_context):
+    for etat, objets in (('new', session.new), ('dirty', session.dirty), ('deleted', session.deleted)):
+        for obj in objets:
+            if not isinstance(obj, ParametresEntreprise):
+                continue
+            session.info['parametres_modifies'] = True
+            # Jusqu'au commit, la transaction courante doit voir sa propre ligne
+            if etat != 'dirty' and has_app_context():
+                g.parametres = obj if etat == 'new' else None
+
+@event.listens_for(db.session, "do_orm_execute")
+def _parametres_modifies_bulk(orm_execute_state):
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ is ParametresEntreprise:
+            orm_execute_state.session.info['parametres_modifies'] = True
+
+@event.listens_for(db.session, "after_commit")
+def _invalider_parametres_apres_commit(session):
+    if session.info.pop('parametres_modifies', False):
+        invalider_cache_parametres()
+
+@event.listens_for(db.session, "after_rollback")
+def _oublier_parametres_apres_rollback(session):
+    session.info.pop('parametres_modifies', None)
+
 class Devis(db.Model):
     __tablename__ = 'devis'
     
@@ -1932,7 +2690,7 @@ class Devis(db.Model):
         # Calcul de la TVA
         tva_non_applicable = False
         try:
-            parametres = ParametresEntreprise.query.first()
+            parametres = get_parametres_entreprise()
             if parametres and parametres.tva_non_applicable:
                 tva_non_applicable = True
         except Exception:
@@ -2176,7 +2934,7 @@ class Facture(db.Model):
         # Calcul de la TVA
         tva_non_applicable = False
         try:
-            parametres = ParametresEntreprise.query.first()
+            parametres = get_parametres_entreprise()
             if parametres and parametres.tva_non_applicable:
                 tva_non_applicable = True
         except Exception:
@@ -2296,6 +3054,11 @@ class Client(db.Model):
     nom = db.Column(db.String(150), nullable=False)
     categories = db.Column(db.Text)
     notes = db.Column(db.Text)
+    adresse = db.Column(db.Text)
+    adresse_lat = db.Column(db.Float)
+    adresse_lng = db.Column(db.Float)
+    adresse_geocode_statut = db.Column(db.String(20))  # a_faire, ok, introuvable, erreur
+    adresse_geocoded_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=utcnow)
     updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)
 
@@ -2530,6 +3293,180 @@ def _validate_materiel_presta(mapper, connection, target):
     if existing_id and existing_id != getattr(target, 'id', None):
         raise ValueError("Matériel déjà assigné à cette mission/réservation")
 
+# ==================== SOLDES MOUVEMENTS MATÉRIEL ====================
+
+class SoldeMaterielPrestation(db.Model):
+    """Solde courant des mouvements (sorties/retours) par prestation et matériel.
+
+    Tenu à jour dans la même transaction que chaque MouvementMateriel ; remplace
+    les SUM() sur l'historique. Reconstructible via verifier_soldes_materiel().
+    """
+    __tablename__ = 'materiel_soldes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    prestation_id = db.Column(db.Integer, nullable=False)
+    materiel_id = db.Column(db.Integer, nullable=False)
+    quantite_sortie = db.Column(db.Integer, nullable=False, default=0)
+    quantite_retour = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('prestation_id', 'materiel_id', name='uix_materiel_soldes_prestation_materiel'),
+    )
+
+    @property
+    def quantite_dehors(self):
+        return max(0, (self.quantite_sortie or 0) - (self.quantite_retour or 0))
+
+def _appliquer_delta_solde(connection, prestation_id, materiel_id, type_mouvement, delta):
+    if not prestation_id or not materiel_id or not delta or type_mouvement not in ('sortie', 'retour'):
+        return
+    table = SoldeMaterielPrestation.__table__
+    colonne = table.c.quantite_sortie if type_mouvement == 'sortie' else table.c.quantite_retour
+    result = connection.execute(
+        table.update()
+        .where(table.c.prestation_id == prestation_id, table.c.materiel_id == materiel_id)
+        .values({colonne.name: colonne + delta, 'updated_at': utcnow()})
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(
+            prestation_id=prestation_id,
+            materiel_id=materiel_id,
+            quantite_sortie=delta if type_mouvement == 'sortie' else 0,
+            quantite_retour=delta if type_mouvement == 'retour' else 0,
+            updated_at=utcnow()
+        ))
+
+def _quantite_mouvement(target):
+    try:
+        return int(target.quantite if target.quantite is not None else 1)
+    except (TypeError, ValueError):
+        return 0
+
+@event.listens_for(MouvementMateriel, 'after_insert')
+def _solde_apres_insert_mouvement(mapper, connection, target):
+    _appliquer_delta_solde(connection, target.prestation_id, target.materiel_id,
+                           target.type_mouvement, _quantite_mouvement(target))
+
+@event.listens_for(MouvementMateriel, 'before_delete')
+def _solde_avant_delete_mouvement(mapper, connection, target):
+    _appliquer_delta_solde(connection, target.prestation_id, target.materiel_id,
+                           target.type_mouvement, -_quantite_mouvement(target))
+
+def _recalculer_solde(connection, prestation_id, materiel_id):
+    if not prestation_id or not materiel_id:
+        return
+    mv = MouvementMateriel.__table__
+    table = SoldeMaterielPrestation.__table__
+    row = connection.execute(
+        select(
+            db.func.coalesce(db.func.sum(db.case((mv.c.type_mouvement == 'sortie', mv.c.quantite), else_=0)), 0),
+            db.func.coalesce(db.func.sum(db.case((mv.c.type_mouvement == 'retour', mv.c.quantite), else_=0)), 0)
+        ).where(mv.c.prestation_id == prestation_id, mv.c.materiel_id == materiel_id)
+    ).first()
+    connection.execute(table.delete().where(
+        table.c.prestation_id == prestation_id,
+        table.c.materiel_id == materiel_id
+    ))
+    if row[0] or row[1]:
+        connection.execute(table.insert().values(
+            prestation_id=prestation_id,
+            materiel_id=materiel_id,
+            quantite_sortie=int(row[0]),
+            quantite_retour=int(row[1]),
+            updated_at=utcnow()
+        ))
+
+@event.listens_for(MouvementMateriel, 'after_update')
+def _solde_apres_update_mouvement(mapper, connection, target):
+    # Modification d'un mouvement existant (rare) : l'ancienne valeur peut être
+    # expirée, on recalcule donc les soldes concernés depuis l'historique.
+    state = sa_inspect(target)
+    cles = {(target.prestation_id, target.materiel_id)}
+    prestations = state.attrs['prestation_id'].history.deleted or [target.prestation_id]
+    materiels = state.attrs['materiel_id'].history.deleted or [target.materiel_id]
+    cles.update((p, m) for p in prestations for m in materiels)
+    for prestation_id, materiel_id in cles:
+        _recalculer_solde(connection, prestation_id, materiel_id)
+
+def get_soldes_mouvements(prestation_id, materiel_ids=None):
+    """Soldes (sortie, retour) d'une prestation, par matériel, en une requête.
+
+    Returns:
+        dict: {materiel_id: (quantite_sortie, quantite_retour)}
+    """
+    query = db.session.query(
+        SoldeMaterielPrestation.materiel_id,
+        SoldeMaterielPrestation.quantite_sortie,
+        SoldeMaterielPrestation.quantite_retour
+    ).filter(SoldeMaterielPrestation.prestation_id == prestation_id)
+    if materiel_ids is not None:
+        query = query.filter(SoldeMaterielPrestation.materiel_id.in_(list(materiel_ids)))
+    return {row.materiel_id: (row.quantite_sortie or 0, row.quantite_retour or 0) for row in query.all()}
+
+def get_solde_mouvement(prestation_id, materiel_id):
+    """Solde (sortie, retour) d'un couple prestation/matériel (O(1), index unique)."""
+    return get_soldes_mouvements(prestation_id, [materiel_id]).get(materiel_id, (0, 0))
+
+def verifier_soldes_materiel(reparer=False):
+    """
+    Compare les soldes avec l'historique des mouvements.
+
+    Args:
+        reparer: si True, reconstruit les soldes divergents depuis l'historique
+
+    Returns:
+        list: écarts détectés [{prestation_id, materiel_id, attendu, enregistre}]
+    """
+    mv = MouvementMateriel.__table__
+    table = SoldeMaterielPrestation.__table__
+    sortie_expr = db.func.coalesce(db.func.sum(db.case((mv.c.type_mouvement == 'sortie', mv.c.quantite), else_=0)), 0)
+    retour_expr = db.func.coalesce(db.func.sum(db.case((mv.c.type_mouvement == 'retour', mv.c.quantite), else_=0)), 0)
+    attendus = {
+        (row.prestation_id, row.materiel_id): (int(row.sortie), int(row.retour))
+        for row in db.session.execute(
+            select(mv.c.prestation_id, mv.c.materiel_id, sortie_expr.label('sortie'), retour_expr.label('retour'))
+            .where(mv.c.prestation_id.isnot(None))
+            .group_by(mv.c.prestation_id, mv.c.materiel_id)
+        )
+    }
+    enregistres = {
+        (row.prestation_id, row.materiel_id): (row.quantite_sortie or 0, row.quantite_retour or 0)
+        for row in db.session.execute(
+            select(table.c.prestation_id, table.c.materiel_id, table.c.quantite_sortie, table.c.quantite_retour)
+        )
+    }
+    ecarts = []
+    for key in set(attendus) | set(enregistres):
+        attendu = attendus.get(key, (0, 0))
+        enregistre = enregistres.get(key)
+        if enregistre is None and attendu == (0, 0):
+            continue
+        if enregistre != attendu:
+            ecarts.append({
+                'prestation_id': key[0],
+                'materiel_id': key[1],
+                'attendu': attendu,
+                'enregistre': enregistre
+            })
+    if reparer and ecarts:
+        for ecart in ecarts:
+            db.session.execute(table.delete().where(
+                table.c.prestation_id == ecart['prestation_id'],
+                table.c.materiel_id == ecart['materiel_id']
+            ))
+            sortie, retour = ecart['attendu']
+            if sortie or retour:
+                db.session.execute(table.insert().values(
+                    prestation_id=ecart['prestation_id'],
+                    materiel_id=ecart['materiel_id'],
+                    quantite_sortie=sortie,
+                    quantite_retour=retour,
+                    updated_at=utcnow()
+                ))
+        db.session.commit()
+    return ecarts
+
 class Prestation(db.Model):
     __tablename__ = 'prestations'
     id = db.Column(db.Integer, primary_key=True)
@@ -2537,6 +3474,8 @@ class Prestation(db.Model):
     date_fin = db.Column(db.Date, nullable=False)
     heure_debut = db.Column(db.Time, nullable=False, default=time(20, 0))
     heure_fin = db.Column(db.Time, nullable=False, default=time(2, 0))
+    debut_dt = db.Column(db.DateTime, index=True)  # date_debut + heure_debut (maintenu automatiquement)
+    fin_dt = db.Column(db.DateTime, index=True)  # date_fin + heure_fin, passage de minuit inclus
     client = db.Column(db.String(100), nullable=False)
     client_telephone = db.Column(db.String(20))
     client_email = db.Column(db.String(120))
@@ -2546,6 +3485,7 @@ class Prestation(db.Model):
     lieu_lng = db.Column(db.Float)
     lieu_formatted = db.Column(db.String(255))
     lieu_geocoded_at = db.Column(db.DateTime)
+    lieu_geocode_statut = db.Column(db.String(20))  # a_faire, ok, introuvable, erreur
     distance_km = db.Column(db.Float)
     distance_source = db.Column(db.String(20))
     indemnite_km = db.Column(db.Float)
@@ -2564,6 +3504,11 @@ class Prestation(db.Model):
     # Relations - dj est défini via le backref dans DJ.prestations
     technicien = db.relationship('User', foreign_keys=[technicien_id], backref='prestations_techniques')
     client_ref = db.relationship('Client', backref='prestations')
+
+    __table_args__ = (
+        db.Index('ix_prestations_dj_periode', 'dj_id', 'debut_dt', 'fin_dt'),
+        db.Index('ix_prestations_technicien_periode', 'technicien_id', 'debut_dt', 'fin_dt'),
+    )
     
     @property
     def materiels(self):
@@ -2600,24 +3545,14 @@ class Prestation(db.Model):
 
         if nouveau_statut == 'terminee':
             try:
-                assignations = MaterielPresta.query.filter_by(prestation_id=self.id).all()
-                for assignation in assignations:
-                    total_sortie = db.session.query(
-                        db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)
-                    ).filter_by(
-                        materiel_id=assignation.materiel_id,
-                        prestation_id=self.id,
-                        type_mouvement='sortie'
-                    ).scalar() or 0
-                    total_retour = db.session.query(
-                        db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)
-                    ).filter_by(
-                        materiel_id=assignation.materiel_id,
-                        prestation_id=self.id,
-                        type_mouvement='retour'
-                    ).scalar() or 0
-                    if total_sortie > total_retour:
-                        return False, "Impossible de terminer : retours matériel manquants"
+                assignes = select(MaterielPresta.materiel_id).where(MaterielPresta.prestation_id == self.id)
+                retours_manquants = db.session.query(SoldeMaterielPrestation.id).filter(
+                    SoldeMaterielPrestation.prestation_id == self.id,
+                    SoldeMaterielPrestation.materiel_id.in_(assignes),
+                    SoldeMaterielPrestation.quantite_sortie > SoldeMaterielPrestation.quantite_retour
+                ).first()
+                if retours_manquants:
+                    return False, "Impossible de terminer : retours matériel manquants"
             except Exception:
                 return False, "Impossible de vérifier les retours matériel"
         
@@ -2635,33 +3570,543 @@ class Prestation(db.Model):
         
         return True, f"Statut changé de '{ancien_statut}' à '{nouveau_statut}'"
 
+@event.listens_for(Prestation, 'before_insert')
+@event.listens_for(Prestation, 'before_update')
+def _normaliser_periode_prestation(mapper, connection, target):
+    """Maintient debut_dt/fin_dt, utilisés pour la détection de conflits en SQL."""
+    target.debut_dt, target.fin_dt = _build_datetime_range(
+        target.date_debut, target.date_fin, target.heure_debut, target.heure_fin
+    )
+
 # Table de liaison gérée par le modèle MaterielPresta
 
-# ==================== SYNCHRONISATION OFFLINE ====================
+# ==================== OCCUPATION MATÉRIEL (TIMELINE) ====================
 
-class SyncConfig(db.Model):
-    __tablename__ = 'sync_config'
+class MaterielOccupation(db.Model):
+    """Intervalle d'occupation matérialisé d'un matériel (buffers logistiques inclus).
+
+    Table dérivée : une ligne par matériel et par prestation/réservation, tenue à jour
+    par les listeners de session ci-dessous et reconstructible à tout moment.
+    """
+    __tablename__ = 'materiel_occupations'
 
     id = db.Column(db.Integer, primary_key=True)
-    enabled = db.Column(db.Boolean, default=False)
-    server_url = db.Column(db.String(255))
-    auth_url = db.Column(db.String(255))
-    token_url = db.Column(db.String(255))
-    client_id = db.Column(db.String(255))
-    client_secret = db.Column(db.String(255))
-    scopes = db.Column(db.String(500))
-    access_token = db.Column(db.Text)
-    refresh_token = db.Column(db.Text)
-    token_expires_at = db.Column(db.DateTime)
-    device_id = db.Column(db.String(64))
-    sync_interval_seconds = db.Column(db.Integer, default=20)
-    last_sync_at = db.Column(db.DateTime)
-    last_success_at = db.Column(db.DateTime)
+    materiel_id = db.Column(db.Integer, db.ForeignKey('materiels.id'), nullable=False)
+    source_type = db.Column(db.String(20), nullable=False)  # prestation, retour_manquant, reservation
+    prestation_id = db.Column(db.Integer, index=True)
+    reservation_id = db.Column(db.Integer, index=True)
+    debut = db.Column(db.DateTime, nullable=False)
+    fin = db.Column(db.DateTime, nullable=False)
+    quantite = db.Column(db.Integer, nullable=False, default=1)
+    libelle = db.Column(db.String(100))
+    date_reference = db.Column(db.Date)
+    heure_libelle = db.Column(db.String(50))
+
+    __table_args__ = (
+        db.Index('ix_materiel_occupations_materiel_periode', 'materiel_id', 'debut', 'fin'),
+    )
+
+    def to_conflit(self):
+        return {
+            'type': self.source_type,
+            'id': self.reservation_id if self.source_type == 'reservation' else self.prestation_id,
+            'nom': self.libelle,
+            'date': self.date_reference,
+            'heure': self.heure_libelle,
+            'quantite': self.quantite
+        }
+
+_OCCUPATION_BUFFER_FIELDS = ('materiel_sortie_avant_heures', 'materiel_retour_apres_heures')
+
+def _buffers_depuis_connexion(connection):
+    """Buffers logistiques lus directement sur la connexion (utilisable pendant un flush)."""
+    table = ParametresEntreprise.__table__
+    row = connection.execute(
+        select(*[table.c[name] for name in _OCCUPATION_BUFFER_FIELDS]).limit(1)
+    ).first()
+    if row is None:
+        return DEFAULT_MATERIEL_SORTIE_AVANT_HEURES, DEFAULT_MATERIEL_RETOUR_APRES_HEURES
+    return _get_materiel_logistique_buffers(row)
+
+def _lignes_occupation_prestations(connection, prestation_ids, sortie_avant_h, retour_apres_h):
+    mp = MaterielPresta.__table__
+    p = Prestation.__table__
+    sm = SoldeMaterielPrestation.__table__
+    stmt = select(
+        mp.c.materiel_id, mp.c.quantite, p.c.id, p.c.client, p.c.statut,
+        p.c.date_debut, p.c.date_fin, p.c.heure_debut, p.c.heure_fin
+    ).select_from(mp.join(p, mp.c.prestation_id == p.c.id)).where(
+        p.c.statut.in_(PRESTATION_STATUTS_ACTIFS + PRESTATION_STATUTS_CLOS)
+    )
+    if prestation_ids is not None:
+        stmt = stmt.where(p.c.id.in_(prestation_ids))
+    assignations = connection.execute(stmt).all()
+
+    closes = {row.id for row in assignations if row.statut in PRESTATION_STATUTS_CLOS}
+    restants = {}
+    if closes:
+        soldes = connection.execute(
+            select(sm.c.prestation_id, sm.c.materiel_id, (sm.c.quantite_sortie - sm.c.quantite_retour).label('restant'))
+            .where(sm.c.prestation_id.in_(closes))
+        ).all()
+        restants = {(row.prestation_id, row.materiel_id): int(row.restant or 0) for row in soldes}
+
+    lignes = []
+    for row in assignations:
+        start_dt, end_dt = _fenetre_demandee(row.date_debut, row.date_fin, row.heure_debut, row.heure_fin)
+        if not start_dt or not end_dt:
+            continue
+        base = {
+            'materiel_id': row.materiel_id,
+            'prestation_id': row.id,
+            'reservation_id': None,
+            'libelle': row.client,
+            'date_reference': row.date_debut,
+            'heure_libelle': f"{row.heure_debut} - {row.heure_fin}",
+        }
+        if row.statut in PRESTATION_STATUTS_ACTIFS:
+            lignes.append(dict(
+                base,
+                source_type='prestation',
+                debut=start_dt - timedelta(hours=sortie_avant_h),
+                fin=end_dt + timedelta(hours=retour_apres_h),
+                quantite=row.quantite
+            ))
+            continue
+        restant = restants.get((row.id, row.materiel_id), 0)
+        if restant > 0:
+            lignes.append(dict(
+                base,
+                source_type='retour_manquant',
+                debut=end_dt,
+                fin=end_dt + timedelta(days=RETOUR_MANQUANT_BLOCAGE_JOURS),
+                quantite=restant
+            ))
+    return lignes
+
+def _lignes_occupation_reservations(connection, reservation_ids, sortie_avant_h, retour_apres_h):
+    mp = MaterielPresta.__table__
+    r = ReservationClient.__table__
+    stmt = select(
+        mp.c.materiel_id, mp.c.quantite, r.c.id, r.c.nom,
+        r.c.date_souhaitee, r.c.heure_souhaitee, r.c.duree_heures
+    ).select_from(mp.join(r, mp.c.reservation_id == r.c.id)).where(
+        r.c.statut.in_(list(RESERVATION_STATUTS_BLOQUANTS))
+    )
+    if reservation_ids is not None:
+        stmt = stmt.where(r.c.id.in_(reservation_ids))
+    lignes = []
+    for row in connection.execute(stmt).all():
+        if not row.date_souhaitee:
+            continue
+        date_fin_res, heure_fin_res = compute_reservation_end(
+            row.date_souhaitee, row.heure_souhaitee, row.duree_heures
+        )
+        start_dt, end_dt = _fenetre_demandee(row.date_souhaitee, date_fin_res, row.heure_souhaitee, heure_fin_res)
+        if not start_dt or not end_dt:
+            continue
+        lignes.append({
+            'materiel_id': row.materiel_id,
+            'source_type': 'reservation',
+            'prestation_id': None,
+            'reservation_id': row.id,
+            'debut': start_dt - timedelta(hours=sortie_avant_h),
+            'fin': end_dt + timedelta(hours=retour_apres_h),
+            'quantite': row.quantite,
+            'libelle': row.nom,
+            'date_reference': row.date_souhaitee,
+            'heure_libelle': row.heure_souhaitee.strftime('%H:%M') if row.heure_souhaitee else 'Non précisée',
+        })
+    return lignes
+
+def _reconstruire_occupations(connection, prestation_ids=(), reservation_ids=(), materiel_ids=(), tout=False):
+    """Recalcule les occupations des sources indiquées (ou de toute la table si tout=True)."""
+    table = MaterielOccupation.__table__
+    sortie_avant_h, retour_apres_h = _buffers_depuis_connexion(connection)
+    if tout:
+        connection.execute(table.delete())
+        lignes = _lignes_occupation_prestations(connection, None, sortie_avant_h, retour_apres_h)
+        lignes += _lignes_occupation_reservations(connection, None, sortie_avant_h, retour_apres_h)
+        touches = None
+    else:
+        prestation_ids = list(prestation_ids or [])
+        reservation_ids = list(reservation_ids or [])
+        lignes = []
+        touches = set(materiel_ids or ())
+        conditions = []
+        if prestation_ids:
+            conditions.append(table.c.prestation_id.in_(prestation_ids))
+        if reservation_ids:
+            conditions.append(table.c.reservation_id.in_(reservation_ids))
+        if conditions:
+            touches.update(connection.execute(
+                select(table.c.materiel_id).where(or_(*conditions)).distinct()
+            ).scalars())
+        if materiel_ids:
+            connection.execute(table.delete().where(table.c.materiel_id.in_(list(materiel_ids))))
+        if prestation_ids:
+            connection.execute(table.delete().where(table.c.prestation_id.in_(prestation_ids)))
+            lignes += _lignes_occupation_prestations(connection, prestation_ids, sortie_avant_h, retour_apres_h)
+        if reservation_ids:
+            connection.execute(table.delete().where(table.c.reservation_id.in_(reservation_ids)))
+            lignes += _lignes_occupation_reservations(connection, reservation_ids, sortie_avant_h, retour_apres_h)
+        touches.update(ligne['materiel_id'] for ligne in lignes)
+    if lignes:
+        connection.execute(table.insert(), lignes)
+    _marquer_disponibilites_modifiees(touches)
+    return len(lignes)
+
+def reconstruire_occupations_materiel():
+    """Reconstruit entièrement la timeline d'occupation depuis les données sources."""
+    count = _reconstruire_occupations(db.session.connection(), tout=True)
+    db.session.commit()
+    return count
+
+def _historique_valeurs(obj, attr):
+    """Valeurs courante et précédentes d'un attribut (avant reset de l'historique)."""
+    valeurs = {getattr(obj, attr, None)}
+    try:
+        valeurs.update(sa_inspect(obj).attrs[attr].history.deleted or ())
+    except Exception:
+        pass
+    return {v for v in valeurs if v is not None}
+
+def _collecter_sources_occupation(objets):
+    prestation_ids, reservation_ids, materiel_ids = set(), set(), set()
+    tout = False
+    for obj in objets:
+        if isinstance(obj, Prestation):
+            prestation_ids.update(_historique_valeurs(obj, 'id'))
+        elif isinstance(obj, ReservationClient):
+            reservation_ids.update(_historique_valeurs(obj, 'id'))
+        elif isinstance(obj, (MaterielPresta, MouvementMateriel)):
+            prestation_ids.update(_historique_valeurs(obj, 'prestation_id'))
+            if isinstance(obj, MaterielPresta):
+                reservation_ids.update(_historique_valeurs(obj, 'reservation_id'))
+        elif isinstance(obj, ParametresEntreprise):
+            state = sa_inspect(obj)
+            if any(state.attrs[name].history.has_changes() for name in _OCCUPATION_BUFFER_FIELDS):
+                tout = True
+    return prestation_ids, reservation_ids, materiel_ids, tout
+
+@event.listens_for(db.session, "after_flush")
+def _maj_occupations_apres_flush(session, flush_context):
+    # Pas de capture d'erreur : une timeline non mise à jour fausserait les contrôles de
+    # disponibilité, l'échec fait échouer le flush (et donc la transaction)
+    objets = list(session.new) + list(session.dirty) + list(session.deleted)
+    prestation_ids, reservation_ids, materiel_ids, tout = _collecter_sources_occupation(objets)
+    materiel_ids.update(obj.id for obj in session.deleted if isinstance(obj, Materiel) and obj.id)
+    if tout or prestation_ids or reservation_ids or materiel_ids:
+        _reconstruire_occupations(
+            session.connection(), prestation_ids, reservation_ids, materiel_ids, tout=tout
+        )
+
+_OCCUPATION_SOURCE_COLUMNS = {
+    'Prestation': (('id', 'prestation'),),
+    'ReservationClient': (('id', 'reservation'),),
+    'MaterielPresta': (('prestation_id', 'prestation'), ('reservation_id', 'reservation')),
+    'MouvementMateriel': (('prestation_id', 'prestation'),),
+}
+
+@event.listens_for(db.session, "do_orm_execute")
+def _maj_occupations_apres_bulk(orm_execute_state):
+    """Couvre les Query.update()/delete() en masse, qui ne passent pas par le flush."""
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return None
+    mapper = orm_execute_state.bind_mapper
+    colonnes = _OCCUPATION_SOURCE_COLUMNS.get(mapper.class_.__name__) if mapper else None
+    if not colonnes:
+        return None
+    session = orm_execute_state.session
+    model = mapper.class_
+    sources = {'prestation': set(), 'reservation': set()}
+    soldes = set()
+    tout = False
+    try:
+        stmt = select(*[getattr(model, name) for name, _ in colonnes])
+        whereclause = orm_execute_state.statement.whereclause
+        if whereclause is not None:
+            stmt = stmt.where(whereclause)
+        for row in session.connection().execute(stmt):
+            for (_, source), value in zip(colonnes, row):
+                if value is not None:
+                    sources[source].add(value)
+        if model is MouvementMateriel:
+            # Les soldes de mouvements sont aussi maintenus hors flush
+            stmt = select(model.prestation_id, model.materiel_id).distinct()
+            if whereclause is not None:
+                stmt = stmt.where(whereclause)
+            soldes = {tuple(row) for row in session.connection().execute(stmt)}
+    except Exception as e:
+        # Lignes visées inconnues (critère non rejouable en SELECT) : reconstruction complète
+        logger.warning(f"Collecte occupations (bulk) impossible, reconstruction complète: {e}")
+        tout = True
+    result = orm_execute_state.invoke_statement()
+    # Les erreurs de mise à jour remontent : la transaction de l'appelant échoue plutôt que de
+    # laisser la timeline (et les contrôles de disponibilité) désynchronisés
+    for prestation_id, materiel_id in soldes:
+        _recalculer_solde(session.connection(), prestation_id, materiel_id)
+    if tout or sources['prestation'] or sources['reservation']:
+        _reconstruire_occupations(session.connection(), sources['prestation'], sources['reservation'], tout=tout)
+    return result
+
+
+# ==================== CACHE GÉOCODAGE ====================
+
+class GeocodeCache(db.Model):
+    """Résultat de géocodage mémorisé par adresse normalisée (positif ou introuvable)."""
+    __tablename__ = 'geocode_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    cle = db.Column(db.String(255), unique=True, nullable=False)
+    adresse = db.Column(db.String(500))
+    trouve = db.Column(db.Boolean, nullable=False, default=True)
+    lat = db.Column(db.Float)
+    lng = db.Column(db.Float)
+    formatted = db.Column(db.String(500))
+    provider = db.Column(db.String(30))
+    erreur = db.Column(db.String(255))
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_used_at = db.Column(db.DateTime, default=utcnow, index=True)
+
+
+class DistanceCache(db.Model):
+    """Distance/durée routière mémorisée entre deux points arrondis ("lat,lng")."""
+    __tablename__ = 'distance_matrix'
+
+    id = db.Column(db.Integer, primary_key=True)
+    origine = db.Column(db.String(32), nullable=False)
+    destination = db.Column(db.String(32), nullable=False)
+    distance_km = db.Column(db.Float, nullable=False)
+    duree_min = db.Column(db.Float)
+    distance_air_km = db.Column(db.Float)  # vol d'oiseau, pour calibrer le facteur de détour
+    created_at = db.Column(db.DateTime, default=utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('origine', 'destination', name='uix_distance_matrix_couple'),
+    )
+
+
+# ==================== COORDONNÉES STOCKÉES (GÉOCODAGE DIFFÉRÉ) ====================
+
+# Les coordonnées des locaux, clients et lieux de prestation sont stockées en base.
+# Un changement d'adresse les remet à 'a_faire' ; un thread de fond les géocode
+# hors requête, de sorte que les calculs de distance ne lisent que des colonnes.
+GEOCODE_A_FAIRE = 'a_faire'
+GEOCODE_OK = 'ok'
+GEOCODE_INTROUVABLE = 'introuvable'
+GEOCODE_ERREUR = 'erreur'
+
+# Modèle -> (adresse, latitude, longitude, statut, horodatage)
+GEOCODAGE_CIBLES = {
+    Local: ('adresse', 'adresse_lat', 'adresse_lng', 'adresse_geocode_statut', 'adresse_geocoded_at'),
+    Client: ('adresse', 'adresse_lat', 'adresse_lng', 'adresse_geocode_statut', 'adresse_geocoded_at'),
+    Prestation: ('lieu', 'lieu_lat', 'lieu_lng', 'lieu_geocode_statut', 'lieu_geocoded_at'),
+}
+
+_geocodage_evenement = threading.Event()
+_geocodage_thread = None
+_geocodage_stop = threading.Event()
+
+def coordonnees_stockees(obj):
+    """(lat, lng) déjà géocodées pour un Local, Client ou Prestation, sinon None."""
+    if obj is None:
+        return None
+    _, col_lat, col_lng, _, _ = GEOCODAGE_CIBLES[type(obj)]
+    lat, lng = getattr(obj, col_lat), getattr(obj, col_lng)
+    if lat is None or lng is None:
+        return None
+    return float(lat), float(lng)
+
+def _marquer_adresse(mapper, connection, target, insertion):
+    col_adresse, col_lat, col_lng, col_statut, col_date = GEOCODAGE_CIBLES[type(target)]
+    etat = sa_inspect(target)
+    if not insertion and not etat.attrs[col_adresse].history.has_changes():
+        return
+    if getattr(target, col_lat) is not None and getattr(target, col_lng) is not None and (
+        insertion or etat.attrs[col_lat].history.has_changes()
+    ):
+        # Coordonnées fournies avec l'adresse (validation à la saisie)
+        setattr(target, col_statut, GEOCODE_OK)
+        return
+    setattr(target, col_lat, None)
+    setattr(target, col_lng, None)
+    setattr(target, col_date, None)
+    if isinstance(target, Prestation):
+        target.lieu_formatted = None
+        target.distance_km = None
+        target.distance_source = None
+        target.indemnite_km = None
+    if not normalize_whitespace(getattr(target, col_adresse)):
+        setattr(target, col_statut, None)
+        return
+    setattr(target, col_statut, GEOCODE_A_FAIRE)
+    if etat.session is not None:
+        etat.session.info['geocodage_en_attente'] = True
+
+for _modele in GEOCODAGE_CIBLES:
+    event.listen(_modele, 'before_insert', lambda m, c, t: _marquer_adresse(m, c, t, True))
+    event.listen(_modele, 'before_update', lambda m, c, t: _marquer_adresse(m, c, t, False))
+
+@event.listens_for(db.session, "after_commit")
+def _reveiller_geocodage_apres_commit(session):
+    if session.info.pop('geocodage_en_attente', False):
+        _geocodage_evenement.set()
+
+@event.listens_for(db.session, "after_rollback")
+def _annuler_reveil_geocodage(session):
+    session.info.pop('geocodage_en_attente', None)
+
+def backfill_statuts_geocodage(modele):
+    """Initialise le statut de géocodage des lignes existantes (idempotent)."""
+    col_adresse, col_lat, _, col_statut, _ = GEOCODAGE_CIBLES[modele]
+    table = modele.__table__
+    db.session.execute(table.update().where(
+        table.c[col_statut].is_(None), table.c[col_lat].isnot(None)
+    ).values({col_statut: GEOCODE_OK}))
+    db.session.execute(table.update().where(
+        table.c[col_statut].is_(None), table.c[col_lat].is_(None),
+        table.c[col_adresse].isnot(None), table.c[col_adresse] != ''
+    ).values({col_statut: GEOCODE_A_FAIRE}))
+    db.session.commit()
+
+def geocoder_adresses_en_attente(limite=50, arret=None):
+    """
+    Géocode un lot d'adresses en attente (ou en erreur depuis GEOCODE_JOB_RETRY secondes).
+
+    Les appels réseau (géocodage, distance) sont faits hors transaction d'écriture ;
+    chaque ligne est ensuite mise à jour et validée seule. Les mises à jour sont
+    conditionnées à l'adresse lue : une adresse modifiée pendant le géocodage
+    reste en attente pour le tour suivant.
+
+    Args:
+        limite: nombre maximal de lignes par type d'entité
+        arret: fonction consultée entre deux lignes ; le lot s'interrompt si elle retourne True
+
+    Returns:
+        int: nombre de lignes traitées
+    """
+    parametres = get_parametres_entreprise()
+    contact_email = parametres.email if parametres else None
+    company_coords = None
+    reessai_avant = utcnow() - timedelta(seconds=app.config.get('GEOCODE_JOB_RETRY', 3600))
+    traites = 0
+    for modele, (col_adresse, col_lat, col_lng, col_statut, col_date) in GEOCODAGE_CIBLES.items():
+        table = modele.__table__
+        lignes = db.session.execute(
+            select(table.c.id, table.c[col_adresse]).where(or_(
+                table.c[col_statut] == GEOCODE_A_FAIRE,
+                and_(table.c[col_statut] == GEOCODE_ERREUR, table.c[col_date] < reessai_avant)
+            )).limit(limite)
+        ).all()
+        db.session.commit()
+        for ligne_id, adresse in lignes:
+            if arret is not None and arret():
+                return traites
+            geo, err = geocode_address(adresse, contact_email=contact_email)
+            valeurs = {col_date: utcnow()}
+            if geo:
+                valeurs.update({col_lat: geo['lat'], col_lng: geo['lng'], col_statut: GEOCODE_OK})
+                if modele is Prestation:
+                    valeurs['lieu_formatted'] = geo.get('formatted') or adresse
+                    if company_coords is None:
+                        company_coords = get_company_coordinates(parametres) or ()
+                    if company_coords:
+                        distance_km, distance_source = compute_distance_km(
+                            company_coords[0], company_coords[1], geo['lat'], geo['lng']
+                        )
+                        valeurs.update({
+                            'distance_km': distance_km,
+                            'distance_source': distance_source,
+                            'indemnite_km': compute_indemnite_km(distance_km, parametres),
+                        })
+            else:
+                valeurs[col_statut] = GEOCODE_ERREUR if err == GEOCODE_ERREUR_RESEAU else GEOCODE_INTROUVABLE
+            db.session.execute(
+                table.update().where(table.c.id == ligne_id, table.c[col_adresse] == adresse).values(valeurs)
+            )
+            db.session.commit()
+            traites += 1
+    return traites
+
+def _geocodage_autorise(base):
+    """Le job tourne tant que l'application n'est pas en test, que la validation
+    d'adresse est active et que la base n'a pas changé depuis son démarrage."""
+    return (
+        not app.config.get('TESTING')
+        and app.config.get('ADDRESS_VALIDATION_ENABLED')
+        and app.config.get('DB_READY')
+        and app.config.get('SQLALCHEMY_DATABASE_URI') == base
+    )
+
+def start_geocoding_service():
+    global _geocodage_thread
+    base = app.config.get('SQLALCHEMY_DATABASE_URI')
+    if not _geocodage_autorise(base):
+        return
+    if _geocodage_thread and _geocodage_thread.is_alive():
+        return
+    def _arret():
+        return _geocodage_stop.is_set() or not _geocodage_autorise(base)
+    def _loop():
+        while not _arret():
+            _geocodage_evenement.clear()
+            try:
+                with app.app_context():
+                    traites = geocoder_adresses_en_attente(arret=_arret)
+                if traites:
+                    continue
+            except Exception as e:
+                logger.warning(f"Geocoding job error: {e}")
+            _geocodage_evenement.wait(app.config.get('GEOCODE_JOB_INTERVAL', 300))
+    _geocodage_stop.clear()
+    _geocodage_thread = threading.Thread(target=_loop, daemon=True)
+    _geocodage_thread.start()
+
+def stop_geocoding_service(timeout=10):
+    """Arrête le job de géocodage et attend la fin de la ligne en cours."""
+    global _geocodage_thread
+    _geocodage_stop.set()
+    _geocodage_evenement.set()
+    thread = _geocodage_thread
+    if thread and thread.is_alive() and thread is not threading.current_thread():
+        thread.join(timeout)
+    _geocodage_thread = None
+
+
+# ==================== SYNCHRONISATION OFFLINE ====================
+
+class SyncConfig(db.Model):
+    __tablename__ = 'sync_config'
+
+    id = db.Column(db.Integer, primary_key=True)
+    enabled = db.Column(db.Boolean, default=False)
+    server_url = db.Column(db.String(255))
+    auth_url = db.Column(db.String(255))
+    token_url = db.Column(db.String(255))
+    client_id = db.Column(db.String(255))
+    client_secret = db.Column(db.String(255))
+    scopes = db.Column(db.String(500))
+    access_token = db.Column(db.Text)
+    refresh_token = db.Column(db.Text)
+    token_expires_at = db.Column(db.DateTime)
+    device_id = db.Column(db.String(64))
+    sync_interval_seconds = db.Column(db.Integer, default=20)
+    pull_cursor = db.Column(db.Integer, default=0)  # dernier changement serveur reçu (GET /api/sync/pull)
+    log_purged_through = db.Column(db.Integer)  # serveur : dernière suppression effacée du journal (rétention)
+    last_sync_at = db.Column(db.DateTime)
+    last_success_at = db.Column(db.DateTime)
     last_sync_status = db.Column(db.String(20))
     last_sync_error = db.Column(db.Text)
 
 class SyncChangeLog(db.Model):
     __tablename__ = 'sync_change_log'
+    __table_args__ = (
+        db.Index('ix_sync_change_log_changed_at', 'changed_at'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     entity_type = db.Column(db.String(64), nullable=False)
@@ -2674,6 +4119,7 @@ class SyncChangeLog(db.Model):
     payload = db.Column(db.Text)
     status = db.Column(db.String(20), default='pending')
     sent_at = db.Column(db.DateTime)
+    push_attempted_at = db.Column(db.DateTime)  # premier envoi tenté : le serveur a pu le recevoir sans acquittement
     error = db.Column(db.Text)
 
 class SyncConflict(db.Model):
@@ -2690,10 +4136,14 @@ class SyncConflict(db.Model):
 
 class SyncIncomingLog(db.Model):
     __tablename__ = 'sync_incoming_log'
+    __table_args__ = (
+        db.Index('ix_sync_incoming_device_change', 'device_id', 'change_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     received_at = db.Column(db.DateTime, default=utcnow, nullable=False)
     device_id = db.Column(db.String(64))
+    change_id = db.Column(db.Integer)  # identifiant du changement sur l'appareil émetteur (dédoublonnage)
     entity_type = db.Column(db.String(64))
     entity_id = db.Column(db.Integer)
     operation = db.Column(db.String(10))
@@ -2701,7 +4151,22 @@ class SyncIncomingLog(db.Model):
     status = db.Column(db.String(20), default='received')
     error = db.Column(db.Text)
 
-SYNC_EXCLUDED_MODELS = {'AuditLog', 'SyncConfig', 'SyncChangeLog', 'SyncConflict', 'SyncIncomingLog'}
+class SyncBaseVersion(db.Model):
+    """Dernier état d'une entité connu du serveur central (base des fusions à trois voies)."""
+    __tablename__ = 'sync_base_versions'
+    __table_args__ = (
+        db.UniqueConstraint('entity_type', 'entity_id', name='uq_sync_base_entity'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    entity_type = db.Column(db.String(64), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, default=utcnow, nullable=False)
+
+SYNC_EXCLUDED_MODELS = {
+    'AuditLog', 'SyncConfig', 'SyncChangeLog', 'SyncConflict', 'SyncIncomingLog', 'SyncBaseVersion'
+}
 SYNC_EXCLUDED_FIELDS = {'password_hash'}
 SYNC_EXCLUDED_FIELD_SUBSTRINGS = ('password', 'token', 'secret')
 
@@ -2722,6 +4187,27 @@ def _serialize_value(value):
             return value.hex()
     return value
 
+def _deserialize_value(column, value):
+    """Valeur d'un payload de synchronisation convertie vers le type de la colonne."""
+    if value is None:
+        return None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if isinstance(value, str):
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if python_type is date:
+            return date.fromisoformat(value[:10])
+        if python_type is time:
+            return time.fromisoformat(value)
+    if python_type is bool:
+        return bool(value)
+    if python_type is Decimal:
+        return Decimal(str(value))
+    return value
+
 def _model_to_payload(target):
     payload = {}
     for column in target.__table__.columns:
@@ -2739,46 +4225,130 @@ def _get_request_user_id():
         return session.get('user_id')
     return None
 
-def _log_sync_change(connection, target, operation, changed_fields=None):
+# Changements appliqués depuis la synchronisation : journalisés au nom de l'appareil
+# d'origine (serveur central), ou pas du tout (appareil qui reçoit un pull)
+_sync_capture = contextvars.ContextVar('sync_capture', default=None)
+_SYNC_SANS_JOURNAL = object()
+
+# Capture par session : chaque flush ajoute au tampon de la session les colonnes
+# modifiées (valeurs brutes) ; le journal est sérialisé et écrit en une seule
+# insertion groupée à before_commit. Un point de sauvegarde annulé retire ses
+# changements du tampon, une transaction annulée le vide.
+_SYNC_TAMPON = 'sync_tampon'
+_SYNC_MARQUES = 'sync_marques'
+_sync_colonnes = {}
+
+def _colonnes_sync(mapper):
+    """{attribut: colonne} des colonnes journalisées d'un modèle (calculé une fois par modèle)."""
+    colonnes = _sync_colonnes.get(mapper.class_)
+    if colonnes is None:
+        colonnes = {
+            prop.key: prop.columns[0].name
+            for prop in mapper.column_attrs
+            if not _should_exclude_field(prop.columns[0].name)
+        }
+        _sync_colonnes[mapper.class_] = colonnes
+    return colonnes
+
+def _log_sync_change(mapper, target, operation):
     if target.__class__.__name__ in SYNC_EXCLUDED_MODELS:
         return
-    try:
-        payload = _model_to_payload(target)
-        payload_json = json.dumps(payload, ensure_ascii=True, default=str)
-        fields_json = json.dumps(changed_fields or [], ensure_ascii=True, default=str)
-        device_id = get_device_id()
-        user_id = _get_request_user_id()
-        insert_stmt = SyncChangeLog.__table__.insert().values(
-            entity_type=target.__class__.__name__,
-            entity_id=getattr(target, 'id', None),
-            operation=operation,
-            changed_at=utcnow(),
-            user_id=user_id,
-            device_id=device_id,
-            changed_fields=fields_json,
-            payload=payload_json,
-            status='pending'
-        )
-        connection.execute(insert_stmt)
-    except Exception as e:
-        logger.warning(f"Sync log error: {e}")
+    origine = _sync_capture.get()
+    if origine is _SYNC_SANS_JOURNAL:
+        return
+    state = sa_inspect(target)
+    if state.session is None:
+        return
+    colonnes = _colonnes_sync(mapper)
+    if operation == 'update':
+        champs = [cle for cle in state.committed_state if cle in colonnes]
+        if not champs:
+            return
+        cles = champs if 'id' in champs else ['id'] + champs
+    elif operation == 'delete':
+        champs, cles = [], ['id']
+    else:
+        champs, cles = [], colonnes
+    valeurs = state.dict
+    state.session.info.setdefault(_SYNC_TAMPON, []).append((
+        target.__class__.__name__,
+        valeurs.get('id'),
+        operation,
+        utcnow(),
+        origine,
+        [colonnes[cle] for cle in champs],
+        {colonnes[cle]: valeurs.get(cle) for cle in cles if cle in colonnes},
+    ))
 
 def _on_after_insert(mapper, connection, target):
-    _log_sync_change(connection, target, 'insert')
+    _log_sync_change(mapper, target, 'insert')
 
 def _on_after_update(mapper, connection, target):
-    try:
-        state = sa_inspect(target)
-        changed_fields = [
-            attr.key for attr in state.attrs
-            if attr.history.has_changes()
-        ]
-    except Exception:
-        changed_fields = []
-    _log_sync_change(connection, target, 'update', changed_fields=changed_fields)
+    _log_sync_change(mapper, target, 'update')
 
 def _on_after_delete(mapper, connection, target):
-    _log_sync_change(connection, target, 'delete')
+    _log_sync_change(mapper, target, 'delete')
+
+@event.listens_for(db.session, "before_commit")
+def _ecrire_journal_sync(session):
+    if session.get_nested_transaction() is not None:
+        return
+    # Le dernier flush a lieu après before_commit : il est déclenché ici pour être capturé
+    session.flush()
+    tampon = session.info.pop(_SYNC_TAMPON, None)
+    session.info.pop(_SYNC_MARQUES, None)
+    if not tampon:
+        return
+    # Réveille l'ordonnanceur de synchronisation une fois le commit effectif
+    session.info['sync_journal_ecrit'] = True
+    try:
+        device_id = get_device_id()
+        user_id = _get_request_user_id()
+        session.connection().execute(SyncChangeLog.__table__.insert(), [
+            {
+                'entity_type': entity_type,
+                'entity_id': entity_id,
+                'operation': operation,
+                'changed_at': changed_at,
+                'user_id': user_id,
+                'device_id': origine or device_id,
+                'changed_fields': json.dumps(champs, ensure_ascii=True),
+                'payload': json.dumps(
+                    {nom: _serialize_value(valeur) for nom, valeur in valeurs.items()},
+                    ensure_ascii=True, default=str
+                ),
+                'status': 'pending',
+            }
+            for entity_type, entity_id, operation, changed_at, origine, champs, valeurs in tampon
+        ])
+    except Exception as e:
+        logger.warning(f"Sync log error: {e}")
+
+@event.listens_for(db.session, "after_transaction_create")
+def _marquer_savepoint_sync(session, transaction):
+    if transaction.nested:
+        session.info.setdefault(_SYNC_MARQUES, {})[transaction] = len(session.info.get(_SYNC_TAMPON, ()))
+
+@event.listens_for(db.session, "after_soft_rollback")
+def _annuler_savepoint_sync(session, previous_transaction):
+    if previous_transaction.nested:
+        marque = session.info.get(_SYNC_MARQUES, {}).pop(previous_transaction, None)
+        if marque is not None and _SYNC_TAMPON in session.info:
+            del session.info[_SYNC_TAMPON][marque:]
+
+@event.listens_for(db.session, "after_transaction_end")
+def _vider_tampon_sync(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(_SYNC_TAMPON, None)
+        session.info.pop(_SYNC_MARQUES, None)
+        session.info.pop('sync_journal_ecrit', None)
+
+SYNC_TRACKED_MODELS = [
+    Local, GrilleTarifaire, User, DJ, ParametresEntreprise,
+    Devis, Facture, Paiement, ReservationClient, Materiel,
+    MouvementMateriel, MaterielPresta, Prestation, PrestationRating
+]
+SYNC_MODELES = {model.__name__: model for model in SYNC_TRACKED_MODELS}
 
 _sync_listeners_registered = False
 
@@ -2786,12 +4356,7 @@ def register_sync_listeners():
     global _sync_listeners_registered
     if _sync_listeners_registered:
         return
-    models_to_track = [
-        Local, GrilleTarifaire, User, DJ, ParametresEntreprise,
-        Devis, Facture, Paiement, ReservationClient, Materiel,
-        MouvementMateriel, MaterielPresta, Prestation, PrestationRating
-    ]
-    for model in models_to_track:
+    for model in SYNC_TRACKED_MODELS:
         event.listen(model, 'after_insert', _on_after_insert)
         event.listen(model, 'after_update', _on_after_update)
         event.listen(model, 'after_delete', _on_after_delete)
@@ -2921,11 +4486,7 @@ def _get_active_terminology_profile():
     try:
         if not app.config.get('DB_READY'):
             return 'missions'
-        if hasattr(g, 'parametres'):
-            parametres = g.parametres
-        else:
-            parametres = ParametresEntreprise.query.first()
-            g.parametres = parametres
+        parametres = get_parametres_entreprise()
         profile = (parametres.terminology_profile if parametres else '') or 'missions'
         if profile not in TERMINOLOGY_PROFILES:
             return 'missions'
@@ -3089,14 +4650,11 @@ def inject_current_user():
             csrf_token=session.get('csrf_token'),
             public_api_token=None
         )
-    if hasattr(g, 'parametres'):
-        parametres = g.parametres
-    else:
-        try:
-            parametres = ParametresEntreprise.query.first()
-        except Exception:
-            parametres = None
-        g.parametres = parametres
+    try:
+        parametres = get_parametres_entreprise()
+    except Exception:
+        parametres = None
+    g.parametres = parametres
     return dict(
         current_user=get_current_user(),
         parametres=parametres,
@@ -3155,29 +4713,10 @@ def update_all_materiels_status():
     for materiel in materiels:
         update_materiel_status(materiel.id)
 
-def get_materiel_status_at_time(materiel_id, date, heure_debut, heure_fin):
-    """Détermine le statut d'un matériel à une date et heure spécifiques"""
-    materiel = db.session.get(Materiel, materiel_id)
-    if not materiel:
-        return 'indisponible'
-    
-    # Si le matériel est en maintenance, hors service ou archivé
-    if materiel.statut == 'maintenance':
-        return 'maintenance'
-    if materiel.statut == 'hors_service':
-        return 'hors_service'
-    if materiel.statut == 'archive':
-        return 'archive'
-
-    dispo = verifier_disponibilite_materiel(
-        materiel_id=materiel_id,
-        quantite_demandee=1,
-        date_debut=date,
-        date_fin=date,
-        heure_debut=heure_debut,
-        heure_fin=heure_fin
-    )
-    if not dispo.get('disponible'):
+def _statut_depuis_disponibilite(materiel, dispo):
+    if materiel.statut in STATUTS_MATERIEL_INDISPONIBLES:
+        return materiel.statut
+    if not dispo or not dispo.get('disponible'):
         return 'occupe'
     quantite_dispo = dispo.get('quantite_disponible', materiel.quantite)
     quantite_totale = dispo.get('quantite_totale', materiel.quantite)
@@ -3185,273 +4724,595 @@ def get_materiel_status_at_time(materiel_id, date, heure_debut, heure_fin):
         return 'partiel'
     return 'disponible'
 
-def verifier_disponibilite_materiel(materiel_id, quantite_demandee, date_debut, date_fin, 
-                                    heure_debut=None, heure_fin=None, 
-                                    exclure_prestation_id=None, exclure_reservation_id=None):
-    """
-    Vérifie si une quantité de matériel est disponible sur une période donnée
-    
-    Args:
-        materiel_id: ID du matériel
-        quantite_demandee: Quantité souhaitée
-        date_debut: Date de début de la prestation
-        date_fin: Date de fin de la prestation
-        heure_debut: Heure de début (optionnel)
-        heure_fin: Heure de fin (optionnel)
-        exclure_prestation_id: ID de prestation à exclure (pour édition)
-        exclure_reservation_id: ID de réservation à exclure (pour édition)
-    
-    Returns:
-        dict: {
-            'disponible': bool,
-            'quantite_disponible': int,
-            'quantite_totale': int,
-            'quantite_utilisee': int,
-            'conflits': list  # Liste des prestations en conflit
-        }
-    """
+def get_materiel_status_at_time(materiel_id, date, heure_debut, heure_fin):
+    """Détermine le statut d'un matériel à une date et heure spécifiques"""
     materiel = db.session.get(Materiel, materiel_id)
     if not materiel:
-        return {
-            'disponible': False,
-            'quantite_disponible': 0,
-            'quantite_totale': 0,
-            'quantite_utilisee': 0,
-            'conflits': [],
-            'erreur': 'Matériel introuvable'
-        }
-    
-    # Si le matériel est en maintenance ou hors service, non disponible
-    if materiel.statut in {'maintenance', 'hors_service', 'archive'}:
-        return {
-            'disponible': False,
-            'quantite_disponible': 0,
-            'quantite_totale': materiel.quantite,
-            'quantite_utilisee': materiel.quantite,
-            'conflits': [],
-            'erreur': f"Matériel en {materiel.statut.replace('_', ' ')}"
-        }
-    
-    try:
-        if not date_debut or not date_fin:
-            return {
-                'disponible': False,
-                'quantite_disponible': 0,
-                'quantite_totale': materiel.quantite,
-                'quantite_utilisee': 0,
-                'conflits': [],
-                'erreur': 'Dates manquantes'
-            }
+        return 'indisponible'
+    statuts = get_materiels_status_at_time([materiel], date, heure_debut, heure_fin)
+    return statuts.get(materiel.id, 'indisponible')
 
-        # Si aucune heure fournie, considérer la journée entière
-        heure_debut_effective = heure_debut or time(0, 0)
-        heure_fin_effective = heure_fin or time(23, 59)
-        req_start, req_end = _build_datetime_range(
-            date_debut, date_fin, heure_debut_effective, heure_fin_effective
-        )
-        if not req_start or not req_end:
-            return {
-                'disponible': False,
-                'quantite_disponible': 0,
-                'quantite_totale': materiel.quantite,
-                'quantite_utilisee': 0,
-                'conflits': [],
-                'erreur': 'Période invalide'
-            }
+def get_materiels_status_at_time(materiels, date, heure_debut, heure_fin):
+    """Statut de plusieurs matériels à une date/heure, calculé en une seule passe.
 
-        sortie_avant_h, retour_apres_h = _get_materiel_logistique_buffers()
+    Returns:
+        dict: {materiel_id: 'disponible' | 'partiel' | 'occupe' | 'maintenance' | ...}
+    """
+    materiels = [m for m in materiels if m is not None]
+    a_verifier = [m.id for m in materiels if m.statut not in STATUTS_MATERIEL_INDISPONIBLES]
+    disponibilites = verifier_disponibilite_materiels(
+        a_verifier, date, date, heure_debut=heure_debut, heure_fin=heure_fin
+    ) if a_verifier else {}
+    return {
+        materiel.id: _statut_depuis_disponibilite(materiel, disponibilites.get(materiel.id))
+        for materiel in materiels
+    }
 
-        # Chercher toutes les assignations qui se chevauchent avec cette période
-        # 1. Assignations à des PRESTATIONS actives
-        active_statuses = ['planifiee', 'confirmee', 'en_cours']
-        ended_statuses = ['terminee', 'annulee']
-        query_prestations = db.session.query(MaterielPresta).join(Prestation).filter(
-            MaterielPresta.materiel_id == materiel_id,
-            MaterielPresta.prestation_id.isnot(None),
-            Prestation.statut.in_(active_statuses),
-            # Chevauchement de dates
-            Prestation.date_debut <= date_fin,
-            Prestation.date_fin >= date_debut
-        )
-        
-        if exclure_prestation_id:
-            query_prestations = query_prestations.filter(MaterielPresta.prestation_id != exclure_prestation_id)
-        
-        assignations_prestations = query_prestations.all()
+STATUTS_AFFICHAGE_LOCAL = ('disponible', 'partiel', 'occupe', 'maintenance', 'hors_service', 'archive')
 
-        # 1bis. Prestations terminées/annulées avec retours manquants
-        query_prestations_ended = db.session.query(MaterielPresta).join(Prestation).filter(
-            MaterielPresta.materiel_id == materiel_id,
-            MaterielPresta.prestation_id.isnot(None),
-            Prestation.statut.in_(ended_statuses)
-        )
-        if exclure_prestation_id:
-            query_prestations_ended = query_prestations_ended.filter(MaterielPresta.prestation_id != exclure_prestation_id)
-        assignations_prestations_ended = query_prestations_ended.all()
-        
-        # 2. Assignations à des RÉSERVATIONS en attente de validation DJ
-        query_reservations = db.session.query(MaterielPresta).join(ReservationClient).filter(
-            MaterielPresta.materiel_id == materiel_id,
-            MaterielPresta.reservation_id.isnot(None),
-            ReservationClient.statut.in_(list(RESERVATION_STATUTS_BLOQUANTS))
+def statut_materiels_local(local_id, now_dt=None):
+    """
+    État courant de tout le matériel d'un local, en un nombre fixe de requêtes.
+
+    Quatre requêtes quel que soit le nombre de références : matériels, occupations
+    en cours (timeline materiel_occupations), prochaine réservation par matériel et
+    soldes de mouvements. Les totaux par statut sont calculés dans la même passe.
+
+    Returns:
+        dict: {'materiels': [...], 'totaux': {...}}
+    """
+    now_dt = now_dt or datetime.now()
+    fin_fenetre = now_dt + timedelta(minutes=1)
+    occ = MaterielOccupation
+    sources_reservables = ('prestation', 'reservation')
+
+    materiels = Materiel.query.filter_by(local_id=local_id).order_by(Materiel.categorie, Materiel.nom).all()
+
+    en_cours = db.session.query(occ).join(Materiel, Materiel.id == occ.materiel_id).filter(
+        Materiel.local_id == local_id,
+        occ.debut < fin_fenetre,
+        occ.fin > now_dt
+    ).order_by(occ.debut).all()
+    occupations = defaultdict(list)
+    affectations = {}
+    for occupation in en_cours:
+        occupations[occupation.materiel_id].append(
+            (occupation.debut, occupation.fin, occupation.quantite, occupation.to_conflit())
         )
-        
-        if exclure_reservation_id:
-            query_reservations = query_reservations.filter(MaterielPresta.reservation_id != exclure_reservation_id)
-        
-        assignations_reservations = query_reservations.all()
-        
-        # Calculer la quantité maximale utilisée sur la période (concurrence)
-        events = []
-        conflits = []
-        
-        for assignation in assignations_prestations:
-            prestation = assignation.prestation
-            start_dt, end_dt = _build_datetime_range(
-                prestation.date_debut,
-                prestation.date_fin,
-                prestation.heure_debut or time(0, 0),
-                prestation.heure_fin or time(23, 59)
-            )
-            if not start_dt or not end_dt:
-                continue
-            buffer_start = start_dt - timedelta(hours=sortie_avant_h)
-            buffer_end = end_dt + timedelta(hours=retour_apres_h)
-            if buffer_end <= req_start or buffer_start >= req_end:
-                continue
+        if occupation.source_type in sources_reservables:
+            affectations.setdefault(occupation.materiel_id, occupation.libelle)
+    pics = _calculer_pics_occupation(occupations, now_dt, fin_fenetre)
+
+    prochains_debuts = db.session.query(
+        occ.materiel_id.label('materiel_id'),
+        db.func.min(occ.debut).label('debut')
+    ).join(Materiel, Materiel.id == occ.materiel_id).filter(
+        Materiel.local_id == local_id,
+        occ.source_type.in_(sources_reservables),
+        occ.debut >= fin_fenetre
+    ).group_by(occ.materiel_id).subquery()
+    prochaines = {}
+    for occupation in db.session.query(occ).join(prochains_debuts, and_(
+        occ.materiel_id == prochains_debuts.c.materiel_id,
+        occ.debut == prochains_debuts.c.debut
+    )).filter(occ.source_type.in_(sources_reservables)).order_by(occ.id).all():
+        prochaines.setdefault(occupation.materiel_id, occupation)
+
+    sm = SoldeMaterielPrestation
+    dehors = db.case((sm.quantite_sortie > sm.quantite_retour, sm.quantite_sortie - sm.quantite_retour), else_=0)
+    soldes = {
+        row.materiel_id: (int(row.dehors or 0), int(row.manquant or 0))
+        for row in db.session.query(
+            sm.materiel_id,
+            db.func.sum(dehors).label('dehors'),
+            db.func.sum(db.case((Prestation.statut.in_(PRESTATION_STATUTS_CLOS), dehors), else_=0)).label('manquant')
+        ).join(Materiel, Materiel.id == sm.materiel_id).join(
+            Prestation, Prestation.id == sm.prestation_id
+        ).filter(Materiel.local_id == local_id).group_by(sm.materiel_id).all()
+    }
 
-            overlap_start = max(buffer_start, req_start)
-            overlap_end = min(buffer_end, req_end)
-            if overlap_end <= overlap_start:
-                continue
-            events.append((overlap_start, assignation.quantite))
-            events.append((overlap_end, -assignation.quantite))
-            conflits.append({
-                'type': 'prestation',
-                'id': prestation.id,
-                'nom': prestation.client,
-                'date': prestation.date_debut,
-                'heure': f"{prestation.heure_debut} - {prestation.heure_fin}",
-                'quantite': assignation.quantite
-            })
-        
-        # Ajouter les retours manquants pour prestations terminées/annulées
-        for assignation in assignations_prestations_ended:
-            prestation = assignation.prestation
-            if not prestation:
-                continue
-            total_sortie = db.session.query(
-                db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)
-            ).filter_by(
-                materiel_id=materiel_id,
-                prestation_id=prestation.id,
-                type_mouvement='sortie'
-            ).scalar() or 0
-            total_retour = db.session.query(
-                db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)
-            ).filter_by(
-                materiel_id=materiel_id,
-                prestation_id=prestation.id,
-                type_mouvement='retour'
-            ).scalar() or 0
-            quantite_restante = total_sortie - total_retour
-            if quantite_restante <= 0:
-                continue
-            start_dt, end_dt = _build_datetime_range(
-                prestation.date_debut,
-                prestation.date_fin,
-                prestation.heure_debut or time(0, 0),
-                prestation.heure_fin or time(23, 59)
-            )
-            if not end_dt:
-                continue
-            block_start = end_dt
-            block_end = end_dt + timedelta(days=RETOUR_MANQUANT_BLOCAGE_JOURS)
-            if block_end <= req_start or block_start >= req_end:
-                continue
-            overlap_start = max(block_start, req_start)
-            overlap_end = min(block_end, req_end)
+    lignes = []
+    totaux = {statut: 0 for statut in STATUTS_AFFICHAGE_LOCAL}
+    totaux.update({'references': 0, 'quantite_totale': 0, 'quantite_utilisee': 0,
+                   'quantite_dehors': 0, 'retours_manquants': 0})
+    for materiel in materiels:
+        quantite_utilisee = pics.get(materiel.id, (0, []))[0]
+        quantite_disponible = max(0, (materiel.quantite or 0) - quantite_utilisee)
+        statut_affichage = _statut_depuis_disponibilite(materiel, {
+            'disponible': quantite_disponible >= 1,
+            'quantite_disponible': quantite_disponible,
+            'quantite_totale': materiel.quantite,
+        })
+        quantite_dehors, quantite_manquante = soldes.get(materiel.id, (0, 0))
+        prochaine = prochaines.get(materiel.id)
+        lignes.append({
+            'id': materiel.id,
+            'nom': materiel.nom,
+            'categorie': materiel.categorie,
+            'quantite': materiel.quantite,
+            'statut': materiel.statut,
+            'statut_affichage': statut_affichage,
+            'quantite_utilisee': quantite_utilisee,
+            'quantite_disponible': quantite_disponible,
+            'quantite_dehors': quantite_dehors,
+            'quantite_manquante': quantite_manquante,
+            'retour_manquant': quantite_manquante > 0,
+            'prestation': affectations.get(materiel.id),
+            'prochaine_reservation': {
+                'type': prochaine.source_type,
+                'id': prochaine.reservation_id if prochaine.source_type == 'reservation' else prochaine.prestation_id,
+                'nom': prochaine.libelle,
+                'debut': prochaine.debut.isoformat(),
+            } if prochaine else None
+        })
+        totaux[statut_affichage] = totaux.get(statut_affichage, 0) + 1
+        totaux['references'] += 1
+        totaux['quantite_totale'] += materiel.quantite or 0
+        totaux['quantite_utilisee'] += quantite_utilisee
+        totaux['quantite_dehors'] += quantite_dehors
+        totaux['retours_manquants'] += 1 if quantite_manquante > 0 else 0
+    return {'materiels': lignes, 'totaux': totaux}
+
+STATUTS_MATERIEL_INDISPONIBLES = {'maintenance', 'hors_service', 'archive'}
+PRESTATION_STATUTS_ACTIFS = ('planifiee', 'confirmee', 'en_cours')
+PRESTATION_STATUTS_CLOS = ('terminee', 'annulee')
+# Au-delà, le filtre par identifiants se fait en Python (limite de paramètres SQLite)
+BULK_IN_CLAUSE_MAX = 500
+
+def _resultat_disponibilite_erreur(quantite_totale, erreur, quantite_utilisee=0):
+    return {
+        'disponible': False,
+        'quantite_disponible': 0,
+        'quantite_totale': quantite_totale,
+        'quantite_utilisee': quantite_utilisee,
+        'conflits': [],
+        'erreur': erreur
+    }
+
+def _fenetre_demandee(date_debut, date_fin, heure_debut=None, heure_fin=None):
+    """Fenêtre datetime demandée (journée entière si aucune heure fournie)."""
+    return _build_datetime_range(
+        date_debut, date_fin, heure_debut or time(0, 0), heure_fin or time(23, 59)
+    )
+
+def _filtrer_ids(query, column, ids):
+    if ids is not None and len(ids) <= BULK_IN_CLAUSE_MAX:
+        query = query.filter(column.in_(ids))
+    return query
+
+def _charger_occupations_materiels(materiel_ids, req_start, req_end,
+                                   exclure_prestation_id=None, exclure_reservation_id=None):
+    """
+    Charge en une requête de plage indexée (table materiel_occupations) toutes les
+    occupations des matériels qui chevauchent la fenêtre [req_start, req_end[.
+
+    Sources prises en compte (buffers logistiques déjà appliqués) :
+        - assignations à des prestations actives
+        - retours manquants des prestations terminées/annulées
+        - assignations à des réservations bloquantes
+
+    Returns:
+        dict: {materiel_id: [(debut, fin, quantite, conflit), ...]}
+    """
+    ids = set(materiel_ids) if materiel_ids is not None else None
+    occupations = defaultdict(list)
+    query = MaterielOccupation.query.filter(
+        MaterielOccupation.debut < req_end,
+        MaterielOccupation.fin > req_start
+    )
+    query = _filtrer_ids(query, MaterielOccupation.materiel_id, ids)
+    if exclure_prestation_id:
+        query = query.filter(or_(
+            MaterielOccupation.prestation_id.is_(None),
+            MaterielOccupation.prestation_id != exclure_prestation_id
+        ))
+    if exclure_reservation_id:
+        query = query.filter(or_(
+            MaterielOccupation.reservation_id.is_(None),
+            MaterielOccupation.reservation_id != exclure_reservation_id
+        ))
+    for occupation in query.all():
+        if ids is not None and occupation.materiel_id not in ids:
+            continue
+        occupations[occupation.materiel_id].append(
+            (occupation.debut, occupation.fin, occupation.quantite, occupation.to_conflit())
+        )
+    return occupations
+
+def _calculer_pics_occupation(occupations, req_start, req_end):
+    """
+    Calcule en un seul balayage le pic de concurrence de chaque matériel sur la fenêtre.
+
+    Returns:
+        dict: {materiel_id: (quantite_max, conflits)}
+    """
+    events = []
+    conflits = defaultdict(list)
+    for materiel_id, intervalles in occupations.items():
+        for debut, fin, quantite, conflit in intervalles:
+            overlap_start = max(debut, req_start)
+            overlap_end = min(fin, req_end)
             if overlap_end <= overlap_start:
                 continue
-            events.append((overlap_start, quantite_restante))
-            events.append((overlap_end, -quantite_restante))
-            conflits.append({
-                'type': 'retour_manquant',
-                'id': prestation.id,
-                'nom': prestation.client,
-                'date': prestation.date_debut,
-                'heure': f"{prestation.heure_debut} - {prestation.heure_fin}",
-                'quantite': quantite_restante
-            })
+            # Les fins passent avant les débuts à instant égal (intervalles semi-ouverts)
+            events.append((materiel_id, overlap_start, 1, quantite))
+            events.append((materiel_id, overlap_end, 0, -quantite))
+            conflits[materiel_id].append(conflit)
+
+    events.sort(key=lambda item: (item[0], item[1], item[2]))
+    pics = {}
+    courant_id = None
+    quantite_utilisee = 0
+    for materiel_id, _, _, delta in events:
+        if materiel_id != courant_id:
+            courant_id = materiel_id
+            quantite_utilisee = 0
+        quantite_utilisee += delta
+        if quantite_utilisee > pics.get(materiel_id, 0):
+            pics[materiel_id] = quantite_utilisee
+    return {mid: (pics.get(mid, 0), conflits[mid]) for mid in conflits}
+
+# Cache versionné des pics d'occupation : clé (matériel, fenêtre, exclusions), valeur
+# estampillée par la version du matériel. Toute reconstruction de la timeline
+# incrémente la version (au flush, puis de nouveau au commit/rollback), une
+# réponse calculée avant un changement n'est donc jamais resservie.
+_dispo_cache = OrderedDict()
+_dispo_cache_lock = threading.Lock()
+_dispo_versions = defaultdict(int)
+_dispo_version_globale = 0
+_dispo_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+def _versions_disponibilite(materiel_ids):
+    with _dispo_cache_lock:
+        return {mid: (_dispo_version_globale, _dispo_versions[mid]) for mid in materiel_ids}
+
+def invalider_cache_disponibilite(materiel_ids=None):
+    """Incrémente la version des matériels indiqués (tous si None)."""
+    global _dispo_version_globale
+    with _dispo_cache_lock:
+        if materiel_ids is None:
+            _dispo_version_globale += 1
+            _dispo_cache.clear()
+        else:
+            for mid in materiel_ids:
+                _dispo_versions[mid] += 1
+        _dispo_cache_stats['invalidations'] += 1
 
-        # Ajouter les réservations en attente
-        for assignation in assignations_reservations:
-            reservation = assignation.reservation
-            if not reservation or not reservation.date_souhaitee:
-                continue
-            date_fin_res, heure_fin_res = compute_reservation_end(
-                reservation.date_souhaitee,
-                reservation.heure_souhaitee,
-                reservation.duree_heures
-            )
-            start_dt, end_dt = _build_datetime_range(
-                reservation.date_souhaitee,
-                date_fin_res,
-                reservation.heure_souhaitee or time(0, 0),
-                heure_fin_res or time(23, 59)
+def _marquer_disponibilites_modifiees(materiel_ids):
+    """Invalide immédiatement et mémorise les matériels pour ré-invalider à la fin de la transaction."""
+    if materiel_ids is not None and not materiel_ids:
+        return
+    invalider_cache_disponibilite(materiel_ids)
+    try:
+        en_attente = db.session.info.setdefault('dispo_cache_materiels', set())
+        if materiel_ids is None:
+            db.session.info['dispo_cache_tout'] = True
+        else:
+            en_attente.update(materiel_ids)
+    except Exception:
+        pass
+
+def _finaliser_invalidation_disponibilite(session):
+    materiel_ids = session.info.pop('dispo_cache_materiels', None)
+    if session.info.pop('dispo_cache_tout', False):
+        invalider_cache_disponibilite()
+    elif materiel_ids:
+        invalider_cache_disponibilite(materiel_ids)
+
+@event.listens_for(db.session, "after_commit")
+def _invalider_disponibilites_apres_commit(session):
+    tout = session.info.get('dispo_cache_tout', False)
+    materiel_ids = set(session.info.get('dispo_cache_materiels') or ())
+    materiel_ids |= session.info.pop('dispo_stream_materiels', set())
+    _finaliser_invalidation_disponibilite(session)
+    if _dispo_stream_abonnes and (tout or materiel_ids):
+        _publier_changements_disponibilite(None if tout else materiel_ids)
+
+@event.listens_for(db.session, "after_rollback")
+def _invalider_disponibilites_apres_rollback(session):
+    session.info.pop('dispo_stream_materiels', None)
+    _finaliser_invalidation_disponibilite(session)
+
+def _cache_disponibilite_actif():
+    """
+    Cache utilisable par la session courante : pas si elle a modifié la timeline
+    sans valider, ses calculs voient des occupations qui peuvent être annulées.
+    """
+    if app.config.get('DISPO_CACHE_SIZE', 0) <= 0:
+        return False
+    try:
+        info = db.session.info
+    except Exception:
+        return True
+    return not info.get('dispo_cache_tout') and not info.get('dispo_cache_materiels')
+
+def _lire_cache_disponibilite(cle, version):
+    with _dispo_cache_lock:
+        entree = _dispo_cache.get(cle)
+        if entree is None or entree[0] != version or time_module.monotonic() > entree[1]:
+            _dispo_cache_stats['misses'] += 1
+            return None
+        _dispo_cache.move_to_end(cle)
+        _dispo_cache_stats['hits'] += 1
+        return entree[2]
+
+def _ecrire_cache_disponibilite(cle, version, valeur):
+    expire = time_module.monotonic() + app.config.get('DISPO_CACHE_TTL', 60)
+    with _dispo_cache_lock:
+        if (_dispo_version_globale, _dispo_versions[cle[0]]) != version:
+            return
+        _dispo_cache[cle] = (version, expire, valeur)
+        _dispo_cache.move_to_end(cle)
+        while len(_dispo_cache) > app.config.get('DISPO_CACHE_SIZE', 0):
+            _dispo_cache.popitem(last=False)
+
+def get_cache_disponibilite_stats():
+    """Statistiques du cache de disponibilité (hits/misses/invalidations/taille)."""
+    with _dispo_cache_lock:
+        return dict(_dispo_cache_stats, taille=len(_dispo_cache))
+
+def verifier_disponibilite_materiels(materiel_ids, date_debut, date_fin, heure_debut=None, heure_fin=None,
+                                     quantites=None, exclure_prestation_id=None, exclure_reservation_id=None):
+    """
+    Vérifie en masse la disponibilité d'une liste de matériels sur une même période.
+
+    Les assignations, réservations et soldes de mouvements de tous les matériels sont
+    chargés en un nombre fixe de requêtes, puis le pic d'utilisation est calculé pour
+    tous les matériels en un seul balayage.
+
+    Args:
+        materiel_ids: Liste des IDs de matériel
+        quantites: dict {materiel_id: quantité demandée} ou entier commun (défaut 1)
+        (autres arguments : voir verifier_disponibilite_materiel)
+
+    Returns:
+        dict: {materiel_id: résultat au format de verifier_disponibilite_materiel}
+    """
+    ids = []
+    for raw_id in materiel_ids or []:
+        try:
+            materiel_id = int(raw_id)
+        except (TypeError, ValueError):
+            continue
+        if materiel_id not in ids:
+            ids.append(materiel_id)
+    if not ids:
+        return {}
+
+    def _quantite_demandee(materiel_id):
+        if isinstance(quantites, dict):
+            return quantites.get(materiel_id, 1)
+        return quantites if quantites is not None else 1
+
+    materiels_map = {}
+    for start in range(0, len(ids), BULK_IN_CLAUSE_MAX):
+        chunk = ids[start:start + BULK_IN_CLAUSE_MAX]
+        for materiel in Materiel.query.filter(Materiel.id.in_(chunk)).all():
+            materiels_map[materiel.id] = materiel
+
+    resultats = {}
+    a_calculer = []
+    for materiel_id in ids:
+        materiel = materiels_map.get(materiel_id)
+        if not materiel:
+            resultats[materiel_id] = _resultat_disponibilite_erreur(0, 'Matériel introuvable')
+        elif materiel.statut in STATUTS_MATERIEL_INDISPONIBLES:
+            resultats[materiel_id] = _resultat_disponibilite_erreur(
+                materiel.quantite, f"Matériel en {materiel.statut.replace('_', ' ')}", materiel.quantite
             )
-            if not start_dt or not end_dt:
-                continue
-            buffer_start = start_dt - timedelta(hours=sortie_avant_h)
-            buffer_end = end_dt + timedelta(hours=retour_apres_h)
-            if buffer_end <= req_start or buffer_start >= req_end:
-                continue
+        elif not date_debut or not date_fin:
+            resultats[materiel_id] = _resultat_disponibilite_erreur(materiel.quantite, 'Dates manquantes')
+        else:
+            a_calculer.append(materiel)
+    if not a_calculer:
+        return resultats
 
-            overlap_start = max(buffer_start, req_start)
-            overlap_end = min(buffer_end, req_end)
-            if overlap_end <= overlap_start:
-                continue
-            events.append((overlap_start, assignation.quantite))
-            events.append((overlap_end, -assignation.quantite))
-            conflits.append({
-                'type': 'reservation',
-                'id': reservation.id,
-                'nom': reservation.nom,
-                'date': reservation.date_souhaitee,
-                'heure': reservation.heure_souhaitee.strftime('%H:%M') if reservation.heure_souhaitee else 'Non précisée',
-                'quantite': assignation.quantite
-            })
-        
-        # Calculer le pic de concurrence
-        events.sort(key=lambda item: (item[0], 0 if item[1] < 0 else 1))
-        quantite_utilisee = 0
-        quantite_max = 0
-        for _, delta in events:
-            quantite_utilisee += delta
-            if quantite_utilisee > quantite_max:
-                quantite_max = quantite_utilisee
-        quantite_disponible = max(0, materiel.quantite - quantite_max)
-        
-        return {
-            'disponible': quantite_disponible >= quantite_demandee,
-            'quantite_disponible': quantite_disponible,
-            'quantite_totale': materiel.quantite,
-            'quantite_utilisee': quantite_max,
-            'conflits': conflits
+    req_start, req_end = _fenetre_demandee(date_debut, date_fin, heure_debut, heure_fin)
+    if not req_start or not req_end:
+        for materiel in a_calculer:
+            resultats[materiel.id] = _resultat_disponibilite_erreur(materiel.quantite, 'Période invalide')
+        return resultats
+
+    try:
+        pics = {}
+        cache_actif = _cache_disponibilite_actif()
+        cles = {
+            materiel.id: (materiel.id, req_start, req_end, exclure_prestation_id, exclure_reservation_id)
+            for materiel in a_calculer
         }
-        
+        # Versions relevées avant lecture : un changement concurrent rend l'entrée obsolète
+        versions = _versions_disponibilite(cles) if cache_actif else {}
+        manquants = []
+        for materiel_id, cle in cles.items():
+            valeur = _lire_cache_disponibilite(cle, versions[materiel_id]) if cache_actif else None
+            if valeur is None:
+                manquants.append(materiel_id)
+            else:
+                pics[materiel_id] = valeur
+        if manquants:
+            occupations = _charger_occupations_materiels(
+                manquants, req_start, req_end,
+                exclure_prestation_id=exclure_prestation_id,
+                exclure_reservation_id=exclure_reservation_id
+            )
+            calcules = _calculer_pics_occupation(occupations, req_start, req_end)
+            # L'autoflush du chargement a pu écrire des occupations non validées
+            cache_actif = cache_actif and _cache_disponibilite_actif()
+            for materiel_id in manquants:
+                valeur = calcules.get(materiel_id, (0, []))
+                pics[materiel_id] = valeur
+                if cache_actif:
+                    _ecrire_cache_disponibilite(cles[materiel_id], versions[materiel_id], valeur)
     except Exception as e:
         logger.error(f"Erreur vérification disponibilité matériel: {e}")
         import traceback
         traceback.print_exc()
-        return {
-            'disponible': False,
-            'quantite_disponible': 0,
-            'quantite_totale': materiel.quantite if materiel else 0,
-            'quantite_utilisee': 0,
-            'conflits': [],
-            'erreur': str(e)
+        for materiel in a_calculer:
+            resultats[materiel.id] = _resultat_disponibilite_erreur(materiel.quantite, str(e))
+        return resultats
+
+    for materiel in a_calculer:
+        quantite_max, conflits = pics.get(materiel.id, (0, []))
+        quantite_disponible = max(0, (materiel.quantite or 0) - quantite_max)
+        resultats[materiel.id] = {
+            'disponible': quantite_disponible >= _quantite_demandee(materiel.id),
+            'quantite_disponible': quantite_disponible,
+            'quantite_totale': materiel.quantite,
+            'quantite_utilisee': quantite_max,
+            'conflits': [dict(conflit) for conflit in conflits]
+        }
+    return resultats
+
+def verifier_disponibilite_materiel(materiel_id, quantite_demandee, date_debut, date_fin, 
+                                    heure_debut=None, heure_fin=None, 
+                                    exclure_prestation_id=None, exclure_reservation_id=None):
+    """
+    Vérifie si une quantité de matériel est disponible sur une période donnée
+    
+    Args:
+        materiel_id: ID du matériel
+        quantite_demandee: Quantité souhaitée
+        date_debut: Date de début de la prestation
+        date_fin: Date de fin de la prestation
+        heure_debut: Heure de début (optionnel)
+        heure_fin: Heure de fin (optionnel)
+        exclure_prestation_id: ID de prestation à exclure (pour édition)
+        exclure_reservation_id: ID de réservation à exclure (pour édition)
+    
+    Returns:
+        dict: {
+            'disponible': bool,
+            'quantite_disponible': int,
+            'quantite_totale': int,
+            'quantite_utilisee': int,
+            'conflits': list  # Liste des prestations en conflit
+        }
+    """
+    try:
+        materiel_id = int(materiel_id)
+    except (TypeError, ValueError):
+        return _resultat_disponibilite_erreur(0, 'Matériel introuvable')
+    resultats = verifier_disponibilite_materiels(
+        [materiel_id], date_debut, date_fin,
+        heure_debut=heure_debut,
+        heure_fin=heure_fin,
+        quantites={materiel_id: quantite_demandee},
+        exclure_prestation_id=exclure_prestation_id,
+        exclure_reservation_id=exclure_reservation_id
+    )
+    return resultats.get(materiel_id) or _resultat_disponibilite_erreur(0, 'Matériel introuvable')
+
+CRENEAUX_MAX = 50
+
+def evaluer_creneaux(creneaux, besoins_materiel=None, dj_ids=None, technicien_ids=None,
+                     exclure_prestation_id=None, exclure_reservation_id=None):
+    """
+    Évalue plusieurs créneaux candidats (« et si ? ») en une passe sur des données
+    préchargées une seule fois pour l'enveloppe de tous les créneaux.
+
+    Args:
+        creneaux: liste de tuples (date_debut, date_fin, heure_debut, heure_fin)
+        besoins_materiel: dict {materiel_id: quantité}
+        dj_ids / technicien_ids: candidats ; au moins un doit être libre (None = pas d'exigence)
+
+    Returns:
+        list: un dict par créneau, classé du plus faisable au moins faisable
+    """
+    besoins_materiel = besoins_materiel or {}
+    fenetres = [_fenetre_demandee(*creneau) for creneau in creneaux]
+    valides = [fenetre for fenetre in fenetres if fenetre[0] and fenetre[1]]
+    enveloppe_debut = min((f[0] for f in valides), default=None)
+    enveloppe_fin = max((f[1] for f in valides), default=None)
+
+    materiels = {
+        m.id: m for m in Materiel.query.filter(Materiel.id.in_(list(besoins_materiel))).all()
+    } if besoins_materiel else {}
+    actifs = [mid for mid, m in materiels.items() if m.statut not in STATUTS_MATERIEL_INDISPONIBLES]
+    occupations = _charger_occupations_materiels(
+        actifs, enveloppe_debut, enveloppe_fin,
+        exclure_prestation_id=exclure_prestation_id,
+        exclure_reservation_id=exclure_reservation_id
+    ) if actifs and valides else {}
+    periodes = {
+        'dj': charger_periodes_staff('dj', dj_ids, enveloppe_debut, enveloppe_fin, exclure_prestation_id)
+        if dj_ids and valides else {},
+        'technicien': charger_periodes_staff('technicien', technicien_ids, enveloppe_debut, enveloppe_fin, exclure_prestation_id)
+        if technicien_ids and valides else {},
+    }
+
+    def _staff_libres(staff_type, candidats, start_dt, end_dt):
+        return [
+            staff_id for staff_id in candidats
+            if not any(row.debut_dt < end_dt and row.fin_dt > start_dt for row in periodes[staff_type].get(staff_id, ()))
+        ]
+
+    resultats = []
+    for index, (creneau, (start_dt, end_dt)) in enumerate(zip(creneaux, fenetres)):
+        date_debut, date_fin, heure_debut, heure_fin = creneau
+        resultat = {
+            'index': index,
+            'date_debut': date_debut.isoformat() if date_debut else None,
+            'date_fin': date_fin.isoformat() if date_fin else None,
+            'heure_debut': heure_debut.strftime('%H:%M') if heure_debut else None,
+            'heure_fin': heure_fin.strftime('%H:%M') if heure_fin else None,
+            'materiels': [],
+            'manque_total': 0,
+            'djs_disponibles': [],
+            'techniciens_disponibles': [],
+            'erreurs': [],
         }
+        if not start_dt or not end_dt:
+            resultat['erreurs'].append('Créneau invalide')
+            resultat['faisable'] = False
+            resultat['contraintes_non_satisfaites'] = 1 + len(besoins_materiel)
+            resultats.append(resultat)
+            continue
+
+        pics = _calculer_pics_occupation(occupations, start_dt, end_dt)
+        for materiel_id, demande in besoins_materiel.items():
+            materiel = materiels.get(materiel_id)
+            if not materiel:
+                disponible, erreur = 0, 'Matériel introuvable'
+            elif materiel.statut in STATUTS_MATERIEL_INDISPONIBLES:
+                disponible, erreur = 0, f"Matériel en {materiel.statut.replace('_', ' ')}"
+            else:
+                disponible = max(0, (materiel.quantite or 0) - pics.get(materiel_id, (0, []))[0])
+                erreur = None
+            manque = max(0, demande - disponible)
+            resultat['materiels'].append({
+                'materiel_id': materiel_id,
+                'nom': materiel.nom if materiel else None,
+                'demande': demande,
+                'disponible': disponible,
+                'manque': manque,
+                'erreur': erreur,
+            })
+            resultat['manque_total'] += manque
+
+        non_satisfaites = sum(1 for item in resultat['materiels'] if item['manque'])
+        if dj_ids:
+            resultat['djs_disponibles'] = _staff_libres('dj', dj_ids, start_dt, end_dt)
+            if not resultat['djs_disponibles']:
+                resultat['erreurs'].append('Aucun DJ disponible')
+                non_satisfaites += 1
+        if technicien_ids:
+            resultat['techniciens_disponibles'] = _staff_libres('technicien', technicien_ids, start_dt, end_dt)
+            if not resultat['techniciens_disponibles']:
+                resultat['erreurs'].append('Aucun technicien disponible')
+                non_satisfaites += 1
+        resultat['contraintes_non_satisfaites'] = non_satisfaites
+        resultat['faisable'] = non_satisfaites == 0
+        resultat['_debut'] = start_dt
+        resultats.append(resultat)
+
+    resultats.sort(key=lambda r: (
+        not r['faisable'], r['contraintes_non_satisfaites'], r['manque_total'],
+        r.get('_debut') or datetime.max
+    ))
+    for rang, resultat in enumerate(resultats, start=1):
+        resultat.pop('_debut', None)
+        resultat['rang'] = rang
+    return resultats
 
 def calculer_cout_materiel_reel(prestation_id=None, devis_id=None, reservation_id=None):
     """
@@ -3603,7 +5464,7 @@ def login():
             flash('Nom d\'utilisateur ou mot de passe incorrect', 'error')
     
     # Récupérer les paramètres d'entreprise pour l'affichage
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     return render_template('login.html', parametres=parametres)
 
 @app.route('/initialisation', methods=['GET', 'POST'])
@@ -3983,7 +5844,7 @@ def register():
 
 def _get_groq_status():
     from ai_assistant import GROQ_AVAILABLE, ai_assistant
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     db_groq_key = (parametres.groq_api_key or '').strip() if parametres else ''
     env_groq_key = (os.environ.get('GROQ_API_KEY') or '').strip()
     groq_configured = bool(env_groq_key or db_groq_key)
@@ -4028,6 +5889,20 @@ def _get_groq_status():
         'error': last_error if error_is_recent else None,
     }
 
+@app.route('/api/admin/services-externes')
+@login_required
+@role_required(['admin'])
+def api_services_externes():
+    """État des disjoncteurs et métriques des appels sortants (géocodage, routage, IA, Google, Stripe)."""
+    return jsonify({
+        'success': True,
+        'services': outbound_http.get_metrics(),
+        'caches': {
+            'geocodage': get_cache_geocodage_stats(),
+            'distances': get_cache_distances_stats(),
+        }
+    })
+
 @app.route('/admin')
 @login_required
 @role_required(['admin'])
@@ -4072,7 +5947,7 @@ def ia_hub():
     """Page centrale des fonctionnalités IA"""
     user = get_current_user()
     groq_status = _get_groq_status()
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     djs = DJ.query.order_by(DJ.nom).all()
     materiels = Materiel.query.order_by(Materiel.nom).all()
     return render_template('ia_hub.html',
@@ -4088,7 +5963,7 @@ def ia_hub():
 def ia_update_key():
     """Met à jour la clé Groq depuis la page IA"""
     try:
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         if not parametres:
             parametres = ParametresEntreprise()
             db.session.add(parametres)
@@ -4409,7 +6284,7 @@ def nouveau_devis():
                 return redirect(url_for('nouveau_devis'))
             
             # Créer le devis
-            client_ref = get_or_create_client(client_nom, client_email, client_telephone)
+            client_ref = get_or_create_client(client_nom, client_email, client_telephone, adresse=client_adresse)
             numero_devis = generate_document_number('DEV')
             devis = Devis(
                 numero=numero_devis,
@@ -4450,7 +6325,7 @@ def nouveau_devis():
             devis.calculer_totaux()
 
             if not devis.contenu_html:
-                parametres = ParametresEntreprise.query.first()
+                parametres = get_parametres_entreprise()
                 devis.contenu_html = build_devis_template(devis, parametres)
             
             db.session.add(devis)
@@ -4486,7 +6361,7 @@ def nouveau_devis():
 def detail_devis(devis_id):
     """Détail d'un devis"""
     devis = get_or_404(Devis, devis_id)
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     devis_content_raw = devis.contenu_html or build_devis_template(devis, parametres)
     devis_content = sanitize_rich_html(devis_content_raw)
     return render_template(
@@ -4725,7 +6600,7 @@ def changer_statut_devis(devis_id):
 def parametres():
     """Page des paramètres d'entreprise"""
     # Récupérer ou créer les paramètres
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     if not parametres:
         parametres = ParametresEntreprise()
         db.session.add(parametres)
@@ -4750,7 +6625,7 @@ def parametres():
 @role_required(['admin'])
 def personnalisation():
     """Page de personnalisation et données entreprise"""
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     if not parametres:
         parametres = ParametresEntreprise()
         db.session.add(parametres)
@@ -4763,7 +6638,7 @@ def personnalisation():
 def modifier_parametres():
     """Modifier les paramètres d'entreprise"""
     try:
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         if not parametres:
             parametres = ParametresEntreprise()
             db.session.add(parametres)
@@ -5038,7 +6913,7 @@ def modifier_parametres():
 def modifier_personnalisation():
     """Met à jour uniquement la personnalisation de l'interface (sans modules)."""
     try:
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         if not parametres:
             parametres = ParametresEntreprise()
             db.session.add(parametres)
@@ -5190,7 +7065,7 @@ def export_parametres():
         exporter = ClientExport()
         
         # Export des paramètres uniquement
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         if not parametres:
             flash('Aucun paramètre d\'entreprise trouvé', 'warning')
             return redirect(url_for('parametres'))
@@ -5299,7 +7174,7 @@ def devis_pdf(devis_id):
     devis = get_or_404(Devis, devis_id)
     
     # Récupérer les paramètres d'entreprise
-    parametres_entreprise = ParametresEntreprise.query.first()
+    parametres_entreprise = get_parametres_entreprise()
     if not devis.contenu_html:
         devis.contenu_html = build_devis_template(devis, parametres_entreprise)
         db.session.commit()
@@ -5352,7 +7227,7 @@ def devis_pdf(devis_id):
 def devis_choix_tva(devis_id):
     """Page de choix de TVA pour un devis"""
     devis = get_or_404(Devis, devis_id)
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     return render_template('devis_choix_tva.html', devis=devis, parametres=parametres)
 
 # Routes d'export Excel
@@ -5477,7 +7352,7 @@ def send_reservation_confirmation_email(reservation):
         from email_service import EmailService
         email_service = EmailService()
         
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         nom_entreprise = parametres.nom_entreprise if parametres else 'Planify'
         
         subject = f"Confirmation de réservation {reservation.numero}"
@@ -5576,7 +7451,7 @@ def notify_dj_new_reservation(reservation):
             logger.info(f"DJ {reservation.dj.nom} n'a pas d'utilisateur associé avec email")
             return
         
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         nom_entreprise = parametres.nom_entreprise if parametres else 'Planify'
         
         subject = f"Nouvelle réservation assignée {reservation.numero}"
@@ -5704,7 +7579,7 @@ def send_devis_to_client(devis, include_tva=None):
         
         # Générer le PDF du devis
         from pdf_generator import generate_devis_pdf
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         nom_entreprise = parametres.nom_entreprise if parametres else 'Planify'
         if include_tva is None:
             include_tva = True if devis.tva_incluse is None else bool(devis.tva_incluse)
@@ -5798,7 +7673,7 @@ def _envoyer_devis_email(devis, include_tva=True):
     from email_service import EmailService
     import secrets
 
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     if parametres and parametres.tva_non_applicable:
         include_tva = False
     if devis.est_signe:
@@ -5895,7 +7770,7 @@ def page_signature_devis(token):
     if devis.est_signe:
         return render_template('devis_deja_signe.html', devis=devis)
     
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     return render_template('signer_devis.html', devis=devis, parametres=parametres)
 
 @app.route('/api/signer-devis/<token>', methods=['POST'])
@@ -5967,7 +7842,7 @@ def notifier_signature_devis(devis):
         from email_service import EmailService
         email_service = EmailService()
         
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         nom_entreprise = parametres.nom_entreprise if parametres else 'Planify'
         
         # Email au client
@@ -6474,22 +8349,22 @@ def valider_reservation(reservation_id):
         
         # ✅ NOUVEAU: Vérifier disponibilité AVANT d'assigner
         erreurs_materiel = []
+        # Vérifier la disponibilité de tous les matériels en une passe (1 unité par défaut)
+        disponibilites = verifier_disponibilite_materiels(
+            [int(materiel_id) for materiel_id in materiels_ids if materiel_id],
+            reservation.date_souhaitee,
+            date_fin_res,
+            heure_debut=reservation.heure_souhaitee,
+            heure_fin=heure_fin_res,
+            exclure_reservation_id=reservation.id
+        )
         for materiel_id in materiels_ids:
             if materiel_id:
                 materiel = db.session.get(Materiel, int(materiel_id))
                 if not materiel:
                     continue
                 
-                # Vérifier disponibilité
-                dispo = verifier_disponibilite_materiel(
-                    materiel_id=int(materiel_id),
-                    quantite_demandee=1,  # Par défaut 1 unité
-                    date_debut=reservation.date_souhaitee,
-                    date_fin=date_fin_res,
-                    heure_debut=reservation.heure_souhaitee,
-                    heure_fin=heure_fin_res,
-                    exclure_reservation_id=reservation.id
-                )
+                dispo = disponibilites[materiel.id]
                 
                 if not dispo['disponible']:
                     erreurs_materiel.append(f"{materiel.nom}: non disponible ({dispo['quantite_disponible']}/{dispo['quantite_totale']})")
@@ -6613,6 +8488,7 @@ def assigner_materiel_reservation(reservation_id):
             reservation.duree_heures
         )
         
+        quantites_demandees = {}
         for materiel_id in materiel_ids:
             if not materiel_id:
                 continue
@@ -6627,23 +8503,27 @@ def assigner_materiel_reservation(reservation_id):
             # Validation: quantité minimum 1
             if quantite_demandee < 1:
                 quantite_demandee = 1
-            
-            materiel = db.session.get(Materiel, int(materiel_id))
+            quantites_demandees[int(materiel_id)] = quantite_demandee
+        
+        # Vérifier disponibilité avec les quantités demandées (réservation exclue si déjà assignée)
+        disponibilites = verifier_disponibilite_materiels(
+            list(quantites_demandees.keys()),
+            reservation.date_souhaitee,
+            date_fin_res,
+            heure_debut=reservation.heure_souhaitee,
+            heure_fin=heure_fin_res,
+            quantites=quantites_demandees,
+            exclure_reservation_id=reservation_id
+        )
+        
+        for materiel_id, quantite_demandee in quantites_demandees.items():
+            materiel = db.session.get(Materiel, materiel_id)
             
             if not materiel:
                 erreurs.append(f"Matériel #{materiel_id} introuvable")
                 continue
             
-            # Vérifier disponibilité avec la quantité demandée
-            dispo = verifier_disponibilite_materiel(
-                materiel_id=int(materiel_id),
-                quantite_demandee=quantite_demandee,
-                date_debut=reservation.date_souhaitee,
-                date_fin=date_fin_res,
-                heure_debut=reservation.heure_souhaitee,
-                heure_fin=heure_fin_res,
-                exclure_reservation_id=reservation_id  # Exclure cette réservation si déjà assignée
-            )
+            dispo = disponibilites[materiel_id]
             
             if not dispo['disponible']:
                 erreur_msg = f"❌ {materiel.nom}: {quantite_demandee} demandé(s), seulement {dispo['quantite_disponible']}/{dispo['quantite_totale']} disponible(s)"
@@ -6734,7 +8614,7 @@ def valider_reservation_dj(reservation_id):
         )
         
         # Créer la PRESTATION
-        client_ref = get_or_create_client(reservation.nom, reservation.email, reservation.telephone)
+        client_ref = get_or_create_client(reservation.nom, reservation.email, reservation.telephone, adresse=reservation.adresse)
         prestation = Prestation(
             client=reservation.nom,
             client_email=reservation.email,
@@ -6827,7 +8707,7 @@ def valider_reservation_dj(reservation_id):
         devis.synchroniser_frais_materiel()
         devis.calculer_totaux()
         if not devis.contenu_html:
-            parametres = ParametresEntreprise.query.first()
+            parametres = get_parametres_entreprise()
             devis.contenu_html = build_devis_template(devis, parametres)
         
         reservation.devis_id = devis.id
@@ -6875,7 +8755,7 @@ def confirmer_reservation(reservation_id):
                 reservation.heure_souhaitee,
                 reservation.duree_heures
             )
-            client_ref = get_or_create_client(reservation.nom, reservation.email, reservation.telephone)
+            client_ref = get_or_create_client(reservation.nom, reservation.email, reservation.telephone, adresse=reservation.adresse)
             devis = Devis(
                 numero=generate_document_number('DEV'),
                 client_nom=reservation.nom,
@@ -6910,7 +8790,7 @@ def confirmer_reservation(reservation_id):
             reservation.date_confirmation = utcnow()
 
             if not devis.contenu_html:
-                parametres = ParametresEntreprise.query.first()
+                parametres = get_parametres_entreprise()
                 devis.contenu_html = build_devis_template(devis, parametres)
             
             db.session.commit()
@@ -7230,7 +9110,7 @@ def produits():
     materiels = query.order_by(Materiel.nom.asc()).paginate(
         page=page, per_page=ITEMS_PER_PAGE, error_out=False
     )
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     tva_rate = 20.0
     if parametres:
         tva_rate = parametres.taux_tva_defaut if parametres.taux_tva_defaut is not None else 20.0
@@ -7581,7 +9461,7 @@ def nouvelle_facture():
 def detail_facture(facture_id):
     """Détail d'une facture"""
     facture = get_or_404(Facture, facture_id)
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     if parametres and parametres.stripe_enabled and parametres.stripe_secret_key:
         if facture.montant_restant > 0 and facture.statut not in ['annulee']:
             ensure_facture_payment_token(facture)
@@ -7958,7 +9838,7 @@ def enregistrer_paiement(facture_id):
             flash(message, 'error')
             return redirect(url_for('detail_facture', facture_id=facture.id))
 
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         paiement = Paiement(
             numero=generate_document_number('PAY'),
             montant=montant_paye,
@@ -8084,7 +9964,7 @@ def facture_pdf(facture_id):
     facture = get_or_404(Facture, facture_id)
     
     # Récupérer les paramètres de l'entreprise
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     include_company_signature = None
     if parametres and getattr(parametres, 'signature_entreprise_path', None):
         if 'signature' in request.args:
@@ -8144,7 +10024,7 @@ def envoyer_facture_email(facture_id):
         # Générer le PDF de la facture
         from pdf_generator import generate_facture_pdf
         from email_service import EmailService
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         pdf_data = generate_facture_pdf(facture, parametres)
 
         payment_option = (request.form.get('payment_option') or '').strip().lower()
@@ -8249,7 +10129,7 @@ def envoyer_devis_email(devis_id):
         include_tva = True if devis.tva_incluse is None else bool(devis.tva_incluse)
     else:
         include_tva = str(include_tva_raw).lower() in ('1', 'true', 'on', 'yes')
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     if parametres and parametres.tva_non_applicable:
         include_tva = False
     
@@ -8296,7 +10176,7 @@ def envoyer_devis_apres_edition(devis_id):
             include_tva = True if devis.tva_incluse is None else bool(devis.tva_incluse)
         else:
             include_tva = str(include_tva_raw).lower() in ('1', 'true', 'on', 'yes')
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         if parametres and parametres.tva_non_applicable:
             include_tva = False
         _envoyer_devis_email(devis, include_tva=include_tva)
@@ -8334,7 +10214,7 @@ def creer_facture_depuis_prestation_id(prestation_id):
         try:
             # Générer un numéro de facture unique et séquentiel
             numero_facture = generate_document_number('FAC')
-            parametres = ParametresEntreprise.query.first()
+            parametres = get_parametres_entreprise()
             include_tva = True if devis.tva_incluse is None else bool(devis.tva_incluse)
             if parametres and parametres.tva_non_applicable:
                 include_tva = False
@@ -8687,28 +10567,13 @@ def detail_prestation(prestation_id):
         elif current_user.role == 'technicien':
             if prestation.technicien_id != current_user.id:
                 abort(404)
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     company_coords = None
     if parametres:
         company_coords = get_company_coordinates(parametres)
-    if app.config.get('ADDRESS_VALIDATION_ENABLED') and prestation.lieu and (not prestation.lieu_lat or not prestation.lieu_lng):
-        try:
-            geo, err = geocode_address(prestation.lieu, contact_email=parametres.email if parametres else None)
-            if geo:
-                prestation.lieu_lat = geo['lat']
-                prestation.lieu_lng = geo['lng']
-                prestation.lieu_formatted = geo.get('formatted') or prestation.lieu
-                prestation.lieu_geocoded_at = utcnow()
-                if company_coords:
-                    distance_km, distance_source = compute_distance_km(
-                        company_coords[0], company_coords[1], geo['lat'], geo['lng']
-                    )
-                    prestation.distance_km = distance_km
-                    prestation.distance_source = distance_source
-                    prestation.indemnite_km = compute_indemnite_km(distance_km, parametres)
-                db.session.commit()
-        except Exception as e:
-            logger.warning(f"Impossible de géocoder la mission #{prestation.id}: {e}")
+    if prestation.lieu_geocode_statut == GEOCODE_A_FAIRE:
+        # Géocodage en attente : traité par le thread de fond, jamais dans la requête
+        _geocodage_evenement.set()
     custom_definitions = get_custom_fields_definitions(parametres)
     custom_values = parse_custom_fields_values(prestation.custom_fields)
     custom_fields_display = build_custom_fields_display(custom_definitions, custom_values)
@@ -8726,7 +10591,7 @@ def detail_prestation(prestation_id):
 def modifier_prestation(prestation_id):
     """Modifier une prestation"""
     prestation = get_or_404(Prestation, prestation_id)
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     custom_definitions = get_custom_fields_definitions(parametres)
     custom_values_existing = parse_custom_fields_values(prestation.custom_fields)
     
@@ -8916,6 +10781,15 @@ def modifier_prestation(prestation_id):
             
             # Vérifier les conflits avant d'assigner
             conflits_detectes = []
+            disponibilites = verifier_disponibilite_materiels(
+                list(materiel_quantites.keys()),
+                prestation.date_debut,
+                prestation.date_fin,
+                heure_debut=prestation.heure_debut,
+                heure_fin=prestation.heure_fin,
+                quantites=materiel_quantites,
+                exclure_prestation_id=prestation.id
+            )
             for materiel_id_int, quantite in materiel_quantites.items():
                 materiel = db.session.get(Materiel, materiel_id_int)
                 if not materiel:
@@ -8926,15 +10800,7 @@ def modifier_prestation(prestation_id):
                         f"{materiel.nom}: matériel en {materiel.statut.replace('_', ' ')}"
                     )
                     continue
-                dispo = verifier_disponibilite_materiel(
-                    materiel_id=materiel_id_int,
-                    quantite_demandee=quantite,
-                    date_debut=prestation.date_debut,
-                    date_fin=prestation.date_fin,
-                    heure_debut=prestation.heure_debut,
-                    heure_fin=prestation.heure_fin,
-                    exclure_prestation_id=prestation.id
-                )
+                dispo = disponibilites.get(materiel_id_int, {})
                 
                 if not dispo.get('disponible'):
                     conflits_detectes.append(
@@ -8991,18 +10857,20 @@ def modifier_prestation(prestation_id):
     materiels_en_maintenance = Materiel.query.filter_by(statut='maintenance').all()
     materiels_autres = Materiel.query.filter(~Materiel.statut.in_(['maintenance', 'archive'])).all()
     
+    # Vérifier la disponibilité pour la date/heure de la prestation (prestation actuelle exclue)
+    disponibilites = verifier_disponibilite_materiels(
+        [materiel.id for materiel in materiels_autres],
+        prestation.date_debut,
+        prestation.date_fin,
+        heure_debut=prestation.heure_debut,
+        heure_fin=prestation.heure_fin,
+        exclure_prestation_id=prestation.id
+    )
+    materiels_assignes_ids = {materiel.id for materiel in prestation.materiels}
     for materiel in materiels_autres:
-        # Vérifier la disponibilité pour la date/heure de la prestation
-        disponible, message = check_materiel_availability(
-            materiel.id, 
-            prestation.date_debut, 
-            prestation.date_fin, 
-            prestation.heure_debut, 
-            prestation.heure_fin,
-            prestation.id  # Exclure la prestation actuelle
-        )
+        disponible = bool(disponibilites.get(materiel.id, {}).get('disponible'))
         
-        if disponible or materiel in prestation.materiels:
+        if disponible or materiel.id in materiels_assignes_ids:
             # Inclure les matériels disponibles ET ceux déjà assignés à cette prestation
             materiels_disponibles.append(materiel)
     
@@ -9088,24 +10956,12 @@ def annuler_prestation(prestation_id):
         
         # 4. Libérer les MATÉRIELS assignés (conserver ceux avec retours manquants)
         materiels_assignations = MaterielPresta.query.filter_by(prestation_id=prestation.id).all()
+        soldes = get_soldes_mouvements(prestation.id)
         materiels_count = 0
         materiels_retour_en_attente = 0
         for ma in materiels_assignations:
             if db.session.get(Materiel, ma.materiel_id):
-                total_sortie = db.session.query(
-                    db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)
-                ).filter_by(
-                    materiel_id=ma.materiel_id,
-                    prestation_id=prestation.id,
-                    type_mouvement='sortie'
-                ).scalar() or 0
-                total_retour = db.session.query(
-                    db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)
-                ).filter_by(
-                    materiel_id=ma.materiel_id,
-                    prestation_id=prestation.id,
-                    type_mouvement='retour'
-                ).scalar() or 0
+                total_sortie, total_retour = soldes.get(ma.materiel_id, (0, 0))
                 if total_sortie > total_retour:
                     materiels_retour_en_attente += 1
                     continue
@@ -9148,7 +11004,7 @@ def envoyer_notifications_annulation(prestation, client_email, dj_email, nb_devi
         from email_service import EmailService
         email_service = EmailService()
         
-        parametres = ParametresEntreprise.query.first()
+        parametres = get_parametres_entreprise()
         nom_entreprise = parametres.nom_entreprise if parametres else 'Planify'
         
         mission_titre = prestation.client or "Mission"
@@ -9264,7 +11120,7 @@ def nouvelle_prestation():
         try:
             # Récupération des données du formulaire
             erreurs = []
-            parametres = ParametresEntreprise.query.first()
+            parametres = get_parametres_entreprise()
             custom_definitions = get_custom_fields_definitions(parametres)
             date_debut = parse_date_field(request.form.get('date_debut'), "Date de début", erreurs)
             date_fin = parse_date_field(request.form.get('date_fin'), "Date de fin", erreurs)
@@ -9377,17 +11233,18 @@ def nouvelle_prestation():
             materiels_disponibles = []
             conflits_detectes = []
             
+            disponibilites = verifier_disponibilite_materiels(
+                list(materiel_quantites.keys()),
+                date_debut,
+                date_fin,
+                heure_debut=heure_debut,
+                heure_fin=heure_fin,
+                quantites=materiel_quantites
+            )
             for materiel_id_int, quantite in materiel_quantites.items():
                 materiel = db.session.get(Materiel, materiel_id_int)
                 if materiel:
-                    dispo = verifier_disponibilite_materiel(
-                        materiel_id=materiel.id,
-                        quantite_demandee=quantite,
-                        date_debut=date_debut,
-                        date_fin=date_fin,
-                        heure_debut=heure_debut,
-                        heure_fin=heure_fin
-                    )
+                    dispo = disponibilites.get(materiel.id, {})
 
                     if dispo.get('disponible'):
                         materiels_disponibles.append((materiel, quantite))
@@ -9472,7 +11329,7 @@ def nouvelle_prestation():
     # GET - Affichage du formulaire
     djs = DJ.query.all()
     techniciens = User.query.filter_by(role='technicien', actif=True).all()
-    parametres = ParametresEntreprise.query.first()
+    parametres = get_parametres_entreprise()
     custom_fields_definitions = get_custom_fields_definitions(parametres)
     return render_template(
         'nouvelle_prestation.html',
@@ -9506,10 +11363,11 @@ def materiels():
             date_consultation_dt = datetime.strptime(date_consultation, '%Y-%m-%d').date()
             heure_debut_dt = datetime.strptime(heure_debut_consultation, '%H:%M').time()
             heure_fin_dt = datetime.strptime(heure_fin_consultation, '%H:%M').time()
+            statuts = get_materiels_status_at_time(
+                materiels, date_consultation_dt, heure_debut_dt, heure_fin_dt
+            )
             for materiel in materiels:
-                materiel.statut_consultation = get_materiel_status_at_time(
-                    materiel.id, date_consultation_dt, heure_debut_dt, heure_fin_dt
-                )
+                materiel.statut_consultation = statuts.get(materiel.id, materiel.statut)
             if statut:
                 materiels = [m for m in materiels if (m.statut_consultation or m.statut) == statut]
         except ValueError:
@@ -9537,124 +11395,324 @@ def materiels_disponibilites():
     """Écran de monitoring en temps réel de la disponibilité du matériel par local"""
     return render_template('materiels_disponibilites.html')
 
-@app.route('/api/materiels/disponibilites')
+HEATMAP_MAX_COLONNES = 24 * 93
+
+@app.route('/api/materiels/heatmap')
 @login_required
-@role_required(['admin', 'manager'])
-def api_materiels_disponibilites():
+def api_materiels_heatmap():
     """
-    API pour récupérer l'état de disponibilité du matériel en temps réel
-    Retourne pour chaque local : disponible / en prestation / maintenance
+    Matrice de capacité matériel × jour (ou × heure) sur une plage de dates.
+
+    Paramètres : date_debut, date_fin (YYYY-MM-DD, inclusifs), granularite
+    (jour|heure), local_id et categorie optionnels.
     """
+    from availability_matrix import GRANULARITES, capacity_matrix
+
     try:
-        locaux = Local.query.all()
-        resultats = []
-        
-        # Récupérer toutes les prestations actives (filtrées ensuite par fenêtre logistique)
-        prestations_actives = Prestation.query.filter(
-            Prestation.statut.in_(['planifiee', 'confirmee', 'en_cours'])
+        date_debut = datetime.strptime(request.args.get('date_debut', ''), '%Y-%m-%d').date()
+        date_fin = datetime.strptime(request.args.get('date_fin', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Dates invalides (format YYYY-MM-DD)'}), 400
+    if date_fin < date_debut:
+        return jsonify({'success': False, 'error': 'La date de fin précède la date de début'}), 400
+    granularite = request.args.get('granularite', 'jour')
+    pas = GRANULARITES.get(granularite)
+    if not pas:
+        return jsonify({'success': False, 'error': 'Granularité invalide (jour ou heure)'}), 400
+
+    origine = datetime.combine(date_debut, time(0, 0))
+    fin_plage = datetime.combine(date_fin + timedelta(days=1), time(0, 0))
+    n_colonnes = int((fin_plage - origine) / pas)
+    if n_colonnes > HEATMAP_MAX_COLONNES:
+        return jsonify({'success': False, 'error': f'Plage trop longue (max {HEATMAP_MAX_COLONNES} colonnes)'}), 400
+
+    try:
+        query = Materiel.query.filter(Materiel.statut != 'archive')
+        local_id = request.args.get('local_id', type=int)
+        if local_id:
+            query = query.filter(Materiel.local_id == local_id)
+        categorie = request.args.get('categorie')
+        if categorie:
+            query = query.filter(Materiel.categorie == categorie)
+        materiels = query.order_by(Materiel.nom).all()
+        index = {materiel.id: i for i, materiel in enumerate(materiels)}
+
+        occupations = _filtrer_ids(
+            db.session.query(
+                MaterielOccupation.materiel_id,
+                MaterielOccupation.debut,
+                MaterielOccupation.fin,
+                MaterielOccupation.quantite
+            ).filter(
+                MaterielOccupation.debut < fin_plage,
+                MaterielOccupation.fin > origine
+            ),
+            MaterielOccupation.materiel_id,
+            list(index)
         ).all()
-        
-        # Créer un dictionnaire materiel_id -> quantité en prestation
-        materiel_en_prestation = {}
-        now_dt = datetime.now()
-        sortie_avant_h, retour_apres_h = _get_materiel_logistique_buffers()
-        for prestation in prestations_actives:
-            start_dt, end_dt = _build_datetime_range(
-                prestation.date_debut,
-                prestation.date_fin,
-                prestation.heure_debut or time(0, 0),
-                prestation.heure_fin or time(23, 59)
-            )
-            if not start_dt or not end_dt:
-                continue
-            window_start = start_dt - timedelta(hours=sortie_avant_h)
-            window_end = end_dt + timedelta(hours=retour_apres_h)
-            if not (window_start <= now_dt <= window_end):
-                continue
-            materiels_presta = MaterielPresta.query.filter_by(prestation_id=prestation.id).all()
-            for mp in materiels_presta:
-                if mp.materiel_id not in materiel_en_prestation:
-                    materiel_en_prestation[mp.materiel_id] = 0
-                materiel_en_prestation[mp.materiel_id] += mp.quantite
-
-        # Ajouter les réservations bloquantes (filtrées par fenêtre logistique)
-        reservations_actives = ReservationClient.query.filter(
-            ReservationClient.statut.in_(list(RESERVATION_STATUTS_BLOQUANTS))
-        ).all()
-        for reservation in reservations_actives:
-            if not reservation.date_souhaitee:
-                continue
-            date_fin_res, heure_fin_res = compute_reservation_end(
-                reservation.date_souhaitee,
-                reservation.heure_souhaitee,
-                reservation.duree_heures
-            )
-            start_dt, end_dt = _build_datetime_range(
-                reservation.date_souhaitee,
-                date_fin_res,
-                reservation.heure_souhaitee or time(0, 0),
-                heure_fin_res or time(23, 59)
-            )
-            if not start_dt or not end_dt:
-                continue
-            window_start = start_dt - timedelta(hours=sortie_avant_h)
-            window_end = end_dt + timedelta(hours=retour_apres_h)
-            if not (window_start <= now_dt <= window_end):
-                continue
-            materiels_resa = MaterielPresta.query.filter_by(reservation_id=reservation.id).all()
-            for mp in materiels_resa:
-                if mp.materiel_id not in materiel_en_prestation:
-                    materiel_en_prestation[mp.materiel_id] = 0
-                materiel_en_prestation[mp.materiel_id] += mp.quantite
-        
-        # Pour chaque local, calculer les dispos
-        for local in locaux:
-            materiels = Materiel.query.filter_by(local_id=local.id).all()
-            
-            materiels_data = []
-            for materiel in materiels:
-                if materiel.statut == 'archive':
-                    continue
-                quantite_en_prestation = materiel_en_prestation.get(materiel.id, 0)
-                quantite_maintenance = materiel.quantite if materiel.statut == 'maintenance' else 0
-                quantite_hors_service = materiel.quantite if materiel.statut == 'hors_service' else 0
-                
-                # Quantité disponible = total - en prestation - maintenance - hors service
-                quantite_disponible = max(0, materiel.quantite - quantite_en_prestation - quantite_maintenance - quantite_hors_service)
-                
-                materiels_data.append({
+        occupations = [occ for occ in occupations if occ.materiel_id in index]
+
+        capacites = [
+            0 if materiel.statut in STATUTS_MATERIEL_INDISPONIBLES else (materiel.quantite or 0)
+            for materiel in materiels
+        ]
+        utilise, disponible = capacity_matrix(
+            capacites,
+            [index[occ.materiel_id] for occ in occupations],
+            [occ.debut for occ in occupations],
+            [occ.fin for occ in occupations],
+            [occ.quantite or 0 for occ in occupations],
+            origine,
+            pas,
+            n_colonnes
+        )
+
+        format_colonne = '%Y-%m-%d' if granularite == 'jour' else '%Y-%m-%dT%H:00'
+        return jsonify({
+            'success': True,
+            'granularite': granularite,
+            'colonnes': [(origine + pas * i).strftime(format_colonne) for i in range(n_colonnes)],
+            'materiels': [
+                {
                     'id': materiel.id,
                     'nom': materiel.nom,
                     'categorie': materiel.categorie,
-                    'quantite_totale': materiel.quantite,
-                    'disponible': quantite_disponible,
-                    'en_prestation': quantite_en_prestation,
-                    'maintenance': quantite_maintenance,
-                    'hors_service': quantite_hors_service,
+                    'local_id': materiel.local_id,
+                    'quantite': materiel.quantite or 0,
                     'statut': materiel.statut
-                })
-            
-            # Trier par catégorie puis par nom (gérer les valeurs nulles)
-            materiels_data.sort(key=lambda x: ((x.get('categorie') or ''), (x.get('nom') or '')))
-            
-            resultats.append({
-                'local_id': local.id,
-                'local_nom': local.nom,
-                'local_adresse': local.adresse or '',
-                'materiels': materiels_data,
+                }
+                for materiel in materiels
+            ],
+            'utilise': utilise.tolist(),
+            'disponible': disponible.tolist()
+        })
+    except Exception as e:
+        logger.error(f"Erreur heatmap disponibilités: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def _quantites_en_prestation(now_dt, materiel_ids=None):
+    """Quantités engagées à l'instant (prestations actives et réservations bloquantes, buffers inclus)."""
+    query = db.session.query(
+        MaterielOccupation.materiel_id,
+        db.func.sum(MaterielOccupation.quantite)
+    ).filter(
+        MaterielOccupation.source_type.in_(('prestation', 'reservation')),
+        MaterielOccupation.debut <= now_dt,
+        MaterielOccupation.fin >= now_dt
+    )
+    query = _filtrer_ids(query, MaterielOccupation.materiel_id, materiel_ids)
+    return {mid: int(quantite or 0) for mid, quantite in query.group_by(MaterielOccupation.materiel_id).all()}
+
+def _ligne_disponibilite(materiel, quantite_en_prestation):
+    quantite_maintenance = materiel.quantite if materiel.statut == 'maintenance' else 0
+    quantite_hors_service = materiel.quantite if materiel.statut == 'hors_service' else 0
+    # Quantité disponible = total - en prestation - maintenance - hors service
+    quantite_disponible = max(0, materiel.quantite - quantite_en_prestation - quantite_maintenance - quantite_hors_service)
+    return {
+        'id': materiel.id,
+        'local_id': materiel.local_id,
+        'nom': materiel.nom,
+        'categorie': materiel.categorie,
+        'quantite_totale': materiel.quantite,
+        'disponible': quantite_disponible,
+        'en_prestation': quantite_en_prestation,
+        'maintenance': quantite_maintenance,
+        'hors_service': quantite_hors_service,
+        'statut': materiel.statut
+    }
+
+def _stats_disponibilite(materiels_data):
+    return {
+        'total_materiels': len(materiels_data),
+        'total_disponible': sum(m['disponible'] for m in materiels_data),
+        'total_en_prestation': sum(m['en_prestation'] for m in materiels_data),
+        'total_maintenance': sum(m['maintenance'] for m in materiels_data),
+        'total_hors_service': sum(m['hors_service'] for m in materiels_data)
+    }
+
+def _local_disponibilite(local, materiels_data):
+    # Trier par catégorie puis par nom (gérer les valeurs nulles)
+    materiels_data.sort(key=lambda x: ((x.get('categorie') or ''), (x.get('nom') or '')))
+    return {
+        'local_id': local.id,
+        'local_nom': local.nom,
+        'local_adresse': local.adresse or '',
+        'materiels': materiels_data,
+        'stats': _stats_disponibilite(materiels_data)
+    }
+
+def _lignes_disponibilite(now_dt, materiel_ids=None):
+    """Lignes de disponibilité {materiel_id: ligne} en deux requêtes (hors matériel archivé)."""
+    query = Materiel.query.filter(Materiel.statut != 'archive')
+    if materiel_ids is not None:
+        query = query.filter(Materiel.id.in_(list(materiel_ids)))
+    materiels = query.all()
+    en_prestation = _quantites_en_prestation(now_dt, [m.id for m in materiels] if materiel_ids is not None else None)
+    return {m.id: _ligne_disponibilite(m, en_prestation.get(m.id, 0)) for m in materiels}
+
+def snapshot_disponibilites_materiel(now_dt=None):
+    """État de disponibilité instantané de tout le matériel, groupé par local."""
+    now_dt = now_dt or datetime.now()
+    lignes = _lignes_disponibilite(now_dt)
+    par_local = defaultdict(list)
+    for ligne in lignes.values():
+        par_local[ligne['local_id']].append(ligne)
+    return [_local_disponibilite(local, par_local.get(local.id, [])) for local in Local.query.all()]
+
+# ---- Flux temps réel (server-sent events) ----
+# Chaque connexion SSE a sa file ; les commits y publient les matériels touchés
+# (None = tout recalculer). Le flux n'envoie ensuite que les lignes modifiées.
+_dispo_stream_abonnes = set()
+_dispo_stream_lock = threading.Lock()
+
+def _publier_changements_disponibilite(materiel_ids):
+    with _dispo_stream_lock:
+        abonnes = list(_dispo_stream_abonnes)
+    for abonne in abonnes:
+        abonne.put(None if materiel_ids is None else set(materiel_ids))
+
+@event.listens_for(db.session, "after_flush")
+def _materiels_modifies_apres_flush(session, flush_context):
+    if not _dispo_stream_abonnes:
+        return
+    ids = {
+        obj.id for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+        if isinstance(obj, Materiel) and obj.id
+    }
+    if ids:
+        session.info.setdefault('dispo_stream_materiels', set()).update(ids)
+
+def _materiels_bornes_franchies(depuis, jusqua):
+    """Matériels dont une fenêtre d'occupation a commencé ou s'est terminée entre deux instants."""
+    occ = MaterielOccupation
+    rows = db.session.query(occ.materiel_id).filter(
+        occ.source_type.in_(('prestation', 'reservation')),
+        or_(
+            and_(occ.debut > depuis, occ.debut <= jusqua),
+            and_(occ.fin >= depuis, occ.fin < jusqua)
+        )
+    ).distinct().all()
+    return {row[0] for row in rows}
+
+def _evenement_sse(nom, donnees):
+    return f"event: {nom}\ndata: {json.dumps(donnees, ensure_ascii=False, default=str)}\n\n"
+
+def _flux_disponibilites(abonne):
+    heartbeat = app.config.get('DISPO_STREAM_HEARTBEAT', 15)
+    resync = app.config.get('DISPO_STREAM_RESYNC', 300)
+    try:
+        now_dt = datetime.now()
+        locaux = snapshot_disponibilites_materiel(now_dt)
+        etat = {ligne['id']: ligne for local in locaux for ligne in local['materiels']}
+        locaux_connus = {local['local_id'] for local in locaux}
+        yield _evenement_sse('snapshot', {
+            'timestamp': now_dt.strftime('%H:%M:%S'),
+            'locaux': locaux
+        })
+        derniere_verif = now_dt
+        dernier_resync = time_module.monotonic()
+        while True:
+            try:
+                messages = [abonne.get(timeout=heartbeat)]
+            except queue.Empty:
+                messages = []
+            while True:
+                try:
+                    messages.append(abonne.get_nowait())
+                except queue.Empty:
+                    break
+            tout = any(message is None for message in messages)
+            if time_module.monotonic() - dernier_resync >= resync:
+                tout = True
+            ids = set().union(*[m for m in messages if m is not None])
+
+            db.session.rollback()  # vue fraîche de la base à chaque tour
+            now_dt = datetime.now()
+            if tout:
+                nouvelles = _lignes_disponibilite(now_dt)
+                ids = set(etat) | set(nouvelles)
+                dernier_resync = time_module.monotonic()
+            else:
+                ids |= _materiels_bornes_franchies(derniere_verif, now_dt)
+                nouvelles = _lignes_disponibilite(now_dt, ids) if ids else {}
+            derniere_verif = now_dt
+
+            modifies = [nouvelles[mid] for mid in ids if mid in nouvelles and nouvelles[mid] != etat.get(mid)]
+            supprimes = [mid for mid in ids if mid in etat and mid not in nouvelles]
+            if not modifies and not supprimes:
+                yield ": ping\n\n"
+                continue
+
+            locaux_touches = {etat[mid]['local_id'] for mid in supprimes}
+            for ligne in modifies:
+                if ancienne := etat.get(ligne['id']):
+                    locaux_touches.add(ancienne['local_id'])
+                locaux_touches.add(ligne['local_id'])
+                etat[ligne['id']] = ligne
+            for mid in supprimes:
+                etat.pop(mid, None)
+            nouveaux_locaux = [
+                {'local_id': local.id, 'local_nom': local.nom, 'local_adresse': local.adresse or ''}
+                for local in Local.query.filter(Local.id.in_(list(locaux_touches - locaux_connus))).all()
+            ] if locaux_touches - locaux_connus else []
+            locaux_connus.update(local['local_id'] for local in nouveaux_locaux)
+            yield _evenement_sse('delta', {
+                'timestamp': now_dt.strftime('%H:%M:%S'),
+                'materiels': modifies,
+                'supprimes': supprimes,
+                'locaux': nouveaux_locaux,
                 'stats': {
-                    'total_materiels': len(materiels_data),
-                    'total_disponible': sum(m['disponible'] for m in materiels_data),
-                    'total_en_prestation': sum(m['en_prestation'] for m in materiels_data),
-                    'total_maintenance': sum(m['maintenance'] for m in materiels_data),
-                    'total_hors_service': sum(m['hors_service'] for m in materiels_data)
+                    local_id: _stats_disponibilite([l for l in etat.values() if l['local_id'] == local_id])
+                    for local_id in locaux_touches
                 }
             })
-        
+    finally:
+        with _dispo_stream_lock:
+            _dispo_stream_abonnes.discard(abonne)
+
+def _dispo_stream_max_clients():
+    """Plafond des flux SSE, borné à la moitié des threads du serveur."""
+    plafond = max(1, app.config.get('SERVER_THREADS', 8) // 2)
+    return min(app.config.get('DISPO_STREAM_MAX_CLIENTS', 2), plafond)
+
+@app.route('/api/materiels/disponibilites/stream')
+@login_required
+@role_required(['admin', 'manager'])
+def api_materiels_disponibilites_stream():
+    """Flux SSE : instantané initial puis seulement les variations de disponibilité."""
+    abonne = queue.Queue()
+    with _dispo_stream_lock:
+        # Chaque flux occupe un thread du serveur : au-delà, le client repasse en polling
+        if len(_dispo_stream_abonnes) >= _dispo_stream_max_clients():
+            return jsonify({'success': False, 'error': 'Trop de flux ouverts, utilisez le rafraîchissement'}), 503
+        _dispo_stream_abonnes.add(abonne)
+
+    def _liberer():
+        # Client parti avant la première lecture : le finally du générateur ne s'exécute pas
+        with _dispo_stream_lock:
+            _dispo_stream_abonnes.discard(abonne)
+
+    response = Response(
+        stream_with_context(_flux_disponibilites(abonne)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(_liberer)
+    return response
+
+@app.route('/api/materiels/disponibilites')
+@login_required
+@role_required(['admin', 'manager'])
+def api_materiels_disponibilites():
+    """
+    API pour récupérer l'état de disponibilité du matériel en temps réel
+    Retourne pour chaque local : disponible / en prestation / maintenance
+    """
+    try:
         return jsonify({
             'success': True,
             'timestamp': datetime.now().strftime('%H:%M:%S'),
-            'locaux': resultats
+            'locaux': snapshot_disponibilites_materiel()
         })
         
     except Exception as e:
@@ -10026,11 +12084,7 @@ def sortie_materiel_api():
         if not assignation:
             return jsonify({'success': False, 'error': '❌ Matériel non assigné à cette prestation'}), 400
         
-        total_sortie = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-            materiel_id=materiel_id,
-            prestation_id=prestation_id,
-            type_mouvement='sortie'
-        ).scalar() or 0
+        total_sortie, _ = get_solde_mouvement(prestation.id, materiel.id)
         quantite_restante = assignation.quantite - total_sortie
         if quantite_restante <= 0:
             return jsonify({'success': False, 'error': '❌ Tout le matériel est déjà sorti pour cette prestation'}), 400
@@ -10049,11 +12103,7 @@ def sortie_materiel_api():
         )
         db.session.add(mouvement)
         db.session.flush()
-        total_sortie_check = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-            materiel_id=materiel_id,
-            prestation_id=prestation_id,
-            type_mouvement='sortie'
-        ).scalar() or 0
+        total_sortie_check, _ = get_solde_mouvement(prestation.id, materiel.id)
         if total_sortie_check > assignation.quantite:
             db.session.rollback()
             return jsonify({'success': False, 'error': '❌ Conflit de stock, réessayez'}), 409
@@ -10131,16 +12181,7 @@ def retour_materiel_api():
             return jsonify({'success': False, 'error': '❌ Ce matériel n\'est pas assigné à cette prestation'}), 400
 
         # 9. Quantité retournée > quantité sortie
-        total_sortie = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-            materiel_id=materiel_id,
-            prestation_id=prestation_id,
-            type_mouvement='sortie'
-        ).scalar() or 0
-        total_retour = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-            materiel_id=materiel_id,
-            prestation_id=prestation_id,
-            type_mouvement='retour'
-        ).scalar() or 0
+        total_sortie, total_retour = get_solde_mouvement(prestation.id, materiel.id)
         quantite_sortie_restante = total_sortie - total_retour
         if quantite_sortie_restante <= 0:
             return jsonify({'success': False, 'error': '❌ Aucun matériel sorti à retourner'}), 400
@@ -10162,13 +12203,8 @@ def retour_materiel_api():
         )
         db.session.add(mouvement)
         db.session.flush()
-        total_retour_check = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-            materiel_id=materiel_id,
-            prestation_id=prestation_id,
-            type_mouvement='retour'
-        ).scalar() or 0
-        total_sortie_check = total_sortie
-        if total_retour_check > total_sortie:
+        total_sortie_check, total_retour_check = get_solde_mouvement(prestation.id, materiel.id)
+        if total_retour_check > total_sortie_check:
             db.session.rollback()
             return jsonify({'success': False, 'error': '❌ Conflit de stock, réessayez'}), 409
         
@@ -10193,7 +12229,8 @@ def retour_materiel_api():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def _valider_sortie_materiel(materiel, prestation, quantite):
+def _valider_sortie_contexte(materiel, prestation, quantite, dispo=None):
+    """Contrôles de sortie indépendants des soldes (statut, fenêtre, disponibilité)."""
     if not prestation:
         return "Prestation introuvable"
     if prestation.statut not in ['confirmee', 'en_cours']:
@@ -10217,28 +12254,24 @@ def _valider_sortie_materiel(materiel, prestation, quantite):
         return "Prestation terminée"
     if materiel.statut != 'disponible':
         return f"Matériel en {materiel.statut}"
-    dispo = verifier_disponibilite_materiel(
-        materiel_id=materiel.id,
-        quantite_demandee=quantite,
-        date_debut=prestation.date_debut,
-        date_fin=prestation.date_fin,
-        heure_debut=prestation.heure_debut,
-        heure_fin=prestation.heure_fin,
-        exclure_prestation_id=prestation.id
-    )
+    if dispo is None:
+        dispo = verifier_disponibilite_materiel(
+            materiel_id=materiel.id,
+            quantite_demandee=quantite,
+            date_debut=prestation.date_debut,
+            date_fin=prestation.date_fin,
+            heure_debut=prestation.heure_debut,
+            heure_fin=prestation.heure_fin,
+            exclure_prestation_id=prestation.id
+        )
     if not dispo['disponible']:
         return f"Seulement {dispo['quantite_disponible']}/{materiel.quantite} disponible(s)"
-    assignation = MaterielPresta.query.filter_by(
-        materiel_id=materiel.id,
-        prestation_id=prestation.id
-    ).first()
+    return None
+
+def _valider_sortie_stock(assignation, total_sortie, quantite):
+    """Contrôle de la quantité restante à sortir à partir du solde courant."""
     if not assignation:
         return "Matériel non assigné à cette prestation"
-    total_sortie = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-        materiel_id=materiel.id,
-        prestation_id=prestation.id,
-        type_mouvement='sortie'
-    ).scalar() or 0
     quantite_restante = assignation.quantite - total_sortie
     if quantite_restante <= 0:
         return "Tout le matériel est déjà sorti pour cette prestation"
@@ -10246,7 +12279,19 @@ def _valider_sortie_materiel(materiel, prestation, quantite):
         return f"Quantité max restante à sortir: {quantite_restante}"
     return None
 
-def _valider_retour_materiel(materiel, prestation, quantite):
+def _valider_sortie_materiel(materiel, prestation, quantite):
+    error = _valider_sortie_contexte(materiel, prestation, quantite)
+    if error:
+        return error
+    assignation = MaterielPresta.query.filter_by(
+        materiel_id=materiel.id,
+        prestation_id=prestation.id
+    ).first()
+    total_sortie, _ = get_solde_mouvement(prestation.id, materiel.id)
+    return _valider_sortie_stock(assignation, total_sortie, quantite)
+
+def _valider_retour_contexte(prestation):
+    """Contrôles de retour indépendants des soldes (prestation terminée)."""
     if not prestation:
         return "Prestation introuvable"
     start_dt, end_dt = _build_datetime_range(
@@ -10257,22 +12302,12 @@ def _valider_retour_materiel(materiel, prestation, quantite):
     )
     if prestation.statut not in ['terminee', 'annulee'] and (not end_dt or datetime.now() < end_dt):
         return f"Prestation pas terminée (statut: {prestation.statut})"
-    mp = MaterielPresta.query.filter_by(
-        materiel_id=materiel.id,
-        prestation_id=prestation.id
-    ).first()
-    if not mp:
+    return None
+
+def _valider_retour_stock(assignation, total_sortie, total_retour, quantite):
+    """Contrôle de la quantité retournable à partir du solde courant."""
+    if not assignation:
         return "Ce matériel n'est pas assigné à cette prestation"
-    total_sortie = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-        materiel_id=materiel.id,
-        prestation_id=prestation.id,
-        type_mouvement='sortie'
-    ).scalar() or 0
-    total_retour = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-        materiel_id=materiel.id,
-        prestation_id=prestation.id,
-        type_mouvement='retour'
-    ).scalar() or 0
     quantite_sortie_restante = total_sortie - total_retour
     if quantite_sortie_restante <= 0:
         return "Aucun matériel sorti à retourner"
@@ -10280,6 +12315,17 @@ def _valider_retour_materiel(materiel, prestation, quantite):
         return f"Impossible de retourner {quantite}x, seulement {quantite_sortie_restante}x sorti(s)"
     return None
 
+def _valider_retour_materiel(materiel, prestation, quantite):
+    error = _valider_retour_contexte(prestation)
+    if error:
+        return error
+    mp = MaterielPresta.query.filter_by(
+        materiel_id=materiel.id,
+        prestation_id=prestation.id
+    ).first()
+    total_sortie, total_retour = get_solde_mouvement(prestation.id, materiel.id)
+    return _valider_retour_stock(mp, total_sortie, total_retour, quantite)
+
 @app.route('/api/materiel/validate-movement', methods=['POST'])
 @login_required
 @role_required(['admin', 'manager', 'technicien'])
@@ -10322,11 +12368,7 @@ def validate_materiel_movement():
                 materiel_id=materiel.id,
                 prestation_id=prestation.id
             ).first()
-            total_sortie = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-                materiel_id=materiel.id,
-                prestation_id=prestation.id,
-                type_mouvement='sortie'
-            ).scalar() or 0
+            total_sortie, _ = get_solde_mouvement(prestation.id, materiel.id)
             restante = max(0, (assignation.quantite if assignation else 0) - total_sortie)
             return jsonify({'success': True, 'ok': True, 'message': f'OK · reste {restante} dispo'}), 200
 
@@ -10339,16 +12381,7 @@ def validate_materiel_movement():
         error = _valider_retour_materiel(materiel, prestation, quantite)
         if error:
             return jsonify({'success': True, 'ok': False, 'message': error}), 200
-        total_sortie = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-            materiel_id=materiel.id,
-            prestation_id=prestation.id,
-            type_mouvement='sortie'
-        ).scalar() or 0
-        total_retour = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-            materiel_id=materiel.id,
-            prestation_id=prestation.id,
-            type_mouvement='retour'
-        ).scalar() or 0
+        total_sortie, total_retour = get_solde_mouvement(prestation.id, materiel.id)
         quantite_sortie_restante = total_sortie - total_retour
         if quantite < quantite_sortie_restante and materiel.local_id and materiel.local_id != local_retour.id:
             return jsonify({'success': True, 'ok': False, 'message': 'Retour partiel vers un autre local non autorisé'}), 200
@@ -10397,57 +12430,83 @@ def sortie_materiel_batch_api():
             return jsonify({'success': False, 'error': 'Aucun matériel valide', 'results': results}), 400
         success_count = 0
 
-        with locked_transaction():
-            prestation = db.session.get(Prestation, prestation_id)
-            if not prestation:
-                return jsonify({'success': False, 'error': 'Prestation introuvable'}), 404
-            current_user = get_current_user()
-            if current_user and current_user.role == 'technicien':
-                if not prestation.technicien_id or prestation.technicien_id != current_user.id:
-                    return jsonify({'success': False, 'error': '❌ Vous n’êtes pas assigné à cette prestation'}), 403
-
-            for materiel_id, quantite in normalized_items.items():
-                materiel = db.session.get(Materiel, materiel_id)
-                if not materiel:
-                    results.append({'materiel_id': materiel_id, 'success': False, 'message': 'Matériel introuvable'})
-                    continue
-                error = _valider_sortie_materiel(materiel, prestation, quantite)
-                if error:
-                    results.append({'materiel_id': materiel.id, 'success': False, 'message': error})
-                    continue
-                mouvement = MouvementMateriel(
-                    materiel_id=materiel.id,
-                    prestation_id=prestation.id if prestation else None,
-                    type_mouvement='sortie',
-                    quantite=quantite,
-                    local_depart_id=materiel.local_id,
-                    utilisateur_id=session.get('user_id'),
-                    notes=f"Sortie batch pour {prestation.client if prestation else ''}"
-                )
-                db.session.add(mouvement)
+        prestation = db.session.get(Prestation, prestation_id)
+        if not prestation:
+            return jsonify({'success': False, 'error': 'Prestation introuvable'}), 404
+        current_user = get_current_user()
+        if current_user and current_user.role == 'technicien':
+            if not prestation.technicien_id or prestation.technicien_id != current_user.id:
+                return jsonify({'success': False, 'error': '❌ Vous n’êtes pas assigné à cette prestation'}), 403
+
+        # Contrôles hors verrou : statut, fenêtre logistique et disponibilité (requêtes groupées)
+        materiels = {
+            m.id: m for m in Materiel.query.filter(Materiel.id.in_(list(normalized_items))).all()
+        }
+        dispos = verifier_disponibilite_materiels(
+            list(materiels),
+            prestation.date_debut,
+            prestation.date_fin,
+            prestation.heure_debut,
+            prestation.heure_fin,
+            quantites=normalized_items,
+            exclure_prestation_id=prestation.id
+        ) if materiels else {}
+        candidats = []
+        for materiel_id, quantite in normalized_items.items():
+            materiel = materiels.get(materiel_id)
+            if not materiel:
+                results.append({'materiel_id': materiel_id, 'success': False, 'message': 'Matériel introuvable'})
+                continue
+            error = _valider_sortie_contexte(materiel, prestation, quantite, dispo=dispos.get(materiel_id))
+            if error:
+                results.append({'materiel_id': materiel.id, 'success': False, 'message': error})
+                continue
+            candidats.append((materiel, quantite))
+
+        if candidats:
+            # Sous verrou : uniquement la lecture des soldes et l'écriture des mouvements
+            with locked_transaction():
+                candidat_ids = [materiel.id for materiel, _ in candidats]
+                assignations = {
+                    a.materiel_id: a for a in MaterielPresta.query.filter(
+                        MaterielPresta.prestation_id == prestation.id,
+                        MaterielPresta.materiel_id.in_(candidat_ids)
+                    ).all()
+                }
+                soldes = get_soldes_mouvements(prestation.id, candidat_ids)
+                sortis = []
+                for materiel, quantite in candidats:
+                    total_sortie, _ = soldes.get(materiel.id, (0, 0))
+                    error = _valider_sortie_stock(assignations.get(materiel.id), total_sortie, quantite)
+                    if error:
+                        results.append({'materiel_id': materiel.id, 'success': False, 'message': error})
+                        continue
+                    db.session.add(MouvementMateriel(
+                        materiel_id=materiel.id,
+                        prestation_id=prestation.id,
+                        type_mouvement='sortie',
+                        quantite=quantite,
+                        local_depart_id=materiel.local_id,
+                        utilisateur_id=session.get('user_id'),
+                        notes=f"Sortie batch pour {prestation.client}"
+                    ))
+                    sortis.append((materiel, quantite))
                 db.session.flush()
-                assignation = MaterielPresta.query.filter_by(
-                    materiel_id=materiel.id,
-                    prestation_id=prestation.id
-                ).first()
-                total_sortie_check = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-                    materiel_id=materiel.id,
-                    prestation_id=prestation.id,
-                    type_mouvement='sortie'
-                ).scalar() or 0
-                if assignation and total_sortie_check > assignation.quantite:
-                    db.session.rollback()
-                    return jsonify({'success': False, 'error': 'Conflit de stock, réessayez'}), 409
-                success_count += 1
-                results.append({'materiel_id': materiel.id, 'success': True, 'message': f"{quantite}x {materiel.nom} sorti(s)"})
+                soldes_apres = get_soldes_mouvements(prestation.id, [materiel.id for materiel, _ in sortis])
+                for materiel, quantite in sortis:
+                    if soldes_apres.get(materiel.id, (0, 0))[0] > assignations[materiel.id].quantite:
+                        db.session.rollback()
+                        return jsonify({'success': False, 'error': 'Conflit de stock, réessayez'}), 409
+                    success_count += 1
+                    results.append({'materiel_id': materiel.id, 'success': True, 'message': f"{quantite}x {materiel.nom} sorti(s)"})
 
-            db.session.commit()
+                db.session.commit()
         AuditLog.log_action(
             action='creation',
             entite_type='mouvement',
-            entite_id=prestation.id if prestation else None,
-            entite_nom=f"Sortie batch {prestation.client if prestation else ''}",
-            details={'mode': 'sortie', 'prestation_id': prestation.id if prestation else None, 'items': len(normalized_items), 'success': success_count}
+            entite_id=prestation.id,
+            entite_nom=f"Sortie batch {prestation.client}",
+            details={'mode': 'sortie', 'prestation_id': prestation.id, 'items': len(normalized_items), 'success': success_count}
         )
         return jsonify({
             'success': True,
@@ -10476,78 +12535,85 @@ def retour_materiel_batch_api():
             return jsonify({'success': False, 'error': 'Aucun matériel valide', 'results': results}), 400
         success_count = 0
 
-        with locked_transaction():
-            prestation = db.session.get(Prestation, prestation_id)
-            if not prestation:
-                return jsonify({'success': False, 'error': 'Prestation introuvable'}), 404
-            current_user = get_current_user()
-            if current_user and current_user.role == 'technicien':
-                if not prestation.technicien_id or prestation.technicien_id != current_user.id:
-                    return jsonify({'success': False, 'error': '❌ Vous n’êtes pas assigné à cette prestation'}), 403
-            local_retour = db.session.get(Local, local_retour_id) if local_retour_id else None
-            if not local_retour:
-                return jsonify({'success': False, 'error': 'Local introuvable'}), 400
-
-            for materiel_id, quantite in normalized_items.items():
-                materiel = db.session.get(Materiel, materiel_id)
-                if not materiel:
-                    results.append({'materiel_id': materiel_id, 'success': False, 'message': 'Matériel introuvable'})
-                    continue
-                error = _valider_retour_materiel(materiel, prestation, quantite)
-                if error:
-                    results.append({'materiel_id': materiel.id, 'success': False, 'message': error})
-                    continue
-                total_sortie = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-                    materiel_id=materiel.id,
-                    prestation_id=prestation.id,
-                    type_mouvement='sortie'
-                ).scalar() or 0
-                total_retour = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-                    materiel_id=materiel.id,
-                    prestation_id=prestation.id,
-                    type_mouvement='retour'
-                ).scalar() or 0
-                quantite_sortie_restante = total_sortie - total_retour
-                if quantite < quantite_sortie_restante and materiel.local_id and materiel.local_id != local_retour.id:
-                    results.append({'materiel_id': materiel.id, 'success': False, 'message': 'Retour partiel vers un autre local non autorisé'})
-                    continue
-                mouvement = MouvementMateriel(
-                    materiel_id=materiel.id,
-                    prestation_id=prestation.id if prestation else None,
-                    type_mouvement='retour',
-                    quantite=quantite,
-                    local_retour_id=local_retour.id,
-                    utilisateur_id=session.get('user_id'),
-                    notes=f"Retour batch de {prestation.client if prestation else ''}"
-                )
-                db.session.add(mouvement)
+        prestation = db.session.get(Prestation, prestation_id)
+        if not prestation:
+            return jsonify({'success': False, 'error': 'Prestation introuvable'}), 404
+        current_user = get_current_user()
+        if current_user and current_user.role == 'technicien':
+            if not prestation.technicien_id or prestation.technicien_id != current_user.id:
+                return jsonify({'success': False, 'error': '❌ Vous n’êtes pas assigné à cette prestation'}), 403
+        local_retour = db.session.get(Local, local_retour_id) if local_retour_id else None
+        if not local_retour:
+            return jsonify({'success': False, 'error': 'Local introuvable'}), 400
+
+        # Contrôles hors verrou
+        materiels = {
+            m.id: m for m in Materiel.query.filter(Materiel.id.in_(list(normalized_items))).all()
+        }
+        erreur_contexte = _valider_retour_contexte(prestation)
+        candidats = []
+        for materiel_id, quantite in normalized_items.items():
+            materiel = materiels.get(materiel_id)
+            if not materiel:
+                results.append({'materiel_id': materiel_id, 'success': False, 'message': 'Matériel introuvable'})
+                continue
+            if erreur_contexte:
+                results.append({'materiel_id': materiel.id, 'success': False, 'message': erreur_contexte})
+                continue
+            candidats.append((materiel, quantite))
+
+        if candidats:
+            # Sous verrou : uniquement la lecture des soldes et l'écriture des mouvements
+            with locked_transaction():
+                candidat_ids = [materiel.id for materiel, _ in candidats]
+                assignations = {
+                    a.materiel_id: a for a in MaterielPresta.query.filter(
+                        MaterielPresta.prestation_id == prestation.id,
+                        MaterielPresta.materiel_id.in_(candidat_ids)
+                    ).all()
+                }
+                soldes = get_soldes_mouvements(prestation.id, candidat_ids)
+                retournes = []
+                for materiel, quantite in candidats:
+                    total_sortie, total_retour = soldes.get(materiel.id, (0, 0))
+                    error = _valider_retour_stock(assignations.get(materiel.id), total_sortie, total_retour, quantite)
+                    if error:
+                        results.append({'materiel_id': materiel.id, 'success': False, 'message': error})
+                        continue
+                    quantite_sortie_restante = total_sortie - total_retour
+                    if quantite < quantite_sortie_restante and materiel.local_id and materiel.local_id != local_retour.id:
+                        results.append({'materiel_id': materiel.id, 'success': False, 'message': 'Retour partiel vers un autre local non autorisé'})
+                        continue
+                    db.session.add(MouvementMateriel(
+                        materiel_id=materiel.id,
+                        prestation_id=prestation.id,
+                        type_mouvement='retour',
+                        quantite=quantite,
+                        local_retour_id=local_retour.id,
+                        utilisateur_id=session.get('user_id'),
+                        notes=f"Retour batch de {prestation.client}"
+                    ))
+                    retournes.append((materiel, quantite))
                 db.session.flush()
-                total_sortie_check = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-                    materiel_id=materiel.id,
-                    prestation_id=prestation.id,
-                    type_mouvement='sortie'
-                ).scalar() or 0
-                total_retour_check = db.session.query(db.func.coalesce(db.func.sum(MouvementMateriel.quantite), 0)).filter_by(
-                    materiel_id=materiel.id,
-                    prestation_id=prestation.id,
-                    type_mouvement='retour'
-                ).scalar() or 0
-                if total_retour_check > total_sortie_check:
-                    db.session.rollback()
-                    return jsonify({'success': False, 'error': 'Conflit de stock, réessayez'}), 409
-                all_returned = total_retour_check >= total_sortie_check and total_sortie_check > 0
-                if all_returned and total_sortie_check >= materiel.quantite:
-                    materiel.local_id = local_retour.id
-                success_count += 1
-                results.append({'materiel_id': materiel.id, 'success': True, 'message': f"{quantite}x {materiel.nom} retourné(s)"})
+                soldes_apres = get_soldes_mouvements(prestation.id, [materiel.id for materiel, _ in retournes])
+                for materiel, quantite in retournes:
+                    total_sortie_check, total_retour_check = soldes_apres.get(materiel.id, (0, 0))
+                    if total_retour_check > total_sortie_check:
+                        db.session.rollback()
+                        return jsonify({'success': False, 'error': 'Conflit de stock, réessayez'}), 409
+                    all_returned = total_retour_check >= total_sortie_check and total_sortie_check > 0
+                    if all_returned and total_sortie_check >= materiel.quantite:
+                        materiel.local_id = local_retour.id
+                    success_count += 1
+                    results.append({'materiel_id': materiel.id, 'success': True, 'message': f"{quantite}x {materiel.nom} retourné(s)"})
 
-            db.session.commit()
+                db.session.commit()
         AuditLog.log_action(
             action='creation',
             entite_type='mouvement',
-            entite_id=prestation.id if prestation else None,
-            entite_nom=f"Retour batch {prestation.client if prestation else ''}",
-            details={'mode': 'retour', 'prestation_id': prestation.id if prestation else None, 'items': len(normalized_items), 'success': success_count}
+            entite_id=prestation.id,
+            entite_nom=f"Retour batch {prestation.client}",
+            details={'mode': 'retour', 'prestation_id': prestation.id, 'items': len(normalized_items), 'success': success_count}
         )
         return jsonify({
             'success': True,
@@ -10839,21 +12905,21 @@ def check_materiel_disponibilite_reservation(reservation_id):
         )
         
         # Récupérer TOUS les matériels
-        tous_materiels = Materiel.query.all()
+        tous_materiels = Materiel.query.options(joinedload(Materiel.local)).all()
         
         resultats = []
+        # Vérification groupée (1 unité), en excluant cette réservation si déjà assignée
+        disponibilites = verifier_disponibilite_materiels(
+            [materiel.id for materiel in tous_materiels],
+            reservation.date_souhaitee,
+            date_fin_reservation,
+            heure_debut=reservation.heure_souhaitee,
+            heure_fin=heure_fin_reservation,
+            exclure_reservation_id=reservation_id
+        )
         
         for materiel in tous_materiels:
-            # Vérifier disponibilité avec la fonction existante
-            dispo = verifier_disponibilite_materiel(
-                materiel_id=materiel.id,
-                quantite_demandee=1,  # On vérifie pour 1 unité
-                date_debut=reservation.date_souhaitee,
-                date_fin=date_fin_reservation,
-                heure_debut=reservation.heure_souhaitee,
-                heure_fin=heure_fin_reservation,
-                exclure_reservation_id=reservation_id  # Exclure cette réservation si déjà assignée
-            )
+            dispo = disponibilites[materiel.id]
             
             # Construire le résultat pour ce matériel
             resultat = {
@@ -10926,10 +12992,14 @@ def locals():
     heure_fin = (now + timedelta(minutes=1)).time()
     if heure_fin < heure_debut:
         heure_fin = time(23, 59, 59)
+    statuts = get_materiels_status_at_time(
+        [materiel for local in locals for materiel in local.materiels],
+        now.date(), heure_debut, heure_fin
+    )
     for local in locals:
         local.materiels_en_prestation = sum(
             1 for materiel in local.materiels
-            if get_materiel_status_at_time(materiel.id, now.date(), heure_debut, heure_fin) in {'occupe', 'partiel'}
+            if statuts.get(materiel.id) in {'occupe', 'partiel'}
         )
     return render_template('locals.html', locals=locals)
 
@@ -11001,62 +13071,20 @@ def supprimer_local(local_id):
 def affichage_local(local_id):
     """Interface d'affichage pour un local (lecture seule)"""
     local = get_or_404(Local, local_id)
-    materiels = Materiel.query.filter_by(local_id=local_id).all()
-    now = datetime.now()
-    heure_debut = now.time()
-    heure_fin = (now + timedelta(minutes=1)).time()
-    if heure_fin < heure_debut:
-        heure_fin = time(23, 59, 59)
-    for materiel in materiels:
-        materiel.statut_affichage = get_materiel_status_at_time(
-            materiel.id,
-            now.date(),
-            heure_debut,
-            heure_fin
-        )
-    return render_template('affichage_local.html', local=local, materiels=materiels)
+    etat = statut_materiels_local(local_id)
+    return render_template('affichage_local.html', local=local, materiels=etat['materiels'], totaux=etat['totaux'])
 
 @app.route('/api/materiels/local/<int:local_id>')
 @login_required
 def api_materiels_local(local_id):
     """API pour récupérer les matériels d'un local (pour rafraîchissement AJAX)"""
-    materiels = Materiel.query.filter_by(local_id=local_id).all()
-    now = datetime.now()
-    heure_debut = now.time()
-    heure_fin = (now + timedelta(minutes=1)).time()
-    if heure_fin < heure_debut:
-        heure_fin = time(23, 59, 59)
-    prestations = Prestation.query.join(MaterielPresta).filter(
-        MaterielPresta.materiel_id.in_([m.id for m in materiels]),
-        Prestation.statut.in_(['planifiee', 'confirmee', 'en_cours'])
-    ).all()
-    prestation_map = {}
-    sortie_avant_h, retour_apres_h = _get_materiel_logistique_buffers()
-    for presta in prestations:
-        start_dt, end_dt = _build_datetime_range(
-            presta.date_debut,
-            presta.date_fin,
-            presta.heure_debut or time(0, 0),
-            presta.heure_fin or time(23, 59)
-        )
-        if not start_dt or not end_dt:
-            continue
-        window_start = start_dt - timedelta(hours=sortie_avant_h)
-        window_end = end_dt + timedelta(hours=retour_apres_h)
-        if not (window_start <= now <= window_end):
-            continue
-        for mp in presta.materiel_assignations:
-            if mp.materiel_id not in prestation_map:
-                prestation_map[mp.materiel_id] = presta.client
-    return jsonify([{
-        'id': m.id,
-        'nom': m.nom,
-        'categorie': m.categorie,
-        'quantite': m.quantite,
-        'statut': m.statut,
-        'statut_affichage': get_materiel_status_at_time(m.id, now.date(), heure_debut, heure_fin),
-        'prestation': prestation_map.get(m.id)
-    } for m in materiels])
+    etat = statut_materiels_local(local_id)
+    return jsonify({
+        'success': True,
+        'timestamp': datetime.now().strftime('%H:%M:%S'),
+        'materiels': etat['materiels'],
+        'totaux': etat['totaux']
+    })
 
 @app.route('/djs')
 @login_required
@@ -11243,6 +13271,9 @@ def rapports():
 @login_required
 def api_stats():
     """API pour les statistiques en temps réel"""
+    statuts_jour = get_materiels_status_at_time(
+        Materiel.query.all(), date.today(), time(0, 0), time(23, 59)
+    )
     stats = {
         'prestations_aujourdhui': Prestation.query.filter(
             Prestation.date_debut <= date.today(),
@@ -11250,8 +13281,7 @@ def api_stats():
         ).count(),
         'materiels_disponibles': Materiel.query.filter_by(statut='disponible').count(),
         'materiels_en_prestation': sum(
-            1 for m in Materiel.query.all()
-            if get_materiel_status_at_time(m.id, date.today(), time(0, 0), time(23, 59)) in {'occupe', 'partiel'}
+            1 for statut in statuts_jour.values() if statut in {'occupe', 'partiel'}
         ),
         'prestations_ce_mois': Prestation.query.filter(
             Prestation.date_debut >= date.today().replace(day=1)
@@ -11312,13 +13342,108 @@ def recherche():
     
     return render_template('recherche.html', query=query, results=results)
 
-@app.route('/api/materiels/available', methods=['POST'])
-@login_required
-def api_materiels_available():
-    """API pour récupérer le matériel disponible sur une période donnée."""
-    data = request.get_json(silent=True) or {}
-    date_debut_str = data.get('date_debut')
-    date_fin_str = data.get('date_fin')
+def _coordonnees_cible(lieu, exclude_prestation_id=None, parametres=None):
+    """(coords, mode) du lieu de prestation, ou de l'entreprise à défaut ; (None, None) si inconnu."""
+    if not app.config.get('ADDRESS_VALIDATION_ENABLED'):
+        return None, None
+    if lieu and exclude_prestation_id:
+        # Mission existante au même lieu : coordonnées déjà stockées
+        prestation_existante = db.session.get(Prestation, exclude_prestation_id)
+        if prestation_existante and normalize_whitespace(prestation_existante.lieu) == lieu:
+            coords = coordonnees_stockees(prestation_existante)
+            if coords:
+                return coords, 'prestation'
+    if lieu:
+        geo, err = geocode_address(lieu, contact_email=parametres.email if parametres else None)
+        if geo:
+            return (geo['lat'], geo['lng']), 'prestation'
+    company_coords = get_company_coordinates(parametres)
+    if company_coords:
+        return company_coords, 'entreprise'
+    return None, None
+
+def locaux_pouvant_fournir(materiel_id, quantite, cible, date_debut, date_fin, heure_debut=None, heure_fin=None,
+                           k=3, exclure_prestation_id=None, exclure_reservation_id=None):
+    """
+    Les k locaux les plus proches pouvant fournir `quantite` exemplaires d'un matériel.
+
+    Un même article stocké dans plusieurs locaux correspond à plusieurs fiches
+    Materiel de même nom : leurs disponibilités sont vérifiées en masse puis
+    cumulées par local, et les locaux retenus classés par distance à `cible`.
+
+    Args:
+        materiel_id: fiche de référence de l'article
+        cible: (lat, lng) du lieu, ou None (classement par quantité disponible)
+
+    Returns:
+        list: [{local_id, local, distance_km, quantite_disponible, materiel_ids}]
+    """
+    reference = db.session.get(Materiel, materiel_id)
+    if not reference:
+        return []
+    fiches = Materiel.query.options(joinedload(Materiel.local)).filter(
+        db.func.lower(Materiel.nom) == (reference.nom or '').lower(),
+        ~Materiel.statut.in_(STATUTS_MATERIEL_INDISPONIBLES)
+    ).all()
+    disponibilites = verifier_disponibilite_materiels(
+        [fiche.id for fiche in fiches], date_debut, date_fin, heure_debut=heure_debut, heure_fin=heure_fin,
+        exclure_prestation_id=exclure_prestation_id, exclure_reservation_id=exclure_reservation_id
+    )
+    par_local = {}
+    for fiche in fiches:
+        disponible = disponibilites.get(fiche.id, {}).get('quantite_disponible', 0) or 0
+        if disponible <= 0:
+            continue
+        entree = par_local.setdefault(fiche.local_id, {
+            'local_id': fiche.local_id,
+            'local': fiche.local.nom if fiche.local else '',
+            'distance_km': None,
+            'quantite_disponible': 0,
+            'materiel_ids': [],
+        })
+        entree['quantite_disponible'] += disponible
+        entree['materiel_ids'].append(fiche.id)
+    k = max(1, int(k))
+    # Ordre de départage à distance égale : quantité disponible décroissante (tri stable)
+    candidats = sorted(
+        (entree for entree in par_local.values() if entree['quantite_disponible'] >= quantite),
+        key=lambda c: (-c['quantite_disponible'], c['local_id'])
+    )
+    if not cible or not candidats:
+        return candidats[:k]
+    from geo_ranking import rank_by_distance
+
+    coords = {
+        ligne.id: ligne for ligne in db.session.query(Local.id, Local.adresse_lat, Local.adresse_lng).filter(
+            Local.id.in_([c['local_id'] for c in candidats]),
+            Local.adresse_lat.isnot(None), Local.adresse_lng.isnot(None)
+        ).all()
+    }
+    places = [c for c in candidats if c['local_id'] in coords]
+    retenus = []
+    if places:
+        # Sélection partielle des k plus proches, sans trier tous les candidats
+        ordre, distances = rank_by_distance(
+            cible[0], cible[1],
+            [coords[c['local_id']].adresse_lat for c in places],
+            [coords[c['local_id']].adresse_lng for c in places],
+            k=k
+        )
+        facteur = facteur_detour()
+        for indice, km in zip(ordre, distances):
+            places[indice]['distance_km'] = round(float(km) * facteur, 2)
+            retenus.append(places[indice])
+    # Locaux sans coordonnées : après les locaux situés
+    retenus.extend([c for c in candidats if c['local_id'] not in coords][:k - len(retenus)])
+    return retenus
+
+@app.route('/api/materiels/available', methods=['POST'])
+@login_required
+def api_materiels_available():
+    """API pour récupérer le matériel disponible sur une période donnée."""
+    data = request.get_json(silent=True) or {}
+    date_debut_str = data.get('date_debut')
+    date_fin_str = data.get('date_fin')
     heure_debut_str = data.get('heure_debut')
     heure_fin_str = data.get('heure_fin')
     lieu = normalize_whitespace(data.get('lieu', ''))
@@ -11366,49 +13491,26 @@ def api_materiels_available():
             'available': []
         })
 
-    parametres = ParametresEntreprise.query.first()
-    contact_email = parametres.email if parametres else None
-
-    target_coords = None
-    distance_mode = None
-    if app.config.get('ADDRESS_VALIDATION_ENABLED'):
-        if lieu:
-            geo, err = geocode_address(lieu, contact_email=contact_email)
-            if geo:
-                target_coords = (geo['lat'], geo['lng'])
-                distance_mode = 'prestation'
-        if not target_coords:
-            company_coords = get_company_coordinates(parametres)
-            if company_coords:
-                target_coords = company_coords
-                distance_mode = 'entreprise'
-
-    local_geo_cache = {}
-
-    def get_local_coords(local):
-        if not local or not local.adresse:
-            return None
-        if local.id in local_geo_cache:
-            return local_geo_cache[local.id]
-        geo, _ = geocode_address(local.adresse, contact_email=contact_email)
-        coords = (geo['lat'], geo['lng']) if geo else None
-        local_geo_cache[local.id] = coords
-        return coords
+    parametres = get_parametres_entreprise()
+    target_coords, distance_mode = _coordonnees_cible(lieu, exclude_prestation_id, parametres)
 
     available = []
-    materiels = Materiel.query.options(joinedload(Materiel.local)).all()
+    materiels = [
+        materiel for materiel in Materiel.query.options(joinedload(Materiel.local)).all()
+        if materiel.statut not in STATUTS_MATERIEL_INDISPONIBLES or materiel.id in include_ids
+    ]
+    disponibilites = verifier_disponibilite_materiels(
+        [materiel.id for materiel in materiels],
+        date_debut,
+        date_fin,
+        heure_debut=heure_debut,
+        heure_fin=heure_fin,
+        exclure_prestation_id=exclude_prestation_id
+    )
+    # Une seule opération vectorisée pour tous les locaux
+    distances = distances_locaux(target_coords[0], target_coords[1]) if target_coords else {}
     for materiel in materiels:
-        if materiel.statut in ['maintenance', 'hors_service', 'archive'] and materiel.id not in include_ids:
-            continue
-        dispo = verifier_disponibilite_materiel(
-            materiel_id=materiel.id,
-            quantite_demandee=1,
-            date_debut=date_debut,
-            date_fin=date_fin,
-            heure_debut=heure_debut,
-            heure_fin=heure_fin,
-            exclure_prestation_id=exclude_prestation_id
-        )
+        dispo = disponibilites.get(materiel.id, {})
         is_disponible = bool(dispo.get('disponible'))
         if not is_disponible and materiel.id not in include_ids:
             continue
@@ -11426,13 +13528,8 @@ def api_materiels_available():
             'force_included': (not is_disponible and materiel.id in include_ids)
         }
 
-        if target_coords:
-            coords = get_local_coords(materiel.local)
-            if coords:
-                distance_km, _ = compute_distance_km(
-                    coords[0], coords[1], target_coords[0], target_coords[1]
-                )
-                item['distance_km'] = distance_km
+        if materiel.local_id in distances:
+            item['distance_km'] = distances[materiel.local_id]
 
         available.append(item)
 
@@ -11477,6 +13574,167 @@ def api_materiels_available():
         'distance_mode': distance_mode
     })
 
+@app.route('/api/materiels/<int:materiel_id>/locaux-proches', methods=['POST'])
+@login_required
+def api_materiel_locaux_proches(materiel_id):
+    """API : les k locaux les plus proches du lieu pouvant fournir la quantité demandée (devis, réservations)."""
+    data = request.get_json(silent=True) or {}
+    try:
+        quantite = max(1, int(data.get('quantite') or 1))
+        k = min(max(1, int(data.get('k') or 3)), 20)
+        date_debut = datetime.strptime(data.get('date_debut') or '', '%Y-%m-%d').date()
+        date_fin = datetime.strptime(data.get('date_fin') or data.get('date_debut') or '', '%Y-%m-%d').date()
+        heure_debut = datetime.strptime(data['heure_debut'], '%H:%M').time() if data.get('heure_debut') else None
+        heure_fin = datetime.strptime(data['heure_fin'], '%H:%M').time() if data.get('heure_fin') else None
+        exclude_prestation_id = int(data['exclude_prestation_id']) if data.get('exclude_prestation_id') else None
+        exclude_reservation_id = int(data['exclude_reservation_id']) if data.get('exclude_reservation_id') else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Paramètres invalides'}), 400
+    if not db.session.get(Materiel, materiel_id):
+        return jsonify({'success': False, 'error': 'Matériel introuvable'}), 404
+
+    lieu = normalize_whitespace(data.get('lieu', ''))
+    cible, distance_mode = _coordonnees_cible(lieu, exclude_prestation_id, get_parametres_entreprise())
+    locaux = locaux_pouvant_fournir(
+        materiel_id, quantite, cible, date_debut, date_fin, heure_debut=heure_debut, heure_fin=heure_fin, k=k,
+        exclure_prestation_id=exclude_prestation_id, exclure_reservation_id=exclude_reservation_id
+    )
+    return jsonify({
+        'success': True,
+        'locaux': locaux,
+        'sorted_by_distance': bool(cible),
+        'distance_mode': distance_mode
+    })
+
+@app.route('/api/staff/disponibilites', methods=['POST'])
+@login_required
+@role_required(['admin', 'manager'])
+def api_staff_disponibilites():
+    """API batch : quels prestataires (DJ ou techniciens) sont libres sur un créneau."""
+    data = request.get_json(silent=True) or {}
+    staff_type = data.get('staff_type', 'dj')
+    if staff_type not in ('dj', 'technicien'):
+        return jsonify({'success': False, 'error': 'Type de prestataire invalide'}), 400
+    try:
+        date_debut = datetime.strptime(data.get('date_debut') or '', '%Y-%m-%d').date()
+        date_fin = datetime.strptime(data.get('date_fin') or data.get('date_debut') or '', '%Y-%m-%d').date()
+        heure_debut = datetime.strptime(data.get('heure_debut') or '', '%H:%M').time()
+        heure_fin = datetime.strptime(data.get('heure_fin') or '', '%H:%M').time()
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Dates ou horaires invalides'}), 400
+    try:
+        exclude_prestation_id = int(data['exclude_prestation_id']) if data.get('exclude_prestation_id') else None
+    except (TypeError, ValueError):
+        exclude_prestation_id = None
+
+    staff_ids = set()
+    for raw_id in data.get('staff_ids') or []:
+        try:
+            staff_ids.add(int(raw_id))
+        except (TypeError, ValueError):
+            continue
+    if not staff_ids:
+        if staff_type == 'dj':
+            staff_ids = {row[0] for row in db.session.query(DJ.id).all()}
+        else:
+            staff_ids = {row[0] for row in db.session.query(User.id).filter(
+                User.role == 'technicien', User.actif.is_(True)
+            ).all()}
+
+    resultats = check_staff_availability_batch(
+        staff_type, sorted(staff_ids), date_debut, date_fin, heure_debut, heure_fin, exclude_prestation_id
+    )
+    return jsonify({
+        'success': True,
+        'staff_type': staff_type,
+        'disponibilites': [
+            {'id': staff_id, 'disponible': ok, 'message': message}
+            for staff_id, (ok, message) in resultats.items()
+        ],
+        'disponibles': [staff_id for staff_id, (ok, _) in resultats.items() if ok]
+    })
+
+@app.route('/api/creneaux/evaluer', methods=['POST'])
+@login_required
+@role_required(['admin', 'manager'])
+def api_evaluer_creneaux():
+    """
+    Évalue en une fois plusieurs créneaux candidats pour un devis ou une réservation.
+
+    Corps JSON : creneaux [{date_debut, date_fin?, heure_debut?, heure_fin?}],
+    materiels [{materiel_id, quantite}], dj_ids / technicien_ids (ou dj_requis /
+    technicien_requis pour tous), exclude_prestation_id, exclude_reservation_id.
+    """
+    data = request.get_json(silent=True) or {}
+    creneaux_raw = data.get('creneaux') or []
+    if not isinstance(creneaux_raw, list) or not creneaux_raw:
+        return jsonify({'success': False, 'error': 'Aucun créneau fourni'}), 400
+    if len(creneaux_raw) > CRENEAUX_MAX:
+        return jsonify({'success': False, 'error': f'Maximum {CRENEAUX_MAX} créneaux'}), 400
+
+    creneaux = []
+    try:
+        for item in creneaux_raw:
+            date_debut = datetime.strptime(item.get('date_debut') or '', '%Y-%m-%d').date()
+            date_fin = datetime.strptime(item['date_fin'], '%Y-%m-%d').date() if item.get('date_fin') else date_debut
+            heure_debut = datetime.strptime(item['heure_debut'], '%H:%M').time() if item.get('heure_debut') else None
+            heure_fin = datetime.strptime(item['heure_fin'], '%H:%M').time() if item.get('heure_fin') else None
+            creneaux.append((date_debut, date_fin, heure_debut, heure_fin))
+    except (AttributeError, ValueError):
+        return jsonify({'success': False, 'error': 'Créneau invalide (dates YYYY-MM-DD, heures HH:MM)'}), 400
+
+    besoins = {}
+    for item in data.get('materiels') or []:
+        try:
+            materiel_id = int(item.get('materiel_id'))
+            quantite = int(item.get('quantite', 1))
+        except (AttributeError, TypeError, ValueError):
+            continue
+        if quantite > 0:
+            besoins[materiel_id] = besoins.get(materiel_id, 0) + quantite
+
+    def _ids(key):
+        ids = []
+        for raw_id in data.get(key) or []:
+            try:
+                ids.append(int(raw_id))
+            except (TypeError, ValueError):
+                continue
+        return ids
+
+    dj_ids = _ids('dj_ids')
+    if not dj_ids and data.get('dj_requis'):
+        dj_ids = [row[0] for row in db.session.query(DJ.id).all()]
+    technicien_ids = _ids('technicien_ids')
+    if not technicien_ids and data.get('technicien_requis'):
+        technicien_ids = [row[0] for row in db.session.query(User.id).filter(
+            User.role == 'technicien', User.actif.is_(True)
+        ).all()]
+
+    def _id_optionnel(key):
+        try:
+            return int(data[key]) if data.get(key) else None
+        except (TypeError, ValueError):
+            return None
+
+    try:
+        resultats = evaluer_creneaux(
+            creneaux,
+            besoins,
+            dj_ids=dj_ids or None,
+            technicien_ids=technicien_ids or None,
+            exclure_prestation_id=_id_optionnel('exclude_prestation_id'),
+            exclure_reservation_id=_id_optionnel('exclude_reservation_id')
+        )
+        return jsonify({
+            'success': True,
+            'creneaux': resultats,
+            'faisables': sum(1 for r in resultats if r['faisable'])
+        })
+    except Exception as e:
+        logger.error(f"Erreur évaluation créneaux: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/rapports-data')
 @login_required
 def api_rapports_data():
@@ -11795,6 +14053,31 @@ def ensure_materiel_schema():
         logger.warning(f"Impossible de vérifier/mettre à jour le schéma materiels: {e}")
         db.session.rollback()
 
+def ensure_locals_schema():
+    """Ajoute les colonnes manquantes sur la table locals (SQLite)."""
+    try:
+        existing_cols = set()
+        result = db.session.execute(db.text("PRAGMA table_info(locals)"))
+        for row in result.fetchall():
+            existing_cols.add(row[1])
+        missing = []
+        if 'adresse_lat' not in existing_cols:
+            missing.append("ALTER TABLE locals ADD COLUMN adresse_lat FLOAT")
+        if 'adresse_lng' not in existing_cols:
+            missing.append("ALTER TABLE locals ADD COLUMN adresse_lng FLOAT")
+        if 'adresse_geocode_statut' not in existing_cols:
+            missing.append("ALTER TABLE locals ADD COLUMN adresse_geocode_statut VARCHAR(20)")
+        if 'adresse_geocoded_at' not in existing_cols:
+            missing.append("ALTER TABLE locals ADD COLUMN adresse_geocoded_at DATETIME")
+        if missing:
+            for stmt in missing:
+                db.session.execute(db.text(stmt))
+            db.session.commit()
+        backfill_statuts_geocodage(Local)
+    except Exception as e:
+        logger.warning(f"Impossible de vérifier/mettre à jour le schéma locals: {e}")
+        db.session.rollback()
+
 def ensure_parametres_schema():
     """Ajoute les colonnes manquantes sur la table parametres_entreprise (SQLite)."""
     try:
@@ -11932,6 +14215,27 @@ def ensure_parametres_schema():
         logger.warning(f"Impossible de vérifier/mettre à jour le schéma parametres_entreprise: {e}")
         db.session.rollback()
 
+def backfill_periodes_prestations():
+    """Renseigne debut_dt/fin_dt pour les prestations antérieures à ces colonnes."""
+    p = Prestation.__table__
+    rows = db.session.execute(
+        select(p.c.id, p.c.date_debut, p.c.date_fin, p.c.heure_debut, p.c.heure_fin)
+        .where(or_(p.c.debut_dt.is_(None), p.c.fin_dt.is_(None)))
+    ).all()
+    valeurs = []
+    for row in rows:
+        debut_dt, fin_dt = _build_datetime_range(row.date_debut, row.date_fin, row.heure_debut, row.heure_fin)
+        if debut_dt and fin_dt:
+            valeurs.append({'b_id': row.id, 'debut_dt': debut_dt, 'fin_dt': fin_dt})
+    if valeurs:
+        db.session.execute(
+            p.update().where(p.c.id == db.bindparam('b_id')),
+            valeurs
+        )
+        db.session.commit()
+        logger.info(f"Périodes normalisées renseignées pour {len(valeurs)} prestation(s)")
+    return len(valeurs)
+
 def ensure_prestations_schema():
     """Ajoute les colonnes manquantes sur la table prestations (SQLite)."""
     try:
@@ -11948,6 +14252,8 @@ def ensure_prestations_schema():
             missing.append("ALTER TABLE prestations ADD COLUMN lieu_formatted VARCHAR(255)")
         if 'lieu_geocoded_at' not in existing_cols:
             missing.append("ALTER TABLE prestations ADD COLUMN lieu_geocoded_at DATETIME")
+        if 'lieu_geocode_statut' not in existing_cols:
+            missing.append("ALTER TABLE prestations ADD COLUMN lieu_geocode_statut VARCHAR(20)")
         if 'distance_km' not in existing_cols:
             missing.append("ALTER TABLE prestations ADD COLUMN distance_km FLOAT")
         if 'distance_source' not in existing_cols:
@@ -11960,10 +14266,24 @@ def ensure_prestations_schema():
             missing.append("ALTER TABLE prestations ADD COLUMN client_id INTEGER")
         if 'custom_fields' not in existing_cols:
             missing.append("ALTER TABLE prestations ADD COLUMN custom_fields TEXT")
+        if 'debut_dt' not in existing_cols:
+            missing.append("ALTER TABLE prestations ADD COLUMN debut_dt DATETIME")
+        if 'fin_dt' not in existing_cols:
+            missing.append("ALTER TABLE prestations ADD COLUMN fin_dt DATETIME")
         if missing:
             for stmt in missing:
                 db.session.execute(db.text(stmt))
             db.session.commit()
+        for stmt in (
+            "CREATE INDEX IF NOT EXISTS ix_prestations_debut_dt ON prestations (debut_dt)",
+            "CREATE INDEX IF NOT EXISTS ix_prestations_fin_dt ON prestations (fin_dt)",
+            "CREATE INDEX IF NOT EXISTS ix_prestations_dj_periode ON prestations (dj_id, debut_dt, fin_dt)",
+            "CREATE INDEX IF NOT EXISTS ix_prestations_technicien_periode ON prestations (technicien_id, debut_dt, fin_dt)",
+        ):
+            db.session.execute(db.text(stmt))
+        db.session.commit()
+        backfill_periodes_prestations()
+        backfill_statuts_geocodage(Prestation)
     except Exception as e:
         logger.warning(f"Impossible de vérifier/mettre à jour le schéma prestations: {e}")
         db.session.rollback()
@@ -12219,10 +14539,21 @@ def ensure_clients_schema():
             missing.append("ALTER TABLE clients ADD COLUMN created_at DATETIME")
         if 'updated_at' not in existing_cols:
             missing.append("ALTER TABLE clients ADD COLUMN updated_at DATETIME")
+        if 'adresse' not in existing_cols:
+            missing.append("ALTER TABLE clients ADD COLUMN adresse TEXT")
+        if 'adresse_lat' not in existing_cols:
+            missing.append("ALTER TABLE clients ADD COLUMN adresse_lat FLOAT")
+        if 'adresse_lng' not in existing_cols:
+            missing.append("ALTER TABLE clients ADD COLUMN adresse_lng FLOAT")
+        if 'adresse_geocode_statut' not in existing_cols:
+            missing.append("ALTER TABLE clients ADD COLUMN adresse_geocode_statut VARCHAR(20)")
+        if 'adresse_geocoded_at' not in existing_cols:
+            missing.append("ALTER TABLE clients ADD COLUMN adresse_geocoded_at DATETIME")
         if missing:
             for stmt in missing:
                 db.session.execute(db.text(stmt))
             db.session.commit()
+        backfill_statuts_geocodage(Client)
     except Exception as e:
         logger.warning(f"Impossible de créer le schéma clients: {e}")
         db.session.rollback()
@@ -12278,6 +14609,49 @@ def ensure_document_sequences_schema():
         logger.warning(f"Impossible de créer le schéma document_sequences: {e}")
         db.session.rollback()
 
+def ensure_materiel_soldes():
+    """Vérifie les soldes de mouvements matériel et répare les écarts avec l'historique."""
+    try:
+        ecarts = verifier_soldes_materiel(reparer=True)
+        if ecarts:
+            logger.warning(f"Soldes matériel réparés ({len(ecarts)} écart(s) avec l'historique des mouvements)")
+    except Exception as e:
+        logger.warning(f"Impossible de vérifier les soldes matériel: {e}")
+        db.session.rollback()
+
+def ensure_materiel_occupations():
+    """Reconstruit la timeline d'occupation matériel (table dérivée des assignations)."""
+    try:
+        count = reconstruire_occupations_materiel()
+        logger.info(f"Timeline occupation matériel reconstruite ({count} intervalles)")
+    except Exception as e:
+        logger.warning(f"Impossible de reconstruire la timeline d'occupation matériel: {e}")
+        db.session.rollback()
+
+def ensure_sync_schema():
+    """Ajoute les colonnes et index de synchronisation manquants (SQLite)."""
+    try:
+        existing_cols = {row[1] for row in db.session.execute(db.text("PRAGMA table_info(sync_config)")).fetchall()}
+        if 'pull_cursor' not in existing_cols:
+            db.session.execute(db.text("ALTER TABLE sync_config ADD COLUMN pull_cursor INTEGER DEFAULT 0"))
+        if 'log_purged_through' not in existing_cols:
+            db.session.execute(db.text("ALTER TABLE sync_config ADD COLUMN log_purged_through INTEGER"))
+        existing_cols = {row[1] for row in db.session.execute(db.text("PRAGMA table_info(sync_change_log)")).fetchall()}
+        if 'push_attempted_at' not in existing_cols:
+            db.session.execute(db.text("ALTER TABLE sync_change_log ADD COLUMN push_attempted_at DATETIME"))
+        existing_cols = {row[1] for row in db.session.execute(db.text("PRAGMA table_info(sync_incoming_log)")).fetchall()}
+        if 'change_id' not in existing_cols:
+            db.session.execute(db.text("ALTER TABLE sync_incoming_log ADD COLUMN change_id INTEGER"))
+        for stmt in (
+            "CREATE INDEX IF NOT EXISTS ix_sync_incoming_device_change ON sync_incoming_log (device_id, change_id)",
+            "CREATE INDEX IF NOT EXISTS ix_sync_change_log_changed_at ON sync_change_log (changed_at)",
+        ):
+            db.session.execute(db.text(stmt))
+        db.session.commit()
+    except Exception as e:
+        logger.warning(f"Impossible de vérifier/mettre à jour le schéma sync: {e}")
+        db.session.rollback()
+
 def ensure_sync_config():
     """Crée la configuration de synchronisation si absente."""
     try:
@@ -12373,6 +14747,177 @@ def _build_sync_payload(changes, device_id):
         'changes': items
     }
 
+# ---- Coalescence du journal de synchronisation ----
+# Avant chaque envoi, les changements en attente d'une même entité sont fusionnés
+# en un seul changement net : seul l'état final compte pour le serveur.
+#   insert + update(s)      -> insert (dernier état)
+#   insert + ... + delete   -> rien (l'entité n'a jamais existé côté serveur)
+#   update(s)               -> update (champs modifiés cumulés)
+#   update(s) + delete      -> delete
+#   delete + insert         -> update (identifiant réutilisé)
+_SYNC_FUSION_OPERATIONS = {
+    ('insert', 'update'): 'insert',
+    ('insert', 'delete'): None,
+    ('update', 'update'): 'update',
+    ('update', 'delete'): 'delete',
+    ('delete', 'insert'): 'update',
+}
+
+def _fusionner_operations(operations):
+    """Opération nette d'une suite d'opérations sur une même entité (None : annulées)."""
+    nette = None
+    for operation in operations:
+        if nette is None:
+            nette = operation
+        else:
+            nette = _SYNC_FUSION_OPERATIONS.get((nette, operation), operation)
+    return nette
+
+def _changement_net(rows):
+    """
+    Changement net d'une suite de lignes du journal sur une même entité (ordre croissant).
+
+    Returns:
+        None si les changements s'annulent, sinon (ligne conservée, opération,
+        payload fusionné, champs modifiés)
+    """
+    nette = _fusionner_operations([r.operation for r in rows])
+    if nette is None:
+        return None
+    payload, champs = {}, []
+    for r in rows:
+        try:
+            payload.update(json.loads(r.payload or '{}'))
+            champs.extend(c for c in json.loads(r.changed_fields or '[]') if c not in champs)
+        except (TypeError, ValueError):
+            continue
+    if nette == 'update' and any(r.operation == 'insert' for r in rows):
+        champs = list(payload)
+    conserve = rows[0] if nette == 'insert' else rows[-1]
+    return conserve, nette, payload, champs if nette == 'update' else []
+
+def coalescer_changements_sync():
+    """
+    Fusionne les changements en attente par (entity_type, entity_id).
+
+    Seuls les changements jamais envoyés sont fusionnés : un changement dont
+    l'envoi a été tenté a pu être reçu par le serveur sans que l'acquittement
+    arrive, et le serveur l'acquitterait de nouveau (même change_id) sans
+    appliquer ce qui y aurait été fusionné. Les changements d'une entité
+    postérieurs au dernier envoi tenté sont donc fusionnés entre eux.
+
+    Le changement conservé prend la position du premier changement si l'entité
+    est créée (elle doit exister avant ce qui la référence), celle du dernier
+    sinon. Les payloads sont fusionnés dans l'ordre (le plus récent l'emporte)
+    et les champs modifiés cumulés. La réécriture se fait dans la session, sous
+    verrou d'écriture.
+
+    Returns:
+        dict: {'avant', 'apres', 'octets_avant', 'octets_apres'} pour les entités fusionnées
+    """
+    table = SyncChangeLog.__table__
+    stats = {'avant': 0, 'apres': 0, 'octets_avant': 0, 'octets_apres': 0}
+    if app.config.get('SYNC_SERVER_MODE'):
+        # Serveur central : le journal est la séquence lue par les pulls, il ne doit pas être réécrit
+        return stats
+    try:
+        db.session.commit()
+        with locked_transaction():
+            groupes = db.session.execute(
+                select(table.c.entity_type, table.c.entity_id)
+                .where(table.c.status == 'pending', table.c.push_attempted_at.is_(None))
+                .group_by(table.c.entity_type, table.c.entity_id)
+                .having(db.func.count(table.c.id) > 1)
+            ).all()
+            cles = {(g.entity_type, g.entity_id) for g in groupes}
+            types = sorted({t for t, _ in cles})
+            lignes = {}
+            for start in range(0, len(types), BULK_IN_CLAUSE_MAX):
+                for row in db.session.execute(
+                    select(
+                        table.c.id, table.c.entity_type, table.c.entity_id, table.c.operation,
+                        table.c.changed_at, table.c.user_id, table.c.changed_fields, table.c.payload,
+                        table.c.push_attempted_at
+                    ).where(
+                        table.c.status == 'pending',
+                        table.c.entity_type.in_(types[start:start + BULK_IN_CLAUSE_MAX])
+                    ).order_by(table.c.id.asc())
+                ).all():
+                    if (row.entity_type, row.entity_id) in cles:
+                        lignes.setdefault((row.entity_type, row.entity_id), []).append(row)
+
+            mises_a_jour, suppressions = [], []
+            for rows in lignes.values():
+                tentes = [i for i, r in enumerate(rows) if r.push_attempted_at is not None]
+                if tentes:
+                    rows = rows[tentes[-1] + 1:]
+                if len(rows) < 2:
+                    continue
+                stats['avant'] += len(rows)
+                stats['octets_avant'] += sum(len(r.payload or '') for r in rows)
+                net = _changement_net(rows)
+                if net is None:
+                    suppressions.extend(r.id for r in rows)
+                    continue
+                conserve, nette, payload, champs = net
+                payload_json = json.dumps(payload, ensure_ascii=True, default=str)
+                mises_a_jour.append({
+                    'b_id': conserve.id,
+                    'operation': nette,
+                    'changed_at': rows[-1].changed_at,
+                    'user_id': rows[-1].user_id,
+                    'changed_fields': json.dumps(champs, ensure_ascii=True),
+                    'payload': payload_json,
+                })
+                suppressions.extend(r.id for r in rows if r.id != conserve.id)
+                stats['apres'] += 1
+                stats['octets_apres'] += len(payload_json)
+
+            if mises_a_jour:
+                db.session.execute(
+                    table.update().where(table.c.id == db.bindparam('b_id')).values(
+                        operation=db.bindparam('operation'),
+                        changed_at=db.bindparam('changed_at'),
+                        user_id=db.bindparam('user_id'),
+                        changed_fields=db.bindparam('changed_fields'),
+                        payload=db.bindparam('payload'),
+                    ),
+                    mises_a_jour
+                )
+            for start in range(0, len(suppressions), BULK_IN_CLAUSE_MAX):
+                db.session.execute(table.delete().where(table.c.id.in_(suppressions[start:start + BULK_IN_CLAUSE_MAX])))
+            db.session.commit()
+        if stats['avant']:
+            logger.info(
+                f"Journal sync coalescé: {stats['avant']} -> {stats['apres']} changements, "
+                f"{stats['octets_avant']} -> {stats['octets_apres']} octets"
+            )
+    except Exception as e:
+        logger.warning(f"Coalescence du journal sync impossible: {e}")
+    return stats
+
+_sync_transport = None
+
+def _get_sync_transport(server_url):
+    """Transport persistant (connexion et taille de lot conservées entre deux cycles)."""
+    global _sync_transport
+    if _sync_transport is None or _sync_transport.base_url != server_url.rstrip('/'):
+        if _sync_transport is not None:
+            _sync_transport.close()
+        _sync_transport = SyncTransport(
+            server_url,
+            compression=app.config.get('SYNC_COMPRESSION', 'zstd'),
+            min_batch=app.config.get('SYNC_BATCH_MIN', 20),
+            max_batch=app.config.get('SYNC_BATCH_MAX', 2000),
+            target_latency=app.config.get('SYNC_TARGET_LATENCY', 2.0),
+            max_batch_bytes=app.config.get('SYNC_MAX_BATCH_BYTES', 2 * 1024 * 1024),
+        )
+    return _sync_transport
+
+def get_sync_transport_stats():
+    """Métriques du transport sync (taille de lot courante, compression, octets envoyés)."""
+    return _sync_transport.snapshot() if _sync_transport is not None else None
+
 def _sync_push_changes(cfg):
     if not cfg.server_url:
         return 'config_missing'
@@ -12382,34 +14927,55 @@ def _sync_push_changes(cfg):
     if not access_token:
         return 'auth_missing'
 
-    changes = SyncChangeLog.query.filter_by(status='pending').order_by(SyncChangeLog.id.asc()).limit(200).all()
+    coalescer_changements_sync()
+    transport = _get_sync_transport(cfg.server_url)
+    statut = 'no_changes'
+    # Lots successifs tant que le serveur progresse : les changements non acquittés
+    # d'un lot sont repris en tête du suivant
+    for _ in range(app.config.get('SYNC_MAX_BATCHES_PER_CYCLE', 20)):
+        traites = _sync_push_batch(cfg, transport, access_token)
+        if traites is None:
+            break
+        statut = 'synced'
+        if not traites:
+            break
+    return statut
+
+def _sync_push_batch(cfg, transport, access_token):
+    """Envoie un lot ; retourne le nombre de changements traités par le serveur (None si rien à envoyer)."""
+    changes = SyncChangeLog.query.filter_by(status='pending').order_by(
+        SyncChangeLog.id.asc()
+    ).limit(transport.batch_size).all()
     if not changes:
-        return 'no_changes'
+        return None
 
+    # Marqué avant l'envoi : un lot reçu dont l'acquittement se perd n'est plus fusionné
+    a_marquer = [c.id for c in changes if c.push_attempted_at is None]
+    if a_marquer:
+        SyncChangeLog.query.filter(SyncChangeLog.id.in_(a_marquer)).update(
+            {'push_attempted_at': utcnow()}, synchronize_session=False
+        )
+        db.session.commit()
     payload = _build_sync_payload(changes, cfg.device_id or get_device_id())
-    endpoint = cfg.server_url.rstrip('/') + '/api/sync/push'
-    data = json.dumps(payload, ensure_ascii=True).encode('utf-8')
-    req = urllib.request.Request(
-        endpoint,
-        data=data,
-        headers={
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {access_token}',
-            'User-Agent': 'Planify-Sync/1.0'
-        }
-    )
-    with urllib.request.urlopen(req, timeout=15) as resp:
-        response_data = json.loads(resp.read().decode('utf-8'))
+    items = payload.pop('changes')
+    # Dernier état du serveur vu par l'appareil : les modifications plus récentes sont des conflits
+    payload['cursor'] = cfg.pull_cursor or 0
+    with outbound_http.call('sync') as timeout:
+        response_data = transport.push(
+            payload, items, auth_headers={'Authorization': f'Bearer {access_token}'}, timeout=timeout
+        )
 
-    accepted = set(response_data.get('accepted_ids', []))
+    accepted = list(response_data.get('accepted_ids', []))
     conflicts = response_data.get('conflicts', []) or []
     errors = response_data.get('errors', []) or []
 
     now = utcnow()
-    if accepted:
-        SyncChangeLog.query.filter(SyncChangeLog.id.in_(accepted)).update(
+    for start in range(0, len(accepted), BULK_IN_CLAUSE_MAX):
+        SyncChangeLog.query.filter(SyncChangeLog.id.in_(accepted[start:start + BULK_IN_CLAUSE_MAX])).update(
             {'status': 'sent', 'sent_at': now}, synchronize_session=False
         )
+    acceptes = set(accepted)
+    _maj_bases_sync([item for item in items if item['change_id'] in acceptes])
     for item in conflicts:
         change_id = item.get('change_id')
         if change_id:
@@ -12430,7 +14996,319 @@ def _sync_push_changes(cfg):
                 {'status': 'failed', 'error': item.get('message')}, synchronize_session=False
             )
     db.session.commit()
-    return 'synced'
+    return len(accepted) + len(conflicts) + len(errors)
+
+def _supprimer_entites_absentes_sync(ids_vivants):
+    """
+    Resynchronisation complète : supprime les entités locales absentes du serveur.
+
+    Les entités ayant des changements locaux non acquittés (créations non encore
+    envoyées comprises) sont conservées. La transaction n'est pas validée.
+
+    Args:
+        ids_vivants: {entity_type: [ids présents sur le serveur]}
+
+    Returns:
+        int: nombre d'entités supprimées
+    """
+    suppressions = []
+    for entity_type, ids in ids_vivants.items():
+        modele = SYNC_MODELES.get(entity_type)
+        if modele is None or not isinstance(ids, list):
+            continue
+        vivants = set(ids)
+        en_attente = {
+            row.entity_id for row in db.session.query(SyncChangeLog.entity_id).filter(
+                SyncChangeLog.entity_type == entity_type,
+                SyncChangeLog.status.in_(['pending', 'conflict', 'failed'])
+            )
+        }
+        for (entity_id,) in db.session.query(modele.id).order_by(modele.id.asc()):
+            if entity_id not in vivants and entity_id not in en_attente:
+                suppressions.append({
+                    'change_id': len(suppressions) + 1, 'entity_type': entity_type,
+                    'entity_id': entity_id, 'operation': 'delete', 'payload': {}
+                })
+    if not suppressions:
+        return 0
+    resultats = appliquer_changements_distants(suppressions, origine=_SYNC_SANS_JOURNAL)
+    for change in suppressions:
+        statut, message = resultats[change['change_id']]
+        if statut == 'error':
+            logger.warning(f"Resync: {change['entity_type']} {change['entity_id']} non supprimé: {message}")
+    return sum(1 for statut, _ in resultats.values() if statut == 'applied')
+
+def _sync_pull_changes(cfg):
+    """
+    Récupère et applique les changements des autres appareils depuis cfg.pull_cursor.
+
+    Une entité ayant des changements locaux non envoyés n'est pas écrasée : le
+    changement distant y est fusionné champ par champ, seules les collisions
+    sont consignées en conflit. La version de base de chaque entité reçue est
+    mise à jour pour les fusions suivantes. Les changements non applicables
+    sont rejoués au pull suivant (voir _traiter_changements_serveur).
+
+    Returns:
+        int: nombre de changements reçus
+    """
+    if not cfg.server_url or (not _is_https_url(cfg.server_url) and not app.config.get('SYNC_ALLOW_INSECURE')):
+        return 0
+    access_token = _sync_get_access_token(cfg)
+    if not access_token:
+        return 0
+    transport = _get_sync_transport(cfg.server_url)
+    device_id = cfg.device_id or get_device_id()
+    _rejouer_changements_serveur()
+    recus = 0
+    for _ in range(app.config.get('SYNC_MAX_BATCHES_PER_CYCLE', 20)):
+        try:
+            with outbound_http.call('sync') as timeout:
+                page = transport.pull(
+                    cfg.pull_cursor or 0, app.config.get('SYNC_PULL_PAGE_SIZE', 500), device_id,
+                    auth_headers={'Authorization': f'Bearer {access_token}'}, timeout=timeout
+                )
+        except PushRejected as e:
+            if e.status in (404, 405):
+                # Serveur sans pull : envoi seul
+                return recus
+            raise
+        if page.get('resync_required'):
+            # Historique purgé sur le serveur : les suppressions effacées sont déduites des
+            # identifiants encore présents, puis relecture complète depuis le début du journal
+            logger.warning(f"Curseur sync {cfg.pull_cursor} trop ancien, relecture complète")
+            if isinstance(page.get('live_ids'), dict):
+                supprimees = _supprimer_entites_absentes_sync(page['live_ids'])
+                if supprimees:
+                    logger.info(f"Resync: {supprimees} entité(s) supprimée(s) sur le serveur")
+            cfg.pull_cursor = 0
+            db.session.commit()
+            continue
+        changements = [c for c in page.get('changes') or [] if _changement_sync_valide(c)]
+        if changements:
+            _traiter_changements_serveur(changements)
+        recus += len(changements)
+        cfg.pull_cursor = page.get('cursor', cfg.pull_cursor)
+        db.session.commit()
+        if not page.get('has_more'):
+            break
+    return recus
+
+# Changements du serveur non applicables (erreur) : conservés dans SyncIncomingLog
+# sous cet émetteur et rejoués au pull suivant, avant les nouveaux changements.
+_SYNC_EMETTEUR_SERVEUR = 'serveur'
+
+def _traiter_changements_serveur(changements, a_rejouer=None):
+    """
+    Applique ou fusionne des changements reçus du serveur (ordre croissant).
+
+    Un changement visant une entité dont les changements locaux sont en conflit
+    est consigné en SyncConflict avec son payload, pour être pris en compte à la
+    résolution. Un changement en erreur, et les suivants sur la même entité,
+    sont mis de côté pour être rejoués. La transaction n'est pas validée.
+
+    Args:
+        a_rejouer: lignes SyncIncomingLog rejouées, supprimées si appliquées
+
+    Returns:
+        list: changements mis de côté
+    """
+    a_rejouer = {row.change_id: row for row in a_rejouer or []}
+    query = db.session.query(SyncIncomingLog.entity_type, SyncIncomingLog.entity_id).filter(
+        SyncIncomingLog.device_id == _SYNC_EMETTEUR_SERVEUR, SyncIncomingLog.status == 'retry'
+    )
+    if a_rejouer:
+        # Seuls les changements reçus avant ceux rejoués les précèdent
+        query = query.filter(SyncIncomingLog.id < min(row.id for row in a_rejouer.values()))
+    en_retente = {(row.entity_type, row.entity_id) for row in query}
+    en_attente = {}
+    types = sorted({c['entity_type'] for c in changements})
+    for row in SyncChangeLog.query.filter(
+        SyncChangeLog.status.in_(['pending', 'conflict']),
+        SyncChangeLog.entity_type.in_(types)
+    ).order_by(SyncChangeLog.id.asc()):
+        en_attente.setdefault((row.entity_type, row.entity_id), []).append(row)
+    a_appliquer, a_fusionner, mis_de_cote = [], [], []
+    for change in changements:
+        cle = (change['entity_type'], change['entity_id'])
+        lignes = en_attente.get(cle)
+        if cle in en_retente:
+            # Un changement antérieur sur l'entité attend d'être rejoué : l'ordre est conservé
+            mis_de_cote.append((change, 'Changement antérieur en attente'))
+        elif not lignes:
+            a_appliquer.append(change)
+        elif all(ligne.status == 'pending' for ligne in lignes):
+            a_fusionner.append((change, lignes))
+        else:
+            # Entité déjà en conflit au push : le changement distant est conservé pour la résolution
+            db.session.add(SyncConflict(
+                entity_type=change['entity_type'],
+                entity_id=change['entity_id'],
+                local_change_id=lignes[-1].id,
+                remote_version=str(change['change_id']),
+                details=json.dumps({'raison': 'conflit_en_cours', 'distant': change}, ensure_ascii=True, default=str)
+            ))
+    resultats = appliquer_changements_distants(a_appliquer, origine=_SYNC_SANS_JOURNAL)
+    for change in a_appliquer:
+        statut, message = resultats[change['change_id']]
+        if statut == 'error':
+            logger.warning(f"Changement serveur {change['change_id']} non appliqué, rejoué au prochain pull: {message}")
+            mis_de_cote.append((change, message))
+    for change, lignes in a_fusionner:
+        _fusionner_changement_serveur(change, lignes)
+    _maj_bases_sync(
+        [c for c in a_appliquer if resultats[c['change_id']][0] == 'applied']
+        + [change for change, _ in a_fusionner]
+    )
+    nouveaux = []
+    for change, message in mis_de_cote:
+        row = a_rejouer.pop(change['change_id'], None)
+        if row is not None:
+            # Toujours en échec : reste à sa place dans la file
+            row.error = (message or '')[:500]
+        else:
+            nouveaux.append((change, message))
+    for row in a_rejouer.values():
+        db.session.delete(row)
+    if nouveaux:
+        db.session.execute(SyncIncomingLog.__table__.insert(), [{
+            'received_at': utcnow(),
+            'device_id': _SYNC_EMETTEUR_SERVEUR,
+            'change_id': change['change_id'],
+            'entity_type': change['entity_type'],
+            'entity_id': change['entity_id'],
+            'operation': change['operation'],
+            'payload': json.dumps(change, ensure_ascii=True, default=str),
+            'status': 'retry',
+            'error': (message or '')[:500],
+        } for change, message in sorted(nouveaux, key=lambda m: m[0]['change_id'])])
+    return [change for change, _ in mis_de_cote]
+
+def _rejouer_changements_serveur():
+    """
+    Rejoue dans l'ordre les changements du serveur mis de côté.
+
+    Une entité dont un changement échoue encore garde ses changements suivants
+    en file.
+
+    Returns:
+        int: nombre de changements appliqués
+    """
+    lignes = SyncIncomingLog.query.filter_by(
+        device_id=_SYNC_EMETTEUR_SERVEUR, status='retry'
+    ).order_by(SyncIncomingLog.id.asc()).all()
+    bloquees, appliques = set(), 0
+    for ligne in lignes:
+        cle = (ligne.entity_type, ligne.entity_id)
+        if cle in bloquees:
+            continue
+        if _traiter_changements_serveur([json.loads(ligne.payload)], a_rejouer=[ligne]):
+            bloquees.add(cle)
+        else:
+            appliques += 1
+    db.session.commit()
+    return appliques
+
+def _fusionner_changement_serveur(change, lignes):
+    """
+    Fusionne un changement du serveur avec les changements locaux non envoyés de la même entité.
+
+    Les champs distants sans conflit sont appliqués (sans être rejournalisés) ;
+    un champ local perdant est retiré des changements en attente ; les montants
+    sont recalculés et journalisés pour repartir au serveur. Seules les vraies
+    collisions sont consignées en SyncConflict ; les changements locaux concernés
+    passent alors en 'conflict' et ne sont plus envoyés avant résolution.
+
+    Returns:
+        ResultatFusion, ou None si l'un des côtés supprime l'entité (conflit consigné)
+    """
+    modele = SYNC_MODELES[change['entity_type']]
+    obj = db.session.get(modele, change['entity_id'])
+    if change['operation'] == 'delete' or obj is None or any(l.operation == 'delete' for l in lignes):
+        db.session.add(SyncConflict(
+            entity_type=change['entity_type'],
+            entity_id=change['entity_id'],
+            local_change_id=lignes[-1].id,
+            remote_version=str(change['change_id']),
+            details=json.dumps({'raison': 'suppression', 'distant': change}, ensure_ascii=True, default=str)
+        ))
+        _marquer_lignes_en_conflit(lignes, 'Suppression concurrente sur le serveur')
+        return None
+    base = _charger_bases_sync([(change['entity_type'], change['entity_id'])]).get(
+        (change['entity_type'], change['entity_id'])
+    )
+    champs_local = set()
+    for ligne in lignes:
+        champs = json.loads(ligne.changed_fields or '[]')
+        if ligne.operation == 'update' and champs:
+            champs_local.update(champs)
+        else:
+            champs_local.update(champs_modifies(base, json.loads(ligne.payload or '{}')))
+    payload = change.get('payload') or {}
+    champs_distant = change.get('changed_fields') if change['operation'] == 'update' else None
+    if not champs_distant:
+        champs_distant = champs_modifies(base, payload)
+    try:
+        distant_plus_recent = datetime.fromisoformat(change.get('changed_at')) > max(l.changed_at for l in lignes)
+    except (TypeError, ValueError):
+        distant_plus_recent = False
+    resultat = fusionner(
+        _model_to_payload(obj), payload, champs_local, champs_distant,
+        _regles_fusion_sync(change['entity_type']), distant_plus_recent=distant_plus_recent
+    )
+
+    if resultat.appliquer:
+        appliquer_changements_distants([{
+            'change_id': change['change_id'],
+            'entity_type': change['entity_type'],
+            'entity_id': change['entity_id'],
+            'operation': 'update',
+            'changed_fields': list(resultat.appliquer),
+            'payload': resultat.appliquer,
+        }], origine=_SYNC_SANS_JOURNAL)
+    if resultat.gagnes_distant:
+        for ligne in lignes:
+            valeurs = json.loads(ligne.payload or '{}')
+            if ligne.operation == 'insert':
+                valeurs.update({nom: resultat.appliquer[nom] for nom in resultat.gagnes_distant})
+            else:
+                champs = [nom for nom in json.loads(ligne.changed_fields or '[]') if nom not in resultat.gagnes_distant]
+                valeurs = {nom: valeur for nom, valeur in valeurs.items() if nom not in resultat.gagnes_distant}
+                if not champs:
+                    db.session.delete(ligne)
+                    continue
+                ligne.changed_fields = json.dumps(champs, ensure_ascii=True)
+            ligne.payload = json.dumps(valeurs, ensure_ascii=True, default=str)
+    if resultat.recalcul and hasattr(obj, 'calculer_totaux'):
+        obj.calculer_totaux()
+    if resultat.collisions:
+        db.session.add(SyncConflict(
+            entity_type=change['entity_type'],
+            entity_id=change['entity_id'],
+            local_change_id=lignes[-1].id,
+            remote_version=str(change['change_id']),
+            details=json.dumps({'champs': resultat.collisions, 'distant': change}, ensure_ascii=True, default=str)
+        ))
+        _marquer_lignes_en_conflit(
+            lignes, f"Conflit avec le serveur: {', '.join(sorted(resultat.collisions))}", resultat.collisions
+        )
+    return resultat
+
+def _marquer_lignes_en_conflit(lignes, message, champs=None):
+    """
+    Comme au rejet d'un push, retient les changements locaux en collision jusqu'à
+    résolution : le curseur de pull dépasse le changement distant, un push
+    ultérieur écraserait la modification de l'autre appareil.
+
+    Args:
+        champs: champs en collision ; None pour retenir toutes les lignes
+    """
+    for ligne in lignes:
+        if ligne in db.session.deleted:
+            continue
+        champs_ligne = json.loads(ligne.changed_fields or '[]')
+        if champs is None or ligne.operation != 'update' or not champs_ligne or set(champs_ligne) & set(champs):
+            ligne.status = 'conflict'
+            ligne.error = message
 
 def _sync_once():
     cfg = db.session.get(SyncConfig, 1)
@@ -12442,6 +15320,8 @@ def _sync_once():
     cfg.last_sync_at = utcnow()
     try:
         status = _sync_push_changes(cfg)
+        if status in ('synced', 'no_changes') and _sync_pull_changes(cfg):
+            status = 'synced'
         cfg.last_sync_status = status
         if status in ('synced', 'no_changes'):
             cfg.last_success_at = utcnow()
@@ -12457,36 +15337,748 @@ def _sync_once():
         logger.warning(f"Sync error: {e}")
         return 'failed'
 
-_sync_thread = None
-_sync_stop_event = threading.Event()
+_sync_scheduler = None
+
+def _sync_cycle():
+    """Un cycle de l'ordonnanceur : synchronisation si activée, puis maintenance du journal si due."""
+    with app.app_context():
+        try:
+            cfg = db.session.get(SyncConfig, 1)
+            if not cfg:
+                ensure_sync_config()
+                cfg = db.session.get(SyncConfig, 1)
+            statut = 'disabled'
+            if cfg and cfg.enabled:
+                if cfg.sync_interval_seconds and _sync_scheduler is not None:
+                    _sync_scheduler.idle_min = float(cfg.sync_interval_seconds)
+                statut = _sync_once()
+            maintenance_journal_sync_si_due()
+            return statut
+        finally:
+            db.session.remove()
+
+def get_sync_scheduler_stats():
+    """Etat de l'ordonnanceur, profondeur de la file (changements en attente) et retard du plus ancien."""
+    table = SyncChangeLog.__table__
+    row = db.session.execute(
+        select(db.func.count(table.c.id), db.func.min(table.c.changed_at)).where(table.c.status == 'pending')
+    ).one()
+    return {
+        'ordonnanceur': _sync_scheduler.snapshot() if _sync_scheduler is not None else None,
+        'file_attente': row[0],
+        'retard_secondes': round((utcnow() - row[1]).total_seconds(), 1) if row[1] else 0.0,
+        'transport': get_sync_transport_stats(),
+    }
 
 def start_sync_service():
-    global _sync_thread
+    global _sync_scheduler
     if app.config.get('TESTING'):
         return
-    if _sync_thread and _sync_thread.is_alive():
+    if _sync_scheduler is not None and _sync_scheduler.is_alive():
         return
-    def _loop():
-        while not _sync_stop_event.is_set():
+    _sync_scheduler = SyncScheduler(
+        _sync_cycle,
+        debounce=app.config.get('SYNC_DEBOUNCE_SECONDS', 1.0),
+        max_delay=app.config.get('SYNC_DEBOUNCE_MAX_SECONDS', 5.0),
+        idle_min=app.config.get('SYNC_INTERVAL_DEFAULT', 20),
+        idle_max=app.config.get('SYNC_IDLE_MAX_SECONDS', 300),
+        backoff_base=app.config.get('SYNC_BACKOFF_BASE_SECONDS', 5.0),
+        backoff_max=app.config.get('SYNC_BACKOFF_MAX_SECONDS', 600.0),
+        on_error=lambda e: logger.warning(f"Sync loop error: {e}"),
+    ).start()
+    # Des changements ont pu être journalisés avant le démarrage
+    _sync_scheduler.notify()
+
+def stop_sync_service():
+    if _sync_scheduler is not None:
+        _sync_scheduler.stop(timeout=5)
+
+@event.listens_for(db.session, "after_commit")
+def _reveiller_sync_apres_commit(session):
+    if session.info.pop('sync_journal_ecrit', False) and _sync_scheduler is not None:
+        _sync_scheduler.notify()
+
+@app.route('/api/admin/sync/statut')
+@login_required
+@role_required(['admin'])
+def api_sync_statut():
+    """Ordonnanceur de synchronisation : prochain cycle, repli, file d'attente et retard."""
+    return jsonify({'success': True, **get_sync_scheduler_stats()})
+
+# ==================== SERVEUR DE SYNCHRONISATION ====================
+#
+# En mode serveur (SYNC_SERVER_MODE), l'instance sert de point central aux
+# appareils hors ligne : elle applique les lots poussés (POST /api/sync/push) et
+# republie son journal SyncChangeLog, dont l'identifiant croissant sert de
+# curseur, aux autres appareils (GET /api/sync/pull?cursor=).
+
+def _appliquer_payload(obj, payload, champs=None):
+    """Recopie un payload sur une entité (seulement les champs modifiés si champs est fourni)."""
+    colonnes = obj.__table__.columns
+    for nom, valeur in payload.items():
+        if nom == 'id' or nom not in colonnes or _should_exclude_field(nom):
+            continue
+        if champs and nom not in champs:
+            continue
+        setattr(obj, nom, _deserialize_value(colonnes[nom], valeur))
+
+def appliquer_changements_distants(changements, origine=None):
+    """
+    Applique des changements reçus d'un autre appareil ou du serveur central.
+
+    Les entités visées sont chargées en une requête par modèle ; chaque
+    changement est appliqué dans un point de sauvegarde, un échec n'annule que
+    lui. La transaction n'est pas validée (à la charge de l'appelant).
+
+    Args:
+        origine: appareil sous lequel journaliser les changements appliqués,
+            _SYNC_SANS_JOURNAL pour ne pas les journaliser
+
+    Returns:
+        dict: {change_id: (statut, message)} avec statut 'applied' ou 'error'
+    """
+    ids_par_modele = defaultdict(set)
+    for change in changements:
+        ids_par_modele[SYNC_MODELES[change['entity_type']]].add(change['entity_id'])
+    existants = {}
+    for modele, ids in ids_par_modele.items():
+        ids = sorted(ids)
+        for start in range(0, len(ids), BULK_IN_CLAUSE_MAX):
+            for obj in modele.query.filter(modele.id.in_(ids[start:start + BULK_IN_CLAUSE_MAX])).all():
+                existants[(modele, obj.id)] = obj
+
+    resultats = {}
+    jeton = _sync_capture.set(origine)
+    try:
+        for change in changements:
+            modele = SYNC_MODELES[change['entity_type']]
+            cle = (modele, change['entity_id'])
+            obj = existants.get(cle)
+            operation = change['operation']
+            payload = change.get('payload') or {}
             try:
-                with app.app_context():
-                    cfg = db.session.get(SyncConfig, 1)
-                    if not cfg:
-                        ensure_sync_config()
-                        cfg = db.session.get(SyncConfig, 1)
-                    interval = cfg.sync_interval_seconds if cfg and cfg.sync_interval_seconds else app.config.get('SYNC_INTERVAL_DEFAULT', 20)
-                    if cfg and cfg.enabled:
-                        _sync_once()
-                    _sync_stop_event.wait(interval)
+                with db.session.begin_nested():
+                    if operation == 'delete':
+                        if obj is not None:
+                            db.session.delete(obj)
+                        obj = None
+                    elif obj is None:
+                        obj = modele(id=change['entity_id'])
+                        _appliquer_payload(obj, payload)
+                        db.session.add(obj)
+                    else:
+                        champs = change.get('changed_fields') if operation == 'update' else None
+                        _appliquer_payload(obj, payload, champs)
+                existants[cle] = obj
+                resultats[change['change_id']] = ('applied', None)
             except Exception as e:
-                logger.warning(f"Sync loop error: {e}")
-                _sync_stop_event.wait(app.config.get('SYNC_INTERVAL_DEFAULT', 20))
-    _sync_stop_event.clear()
-    _sync_thread = threading.Thread(target=_loop, daemon=True)
-    _sync_thread.start()
+                # Après annulation du point de sauvegarde, l'état de l'entité est relu
+                existants[cle] = db.session.get(modele, change['entity_id'])
+                resultats[change['change_id']] = ('error', str(e)[:500])
+    finally:
+        _sync_capture.reset(jeton)
+    return resultats
+
+def _changement_sync_valide(change):
+    return (
+        isinstance(change, dict)
+        and isinstance(change.get('change_id'), int)
+        and isinstance(change.get('entity_id'), int)
+        and change.get('entity_type') in SYNC_MODELES
+        and change.get('operation') in ('insert', 'update', 'delete')
+        and isinstance(change.get('payload') or {}, dict)
+    )
 
-def stop_sync_service():
-    _sync_stop_event.set()
+# Règles de fusion par champ ('*' : tous les modèles). Un champ sans règle modifié
+# des deux côtés avec des valeurs différentes est un conflit à résoudre à la main.
+SYNC_REGLES_FUSION = {
+    '*': {
+        'statut': REGLE_PLUS_RECENT,
+        'date_modification': REGLE_PLUS_RECENT,
+        'updated_at': REGLE_PLUS_RECENT,
+    },
+    'Devis': {
+        'frais_materiel': REGLE_RECALCUL,
+        'montant_ht': REGLE_RECALCUL,
+        'montant_tva': REGLE_RECALCUL,
+        'montant_ttc': REGLE_RECALCUL,
+    },
+    'Facture': {
+        'frais_materiel': REGLE_RECALCUL,
+        'montant_ht': REGLE_RECALCUL,
+        'montant_tva': REGLE_RECALCUL,
+        'montant_ttc': REGLE_RECALCUL,
+        'acompte_montant': REGLE_RECALCUL,
+    },
+}
+
+def _regles_fusion_sync(entity_type):
+    return {**SYNC_REGLES_FUSION['*'], **SYNC_REGLES_FUSION.get(entity_type, {})}
+
+def _versions_base_sync(cles):
+    """Lignes SyncBaseVersion existantes, {(entity_type, entity_id): ligne}."""
+    par_type = {}
+    for entity_type, entity_id in cles:
+        par_type.setdefault(entity_type, set()).add(entity_id)
+    versions = {}
+    for entity_type, ids in par_type.items():
+        ids = sorted(ids)
+        for start in range(0, len(ids), BULK_IN_CLAUSE_MAX):
+            for base in SyncBaseVersion.query.filter(
+                SyncBaseVersion.entity_type == entity_type,
+                SyncBaseVersion.entity_id.in_(ids[start:start + BULK_IN_CLAUSE_MAX])
+            ):
+                versions[(base.entity_type, base.entity_id)] = base
+    return versions
+
+def _charger_bases_sync(cles):
+    """Versions de base connues, {(entity_type, entity_id): payload}."""
+    return {cle: json.loads(base.payload or '{}') for cle, base in _versions_base_sync(cles).items()}
+
+def _maj_bases_sync(changements):
+    """
+    Enregistre l'état convenu avec le serveur après des changements acceptés ou reçus.
+
+    Les changements d'une même entité sont cumulés dans l'ordre ; une suppression
+    retire la version de base. Une seule écriture par entité.
+    """
+    if not changements:
+        return
+    existantes = _versions_base_sync({(c['entity_type'], c['entity_id']) for c in changements})
+    finales = {}
+    for change in changements:
+        cle = (change['entity_type'], change['entity_id'])
+        if change['operation'] == 'delete':
+            finales[cle] = None
+            continue
+        etat = finales.get(cle)
+        if etat is None:
+            base = existantes.get(cle)
+            etat = {} if change['operation'] == 'insert' or base is None else json.loads(base.payload or '{}')
+        etat.update(change.get('payload') or {})
+        finales[cle] = etat
+    now = utcnow()
+    for (entity_type, entity_id), etat in finales.items():
+        base = existantes.get((entity_type, entity_id))
+        if etat is None:
+            if base is not None:
+                db.session.delete(base)
+        elif base is None:
+            db.session.add(SyncBaseVersion(
+                entity_type=entity_type, entity_id=entity_id,
+                payload=json.dumps(etat, ensure_ascii=True, default=str), updated_at=now
+            ))
+        else:
+            base.payload = json.dumps(etat, ensure_ascii=True, default=str)
+            base.updated_at = now
+
+def _changements_concurrents(changements, device_id, curseur):
+    """
+    Changements du serveur faits par un autre appareil après le curseur de l'émetteur.
+
+    Returns:
+        dict: {(entity_type, entity_id): [lignes du journal, par id croissant]}
+    """
+    cles = {(c['entity_type'], c['entity_id']) for c in changements}
+    types = sorted({t for t, _ in cles})
+    table = SyncChangeLog.__table__
+    concurrents = {}
+    for start in range(0, len(types), BULK_IN_CLAUSE_MAX):
+        for row in db.session.execute(
+            select(
+                table.c.id, table.c.entity_type, table.c.entity_id, table.c.operation,
+                table.c.changed_at, table.c.changed_fields, table.c.payload
+            ).where(
+                table.c.id > curseur,
+                table.c.entity_type.in_(types[start:start + BULK_IN_CLAUSE_MAX]),
+                or_(table.c.device_id != device_id, table.c.device_id.is_(None))
+            ).order_by(table.c.id.asc())
+        ):
+            if (row.entity_type, row.entity_id) in cles:
+                concurrents.setdefault((row.entity_type, row.entity_id), []).append(row)
+    return concurrents
+
+def _fusionner_changement_appareil(change, lignes):
+    """
+    Fusionne un changement poussé avec les changements concurrents du serveur.
+
+    Returns:
+        (changement à appliquer ou None, résultat de fusion ou None, message de conflit ou None)
+    """
+    obj = db.session.get(SYNC_MODELES[change['entity_type']], change['entity_id'])
+    if change['operation'] == 'delete' and obj is None:
+        return None, None, None
+    if change['operation'] == 'delete' or obj is None or any(l.operation == 'delete' for l in lignes):
+        return None, None, "Suppression concurrente sur le serveur"
+    champs_serveur = set()
+    for ligne in lignes:
+        champs = json.loads(ligne.changed_fields or '[]')
+        champs_serveur.update(champs if ligne.operation == 'update' and champs else json.loads(ligne.payload or '{}'))
+    payload = change.get('payload') or {}
+    champs_appareil = (change.get('changed_fields') if change['operation'] == 'update' else None) or set(payload)
+    try:
+        appareil_plus_recent = datetime.fromisoformat(change.get('changed_at')) > lignes[-1].changed_at
+    except (TypeError, ValueError):
+        appareil_plus_recent = False
+    resultat = fusionner(
+        _model_to_payload(obj), payload, champs_serveur, champs_appareil,
+        _regles_fusion_sync(change['entity_type']), distant_plus_recent=appareil_plus_recent
+    )
+    if resultat.collisions:
+        return None, resultat, f"Champs modifiés des deux côtés: {', '.join(sorted(resultat.collisions))}"
+    return dict(change, operation='update', changed_fields=list(resultat.appliquer), payload=resultat.appliquer), \
+        resultat, None
+
+def recevoir_changements_sync(device_id, changements, curseur=None):
+    """
+    Applique un lot poussé par un appareil et le consigne dans SyncIncomingLog.
+
+    Les changements déjà reçus (même device_id et change_id) sont acquittés sans
+    être réappliqués. Si l'émetteur fournit son curseur de pull, un changement
+    sur une entité modifiée depuis sur le serveur est fusionné champ par champ ;
+    il n'est rejeté en conflit que si un même champ a reçu deux valeurs
+    différentes (ou en cas de suppression concurrente). Le résultat d'une fusion
+    est journalisé au nom du serveur : l'émetteur le recevra à son prochain pull.
+    Le lot est validé en une transaction.
+
+    Returns:
+        dict: accepted_ids, merged (acceptés après fusion), conflicts, errors
+        (changements invalides) et apply_errors (changements reçus mais non applicables)
+    """
+    reponse = {'accepted_ids': [], 'merged': [], 'conflicts': [], 'errors': [], 'apply_errors': []}
+    valides, vus = [], set()
+    for change in changements:
+        if not _changement_sync_valide(change):
+            reponse['errors'].append({
+                'change_id': change.get('change_id') if isinstance(change, dict) else None,
+                'message': 'Changement invalide ou entité non synchronisée'
+            })
+        elif change['change_id'] not in vus:
+            vus.add(change['change_id'])
+            valides.append(change)
+
+    deja_recus = {}
+    ids = [c['change_id'] for c in valides]
+    for start in range(0, len(ids), BULK_IN_CLAUSE_MAX):
+        for row in db.session.query(
+            SyncIncomingLog.change_id, SyncIncomingLog.status, SyncIncomingLog.error
+        ).filter(
+            SyncIncomingLog.device_id == device_id,
+            SyncIncomingLog.change_id.in_(ids[start:start + BULK_IN_CLAUSE_MAX])
+        ):
+            deja_recus[row.change_id] = row
+
+    nouveaux = []
+    for change in valides:
+        recu = deja_recus.get(change['change_id'])
+        if recu is None:
+            nouveaux.append(change)
+        elif recu.status == 'conflict':
+            reponse['conflicts'].append({
+                'change_id': change['change_id'], 'entity_type': change['entity_type'],
+                'entity_id': change['entity_id'], 'message': recu.error
+            })
+        else:
+            reponse['accepted_ids'].append(change['change_id'])
+
+    concurrents = _changements_concurrents(nouveaux, device_id, int(curseur)) if nouveaux and curseur is not None else {}
+    a_appliquer, fusionnes, conflits, a_recalculer = [], [], {}, []
+    for change in nouveaux:
+        lignes = concurrents.get((change['entity_type'], change['entity_id']))
+        if not lignes:
+            a_appliquer.append(change)
+            continue
+        fusionne, resultat, message = _fusionner_changement_appareil(change, lignes)
+        if message:
+            conflits[change['change_id']] = {
+                'change_id': change['change_id'], 'entity_type': change['entity_type'],
+                'entity_id': change['entity_id'], 'remote_version': lignes[-1].id, 'message': message,
+                'fields': resultat.collisions if resultat else {},
+            }
+            continue
+        if fusionne is not None:
+            fusionnes.append(fusionne)
+            if resultat.recalcul:
+                a_recalculer.append(change)
+    resultats = appliquer_changements_distants(a_appliquer, origine=device_id)
+    resultats.update(appliquer_changements_distants(fusionnes, origine=None))
+    for change in a_recalculer:
+        obj = db.session.get(SYNC_MODELES[change['entity_type']], change['entity_id'])
+        if obj is not None and hasattr(obj, 'calculer_totaux'):
+            obj.calculer_totaux()
+
+    journal = []
+    for change in nouveaux:
+        conflit = conflits.get(change['change_id'])
+        if conflit is not None:
+            statut, message = 'conflict', conflit['message']
+            reponse['conflicts'].append(conflit)
+        else:
+            statut, message = resultats.get(change['change_id'], ('applied', None))
+            reponse['accepted_ids'].append(change['change_id'])
+            if statut == 'error':
+                reponse['apply_errors'].append({'change_id': change['change_id'], 'message': message})
+            elif (change['entity_type'], change['entity_id']) in concurrents:
+                statut = 'merged'
+                reponse['merged'].append(change['change_id'])
+        journal.append({
+            'received_at': utcnow(),
+            'device_id': device_id,
+            'change_id': change['change_id'],
+            'entity_type': change['entity_type'],
+            'entity_id': change['entity_id'],
+            'operation': change['operation'],
+            'payload': json.dumps(change.get('payload') or {}, ensure_ascii=True, default=str),
+            'status': statut,
+            'error': message,
+        })
+    if journal:
+        db.session.execute(SyncIncomingLog.__table__.insert(), journal)
+    db.session.commit()
+    return reponse
+
+def lire_changements_sync(curseur, limite, device_id=None):
+    """
+    Page du journal du serveur après le curseur, compactée par entité.
+
+    Les changements de l'appareil demandeur sont omis mais le curseur avance
+    au-delà : il ne les relira pas.
+
+    Returns:
+        dict: {'changes', 'cursor', 'has_more'}, ou resync_required si le
+        curseur est antérieur aux suppressions effacées par la rétention ; la
+        réponse porte alors live_ids, les identifiants présents par type
+        d'entité, d'où l'appareil déduit les suppressions qu'il n'a pas reçues
+    """
+    cfg = db.session.get(SyncConfig, 1)
+    if curseur and cfg and cfg.log_purged_through and curseur < cfg.log_purged_through:
+        # Des suppressions que l'appareil n'a pas reçues ont été effacées par la rétention
+        return {
+            'changes': [], 'cursor': curseur, 'has_more': False, 'resync_required': True,
+            'live_ids': {
+                nom: db.session.execute(select(modele.id).order_by(modele.id.asc())).scalars().all()
+                for nom, modele in SYNC_MODELES.items()
+            },
+        }
+    table = SyncChangeLog.__table__
+    rows = db.session.execute(
+        select(
+            table.c.id, table.c.entity_type, table.c.entity_id, table.c.operation,
+            table.c.changed_at, table.c.device_id, table.c.changed_fields, table.c.payload
+        ).where(table.c.id > curseur).order_by(table.c.id.asc()).limit(limite + 1)
+    ).all()
+    has_more = len(rows) > limite
+    rows = rows[:limite]
+
+    par_entite = {}
+    for row in rows:
+        if device_id and row.device_id == device_id:
+            continue
+        par_entite.setdefault((row.entity_type, row.entity_id), []).append(row)
+    changements = []
+    for (entity_type, entity_id), lignes in par_entite.items():
+        net = _changement_net(lignes)
+        if net is None:
+            continue
+        conserve, operation, payload, champs = net
+        changements.append({
+            'change_id': conserve.id,
+            'entity_type': entity_type,
+            'entity_id': entity_id,
+            'operation': operation,
+            'changed_at': _serialize_value(lignes[-1].changed_at),
+            'changed_fields': champs,
+            'payload': payload,
+        })
+    changements.sort(key=lambda c: c['change_id'])
+    return {
+        'changes': changements,
+        'cursor': rows[-1].id if rows else curseur,
+        'has_more': has_more,
+    }
+
+def _jeton_serveur_sync_valide():
+    attendu = app.config.get('SYNC_SERVER_TOKEN')
+    if not attendu:
+        return False
+    fourni = request.headers.get('X-Sync-Token')
+    if not fourni:
+        auth = request.headers.get('Authorization', '')
+        fourni = auth[7:].strip() if auth.startswith('Bearer ') else None
+    return bool(fourni) and hmac.compare_digest(fourni.encode('utf-8'), attendu.encode('utf-8'))
+
+def _reponse_sync(donnees, statut=200):
+    """Réponse JSON, compressée en gzip si le client l'accepte et qu'elle est volumineuse."""
+    corps = json.dumps(donnees, ensure_ascii=True, default=str).encode('utf-8')
+    response = app.response_class(corps, status=statut, mimetype='application/json')
+    if 'gzip' in request.headers.get('Accept-Encoding', '') and len(corps) > 1024:
+        response.set_data(compress(corps, 'gzip'))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/api/sync/push', methods=['POST'])
+def api_sync_push():
+    """Reçoit un lot de changements d'un appareil (JSON ou NDJSON, gzip/zstd)."""
+    if not app.config.get('SYNC_SERVER_MODE'):
+        abort(404)
+    if not _jeton_serveur_sync_valide():
+        return jsonify({'success': False, 'error': 'Jeton de synchronisation invalide'}), 401
+    try:
+        brut = decompress(request.get_data(), request.headers.get('Content-Encoding'))
+        if (request.content_type or '').startswith(NDJSON):
+            entete, changements = decode_ndjson(brut)
+        else:
+            entete = json.loads(brut.decode('utf-8') or '{}')
+            changements = entete.pop('changes', None) or []
+        device_id = str(entete.get('device_id') or '')[:64]
+        curseur = entete.get('cursor')
+        curseur = int(curseur) if curseur is not None else None
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Corps invalide: {e}'}), 400
+    if not device_id:
+        return jsonify({'success': False, 'error': 'device_id requis'}), 400
+    try:
+        reponse = recevoir_changements_sync(device_id, changements, curseur)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Réception sync ({device_id}) impossible: {e}")
+        return jsonify({'success': False, 'error': 'Lot non enregistré'}), 500
+    if reponse['apply_errors']:
+        logger.warning(f"Sync {device_id}: {len(reponse['apply_errors'])} changement(s) non appliqué(s)")
+    reponse['success'] = True
+    return _reponse_sync(reponse)
+
+@app.route('/api/sync/pull', methods=['GET'])
+def api_sync_pull():
+    """Changements du serveur après ?cursor=, par pages (?limit=), hors ceux de ?device_id=."""
+    if not app.config.get('SYNC_SERVER_MODE'):
+        abort(404)
+    if not _jeton_serveur_sync_valide():
+        return jsonify({'success': False, 'error': 'Jeton de synchronisation invalide'}), 401
+    curseur = max(0, request.args.get('cursor', 0, type=int) or 0)
+    limite = request.args.get('limit', app.config.get('SYNC_PULL_PAGE_SIZE', 500), type=int) or 1
+    limite = min(max(1, limite), app.config.get('SYNC_PULL_MAX_PAGE_SIZE', 5000))
+    reponse = lire_changements_sync(curseur, limite, request.args.get('device_id'))
+    reponse['success'] = True
+    return _reponse_sync(reponse)
+
+# ==================== RÉTENTION DU JOURNAL SYNC ====================
+#
+# Sur un appareil, les changements acquittés par le serveur ne servent plus :
+# ils sont supprimés après SYNC_RETENTION_DAYS. Sur le serveur central, le
+# journal est la séquence lue par les pulls : l'historique plus ancien que
+# l'horizon est compacté (une ligne par entité, à la position de son dernier
+# changement), et seules les suppressions compactées depuis plus de
+# SYNC_TOMBSTONE_RETENTION_DAYS sont effacées. Un appareil dont le curseur est
+# antérieur à ces suppressions effacées doit tout relire (resync_required) : il
+# reçoit les identifiants encore présents et supprime localement les autres.
+
+_sync_maintenance_rapport = None
+_sync_maintenance_lock = threading.Lock()
+
+def _taille_base_sqlite():
+    """(octets occupés, octets libres) du fichier SQLite."""
+    page_size = db.session.execute(db.text("PRAGMA page_size")).scalar() or 0
+    page_count = db.session.execute(db.text("PRAGMA page_count")).scalar() or 0
+    freelist = db.session.execute(db.text("PRAGMA freelist_count")).scalar() or 0
+    return page_size * page_count, page_size * freelist
+
+def _compacter_historique_serveur(connection, horizon):
+    """Compacte par entité les changements antérieurs à l'horizon ; retourne (lignes avant, lignes après)."""
+    table = SyncChangeLog.__table__
+    lignes = {}
+    for row in connection.execute(
+        select(
+            table.c.id, table.c.entity_type, table.c.entity_id, table.c.operation,
+            table.c.changed_at, table.c.user_id, table.c.changed_fields, table.c.payload
+        ).where(table.c.changed_at < horizon).order_by(table.c.id.asc())
+    ):
+        lignes.setdefault((row.entity_type, row.entity_id), []).append(row)
+
+    avant = apres = 0
+    mises_a_jour, suppressions = [], []
+    for rows in lignes.values():
+        avant += len(rows)
+        apres += 1
+        if len(rows) == 1:
+            continue
+        derniere = rows[-1]
+        if derniere.operation == 'delete':
+            # Une suppression reste une suppression : un appareil qui a vu la création doit la recevoir
+            operation, payload, champs = 'delete', json.loads(derniere.payload or '{}'), []
+        else:
+            net = _changement_net(rows)
+            _, operation, payload, champs = net
+            if rows[0].operation == 'insert' or any(r.operation == 'delete' for r in rows):
+                operation, champs = 'insert', []
+        # Position du dernier changement : un appareil dont le curseur est au milieu reçoit l'état final
+        mises_a_jour.append({
+            'b_id': derniere.id,
+            'operation': operation,
+            'changed_fields': json.dumps(champs, ensure_ascii=True),
+            'payload': json.dumps(payload, ensure_ascii=True, default=str),
+        })
+        suppressions.extend(r.id for r in rows[:-1])
+    if mises_a_jour:
+        connection.execute(
+            table.update().where(table.c.id == db.bindparam('b_id')).values(
+                operation=db.bindparam('operation'),
+                changed_fields=db.bindparam('changed_fields'),
+                payload=db.bindparam('payload'),
+            ),
+            mises_a_jour
+        )
+    for start in range(0, len(suppressions), BULK_IN_CLAUSE_MAX):
+        connection.execute(table.delete().where(table.c.id.in_(suppressions[start:start + BULK_IN_CLAUSE_MAX])))
+    return avant, apres
+
+def _vacuum_base(complet):
+    """VACUUM complet (passe la base en auto_vacuum incrémental) ou incremental_vacuum."""
+    db.session.commit()
+    with _plf_autosave_lock:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            if complet:
+                connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+                connection.exec_driver_sql("VACUUM")
+            elif connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2:
+                connection.exec_driver_sql("PRAGMA incremental_vacuum")
+
+def maintenance_journal_sync(vacuum_complet=False, maintenant=None):
+    """
+    Purge et compacte le journal de synchronisation puis récupère l'espace libéré.
+
+    Args:
+        vacuum_complet: VACUUM complet (fenêtre de maintenance) au lieu de incremental_vacuum
+
+    Returns:
+        dict: lignes supprimées/compactées et octets récupérés sur le fichier
+    """
+    maintenant = maintenant or utcnow()
+    horizon = maintenant - timedelta(days=app.config.get('SYNC_RETENTION_DAYS', 30))
+    table = SyncChangeLog.__table__
+    rapport = {
+        'date': maintenant.isoformat(),
+        'mode': 'serveur' if app.config.get('SYNC_SERVER_MODE') else 'appareil',
+        'changements_supprimes': 0,
+        'changements_compactes': 0,
+        'receptions_supprimees': 0,
+        'vacuum': 'complet' if vacuum_complet else 'incremental',
+    }
+    # La ligne d'id le plus haut est toujours gardée : sans AUTOINCREMENT, SQLite
+    # réutiliserait les ids d'une table vidée et les change_id entreraient en
+    # collision avec ceux déjà reçus (dédoublonnage device_id/change_id du serveur)
+    dernier_id = select(db.func.max(table.c.id)).scalar_subquery()
+    with _sync_maintenance_lock:
+        taille_avant, _ = _taille_base_sqlite()
+        db.session.commit()
+        with db.engine.begin() as connection:
+            if app.config.get('SYNC_SERVER_MODE'):
+                avant, apres = _compacter_historique_serveur(connection, horizon)
+                rapport['changements_compactes'] = avant - apres
+                horizon_suppressions = maintenant - timedelta(
+                    days=app.config.get('SYNC_TOMBSTONE_RETENTION_DAYS', 180)
+                )
+                purges = connection.execute(
+                    select(db.func.max(table.c.id), db.func.count(table.c.id)).where(
+                        table.c.operation == 'delete', table.c.changed_at < horizon_suppressions,
+                        table.c.id < dernier_id
+                    )
+                ).one()
+                if purges[1]:
+                    connection.execute(table.delete().where(
+                        table.c.operation == 'delete', table.c.changed_at < horizon_suppressions,
+                        table.c.id < dernier_id
+                    ))
+                    config = SyncConfig.__table__
+                    connection.execute(config.update().where(config.c.id == 1).where(
+                        or_(config.c.log_purged_through.is_(None), config.c.log_purged_through < purges[0])
+                    ).values(log_purged_through=purges[0]))
+                    rapport['changements_supprimes'] = purges[1]
+                incoming = SyncIncomingLog.__table__
+                rapport['receptions_supprimees'] = connection.execute(
+                    incoming.delete().where(incoming.c.received_at < horizon)
+                ).rowcount
+            else:
+                rapport['changements_supprimes'] = connection.execute(table.delete().where(
+                    table.c.status == 'sent', table.c.sent_at < horizon, table.c.id < dernier_id
+                )).rowcount
+        if rapport['changements_supprimes'] or rapport['changements_compactes'] or rapport['receptions_supprimees']:
+            mark_plf_dirty()
+        try:
+            _vacuum_base(vacuum_complet)
+        except Exception as e:
+            # Consigné dans le rapport : la maintenance n'est pas relancée à chaque cycle de la fenêtre
+            logger.warning(f"VACUUM du journal sync impossible: {e}")
+            rapport['vacuum_erreur'] = str(e)[:500]
+        taille_apres, libres = _taille_base_sqlite()
+        rapport.update(
+            octets_avant=taille_avant,
+            octets_apres=taille_apres,
+            octets_recuperes=max(0, taille_avant - taille_apres),
+            octets_libres_restants=libres,
+        )
+    global _sync_maintenance_rapport
+    _sync_maintenance_rapport = rapport
+    logger.info(
+        f"Maintenance journal sync: {rapport['changements_supprimes']} supprimés, "
+        f"{rapport['changements_compactes']} compactés, {rapport['octets_recuperes']} octets récupérés"
+    )
+    return rapport
+
+def _dans_fenetre_maintenance(instant):
+    """Heure locale dans SYNC_MAINTENANCE_WINDOW ('HH:MM-HH:MM', éventuellement à cheval sur minuit)."""
+    try:
+        debut, fin = (
+            datetime.strptime(borne.strip(), '%H:%M').time()
+            for borne in app.config.get('SYNC_MAINTENANCE_WINDOW', '02:00-05:00').split('-')
+        )
+    except ValueError:
+        return False
+    heure = instant.time()
+    return debut <= heure < fin if debut <= fin else (heure >= debut or heure < fin)
+
+def maintenance_journal_sync_si_due():
+    """Appelée par la boucle de synchronisation : une maintenance complète par fenêtre."""
+    if not _dans_fenetre_maintenance(datetime.now()):
+        return None
+    dernier = _sync_maintenance_rapport
+    if dernier and dernier['vacuum'] == 'complet' and \
+            utcnow() - datetime.fromisoformat(dernier['date']) < timedelta(hours=20):
+        return None
+    return maintenance_journal_sync(vacuum_complet=True)
+
+def get_sync_journal_stats():
+    table = SyncChangeLog.__table__
+    row = db.session.execute(select(
+        db.func.count(table.c.id),
+        db.func.coalesce(db.func.sum(db.func.length(table.c.payload)), 0),
+        db.func.min(table.c.changed_at),
+    )).one()
+    taille, libres = _taille_base_sqlite()
+    return {
+        'changements': row[0],
+        'octets_payload': row[1],
+        'plus_ancien': _serialize_value(row[2]),
+        'octets_base': taille,
+        'octets_libres': libres,
+    }
+
+@app.route('/api/admin/sync/maintenance', methods=['GET', 'POST'])
+@login_required
+@role_required(['admin'])
+def api_sync_maintenance():
+    """État du journal sync (GET) ou maintenance immédiate (POST, vacuum_complet optionnel)."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            rapport = maintenance_journal_sync(vacuum_complet=bool(data.get('vacuum_complet')))
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Maintenance journal sync impossible: {e}")
+            return jsonify({'success': False, 'error': str(e)}), 500
+        return jsonify({'success': True, 'rapport': rapport, 'journal': get_sync_journal_stats()})
+    return jsonify({'success': True, 'rapport': _sync_maintenance_rapport, 'journal': get_sync_journal_stats()})
 
 def init_db():
     """Initialise la base de données sans créer d'utilisateurs par défaut"""
@@ -12496,6 +16088,7 @@ def init_db():
     with app.app_context():
         db.create_all()
         ensure_materiel_schema()
+        ensure_locals_schema()
         ensure_parametres_schema()
         ensure_devis_schema()
         ensure_factures_schema()
@@ -12505,7 +16098,11 @@ def init_db():
         ensure_client_contacts_schema()
         ensure_document_sequences_schema()
         ensure_prestations_schema()
+        ensure_sync_schema()
         ensure_sync_config()
+        ensure_materiel_soldes()
+        ensure_materiel_occupations()
+        invalider_cache_parametres()
         logger.info("Tables créées avec succès")
         logger.info("L'application va maintenant afficher la page d'initialisation")
         backfill_clients()
@@ -12526,6 +16123,7 @@ def _start_sync_on_request():
     if app.config.get('TESTING'):
         return None
     start_sync_service()
+    start_geocoding_service()
     _sync_started = True
     return None
 
@@ -12556,6 +16154,8 @@ def _sanitize_db_name(name):
     return safe or None
 
 def _activate_db(sqlite_path, plf_path):
+    global _plf_etat
+    _plf_etat = None
     app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{sqlite_path}"
     app.config['PLF_TEMP_PATH'] = sqlite_path
     app.config['PLF_ACTIVE_PATH'] = plf_path
@@ -12571,11 +16171,30 @@ def _activate_db(sqlite_path, plf_path):
     except Exception:
         pass
 
+# (mot de passe, état du fichier .plf actif) : sel, clé dérivée et empreintes des
+# blocs, pour que les sauvegardes suivantes ne rechiffrent que les blocs modifiés
+_plf_etat = None
+
 def _encrypt_active_db(password):
+    global _plf_etat
     if not app.config.get('PLF_TEMP_PATH') or not app.config.get('PLF_ACTIVE_PATH'):
         return
-    write_plf_from_sqlite(app.config['PLF_TEMP_PATH'], app.config['PLF_ACTIVE_PATH'], password)
+    etat = None
+    if _plf_etat is not None and hmac.compare_digest(_plf_etat[0].encode('utf-8'), password.encode('utf-8')):
+        etat = _plf_etat[1]
+    # PLF_DIRTY est remis à False avant la lecture : un commit pendant la sauvegarde en redemandera une
     app.config['PLF_DIRTY'] = False
+    try:
+        etat, reecrits = update_plf_from_sqlite(
+            app.config['PLF_TEMP_PATH'], app.config['PLF_ACTIVE_PATH'], password, state=etat,
+            chunk_size=app.config.get('PLF_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+        )
+    except Exception:
+        _plf_etat = None
+        app.config['PLF_DIRTY'] = True
+        raise
+    _plf_etat = (password, etat)
+    logger.debug(f"Sauvegarde PLF: {reecrits}/{len(etat.tags)} blocs rechiffrés")
 
 def mark_plf_dirty():
     if app.config.get('DB_READY'):
@@ -12610,7 +16229,9 @@ def start_plf_autosave_service():
 def _finalize_plf_on_exit():
     try:
         if app.config.get('DB_READY') and app.config.get('PLF_PASSWORD'):
-            _encrypt_active_db(app.config['PLF_PASSWORD'])
+            # Une sauvegarde en cours dans le thread d'autosave partage le même état incrémental
+            with _plf_autosave_lock:
+                _encrypt_active_db(app.config['PLF_PASSWORD'])
     except Exception as e:
         logger.warning(f"PLF final save error: {e}")
 
@@ -12631,7 +16252,7 @@ try:
     # Initialize Stripe with keys from DB
     with app.app_context():
         try:
-            params = ParametresEntreprise.query.first()
+            params = get_parametres_entreprise()
             stripe_secret = get_stripe_secret(params) if params else None
             if stripe_secret:
                 app.config['STRIPE_SECRET_KEY'] = stripe_secret
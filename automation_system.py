@@ -35,8 +35,8 @@ class AutomationSystem:
         
         with self.app.app_context():
             try:
-                from app import ParametresEntreprise
-                params = ParametresEntreprise.query.first()
+                from app import get_parametres_entreprise
+                params = get_parametres_entreprise()
                 if params and params.email_expediteur:
                     self.email_config = {
                         'email': params.email_expediteur,
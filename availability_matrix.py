@@ -0,0 +1,108 @@
+"""
+Calcul vectorisé (NumPy) de la matrice de capacité matériel × période.
+
+Les intervalles d'occupation (buffers logistiques et retours manquants déjà
+appliqués, cf. table materiel_occupations) sont balayés une seule fois : le
+pic d'utilisation de chaque cellule (matériel, jour ou heure) est obtenu sans
+aucune requête par cellule.
+"""
+
+from datetime import datetime, timedelta
+from typing import Sequence, Tuple
+
+import numpy as np
+
+GRANULARITES = {
+    'jour': timedelta(days=1),
+    'heure': timedelta(hours=1),
+}
+
+
+def _secondes(valeurs: Sequence[datetime], origine: datetime) -> np.ndarray:
+    if not len(valeurs):
+        return np.zeros(0, dtype=np.float64)
+    instants = np.array(valeurs, dtype='datetime64[s]')
+    return (instants - np.datetime64(origine, 's')).astype(np.float64)
+
+
+def peak_usage_grid(rows: Sequence[int], debuts: Sequence[datetime], fins: Sequence[datetime],
+                    quantites: Sequence[int], n_rows: int, origine: datetime,
+                    pas: timedelta, n_colonnes: int) -> np.ndarray:
+    """
+    Pic d'utilisation simultanée par cellule.
+
+    Args:
+        rows: index de ligne (matériel) de chaque intervalle
+        debuts, fins: bornes des intervalles [debut, fin[
+        quantites: quantité bloquée par intervalle
+        n_rows, n_colonnes: dimensions de la grille
+        origine: début de la première colonne
+        pas: durée d'une colonne
+
+    Returns:
+        np.ndarray (n_rows, n_colonnes) d'entiers : quantité maximale utilisée
+        simultanément dans chaque cellule
+    """
+    grille = np.zeros((n_rows, n_colonnes), dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    if not rows.size or not n_colonnes:
+        return grille
+
+    pas_s = pas.total_seconds()
+    horizon = pas_s * n_colonnes
+    debut = np.clip(_secondes(debuts, origine), 0.0, horizon)
+    fin = np.clip(_secondes(fins, origine), 0.0, horizon)
+    quantite = np.asarray(quantites, dtype=np.int64)
+    utiles = (fin > debut) & (quantite > 0)
+    rows, debut, fin, quantite = rows[utiles], debut[utiles], fin[utiles], quantite[utiles]
+    if not rows.size:
+        return grille
+
+    # Evénements +q au début, -q à la fin ; à instant égal les fins passent d'abord
+    ev_row = np.concatenate([rows, rows])
+    ev_t = np.concatenate([debut, fin])
+    ev_delta = np.concatenate([quantite, -quantite])
+    ordre = np.lexsort((ev_delta, ev_t, ev_row))
+    ev_row, ev_t, ev_delta = ev_row[ordre], ev_t[ordre], ev_delta[ordre]
+
+    # Chaque matériel revient à 0 : le cumul global se remet à zéro entre les lignes
+    niveau = np.cumsum(ev_delta)
+
+    # Segment k : niveau[k] sur [t_k, t_{k+1}[ pour une même ligne
+    meme_ligne = ev_row[:-1] == ev_row[1:]
+    seg_debut = ev_t[:-1]
+    seg_fin = ev_t[1:]
+    seg_niveau = niveau[:-1]
+    garde = meme_ligne & (seg_fin > seg_debut) & (seg_niveau > 0)
+    if not garde.any():
+        return grille
+    seg_row = ev_row[:-1][garde]
+    seg_niveau = seg_niveau[garde]
+    lo = np.floor(seg_debut[garde] / pas_s).astype(np.int64)
+    hi = np.ceil(seg_fin[garde] / pas_s).astype(np.int64) - 1
+    hi = np.minimum(hi, n_colonnes - 1)
+    nb = hi - lo + 1
+
+    # Les segments d'une ligne sont disjoints : l'expansion reste bornée par
+    # (segments + lignes × colonnes)
+    cellules_row = np.repeat(seg_row, nb)
+    cellules_niveau = np.repeat(seg_niveau, nb)
+    decalage = np.arange(nb.sum()) - np.repeat(np.cumsum(nb) - nb, nb)
+    cellules_col = np.repeat(lo, nb) + decalage
+    np.maximum.at(grille, (cellules_row, cellules_col), cellules_niveau)
+    return grille
+
+
+def capacity_matrix(capacites: Sequence[int], rows: Sequence[int], debuts: Sequence[datetime],
+                    fins: Sequence[datetime], quantites: Sequence[int], origine: datetime,
+                    pas: timedelta, n_colonnes: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Matrice de capacité restante.
+
+    Returns:
+        (utilise, disponible) : deux np.ndarray (n_materiels, n_colonnes)
+    """
+    capacites = np.asarray(capacites, dtype=np.int64)
+    utilise = peak_usage_grid(rows, debuts, fins, quantites, capacites.size, origine, pas, n_colonnes)
+    disponible = np.clip(capacites[:, None] - utilise, 0, None)
+    return utilise, disponible
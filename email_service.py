@@ -35,10 +35,10 @@ class EmailService:
     def _get_parametres(self):
         try:
             from flask import current_app
-            from app import ParametresEntreprise
+            from app import get_parametres_entreprise
             if current_app:
                 with current_app.app_context():
-                    return ParametresEntreprise.query.first()
+                    return get_parametres_entreprise()
         except Exception:
             return None
         return None
@@ -0,0 +1,44 @@
+"""
+Classement vectorisé (NumPy) de points par distance à vol d'oiseau.
+
+Toutes les coordonnées candidates sont traitées en une seule opération : le
+classement des locaux par proximité d'un lieu ne coûte ni requête ni appel au
+moteur de routage par candidat.
+"""
+
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+RAYON_TERRE_KM = 6371.0
+
+
+def haversine_km_array(lat: float, lng: float, lats: Sequence[float], lngs: Sequence[float]) -> np.ndarray:
+    """Distances (km) du point (lat, lng) à chaque point (lats[i], lngs[i])."""
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lngs = np.radians(np.asarray(lngs, dtype=np.float64))
+    phi = np.radians(float(lat))
+    dphi = lats - phi
+    dlambda = lngs - np.radians(float(lng))
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi) * np.cos(lats) * np.sin(dlambda / 2) ** 2
+    return 2 * RAYON_TERRE_KM * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def rank_by_distance(lat: float, lng: float, lats: Sequence[float], lngs: Sequence[float],
+                     k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Indices des points du plus proche au plus éloigné.
+
+    Args:
+        k: ne classer que les k plus proches (sélection partielle, O(n))
+
+    Returns:
+        (indices, distances_km) triés par distance croissante
+    """
+    distances = haversine_km_array(lat, lng, lats, lngs)
+    if k is not None and 0 < k < distances.size:
+        candidats = np.argpartition(distances, k - 1)[:k]
+        ordre = candidats[np.argsort(distances[candidats], kind='stable')]
+    else:
+        ordre = np.argsort(distances, kind='stable')
+    return ordre, distances[ordre]
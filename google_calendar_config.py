@@ -16,6 +16,15 @@ from googleapiclient.errors import HttpError
 import logging
 from flask import current_app, url_for
 
+import outbound_http
+
+try:
+    import httplib2
+    import google_auth_httplib2
+except ImportError:  # dépendances de google-api-python-client, absentes sur certaines installations
+    httplib2 = None
+    google_auth_httplib2 = None
+
 # Scopes nécessaires
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
@@ -29,8 +38,8 @@ class GoogleCalendarManager:
     def _get_settings(self):
         """Récupère les paramètres entreprise depuis la DB"""
         try:
-            from app import ParametresEntreprise
-            return ParametresEntreprise.query.first()
+            from app import get_parametres_entreprise
+            return get_parametres_entreprise()
         except Exception as e:
             logging.error(f"Erreur récupération paramètres: {e}")
             return None
@@ -131,7 +140,9 @@ class GoogleCalendarManager:
         # Vérifier si le token a expiré
         if dj.google_token_expiry and datetime.now() >= dj.google_token_expiry:
             try:
-                credentials.refresh(Request())
+                with outbound_http.call('google_calendar') as timeout:
+                    transport = Request()
+                    credentials.refresh(lambda *args, **kwargs: transport(*args, timeout=timeout, **kwargs))
                 # Mettre à jour les tokens dans la base de donnéees
                 self.update_dj_tokens(dj, credentials)
             except Exception as e:
@@ -159,12 +170,34 @@ class GoogleCalendarManager:
             return None
         
         try:
-            service = build('calendar', 'v3', credentials=credentials)
+            if httplib2 is not None and google_auth_httplib2 is not None:
+                # Sans timeout httplib2 attend indéfiniment ; _executer le réajuste à chaque appel
+                http = google_auth_httplib2.AuthorizedHttp(
+                    credentials,
+                    http=httplib2.Http(timeout=outbound_http.timeout_for('google_calendar'))
+                )
+                service = build('calendar', 'v3', http=http, cache_discovery=False)
+            else:
+                service = build('calendar', 'v3', credentials=credentials, cache_discovery=False)
             return service
         except Exception as e:
             logging.error(f"Erreur création service: {e}")
             return None
     
+    def _executer(self, requete):
+        """Exécute une requête de l'API Google sous le disjoncteur 'google_calendar'."""
+        with outbound_http.call('google_calendar') as timeout:
+            http = getattr(requete, 'http', None)
+            http = getattr(http, 'http', http)  # AuthorizedHttp enveloppe le httplib2.Http
+            if httplib2 is not None and isinstance(http, httplib2.Http):
+                http.timeout = timeout
+                # Connexions gardées ouvertes : leur socket garde le timeout de sa création
+                for connexion in http.connections.values():
+                    connexion.timeout = timeout
+                    if connexion.sock is not None:
+                        connexion.sock.settimeout(timeout)
+            return requete.execute(num_retries=0)
+
     def create_event(self, dj, prestation):
         """Crée un événement dans le calendrier du DJ"""
         service = self.get_service(dj)
@@ -212,10 +245,10 @@ class GoogleCalendarManager:
             # Utiliser le calendrier principal ou un calendrier spécifique
             calendar_id = dj.google_calendar_id or 'primary'
             
-            event = service.events().insert(
+            event = self._executer(service.events().insert(
                 calendarId=calendar_id,
                 body=event
-            ).execute()
+            ))
             
             return event.get('id')
             
@@ -272,11 +305,11 @@ class GoogleCalendarManager:
             
             calendar_id = dj.google_calendar_id or 'primary'
             
-            service.events().update(
+            self._executer(service.events().update(
                 calendarId=calendar_id,
                 eventId=event_id,
                 body=event
-            ).execute()
+            ))
             
             return True
             
@@ -295,10 +328,10 @@ class GoogleCalendarManager:
         
         try:
             calendar_id = dj.google_calendar_id or 'primary'
-            service.events().delete(
+            self._executer(service.events().delete(
                 calendarId=calendar_id,
                 eventId=event_id
-            ).execute()
+            ))
             
             return True
             
@@ -317,7 +350,7 @@ class GoogleCalendarManager:
         
         try:
             # Essayer de récupérer la liste des calendriers
-            calendar_list = service.calendarList().list().execute()
+            calendar_list = self._executer(service.calendarList().list())
             return True
         except Exception as e:
             logging.error(f"Erreur test connexion: {e}")
@@ -56,9 +56,9 @@ class InvoiceGenerator:
     def generate_invoice_from_prestation(self, prestation, output_path=None):
         """Génère une facture à partir d'une prestation"""
         try:
-            from app import ParametresEntreprise
+            from app import get_parametres_entreprise
             # Récupérer les paramètres de l'entreprise
-            params = ParametresEntreprise.query.first()
+            params = get_parametres_entreprise()
             if not params:
                 raise Exception("Paramètres d'entreprise non configurés")
             
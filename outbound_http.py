@@ -0,0 +1,227 @@
+"""
+Couche commune des appels sortants (géocodage, routage, Groq, Google Calendar, Stripe, synchronisation).
+
+Chaque service externe est protégé par :
+    - un timeout propre, borné par le budget restant de la requête HTTP en cours
+    - un disjoncteur : après N échecs consécutifs le service est coupé pendant
+      reset_timeout secondes, puis un seul appel d'essai est autorisé
+    - un cloisonnement (bulkhead) : nombre maximal d'appels simultanés, les
+      appels en surnombre sont refusés immédiatement au lieu d'occuper un thread
+
+Un service lent ou en panne ne dégrade ainsi que la fonctionnalité qui l'utilise
+au lieu de bloquer tous les threads du serveur.
+
+Usage :
+    with outbound_http.call('geocoding') as timeout:
+        urllib.request.urlopen(req, timeout=timeout)
+"""
+
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+DEFAULT_POLICIES = {
+    'geocoding': {'timeout': 6.0, 'max_concurrent': 2, 'failure_threshold': 5, 'reset_timeout': 60.0},
+    'routing': {'timeout': 6.0, 'max_concurrent': 2, 'failure_threshold': 5, 'reset_timeout': 60.0},
+    'groq': {'timeout': 20.0, 'max_concurrent': 2, 'failure_threshold': 3, 'reset_timeout': 60.0},
+    'google_calendar': {'timeout': 10.0, 'max_concurrent': 2, 'failure_threshold': 5, 'reset_timeout': 120.0},
+    'stripe': {'timeout': 15.0, 'max_concurrent': 3, 'failure_threshold': 5, 'reset_timeout': 30.0},
+    'sync': {'timeout': 30.0, 'max_concurrent': 1, 'failure_threshold': 3, 'reset_timeout': 60.0},
+}
+# En dessous de ce budget restant, l'appel n'est même pas tenté
+MIN_TIMEOUT = 0.5
+
+FERME = 'ferme'
+OUVERT = 'ouvert'
+SEMI_OUVERT = 'semi_ouvert'
+
+_deadline = contextvars.ContextVar('outbound_deadline', default=None)
+
+
+class OutboundUnavailable(Exception):
+    """Appel refusé sans être tenté (disjoncteur ouvert, cloison pleine ou budget épuisé)."""
+
+    def __init__(self, service, raison):
+        super().__init__(f"{service} indisponible ({raison})")
+        self.service = service
+        self.raison = raison
+
+
+class _Service:
+    def __init__(self, nom, timeout, max_concurrent, failure_threshold, reset_timeout):
+        self.nom = nom
+        self.timeout = float(timeout)
+        self.max_concurrent = int(max_concurrent)
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+        self.lock = threading.Lock()
+        self.en_cours = 0
+        self.etat = FERME
+        self.echecs_consecutifs = 0
+        self.ouvert_depuis = 0.0
+        self.essai_en_cours = False
+        self.metriques = {
+            'appels': 0, 'succes': 0, 'echecs': 0,
+            'refus_disjoncteur': 0, 'refus_cloison': 0, 'refus_budget': 0,
+            'ouvertures': 0,
+        }
+        self.latences = deque(maxlen=200)
+
+    def entrer(self):
+        with self.lock:
+            if self.etat == OUVERT:
+                if time.monotonic() - self.ouvert_depuis < self.reset_timeout:
+                    self.metriques['refus_disjoncteur'] += 1
+                    raise OutboundUnavailable(self.nom, 'disjoncteur')
+                self.etat = SEMI_OUVERT
+            if self.etat == SEMI_OUVERT:
+                if self.essai_en_cours:
+                    self.metriques['refus_disjoncteur'] += 1
+                    raise OutboundUnavailable(self.nom, 'disjoncteur')
+                self.essai_en_cours = True
+            if self.en_cours >= self.max_concurrent:
+                if self.etat == SEMI_OUVERT:
+                    self.essai_en_cours = False
+                self.metriques['refus_cloison'] += 1
+                raise OutboundUnavailable(self.nom, 'cloison')
+            self.en_cours += 1
+            self.metriques['appels'] += 1
+
+    def sortir(self, duree, succes):
+        with self.lock:
+            self.en_cours -= 1
+            self.latences.append(duree)
+            essai = self.etat == SEMI_OUVERT
+            if essai:
+                self.essai_en_cours = False
+            if succes:
+                self.metriques['succes'] += 1
+                self.echecs_consecutifs = 0
+                self.etat = FERME
+                return
+            self.metriques['echecs'] += 1
+            self.echecs_consecutifs += 1
+            if essai or self.echecs_consecutifs >= self.failure_threshold:
+                if self.etat != OUVERT:
+                    self.metriques['ouvertures'] += 1
+                self.etat = OUVERT
+                self.ouvert_depuis = time.monotonic()
+
+    def snapshot(self):
+        with self.lock:
+            latences = sorted(self.latences)
+            return dict(
+                self.metriques,
+                etat=self.etat,
+                en_cours=self.en_cours,
+                timeout=self.timeout,
+                max_concurrent=self.max_concurrent,
+                failure_threshold=self.failure_threshold,
+                latence_moyenne=round(sum(latences) / len(latences), 3) if latences else None,
+                latence_p95=round(latences[int(0.95 * (len(latences) - 1))], 3) if latences else None,
+            )
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def configure(service, **policy):
+    """Crée ou ajuste la politique d'un service (timeout, max_concurrent, failure_threshold, reset_timeout)."""
+    with _services_lock:
+        existant = _services.get(service)
+        base = dict(DEFAULT_POLICIES.get(service, DEFAULT_POLICIES['geocoding']))
+        if existant:
+            base.update(
+                timeout=existant.timeout, max_concurrent=existant.max_concurrent,
+                failure_threshold=existant.failure_threshold, reset_timeout=existant.reset_timeout,
+            )
+        base.update({k: v for k, v in policy.items() if v is not None})
+        if existant:
+            with existant.lock:
+                existant.timeout = float(base['timeout'])
+                existant.max_concurrent = int(base['max_concurrent'])
+                existant.failure_threshold = int(base['failure_threshold'])
+                existant.reset_timeout = float(base['reset_timeout'])
+            return existant
+        _services[service] = _Service(service, **base)
+        return _services[service]
+
+
+def _service(nom):
+    service = _services.get(nom)
+    return service if service is not None else configure(nom)
+
+
+def start_budget(seconds):
+    """Fixe l'échéance des appels sortants du contexte courant (une requête HTTP)."""
+    return _deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def end_budget(token):
+    try:
+        _deadline.reset(token)
+    except ValueError:
+        _deadline.set(None)
+
+
+def remaining_budget():
+    """Secondes restantes avant l'échéance du contexte courant (None si aucune)."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def timeout_for(service):
+    """Timeout effectif : celui du service, borné par le budget restant."""
+    timeout = _service(service).timeout
+    restant = remaining_budget()
+    if restant is not None:
+        timeout = min(timeout, restant)
+    return timeout
+
+
+@contextmanager
+def call(service):
+    """Encadre un appel sortant ; fournit le timeout à utiliser.
+
+    Lève OutboundUnavailable si l'appel ne doit pas être tenté. Toute exception
+    levée dans le bloc compte comme un échec pour le disjoncteur.
+    """
+    etat = _service(service)
+    timeout = timeout_for(service)
+    if timeout < MIN_TIMEOUT:
+        with etat.lock:
+            etat.metriques['refus_budget'] += 1
+        raise OutboundUnavailable(service, 'budget')
+    etat.entrer()
+    debut = time.monotonic()
+    succes = False
+    try:
+        yield timeout
+        succes = True
+    finally:
+        etat.sortir(time.monotonic() - debut, succes)
+
+
+def get_metrics():
+    """Métriques et état du disjoncteur de chaque service utilisé."""
+    with _services_lock:
+        services = list(_services.values())
+    return {service.nom: service.snapshot() for service in services}
+
+
+def reset(service=None):
+    """Referme les disjoncteurs et remet les métriques à zéro (tous les services si None)."""
+    with _services_lock:
+        noms = [service] if service else list(_services)
+        for nom in noms:
+            existant = _services.get(nom)
+            if existant:
+                _services[nom] = _Service(
+                    nom, existant.timeout, existant.max_concurrent,
+                    existant.failure_threshold, existant.reset_timeout,
+                )
@@ -1,16 +1,81 @@
+"""
+Stockage chiffré des bases SQLite (.plf).
+
+Format v2 (PLF2), lu et écrit en flux par blocs de taille fixe :
+    en-tête  : magic | sel | taille de bloc | nombre de blocs | taille en clair
+               | sceau (nonce + AES-GCM de l'empreinte de chaîne, AAD = champs précédents)
+    blocs    : nonce (12) | AES-GCM(bloc) avec AAD = magic | sel | taille de bloc | index
+
+Chaque bloc a son propre nonce et son tag. L'empreinte de chaîne (SHA-256 chaîné
+sur les tags des blocs, dans l'ordre) est scellée dans l'en-tête avec le nombre de
+blocs et la taille : un bloc déplacé, retiré, dupliqué ou provenant d'un autre
+fichier est détecté. Les blocs étant à position fixe, un bloc peut être relu ou
+réécrit seul.
+
+Sauvegarde incrémentale : seuls les blocs dont l'empreinte en clair a changé
+sont rechiffrés. Les blocs réécrits et le nouvel en-tête (le manifeste) passent
+d'abord par un journal de reprise (<fichier>.journal) ; le fichier n'est modifié
+en place qu'une fois le journal complet et durable, et un journal complet laissé
+par une interruption est rejoué à l'ouverture suivante.
+
+La base est chiffrée depuis un instantané cohérent (API de sauvegarde SQLite) :
+un commit concurrent pendant la lecture ne produit pas de copie déchirée.
+
+Le format v1 (PLF1 : un seul bloc AES-GCM) reste lisible.
+"""
+
+import hashlib
+import io
 import os
 import secrets
-from typing import Tuple
+import sqlite3
+import struct
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import BinaryIO, List, Optional, Tuple
 
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
 
 PLF_MAGIC = b"PLF1"
+PLF_MAGIC_V2 = b"PLF2"
 SALT_SIZE = 16
 NONCE_SIZE = 12
+TAG_SIZE = 16
 KDF_ITERATIONS = 200_000
 KEY_SIZE = 32
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 4096
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# magic | sel | taille de bloc (préfixe lié à chaque bloc)
+_PREFIXE = struct.Struct(">4s16sI")
+# préfixe | nombre de blocs | taille en clair (authentifiés par le sceau)
+_CHAMPS = struct.Struct(">4s16sIQQ")
+_SCEAU_SIZE = NONCE_SIZE + hashlib.sha256().digest_size + TAG_SIZE
+HEADER_SIZE_V2 = _CHAMPS.size + _SCEAU_SIZE
+_LECTURE_V1 = 1024 * 1024
+
+JOURNAL_SUFFIX = ".journal"
+_MAGIC_JOURNAL = b"PLFJ"
+# index du bloc | longueur de l'enregistrement
+_ENTREE_JOURNAL = struct.Struct(">QI")
+_EMPREINTE_JOURNAL = hashlib.sha256().digest_size
+
+
+@dataclass
+class PlfState:
+    """État d'un fichier v2 conservé entre deux sauvegardes incrémentales."""
+    salt: bytes
+    key: bytes
+    chunk_size: int
+    plaintext_size: int = 0
+    header: bytes = b""
+    hashes: List[bytes] = field(default_factory=list)  # empreintes des blocs en clair
+    tags: List[bytes] = field(default_factory=list)
 
 
 def _derive_key(password: str, salt: bytes) -> bytes:
@@ -25,43 +90,451 @@ def _derive_key(password: str, salt: bytes) -> bytes:
     return kdf.derive(password.encode("utf-8"))
 
 
-def encrypt_bytes(data: bytes, password: str) -> bytes:
-    salt = secrets.token_bytes(SALT_SIZE)
-    key = _derive_key(password, salt)
+# ==================== FORMAT V2 ====================
+
+def _prefixe(salt: bytes, chunk_size: int) -> bytes:
+    return _PREFIXE.pack(PLF_MAGIC_V2, salt, chunk_size)
+
+
+def _aad_bloc(prefixe: bytes, index: int) -> bytes:
+    return prefixe + struct.pack(">Q", index)
+
+
+def _chaine_initiale(prefixe: bytes) -> bytes:
+    return hashlib.sha256(b"PLF2-chain" + prefixe).digest()
+
+
+def _chainer(empreinte: bytes, tag: bytes) -> bytes:
+    return hashlib.sha256(empreinte + tag).digest()
+
+
+def chunk_record_size(chunk_size: int) -> int:
+    """Taille d'un bloc complet dans le fichier (nonce + données + tag)."""
+    return NONCE_SIZE + chunk_size + TAG_SIZE
+
+
+def chunk_offset(chunk_size: int, index: int) -> int:
+    return HEADER_SIZE_V2 + index * chunk_record_size(chunk_size)
+
+
+def encrypt_chunk(aesgcm: AESGCM, prefixe: bytes, index: int, data: bytes) -> bytes:
     nonce = secrets.token_bytes(NONCE_SIZE)
-    aesgcm = AESGCM(key)
-    ciphertext = aesgcm.encrypt(nonce, data, None)
-    return PLF_MAGIC + salt + nonce + ciphertext
+    return nonce + aesgcm.encrypt(nonce, data, _aad_bloc(prefixe, index))
 
 
-def decrypt_bytes(data: bytes, password: str) -> bytes:
-    if not data.startswith(PLF_MAGIC):
+def seal_header(aesgcm: AESGCM, salt: bytes, chunk_size: int, chunk_count: int,
+                plaintext_size: int, chain: bytes) -> bytes:
+    champs = _CHAMPS.pack(PLF_MAGIC_V2, salt, chunk_size, chunk_count, plaintext_size)
+    nonce = secrets.token_bytes(NONCE_SIZE)
+    return champs + nonce + aesgcm.encrypt(nonce, chain, champs)
+
+
+def read_header(f: BinaryIO) -> Tuple[bytes, int, int, int, bytes]:
+    """(sel, taille de bloc, nombre de blocs, taille en clair, sceau) d'un fichier v2."""
+    entete = f.read(HEADER_SIZE_V2)
+    if len(entete) != HEADER_SIZE_V2:
+        raise ValueError("Format PLF invalide")
+    magic, salt, chunk_size, chunk_count, plaintext_size = _CHAMPS.unpack_from(entete)
+    if magic != PLF_MAGIC_V2 or not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError("Format PLF invalide")
+    if chunk_count != -(-plaintext_size // chunk_size):
+        raise ValueError("Format PLF invalide")
+    return salt, chunk_size, chunk_count, plaintext_size, entete
+
+
+def open_header(aesgcm: AESGCM, entete: bytes) -> bytes:
+    """Vérifie le sceau de l'en-tête et retourne l'empreinte de chaîne attendue."""
+    champs = entete[:_CHAMPS.size]
+    nonce = entete[_CHAMPS.size:_CHAMPS.size + NONCE_SIZE]
+    return aesgcm.decrypt(nonce, entete[_CHAMPS.size + NONCE_SIZE:], champs)
+
+
+def _empreinte_bloc(bloc: bytes) -> bytes:
+    # SHA-256 bénéficie des instructions SHA des processeurs récents (plus rapide que BLAKE2 ici)
+    return hashlib.sha256(bloc).digest()[:16]
+
+
+def chain_from_tags(salt: bytes, chunk_size: int, tags) -> bytes:
+    empreinte = _chaine_initiale(_prefixe(salt, chunk_size))
+    for tag in tags:
+        empreinte = _chainer(empreinte, tag)
+    return empreinte
+
+
+def encrypt_stream(src: BinaryIO, dst: BinaryIO, password: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   key: Optional[Tuple[bytes, bytes]] = None) -> int:
+    """
+    Chiffre src dans dst (positionnable) au format v2, un bloc en mémoire à la fois.
+
+    Args:
+        key: (sel, clé dérivée) à réutiliser ; un nouveau sel est tiré sinon
+
+    Returns:
+        int: taille en clair
+    """
+    if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError("Taille de bloc PLF invalide")
+    salt, cle = key if key else (None, None)
+    if salt is None:
+        salt = secrets.token_bytes(SALT_SIZE)
+        cle = _derive_key(password, salt)
+    return _chiffrer_flux(src, dst, PlfState(salt=salt, key=cle, chunk_size=chunk_size)).plaintext_size
+
+
+def _chiffrer_flux(src: BinaryIO, dst: BinaryIO, etat: PlfState) -> PlfState:
+    """Écrit le fichier v2 complet et remplit etat (empreintes, tags, en-tête)."""
+    aesgcm = AESGCM(etat.key)
+    prefixe = _prefixe(etat.salt, etat.chunk_size)
+    debut = dst.tell()
+    dst.write(b"\0" * HEADER_SIZE_V2)
+    empreinte = _chaine_initiale(prefixe)
+    etat.hashes, etat.tags = [], []
+    index = taille = 0
+    while True:
+        bloc = src.read(etat.chunk_size)
+        if not bloc:
+            break
+        enregistrement = encrypt_chunk(aesgcm, prefixe, index, bloc)
+        dst.write(enregistrement)
+        empreinte = _chainer(empreinte, enregistrement[-TAG_SIZE:])
+        etat.hashes.append(_empreinte_bloc(bloc))
+        etat.tags.append(enregistrement[-TAG_SIZE:])
+        taille += len(bloc)
+        index += 1
+    fin = dst.tell()
+    etat.plaintext_size = taille
+    etat.header = seal_header(aesgcm, etat.salt, etat.chunk_size, index, taille, empreinte)
+    dst.seek(debut)
+    dst.write(etat.header)
+    dst.seek(fin)
+    return etat
+
+
+def _decrypt_stream_v2(src: BinaryIO, dst: BinaryIO, password: str) -> int:
+    salt, chunk_size, chunk_count, plaintext_size, entete = read_header(src)
+    aesgcm = AESGCM(_derive_key(password, salt))
+    attendue = open_header(aesgcm, entete)
+    prefixe = _prefixe(salt, chunk_size)
+    empreinte = _chaine_initiale(prefixe)
+    taille = 0
+    for index in range(chunk_count):
+        longueur = min(chunk_size, plaintext_size - index * chunk_size)
+        enregistrement = src.read(NONCE_SIZE + longueur + TAG_SIZE)
+        if len(enregistrement) != NONCE_SIZE + longueur + TAG_SIZE:
+            raise InvalidTag()
+        bloc = aesgcm.decrypt(enregistrement[:NONCE_SIZE], enregistrement[NONCE_SIZE:], _aad_bloc(prefixe, index))
+        empreinte = _chainer(empreinte, enregistrement[-TAG_SIZE:])
+        dst.write(bloc)
+        taille += len(bloc)
+    if src.read(1) or not secrets.compare_digest(empreinte, attendue):
+        raise InvalidTag()
+    return taille
+
+
+def _decrypt_stream_v1(src: BinaryIO, dst: BinaryIO, password: str) -> int:
+    """Un seul bloc AES-GCM : déchiffré en flux, le tag (fin de fichier) n'est vérifié qu'à la fin."""
+    salt = src.read(SALT_SIZE)
+    nonce = src.read(NONCE_SIZE)
+    debut = src.tell()
+    src.seek(0, os.SEEK_END)
+    fin = src.tell() - TAG_SIZE
+    if len(salt) != SALT_SIZE or len(nonce) != NONCE_SIZE or fin < debut:
         raise ValueError("Format PLF invalide")
-    offset = len(PLF_MAGIC)
-    salt = data[offset:offset + SALT_SIZE]
-    offset += SALT_SIZE
-    nonce = data[offset:offset + NONCE_SIZE]
-    offset += NONCE_SIZE
-    ciphertext = data[offset:]
-    key = _derive_key(password, salt)
-    aesgcm = AESGCM(key)
-    return aesgcm.decrypt(nonce, ciphertext, None)
-
-
-def write_plf_from_sqlite(sqlite_path: str, plf_path: str, password: str) -> None:
+    src.seek(fin)
+    tag = src.read(TAG_SIZE)
+    src.seek(debut)
+    decrypteur = Cipher(algorithms.AES(_derive_key(password, salt)), modes.GCM(nonce, tag)).decryptor()
+    restant = taille = fin - debut
+    while restant:
+        bloc = src.read(min(_LECTURE_V1, restant))
+        if not bloc:
+            raise InvalidTag()
+        restant -= len(bloc)
+        dst.write(decrypteur.update(bloc))
+    dst.write(decrypteur.finalize())
+    return taille
+
+
+def decrypt_stream(src: BinaryIO, dst: BinaryIO, password: str) -> int:
+    """
+    Déchiffre src (v1 ou v2, positionnable) dans dst en mémoire bornée.
+
+    Des données déjà écrites dans dst ne sont authentifiées qu'au retour :
+    en cas d'exception (InvalidTag, ValueError), dst doit être jeté.
+
+    Returns:
+        int: taille en clair
+    """
+    magic = src.read(len(PLF_MAGIC))
+    if magic == PLF_MAGIC_V2:
+        src.seek(-len(magic), os.SEEK_CUR)
+        return _decrypt_stream_v2(src, dst, password)
+    if magic == PLF_MAGIC:
+        return _decrypt_stream_v1(src, dst, password)
+    raise ValueError("Format PLF invalide")
+
+
+def plf_version(plf_path: str) -> int:
+    with open(plf_path, "rb") as f:
+        magic = f.read(len(PLF_MAGIC))
+    return {PLF_MAGIC: 1, PLF_MAGIC_V2: 2}.get(magic, 0)
+
+
+# ==================== OCTETS ET FICHIERS ====================
+
+def encrypt_bytes(data: bytes, password: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> bytes:
+    dst = io.BytesIO()
+    encrypt_stream(io.BytesIO(data), dst, password, chunk_size)
+    return dst.getvalue()
+
+
+def decrypt_bytes(data: bytes, password: str) -> bytes:
+    dst = io.BytesIO()
+    decrypt_stream(io.BytesIO(data), dst, password)
+    return dst.getvalue()
+
+
+def _temp_voisin(path: str) -> str:
+    return f"{path}.{secrets.token_hex(4)}.tmp"
+
+
+def _synchroniser_dossier(path: str) -> None:
+    if hasattr(os, "O_DIRECTORY"):
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _remplacer(temp_path: str, path: str) -> None:
+    """Remplacement atomique de path par temp_path (durable après le retour)."""
+    os.replace(temp_path, path)
+    _synchroniser_dossier(path)
+
+
+_MAGIC_SQLITE = b"SQLite format 3\x00"
+
+
+@contextmanager
+def _instantane_sqlite(sqlite_path: str):
+    """
+    Flux en lecture sur une copie cohérente de la base.
+
+    L'API de sauvegarde copie toutes les pages (WAL compris) sous un même verrou
+    de lecture, dans un fichier temporaire voisin supprimé à la sortie. Un
+    fichier qui n'est pas une base SQLite est lu tel quel.
+    """
     with open(sqlite_path, "rb") as f:
-        plaintext = f.read()
-    encrypted = encrypt_bytes(plaintext, password)
-    with open(plf_path, "wb") as f:
-        f.write(encrypted)
+        est_sqlite = f.read(len(_MAGIC_SQLITE)) == _MAGIC_SQLITE
+    if not est_sqlite:
+        with open(sqlite_path, "rb") as src:
+            yield src
+        return
+    copie_path = _temp_voisin(sqlite_path)
+    try:
+        source = sqlite3.connect(sqlite_path)
+        try:
+            copie = sqlite3.connect(copie_path)
+            try:
+                source.backup(copie)
+            finally:
+                copie.close()
+        finally:
+            source.close()
+        with open(copie_path, "rb") as src:
+            yield src
+    finally:
+        for chemin in (copie_path, copie_path + "-journal", copie_path + "-wal", copie_path + "-shm"):
+            if os.path.exists(chemin):
+                os.remove(chemin)
+
+
+def write_plf_from_sqlite(sqlite_path: str, plf_path: str, password: str,
+                          chunk_size: int = DEFAULT_CHUNK_SIZE) -> PlfState:
+    """
+    Chiffre toute la base au format v2 (nouveau sel) ; le fichier .plf existant
+    n'est remplacé qu'une fois l'écriture terminée.
+
+    Returns:
+        PlfState: état à passer à update_plf_from_sqlite
+    """
+    if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError("Taille de bloc PLF invalide")
+    salt = secrets.token_bytes(SALT_SIZE)
+    etat = PlfState(salt=salt, key=_derive_key(password, salt), chunk_size=chunk_size)
+    temp_path = _temp_voisin(plf_path)
+    try:
+        with _instantane_sqlite(sqlite_path) as src, open(temp_path, "wb") as dst:
+            _chiffrer_flux(src, dst, etat)
+            dst.flush()
+            os.fsync(dst.fileno())
+        _remplacer(temp_path, plf_path)
+        # Un journal antérieur viserait l'ancien fichier
+        if os.path.exists(plf_path + JOURNAL_SUFFIX):
+            os.remove(plf_path + JOURNAL_SUFFIX)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return etat
+
+
+def _taille_fichier_v2(entete: bytes) -> int:
+    _, _, _, chunk_count, plaintext_size = _CHAMPS.unpack_from(entete)
+    return HEADER_SIZE_V2 + chunk_count * (NONCE_SIZE + TAG_SIZE) + plaintext_size
+
+
+def recover_plf(plf_path: str) -> bool:
+    """
+    Termine une sauvegarde incrémentale interrompue.
+
+    Un journal complet est rejoué (l'opération est idempotente) ; un journal
+    incomplet est ignoré, le fichier n'ayant pas encore été modifié.
+
+    Returns:
+        bool: True si un journal a été rejoué
+    """
+    journal_path = plf_path + JOURNAL_SUFFIX
+    if not os.path.exists(journal_path):
+        return False
+    with open(journal_path, "rb") as journal:
+        contenu = journal.read()
+    pied = HEADER_SIZE_V2 + _EMPREINTE_JOURNAL
+    valide = (
+        len(contenu) >= len(_MAGIC_JOURNAL) + pied
+        and contenu.startswith(_MAGIC_JOURNAL)
+        and secrets.compare_digest(hashlib.sha256(contenu[:-_EMPREINTE_JOURNAL]).digest(),
+                                   contenu[-_EMPREINTE_JOURNAL:])
+    )
+    if not valide or not os.path.exists(plf_path):
+        os.remove(journal_path)
+        return False
+    entete = contenu[-pied:-_EMPREINTE_JOURNAL]
+    _, _, chunk_size, _, _ = _CHAMPS.unpack_from(entete)
+    with open(plf_path, "r+b") as plf:
+        position, fin = len(_MAGIC_JOURNAL), len(contenu) - pied
+        while position < fin:
+            index, longueur = _ENTREE_JOURNAL.unpack_from(contenu, position)
+            position += _ENTREE_JOURNAL.size
+            plf.seek(chunk_offset(chunk_size, index))
+            plf.write(contenu[position:position + longueur])
+            position += longueur
+        plf.seek(0)
+        plf.write(entete)
+        plf.truncate(_taille_fichier_v2(entete))
+        plf.flush()
+        os.fsync(plf.fileno())
+    os.remove(journal_path)
+    _synchroniser_dossier(plf_path)
+    return True
+
+
+def _entete_courant(plf_path: str, entete: bytes) -> bool:
+    try:
+        with open(plf_path, "rb") as f:
+            return f.read(HEADER_SIZE_V2) == entete
+    except OSError:
+        return False
+
+
+def update_plf_from_sqlite(sqlite_path: str, plf_path: str, password: str, state: Optional[PlfState] = None,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE) -> Tuple[PlfState, int]:
+    """
+    Sauvegarde incrémentale : ne rechiffre que les blocs modifiés depuis state.
+
+    Un instantané de la base est relu pour comparer les empreintes des blocs
+    (sans chiffrement) ; les blocs modifiés et le nouvel en-tête sont écrits dans le journal, rendu
+    durable, puis appliqués au fichier. Sans état utilisable (premier appel,
+    fichier remplacé entre-temps, autre taille de bloc), le fichier est réécrit
+    en entier.
+
+    Returns:
+        (PlfState à jour, nombre de blocs chiffrés)
+    """
+    recover_plf(plf_path)
+    if state is None or state.chunk_size != chunk_size or not _entete_courant(plf_path, state.header):
+        etat = write_plf_from_sqlite(sqlite_path, plf_path, password, chunk_size)
+        return etat, len(etat.tags)
+
+    aesgcm = AESGCM(state.key)
+    prefixe = _prefixe(state.salt, chunk_size)
+    hashes, tags = list(state.hashes), list(state.tags)
+    journal_path = plf_path + JOURNAL_SUFFIX
+    journal = None
+    controle = hashlib.sha256()
+
+    def _journaliser(donnees):
+        journal.write(donnees)
+        controle.update(donnees)
+
+    try:
+        with _instantane_sqlite(sqlite_path) as src:
+            index = taille = reecrits = 0
+            while True:
+                bloc = src.read(chunk_size)
+                if not bloc:
+                    break
+                empreinte = _empreinte_bloc(bloc)
+                if index >= len(hashes) or hashes[index] != empreinte:
+                    enregistrement = encrypt_chunk(aesgcm, prefixe, index, bloc)
+                    if journal is None:
+                        journal = open(journal_path, "wb")
+                        _journaliser(_MAGIC_JOURNAL)
+                    _journaliser(_ENTREE_JOURNAL.pack(index, len(enregistrement)) + enregistrement)
+                    reecrits += 1
+                    if index < len(hashes):
+                        hashes[index], tags[index] = empreinte, enregistrement[-TAG_SIZE:]
+                    else:
+                        hashes.append(empreinte)
+                        tags.append(enregistrement[-TAG_SIZE:])
+                taille += len(bloc)
+                index += 1
+        del hashes[index:], tags[index:]
+        if journal is None and taille == state.plaintext_size:
+            return state, 0
+        if journal is None:
+            # Base réduite à une frontière de bloc : seul l'en-tête change
+            journal = open(journal_path, "wb")
+            _journaliser(_MAGIC_JOURNAL)
+        entete = seal_header(aesgcm, state.salt, chunk_size, index, taille,
+                             chain_from_tags(state.salt, chunk_size, tags))
+        _journaliser(entete)
+        journal.write(controle.digest())
+        journal.flush()
+        os.fsync(journal.fileno())
+        journal.close()
+        journal = None
+    except BaseException:
+        if journal is not None:
+            journal.close()
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        raise
+
+    recover_plf(plf_path)
+    etat = PlfState(salt=state.salt, key=state.key, chunk_size=chunk_size, plaintext_size=taille,
+                    header=entete, hashes=hashes, tags=tags)
+    return etat, reecrits
 
 
 def decrypt_plf_to_sqlite(plf_path: str, sqlite_path: str, password: str) -> None:
-    with open(plf_path, "rb") as f:
-        data = f.read()
-    plaintext = decrypt_bytes(data, password)
-    with open(sqlite_path, "wb") as f:
-        f.write(plaintext)
+    """Déchiffre un fichier v1 ou v2 ; sqlite_path n'est écrit que si tout le fichier est authentique."""
+    recover_plf(plf_path)
+    temp_path = _temp_voisin(sqlite_path)
+    try:
+        with open(plf_path, "rb") as src, open(temp_path, "wb") as dst:
+            decrypt_stream(src, dst, password)
+            dst.flush()
+            os.fsync(dst.fileno())
+        _remplacer(temp_path, sqlite_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 
 def ensure_dir(path: str) -> None:
@@ -0,0 +1,137 @@
+"""
+Tournées de livraison et de reprise du matériel (plus proche voisin + 2-opt).
+
+Les coûts sont lus dans une matrice carrée (durées en minutes, éventuellement
+asymétrique) déjà calculée par la matrice de distances : l'optimisation ne fait
+aucun appel externe et s'arrête à l'échéance fournie en conservant la meilleure
+solution trouvée.
+"""
+
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+def tour_cost(tour: Sequence[int], couts: np.ndarray) -> float:
+    """Coût d'une tournée (dépôt en première et dernière position)."""
+    idx = np.asarray(tour, dtype=np.int64)
+    if idx.size < 2:
+        return 0.0
+    return float(couts[idx[:-1], idx[1:]].sum())
+
+
+def nearest_neighbour_tours(couts: np.ndarray, depot: int, arrets: Sequence[int],
+                            demandes: Sequence[float], capacite: Optional[float]) -> List[List[int]]:
+    """
+    Découpe les arrêts d'un dépôt en tournées par plus proche voisin.
+
+    Une tournée est close quand plus aucun arrêt restant ne tient dans le
+    véhicule ; un arrêt dépassant à lui seul la capacité forme sa propre tournée.
+    """
+    demandes = np.asarray(demandes, dtype=np.float64)
+    restants = np.zeros(couts.shape[0], dtype=bool)
+    restants[list(arrets)] = True
+    capacite = np.inf if not capacite else float(capacite)
+    tours = []
+    while restants.any():
+        tour = [depot]
+        charge = 0.0
+        courant = depot
+        while True:
+            candidats = restants & (charge + demandes <= capacite)
+            if not candidats.any():
+                break
+            suivant = int(np.argmin(np.where(candidats, couts[courant], np.inf)))
+            tour.append(suivant)
+            restants[suivant] = False
+            charge += demandes[suivant]
+            courant = suivant
+        if len(tour) == 1:
+            suivant = int(np.argmin(np.where(restants, couts[depot], np.inf)))
+            tour.append(suivant)
+            restants[suivant] = False
+        tour.append(depot)
+        tours.append(tour)
+    return tours
+
+
+def two_opt(tour: List[int], couts: np.ndarray, echeance: Optional[float] = None) -> List[int]:
+    """
+    Améliore une tournée par inversions de segments (2-opt, meilleure inversion par position).
+
+    Le coût du segment inversé est recalculé dans le sens inverse : la matrice
+    peut être asymétrique (sens uniques, durées routières).
+    """
+    t = np.asarray(tour, dtype=np.int64)
+    m = t.size
+    if m < 5:
+        return list(t)
+    ameliore = True
+    while ameliore:
+        ameliore = False
+        # avant[k] / arriere[k] : coût cumulé des arcs t[0..k] parcourus dans chaque sens
+        avant = np.concatenate(([0.0], np.cumsum(couts[t[:-1], t[1:]])))
+        arriere = np.concatenate(([0.0], np.cumsum(couts[t[1:], t[:-1]])))
+        for i in range(1, m - 2):
+            if echeance is not None and time.monotonic() > echeance:
+                return list(t)
+            j = np.arange(i + 1, m - 1)
+            delta = (
+                couts[t[i - 1], t[j]] + couts[t[i], t[j + 1]]
+                - couts[t[i - 1], t[i]] - couts[t[j], t[j + 1]]
+                + (arriere[j] - arriere[i]) - (avant[j] - avant[i])
+            )
+            k = int(np.argmin(delta))
+            if delta[k] < -1e-9:
+                t[i:j[k] + 1] = t[i:j[k] + 1][::-1].copy()
+                ameliore = True
+                avant = np.concatenate(([0.0], np.cumsum(couts[t[:-1], t[1:]])))
+                arriere = np.concatenate(([0.0], np.cumsum(couts[t[1:], t[:-1]])))
+    return list(t)
+
+
+def assign_vehicles(durees: Sequence[float], vehicules: int) -> List[List[int]]:
+    """Répartit les tournées entre véhicules (plus longues d'abord, vers le moins chargé)."""
+    vehicules = max(1, int(vehicules))
+    charges = [0.0] * vehicules
+    affectation = [[] for _ in range(vehicules)]
+    for index in sorted(range(len(durees)), key=lambda k: -durees[k]):
+        v = charges.index(min(charges))
+        affectation[v].append(index)
+        charges[v] += durees[index]
+    return [sorted(indices) for indices in affectation if indices]
+
+
+def optimize_routes(couts: np.ndarray, arrets_par_depot: Dict[int, Sequence[int]],
+                    demandes: Sequence[float], capacite: Optional[float] = None,
+                    time_limit: float = 0.3) -> Dict[int, List[List[int]]]:
+    """
+    Tournées optimisées pour chaque dépôt.
+
+    Args:
+        couts: np.ndarray (n, n) des coûts entre points (dépôts et arrêts)
+        arrets_par_depot: index du dépôt -> index des arrêts qu'il dessert
+        demandes: quantité à charger pour chaque point (n,)
+        capacite: capacité d'un véhicule (None : illimitée)
+        time_limit: temps de calcul maximal du 2-opt (s)
+
+    Returns:
+        dict index du dépôt -> liste de tournées [depot, arrêt, ..., depot]
+    """
+    couts = np.asarray(couts, dtype=np.float64)
+    echeance = time.monotonic() + time_limit
+    tournees = {
+        depot: nearest_neighbour_tours(couts, depot, arrets, demandes, capacite)
+        for depot, arrets in arrets_par_depot.items() if len(arrets)
+    }
+    # Les plus longues tournées d'abord : ce sont elles qui gagnent le plus au 2-opt
+    ordre = sorted(
+        ((depot, k) for depot, tours in tournees.items() for k in range(len(tours))),
+        key=lambda cle: -len(tournees[cle[0]][cle[1]])
+    )
+    for depot, k in ordre:
+        if time.monotonic() > echeance:
+            break
+        tournees[depot][k] = two_opt(tournees[depot][k], couts, echeance)
+    return tournees
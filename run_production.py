@@ -34,13 +34,13 @@ logger.info('=' * 70)
 logger.info('')
 
 # Lancer le serveur avec Waitress
-# threads=8 pour gérer plusieurs connexions simultanées
+# threads : SERVER_THREADS (8 par défaut), partagé avec les flux SSE plafonnés
 # channel_timeout=300 pour éviter les timeouts
 serve(
     app, 
     host='0.0.0.0', 
     port=5000, 
-    threads=8,
+    threads=app.config['SERVER_THREADS'],
     channel_timeout=300,
     url_scheme='http'
 )
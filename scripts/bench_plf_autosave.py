@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Banc de la sauvegarde chiffrée : réécriture complète contre sauvegarde
+incrémentale après la modification d'une ligne (fichier temporaire).
+
+    python scripts/bench_plf_autosave.py --size-mb 256 --repeat 3
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from plf_storage import DEFAULT_CHUNK_SIZE, HEADER_SIZE_V2, chunk_record_size, update_plf_from_sqlite, write_plf_from_sqlite
+
+
+def _modifier(chemin, position):
+    """Simule une ligne modifiée : une page de 4 Kio réécrite."""
+    with open(chemin, 'r+b') as f:
+        f.seek(position)
+        f.write(os.urandom(4096))
+
+
+def benchmark(taille_mo, repetitions, chunk_size):
+    with tempfile.TemporaryDirectory() as dossier:
+        sqlite_path = os.path.join(dossier, 'bench.db')
+        plf_path = os.path.join(dossier, 'bench.plf')
+        with open(sqlite_path, 'wb') as f:
+            for _ in range(taille_mo):
+                f.write(os.urandom(1024 * 1024))
+
+        complet, incremental = [], []
+        etat, _ = update_plf_from_sqlite(sqlite_path, plf_path, 'banc', chunk_size=chunk_size)
+        for tour in range(repetitions):
+            _modifier(sqlite_path, (tour * 7919 * 4096) % (taille_mo * 1024 * 1024 - 4096))
+            debut = time.perf_counter()
+            write_plf_from_sqlite(sqlite_path, plf_path, 'banc', chunk_size=chunk_size)
+            complet.append(time.perf_counter() - debut)
+
+            etat, _ = update_plf_from_sqlite(sqlite_path, plf_path, 'banc', chunk_size=chunk_size)
+            _modifier(sqlite_path, (tour * 104729 * 4096) % (taille_mo * 1024 * 1024 - 4096))
+            debut = time.perf_counter()
+            etat, reecrits = update_plf_from_sqlite(sqlite_path, plf_path, 'banc', etat, chunk_size=chunk_size)
+            incremental.append(time.perf_counter() - debut)
+
+    return {
+        'taille_mo': taille_mo,
+        'bloc_kio': chunk_size // 1024,
+        'ms_reecriture_complete': round(min(complet) * 1000, 1),
+        'ms_sauvegarde_incrementale': round(min(incremental) * 1000, 1),
+        'blocs_rechiffres': reecrits,
+        'octets_ecrits_complet': taille_mo * 1024 * 1024 + HEADER_SIZE_V2,
+        # journal puis fichier : blocs modifiés et en-tête, deux fois
+        'octets_ecrits_incremental': 2 * (reecrits * chunk_record_size(chunk_size) + HEADER_SIZE_V2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--chunk-kb', type=int, default=DEFAULT_CHUNK_SIZE // 1024)
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.size_mb, args.repeat, args.chunk_kb * 1024), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
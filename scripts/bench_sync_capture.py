@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Banc du journal de synchronisation : surcoût de la capture des changements
+pour 1 000 lignes modifiées (base SQLite temporaire).
+
+    python scripts/bench_sync_capture.py --rows 1000 --repeat 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from app import app, db
+from app import Local, Materiel, SyncChangeLog, _SYNC_SANS_JOURNAL, _sync_capture
+
+
+def _mesurer(materiel_ids, tour, capture):
+    """Durée (s) de la modification de toutes les lignes, validée en une transaction."""
+    jeton = _sync_capture.set(None if capture else _SYNC_SANS_JOURNAL)
+    try:
+        materiels = Materiel.query.filter(Materiel.id.in_(materiel_ids)).all()
+        debut = time.perf_counter()
+        for materiel in materiels:
+            materiel.quantite = tour
+            materiel.notes_technicien = f"Révision {tour}"
+        db.session.commit()
+        return time.perf_counter() - debut
+    finally:
+        _sync_capture.reset(jeton)
+
+
+def benchmark(lignes, repetitions):
+    with tempfile.TemporaryDirectory() as dossier:
+        chemin = os.path.join(dossier, 'bench.db')
+        app.config.update(TESTING=True, SQLALCHEMY_DATABASE_URI=f"sqlite:///{chemin}", DB_READY=True)
+        with app.app_context():
+            db.create_all()
+            local = Local(nom="Dépôt banc", adresse="1 rue du Banc")
+            db.session.add(local)
+            db.session.flush()
+            db.session.add_all([
+                Materiel(nom=f"Enceinte {i}", local_id=local.id, quantite=1, categorie="Son",
+                         statut="disponible", prix_location=10.0)
+                for i in range(lignes)
+            ])
+            db.session.commit()
+            ids = [m.id for m in Materiel.query.all()]
+
+            sans, avec = [], []
+            for tour in range(repetitions):
+                sans.append(_mesurer(ids, 2 * tour + 2, capture=False))
+                avec.append(_mesurer(ids, 2 * tour + 3, capture=True))
+            journal = SyncChangeLog.query.filter_by(entity_type='Materiel', operation='update').all()
+            octets = sum(len(c.payload or '') for c in journal) / max(1, len(journal))
+            db.session.remove()
+            db.engine.dispose()
+
+    facteur = 1000.0 / lignes
+    sans_ms = min(sans) * 1000 * facteur
+    avec_ms = min(avec) * 1000 * facteur
+    return {
+        'lignes': lignes,
+        'ms_1000_sans_capture': round(sans_ms, 1),
+        'ms_1000_avec_capture': round(avec_ms, 1),
+        'surcout_ms_1000': round(avec_ms - sans_ms, 1),
+        'octets_payload_moyen': round(octets),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.rows, args.repeat), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
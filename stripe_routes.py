@@ -11,8 +11,8 @@ stripe_bp = Blueprint('stripe_bp', __name__)
 logger = logging.getLogger(__name__)
 
 def _get_stripe_params():
-    from app import ParametresEntreprise, get_stripe_secret
-    params = ParametresEntreprise.query.first()
+    from app import get_parametres_entreprise, get_stripe_secret
+    params = get_parametres_entreprise()
     stripe_secret = get_stripe_secret(params) if params else None
     if not params or not params.stripe_enabled or not stripe_secret:
         return None, "Stripe non configuré"
@@ -227,12 +227,12 @@ def _handle_invoice_payment(invoice_id, session):
     facture.reference_paiement = _session_attr(session, 'id')
     if payment_intent:
         facture.stripe_payment_intent_id = payment_intent
-    from app import Paiement, generate_document_number, ParametresEntreprise
+    from app import Paiement, generate_document_number, get_parametres_entreprise
     existing = None
     if payment_intent:
         existing = Paiement.query.filter_by(stripe_payment_intent_id=payment_intent).first()
     if not existing:
-        params = ParametresEntreprise.query.first()
+        params = get_parametres_entreprise()
         paiement = Paiement(
             numero=generate_document_number('PAY'),
             montant=amount_paid,
@@ -282,13 +282,13 @@ def _handle_quote_payment(quote_id, session):
     devis.date_paiement_acompte = datetime.now(timezone.utc).replace(tzinfo=None)
     if devis.statut != 'accepte':
         devis.statut = 'accepte'
-    from app import Paiement, generate_document_number, ParametresEntreprise
+    from app import Paiement, generate_document_number, get_parametres_entreprise
     existing = None
     payment_intent = _session_attr(session, 'payment_intent')
     if payment_intent:
         existing = Paiement.query.filter_by(stripe_payment_intent_id=payment_intent).first()
     if not existing:
-        params = ParametresEntreprise.query.first()
+        params = get_parametres_entreprise()
         paiement = Paiement(
             numero=generate_document_number('PAY'),
             montant=amount_paid,
@@ -1,9 +1,43 @@
 import stripe
 import logging
+import threading
+from contextlib import contextmanager
 from flask import url_for, current_app
 
+import outbound_http
+
 logger = logging.getLogger(__name__)
 
+# Timeout de l'appel Stripe en cours dans ce thread (fourni par outbound_http.call)
+_timeout_appel = threading.local()
+
+
+def _client_http_borne(client_http):
+    """Client HTTP Stripe dont le timeout est relu à chaque requête."""
+    class _ClientHttpBorne(client_http):
+        @property
+        def _timeout(self):
+            timeout = getattr(_timeout_appel, 'valeur', None)
+            return timeout if timeout is not None else outbound_http.timeout_for('stripe')
+
+        @_timeout.setter
+        def _timeout(self, valeur):
+            pass  # fixé par le constructeur, ignoré : le timeout dépend de l'appel
+
+    return _ClientHttpBorne
+
+
+@contextmanager
+def _appel_stripe():
+    """Appel Stripe sous le disjoncteur, avec le timeout borné par le budget restant."""
+    with outbound_http.call('stripe') as timeout:
+        _timeout_appel.valeur = timeout
+        try:
+            yield timeout
+        finally:
+            _timeout_appel.valeur = None
+
+
 class StripeService:
     def __init__(self):
         self.api_key = None
@@ -14,6 +48,16 @@ class StripeService:
         self.api_key = app.config.get('STRIPE_SECRET_KEY')
         if self.api_key:
             stripe.api_key = self.api_key
+            # Pas de nouvelle tentative interne : le disjoncteur d'outbound_http s'en charge
+            stripe.max_network_retries = 0
+            client_http = getattr(stripe, 'RequestsClient', None)
+            if client_http is None:
+                client_http = getattr(getattr(stripe, 'http_client', None), 'RequestsClient', None)
+            if client_http is not None:
+                try:
+                    stripe.default_http_client = _client_http_borne(client_http)()
+                except Exception as e:
+                    logger.warning(f"Stripe HTTP client timeout not applied: {e}")
             self.is_initialized = True
             logger.info("✅ StripeService initialized")
         else:
@@ -49,7 +93,8 @@ class StripeService:
                 'metadata': metadata or {}
             }
             
-            checkout_session = stripe.checkout.Session.create(**session_data)
+            with _appel_stripe():
+                checkout_session = stripe.checkout.Session.create(**session_data)
             return checkout_session, None
             
         except Exception as e:
@@ -60,7 +105,8 @@ class StripeService:
         if not self.is_initialized:
             return None
         try:
-            return stripe.checkout.Session.retrieve(session_id)
+            with _appel_stripe():
+                return stripe.checkout.Session.retrieve(session_id)
         except Exception as e:
             logger.error(f"Error retrieving session {session_id}: {e}")
             return None
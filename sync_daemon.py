@@ -3,34 +3,87 @@
 """
 Daemon de synchronisation offline
 - Peut être lancé en arrière-plan (Tauri sidecar)
-- Envoie les changements toutes les N secondes si activé
+- Envoie les changements peu après chaque commit de l'application (surveillance
+  du fichier SQLite, puis du journal seulement si le fichier a changé)
+- Sans activité, relève les changements distants à intervalle croissant ;
+  après un échec, repli exponentiel avec gigue
 """
 
+import os
 import time
 import logging
 
-from app import app, db, SyncConfig, ensure_sync_config, _sync_once
+from sqlalchemy import func
+
+from app import app, db, SyncChangeLog, ensure_sync_config, _sync_cycle
+from sync_scheduler import SyncScheduler
 
 logger = logging.getLogger(__name__)
 
+INTERVALLE_SURVEILLANCE = 1.0
+
+
+def _signature_fichier(chemin):
+    """Dates de modification de la base et de son journal WAL (None si absents)."""
+    signature = []
+    for suffixe in ('', '-wal'):
+        try:
+            signature.append(os.stat(chemin + suffixe).st_mtime_ns)
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def _dernier_changement_en_attente():
+    with app.app_context():
+        try:
+            return db.session.query(func.max(SyncChangeLog.id)).filter(SyncChangeLog.status == 'pending').scalar()
+        finally:
+            db.session.remove()
+
 
 def main():
     with app.app_context():
         ensure_sync_config()
+        chemin = db.engine.url.database
 
-    while True:
-        try:
-            with app.app_context():
-                cfg = db.session.get(SyncConfig, 1)
-                interval = cfg.sync_interval_seconds if cfg and cfg.sync_interval_seconds else 20
-                if cfg and cfg.enabled:
-                    _sync_once()
-                time.sleep(interval)
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            logger.warning(f"Sync daemon error: {e}")
-            time.sleep(20)
+    scheduler = SyncScheduler(
+        _sync_cycle,
+        debounce=app.config.get('SYNC_DEBOUNCE_SECONDS', 1.0),
+        max_delay=app.config.get('SYNC_DEBOUNCE_MAX_SECONDS', 5.0),
+        idle_min=app.config.get('SYNC_INTERVAL_DEFAULT', 20),
+        idle_max=app.config.get('SYNC_IDLE_MAX_SECONDS', 300),
+        backoff_base=app.config.get('SYNC_BACKOFF_BASE_SECONDS', 5.0),
+        backoff_max=app.config.get('SYNC_BACKOFF_MAX_SECONDS', 600.0),
+        on_error=lambda e: logger.warning(f"Sync daemon error: {e}"),
+    ).start()
+
+    # Les commits ont lieu dans un autre processus : seul le fichier est observé en continu,
+    # le journal n'est lu que lorsqu'il a changé
+    signature = _signature_fichier(chemin) if chemin else None
+    dernier = _dernier_changement_en_attente()
+    scheduler.notify()
+    try:
+        while True:
+            time.sleep(INTERVALLE_SURVEILLANCE)
+            if not chemin:
+                continue
+            nouvelle = _signature_fichier(chemin)
+            if nouvelle == signature:
+                continue
+            signature = nouvelle
+            try:
+                courant = _dernier_changement_en_attente()
+            except Exception as e:
+                logger.warning(f"Sync daemon error: {e}")
+                continue
+            if courant is not None and courant != dernier:
+                scheduler.notify()
+            dernier = courant
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop(timeout=5)
 
 
 if __name__ == "__main__":
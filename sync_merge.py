@@ -0,0 +1,82 @@
+"""
+Fusion à trois voies, champ par champ, de changements concurrents sur une entité.
+
+Chaque côté (local : l'état de celui qui reçoit, distant : le changement reçu)
+a modifié un ensemble de champs depuis la version de base commune :
+    - un champ modifié d'un seul côté garde la valeur de ce côté
+    - un champ modifié des deux côtés avec la même valeur n'est pas un conflit
+    - sinon la règle du champ décide : REGLE_PLUS_RECENT (le changement le plus
+      récent l'emporte), REGLE_RECALCUL (valeur dérivée, recalculée après fusion)
+    - un champ modifié des deux côtés sans règle est une vraie collision, à
+      résoudre par une personne
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Optional, Set
+
+REGLE_PLUS_RECENT = 'plus_recent'
+REGLE_RECALCUL = 'recalcul'
+
+_ABSENT = object()
+
+
+@dataclass
+class ResultatFusion:
+    appliquer: Dict[str, Any] = field(default_factory=dict)  # valeurs distantes à appliquer localement
+    gagnes_distant: Set[str] = field(default_factory=set)  # champs modifiés des deux côtés, valeur distante retenue
+    gagnes_local: Set[str] = field(default_factory=set)  # champs modifiés des deux côtés, valeur locale retenue
+    collisions: Dict[str, Dict[str, Any]] = field(default_factory=dict)  # champ -> {'local', 'distant'}
+    recalcul: bool = False
+
+    @property
+    def automatique(self):
+        return not self.collisions
+
+
+def champs_modifies(base: Optional[Dict[str, Any]], valeurs: Dict[str, Any]) -> Set[str]:
+    """Champs dont la valeur diffère de la base (tous si la base est inconnue)."""
+    base = base or {}
+    return {nom for nom, valeur in valeurs.items() if nom != 'id' and base.get(nom, _ABSENT) != valeur}
+
+
+def fusionner(local: Dict[str, Any], distant: Dict[str, Any], champs_local: Iterable[str],
+              champs_distant: Iterable[str], regles: Optional[Dict[str, str]] = None,
+              distant_plus_recent: bool = False) -> ResultatFusion:
+    """
+    Fusionne un changement distant dans l'état local.
+
+    Args:
+        local: valeurs locales actuelles (sérialisées comme les payloads)
+        distant: valeurs du changement distant
+        champs_local / champs_distant: champs modifiés depuis la base de chaque côté
+        regles: champ -> REGLE_PLUS_RECENT | REGLE_RECALCUL
+        distant_plus_recent: le changement distant est postérieur au dernier changement local
+    """
+    regles = regles or {}
+    champs_local = set(champs_local) - {'id'}
+    resultat = ResultatFusion()
+    for nom in sorted(set(champs_distant) - {'id'}):
+        if nom not in distant:
+            continue
+        valeur = distant[nom]
+        regle = regles.get(nom)
+        if regle == REGLE_RECALCUL:
+            resultat.recalcul = True
+            continue
+        if nom not in champs_local:
+            resultat.appliquer[nom] = valeur
+            continue
+        if local.get(nom, _ABSENT) == valeur:
+            continue
+        if regle == REGLE_PLUS_RECENT:
+            if distant_plus_recent:
+                resultat.appliquer[nom] = valeur
+                resultat.gagnes_distant.add(nom)
+            else:
+                resultat.gagnes_local.add(nom)
+            continue
+        resultat.collisions[nom] = {'local': local.get(nom), 'distant': valeur}
+    # Des valeurs distantes appliquées peuvent être des données d'entrée des champs dérivés
+    if resultat.appliquer and REGLE_RECALCUL in regles.values():
+        resultat.recalcul = True
+    return resultat
@@ -0,0 +1,169 @@
+"""
+Ordonnanceur de la synchronisation, réveillé par les changements.
+
+- notify() (appelé après un commit qui a journalisé des changements) planifie
+  un cycle après une fenêtre d'anti-rebond : une rafale de commits ne donne
+  qu'un cycle, au plus max_delay secondes après le premier
+- sans changement local, un cycle est lancé tous les idle_min secondes pour
+  relever les changements distants ; l'intervalle double à chaque cycle sans
+  effet, jusqu'à idle_max
+- après un échec, le cycle suivant est retardé exponentiellement (avec gigue) ;
+  les notifications reçues pendant ce repli attendent la fin du repli
+
+Le cycle (run) retourne un statut : 'synced' (des changements ont circulé),
+'failed' (ou une exception) pour un échec, tout autre statut pour un cycle sans effet.
+"""
+
+import random
+import threading
+import time
+
+SYNCED = 'synced'
+FAILED = 'failed'
+
+
+class SyncScheduler:
+    """Boucle de synchronisation dans un thread, pilotée par notify()."""
+
+    def __init__(self, run, debounce=1.0, max_delay=5.0, idle_min=20.0, idle_max=300.0,
+                 backoff_base=5.0, backoff_max=600.0, jitter=0.2, on_error=None,
+                 clock=time.monotonic, rand=random.random):
+        self.run = run
+        self.debounce = float(debounce)
+        self.max_delay = float(max_delay)
+        self.idle_min = float(idle_min)
+        self.idle_max = max(float(idle_max), self.idle_min)
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.jitter = float(jitter)
+        self.on_error = on_error
+        self._clock = clock
+        self._rand = rand
+        self._lock = threading.Lock()
+        self._reveil = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._premiere_notif = None
+        self._derniere_notif = None
+        self._intervalle_inactif = self.idle_min
+        self._prochain_inactif = clock() + self.idle_min
+        self._reprise = None
+        self.echecs_consecutifs = 0
+        self.en_cours = False
+        self.metriques = {
+            'notifications': 0, 'cycles': 0, 'echecs': 0,
+            'cycles_changements': 0, 'cycles_inactivite': 0, 'cycles_reprise': 0,
+            'dernier_statut': None, 'derniere_duree': None,
+        }
+
+    # ---- signaux ----
+
+    def notify(self):
+        """Des changements locaux attendent d'être envoyés."""
+        with self._lock:
+            maintenant = self._clock()
+            if self._premiere_notif is None:
+                self._premiere_notif = maintenant
+            self._derniere_notif = maintenant
+            self.metriques['notifications'] += 1
+        self._reveil.set()
+
+    # ---- planification ----
+
+    def _echeance(self):
+        """(instant du prochain cycle, cause)."""
+        if self._premiere_notif is not None:
+            echeance = min(self._derniere_notif + self.debounce, self._premiere_notif + self.max_delay)
+            cause = 'cycles_changements'
+        else:
+            echeance, cause = self._prochain_inactif, 'cycles_inactivite'
+        if self._reprise is not None and self._reprise > echeance:
+            echeance, cause = self._reprise, 'cycles_reprise'
+        elif self._reprise is not None and cause == 'cycles_inactivite':
+            cause = 'cycles_reprise'
+        return echeance, cause
+
+    def _repli(self):
+        delai = min(self.backoff_max, self.backoff_base * (2 ** (self.echecs_consecutifs - 1)))
+        return delai * (1 + self.jitter * (2 * self._rand() - 1))
+
+    def step(self):
+        """Lance le cycle s'il est dû ; retourne le délai (s) avant la prochaine échéance."""
+        with self._lock:
+            echeance, cause = self._echeance()
+            maintenant = self._clock()
+            if maintenant < echeance:
+                return echeance - maintenant
+            # Les notifications reçues pendant le cycle en planifient un nouveau
+            self._premiere_notif = self._derniere_notif = None
+            self.en_cours = True
+        debut = self._clock()
+        try:
+            statut = self.run()
+        except Exception as e:
+            statut = FAILED
+            if self.on_error:
+                self.on_error(e)
+        fin = self._clock()
+        with self._lock:
+            self.en_cours = False
+            self.metriques['cycles'] += 1
+            self.metriques[cause] += 1
+            self.metriques['dernier_statut'] = statut
+            self.metriques['derniere_duree'] = round(fin - debut, 3)
+            if statut == FAILED:
+                self.metriques['echecs'] += 1
+                self.echecs_consecutifs += 1
+                self._reprise = fin + self._repli()
+                self._prochain_inactif = self._reprise
+            else:
+                self.echecs_consecutifs = 0
+                self._reprise = None
+                if statut == SYNCED:
+                    self._intervalle_inactif = self.idle_min
+                else:
+                    self._intervalle_inactif = min(self.idle_max, self._intervalle_inactif * 2)
+                self._prochain_inactif = fin + self._intervalle_inactif
+            return max(0.0, self._echeance()[0] - fin)
+
+    # ---- thread ----
+
+    def _boucle(self):
+        while not self._stop.is_set():
+            self._reveil.clear()
+            delai = self.step()
+            if delai > 0:
+                self._reveil.wait(delai)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._boucle, name='planify-sync', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._reveil.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def snapshot(self):
+        with self._lock:
+            maintenant = self._clock()
+            echeance, cause = self._echeance()
+            return dict(
+                self.metriques,
+                en_cours=self.en_cours,
+                en_repli=self._reprise is not None,
+                echecs_consecutifs=self.echecs_consecutifs,
+                intervalle_inactif=self._intervalle_inactif,
+                prochain_cycle_dans=round(max(0.0, echeance - maintenant), 3),
+                prochaine_cause=cause.replace('cycles_', ''),
+                notifications_en_attente=self._premiere_notif is not None,
+            )
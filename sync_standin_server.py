@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Serveur de synchronisation de substitution (hors ligne) et banc de débit.
+
+Le serveur accepte POST /api/sync/push en NDJSON (gzip/zstd) ou en JSON
+historique, sur des connexions keep-alive, dédoublonne par
+(device_id, change_id) et simule une latence fixe + proportionnelle au volume.
+
+Banc :
+    python sync_standin_server.py --changes 20000 --latency-ms 40 --ms-per-kb 0.2
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sync_transport import NDJSON, SyncTransport, compress, decode_ndjson, decompress
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        serveur = self.server
+        if self.path.rstrip('/') != '/api/sync/push':
+            self._repondre(404, {'error': 'not found'})
+            return
+        longueur = int(self.headers.get('Content-Length') or 0)
+        corps = self.rfile.read(longueur)
+        serveur.connexions.add(self.client_address)
+        try:
+            brut = decompress(corps, self.headers.get('Content-Encoding'))
+            if (self.headers.get('Content-Type') or '').startswith(NDJSON):
+                if not serveur.accept_ndjson:
+                    self._repondre(415, {'error': 'ndjson non supporté'})
+                    return
+                entete, changements = decode_ndjson(brut)
+            else:
+                entete = json.loads(brut.decode('utf-8'))
+                changements = entete.pop('changes', [])
+        except Exception as e:
+            self._repondre(400, {'error': str(e)})
+            return
+
+        time.sleep(serveur.latency + serveur.per_kb * len(corps) / 1024.0)
+        device_id = entete.get('device_id')
+        # Acquittement partiel simulé : seuls les max_accept premiers changements sont appliqués
+        appliques = changements[:serveur.max_accept] if serveur.max_accept else changements
+        acceptes = []
+        with serveur.lock:
+            for change in appliques:
+                cle = (device_id, change.get('change_id'))
+                if cle not in serveur.recus:
+                    serveur.recus[cle] = change
+                acceptes.append(change.get('change_id'))
+            serveur.requetes += 1
+        self._repondre(200, {'accepted_ids': acceptes, 'conflicts': [], 'errors': []})
+
+    def _repondre(self, statut, donnees):
+        corps = json.dumps(donnees).encode('utf-8')
+        entetes = {}
+        if 'gzip' in (self.headers.get('Accept-Encoding') or '') and len(corps) > 512:
+            corps = compress(corps, 'gzip')
+            entetes['Content-Encoding'] = 'gzip'
+        self.send_response(statut)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corps)))
+        for cle, valeur in entetes.items():
+            self.send_header(cle, valeur)
+        self.end_headers()
+        self.wfile.write(corps)
+
+
+class StandInSyncServer(ThreadingHTTPServer):
+    """Serveur local lancé dans un thread (tests et banc de débit)."""
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, per_kb=0.0, accept_ndjson=True, max_accept=None):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.per_kb = per_kb
+        self.accept_ndjson = accept_ndjson
+        self.max_accept = max_accept
+        self.lock = threading.Lock()
+        self.recus = {}
+        self.requetes = 0
+        self.connexions = set()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.shutdown()
+        self.server_close()
+        self._thread = None
+
+
+def _changements_synthetiques(nombre):
+    for i in range(1, nombre + 1):
+        yield {
+            'change_id': i,
+            'entity_type': 'Devis',
+            'entity_id': i % 500 + 1,
+            'operation': 'update',
+            'changed_at': '2031-01-01T12:00:00',
+            'changed_fields': ['montant_ht', 'statut'],
+            'payload': {
+                'id': i % 500 + 1, 'numero': f"DEV-{i:06d}", 'client_nom': 'Client banc',
+                'prestation_titre': 'Soirée', 'lieu': 'Salle des fêtes', 'montant_ht': 1000 + i % 97,
+                'statut': 'envoye', 'notes': 'x' * 200,
+            },
+        }
+
+
+def benchmark(nombre, latency, per_kb, compression, adaptatif):
+    serveur = StandInSyncServer(latency=latency, per_kb=per_kb).start()
+    transport = SyncTransport(serveur.url, compression=compression, initial_batch=200,
+                              min_batch=200 if not adaptatif else 20,
+                              max_batch=200 if not adaptatif else 5000)
+    changements = list(_changements_synthetiques(nombre))
+    debut = time.monotonic()
+    position = 0
+    try:
+        while position < len(changements):
+            lot = changements[position:position + transport.batch_size]
+            reponse = transport.push({'device_id': 'banc'}, lot)
+            position += len(reponse['accepted_ids'])
+    finally:
+        transport.close()
+        serveur.stop()
+    duree = time.monotonic() - debut
+    m = transport.snapshot()
+    return {
+        'compression': m['compression'],
+        'adaptatif': adaptatif,
+        'changements_par_s': round(nombre / duree),
+        'lots': m['lots'],
+        'taille_lot_finale': m['batch_size'],
+        'octets_envoyes': m['octets_envoyes'],
+        'ratio_compression': round(m['octets_bruts'] / max(1, m['octets_envoyes']), 1),
+        'connexions': len(serveur.connexions),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--changes', type=int, default=20000)
+    parser.add_argument('--latency-ms', type=float, default=40.0, help="latence fixe par requête")
+    parser.add_argument('--ms-per-kb', type=float, default=0.2, help="latence par Ko reçu (débit du lien)")
+    args = parser.parse_args()
+    for compression, adaptatif in (('none', False), ('gzip', False), ('gzip', True), ('zstd', True)):
+        print(json.dumps(benchmark(args.changes, args.latency_ms / 1000.0, args.ms_per_kb / 1000.0,
+                                   compression, adaptatif), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Transport des changements de synchronisation vers le serveur central.
+
+- NDJSON compressé (gzip, ou zstd si le module zstandard est installé) : une
+  ligne d'en-tête puis une ligne par changement
+- connexion HTTP keep-alive réutilisée d'un envoi à l'autre
+- taille de lot adaptée à la latence et au volume mesurés
+- reprise par identifiant de changement : le serveur renvoie les changements
+  acceptés (accepted_ids) et/ou le dernier identifiant appliqué sans trou
+  (acked_through) ; le reste est renvoyé au lot suivant, le serveur
+  dédoublonnant par (device_id, change_id)
+
+Un serveur qui ne comprend pas le NDJSON (415) reçoit le format JSON historique.
+
+Les changements des autres appareils sont relus page par page (pull) à partir
+du curseur du dernier changement reçu.
+"""
+
+import gzip
+import http.client
+import json
+import ssl
+import time
+import urllib.parse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import certifi
+except ImportError:
+    certifi = None
+
+NDJSON = 'application/x-ndjson'
+COMPRESSIONS = ('zstd', 'gzip', 'none')
+
+
+def available_compression(preferee):
+    """Compression effectivement utilisable (zstd sans module zstandard -> gzip)."""
+    if preferee == 'zstd' and zstandard is None:
+        return 'gzip'
+    return preferee if preferee in COMPRESSIONS else 'gzip'
+
+
+def compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    return data
+
+
+def decompress(data, encoding):
+    encoding = (encoding or '').lower()
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd non supporté (module zstandard absent)")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    return data
+
+
+def encode_ndjson(entete, changements):
+    lignes = [json.dumps(entete, ensure_ascii=True, separators=(',', ':'))]
+    lignes.extend(json.dumps(c, ensure_ascii=True, separators=(',', ':'), default=str) for c in changements)
+    return ('\n'.join(lignes) + '\n').encode('utf-8')
+
+
+def decode_ndjson(data):
+    """(en-tête, changements) d'un corps NDJSON décompressé."""
+    lignes = [ligne for ligne in data.decode('utf-8').split('\n') if ligne.strip()]
+    if not lignes:
+        return {}, []
+    return json.loads(lignes[0]), [json.loads(ligne) for ligne in lignes[1:]]
+
+
+class PushRejected(Exception):
+    """Réponse HTTP non exploitable du serveur de synchronisation."""
+
+    def __init__(self, status, message):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+
+
+class SyncTransport:
+    """Envoi des lots de changements sur une connexion persistante."""
+
+    def __init__(self, base_url, compression='gzip', min_batch=20, max_batch=2000, initial_batch=200,
+                 target_latency=2.0, max_batch_bytes=2_000_000, allow_insecure=False):
+        self.base_url = base_url.rstrip('/')
+        parsed = urllib.parse.urlsplit(self.base_url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path_prefix = parsed.path.rstrip('/')
+        self.compression = available_compression(compression)
+        self.min_batch = max(1, int(min_batch))
+        self.max_batch = max(self.min_batch, int(max_batch))
+        self.batch_size = min(self.max_batch, max(self.min_batch, int(initial_batch)))
+        self.target_latency = float(target_latency)
+        self.max_batch_bytes = int(max_batch_bytes)
+        self.allow_insecure = allow_insecure
+        self.format = 'ndjson'
+        self._connexion = None
+        self.metriques = {
+            'lots': 0, 'changements': 0, 'octets_bruts': 0, 'octets_envoyes': 0,
+            'reconnexions': 0, 'echecs': 0, 'derniere_latence': None,
+            'pages_recues': 0, 'changements_recus': 0,
+        }
+
+    # ---- connexion ----
+
+    def _ouvrir(self, timeout):
+        if self.scheme == 'https':
+            ctx = None
+            if certifi:
+                try:
+                    ctx = ssl.create_default_context(cafile=certifi.where())
+                except Exception:
+                    ctx = None
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout, context=ctx)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def close(self):
+        if self._connexion is not None:
+            try:
+                self._connexion.close()
+            except Exception:
+                pass
+            self._connexion = None
+
+    def _requete(self, methode, chemin, corps, entetes, timeout):
+        """Requête sur la connexion persistante ; une reconnexion si le serveur l'a fermée entre deux lots."""
+        for tentative in range(2):
+            if self._connexion is None:
+                self._connexion = self._ouvrir(timeout)
+                if tentative:
+                    self.metriques['reconnexions'] += 1
+            self._connexion.timeout = timeout
+            if self._connexion.sock is not None:
+                self._connexion.sock.settimeout(timeout)
+            try:
+                self._connexion.request(methode, self.path_prefix + chemin, body=corps, headers=entetes)
+                reponse = self._connexion.getresponse()
+                donnees = reponse.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError,
+                    http.client.CannotSendRequest, http.client.BadStatusLine):
+                self.close()
+                if tentative:
+                    raise
+                continue
+            except Exception:
+                self.close()
+                raise
+            if reponse.getheader('Connection', '').lower() == 'close':
+                self.close()
+            return reponse.status, decompress(donnees, reponse.getheader('Content-Encoding')), reponse
+        raise http.client.RemoteDisconnected("connexion fermée")
+
+    # ---- envoi ----
+
+    def _corps(self, entete, changements):
+        if self.format == 'json':
+            brut = json.dumps(dict(entete, changes=changements), ensure_ascii=True, default=str).encode('utf-8')
+            return brut, brut, {'Content-Type': 'application/json'}
+        brut = encode_ndjson(entete, changements)
+        corps = compress(brut, self.compression)
+        entetes = {'Content-Type': NDJSON}
+        if self.compression != 'none':
+            entetes['Content-Encoding'] = self.compression
+        return brut, corps, entetes
+
+    def push(self, entete, changements, auth_headers=None, timeout=15.0):
+        """
+        Envoie un lot et retourne la réponse du serveur.
+
+        La réponse est complétée : accepted_ids contient aussi les changements
+        couverts par acked_through.
+        """
+        brut, corps, entetes = self._corps(entete, changements)
+        entetes.update({
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+            'User-Agent': 'Planify-Sync/2.0',
+        })
+        entetes.update(auth_headers or {})
+        debut = time.monotonic()
+        try:
+            statut, donnees, _ = self._requete('POST', '/api/sync/push', corps, entetes, timeout)
+            if statut == 415 and self.format == 'ndjson':
+                # Serveur historique : JSON non compressé
+                self.format = 'json'
+                return self.push(entete, changements, auth_headers, timeout)
+            if statut >= 400:
+                raise PushRejected(statut, donnees[:200].decode('utf-8', 'replace'))
+            reponse = json.loads(donnees.decode('utf-8') or '{}')
+        except Exception:
+            self.metriques['echecs'] += 1
+            self._reduire()
+            raise
+        latence = time.monotonic() - debut
+
+        acceptes = set(reponse.get('accepted_ids') or [])
+        jusqua = reponse.get('acked_through')
+        if jusqua is not None:
+            acceptes.update(c['change_id'] for c in changements if c.get('change_id') is not None and c['change_id'] <= jusqua)
+        reponse['accepted_ids'] = sorted(acceptes)
+
+        self.metriques['lots'] += 1
+        self.metriques['changements'] += len(changements)
+        self.metriques['octets_bruts'] += len(brut)
+        self.metriques['octets_envoyes'] += len(corps)
+        self.metriques['derniere_latence'] = round(latence, 3)
+        self._adapter(len(changements), len(brut), latence)
+        return reponse
+
+    # ---- réception ----
+
+    def pull(self, curseur, limite, device_id=None, auth_headers=None, timeout=15.0):
+        """
+        Page de changements publiés après le curseur.
+
+        Returns:
+            dict: {'changes', 'cursor', 'has_more'} ; cursor est à conserver pour la page suivante
+        """
+        parametres = {'cursor': int(curseur or 0), 'limit': int(limite)}
+        if device_id:
+            parametres['device_id'] = device_id
+        entetes = {
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+            'User-Agent': 'Planify-Sync/2.0',
+        }
+        entetes.update(auth_headers or {})
+        chemin = '/api/sync/pull?' + urllib.parse.urlencode(parametres)
+        try:
+            statut, donnees, _ = self._requete('GET', chemin, None, entetes, timeout)
+            if statut >= 400:
+                raise PushRejected(statut, donnees[:200].decode('utf-8', 'replace'))
+            reponse = json.loads(donnees.decode('utf-8') or '{}')
+        except Exception:
+            self.metriques['echecs'] += 1
+            raise
+        self.metriques['pages_recues'] += 1
+        self.metriques['changements_recus'] += len(reponse.get('changes') or [])
+        reponse.setdefault('cursor', curseur)
+        return reponse
+
+    # ---- taille de lot ----
+
+    def _adapter(self, nombre, octets, latence):
+        if not nombre:
+            return
+        cibles = [self.batch_size * 2]
+        if latence > 0:
+            cibles.append(nombre * self.target_latency / latence)
+        if octets:
+            cibles.append(nombre * self.max_batch_bytes / octets)
+        cible = min(cibles)
+        # Lissage : une mesure isolée ne fait pas osciller la taille de lot
+        nouvelle = int(0.5 * self.batch_size + 0.5 * cible)
+        self.batch_size = min(self.max_batch, max(self.min_batch, nouvelle))
+
+    def _reduire(self):
+        self.batch_size = max(self.min_batch, self.batch_size // 2)
+
+    def snapshot(self):
+        return dict(
+            self.metriques,
+            batch_size=self.batch_size,
+            compression=self.compression if self.format == 'ndjson' else 'none',
+            format=self.format,
+        )
@@ -168,3 +168,98 @@ def test_ai_score_client_with_login(client, login_as, csrf_token):
         headers={'X-CSRF-Token': token} if token else None
     )
     assert response.status_code == 200
+
+
+def test_route_optimizer_two_opt_bounded():
+    import random
+    import time
+    import numpy as np
+    import route_optimizer
+
+    rng = random.Random(7)
+    points = np.array([(50.0, 50.0)] + [(rng.uniform(0, 100), rng.uniform(0, 100)) for _ in range(100)])
+    couts = np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+    nn = route_optimizer.nearest_neighbour_tours(couts, 0, range(1, 101), [0] + [1] * 100, None)[0]
+
+    debut = time.monotonic()
+    tours = route_optimizer.optimize_routes(couts, {0: range(1, 101)}, [0] + [1] * 100, time_limit=0.3)[0]
+    assert time.monotonic() - debut < 1.0
+    assert len(tours) == 1 and sorted(tours[0][1:-1]) == list(range(1, 101))
+    assert route_optimizer.tour_cost(tours[0], couts) < route_optimizer.tour_cost(nn, couts)
+
+    # Capacité : chaque tournée tient dans le véhicule
+    tours = route_optimizer.optimize_routes(couts, {0: range(1, 101)}, [0] + [3] * 100, capacite=30)[0]
+    assert len(tours) == 10 and all(len(tour) == 12 for tour in tours)
+
+
+def test_ai_optimize_logistics_builds_tours(app_instance, client, login_as, csrf_token, monkeypatch):
+    from datetime import date, time
+    from app import app, db, DJ, Local, Materiel, MaterielPresta, Prestation, User, vider_cache_distances
+
+    monkeypatch.setitem(app.config, 'USE_OSRM_DISTANCE', False)
+    jour = date(2031, 6, 14)
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        dj = DJ.query.first()
+        depot = Local(nom="Dépôt Tournées", adresse="1 quai Perrache, Lyon", adresse_lat=45.749, adresse_lng=4.826)
+        db.session.add(depot)
+        db.session.flush()
+        annexe = Local(nom="Annexe Tournées", adresse="2 rue Garibaldi, Lyon", adresse_lat=45.77, adresse_lng=4.85)
+        db.session.add(annexe)
+        db.session.flush()
+        materiel = Materiel(nom="Enceinte Tournées", local_id=depot.id, quantite=50, statut='disponible')
+        eclairage = Materiel(nom="Lyre Tournées", local_id=annexe.id, quantite=10, statut='disponible')
+        db.session.add_all([materiel, eclairage])
+        db.session.flush()
+        lieux = [(45.76, 4.85), (45.19, 5.72), (45.78, 4.87), None]
+        prestations = []
+        for numero, coords in enumerate(lieux):
+            prestation = Prestation(
+                date_debut=jour, date_fin=jour, heure_debut=time(18, 0), heure_fin=time(23, 0),
+                client=f"Client Tournée {numero}", lieu=f"Salle {numero}",
+                lieu_lat=coords[0] if coords else None, lieu_lng=coords[1] if coords else None,
+                dj_id=dj.id, createur_id=admin.id, statut='confirmee',
+            )
+            db.session.add(prestation)
+            db.session.flush()
+            db.session.add(MaterielPresta(materiel_id=materiel.id, prestation_id=prestation.id, quantite=2))
+            prestations.append(prestation.id)
+        # Matériel d'un second local sur la première prestation : livré depuis ce local
+        db.session.add(MaterielPresta(materiel_id=eclairage.id, prestation_id=prestations[0], quantite=3))
+        db.session.commit()
+        depot_id, annexe_id, materiel_id, eclairage_id = depot.id, annexe.id, materiel.id, eclairage.id
+
+    login_as('admin')
+    token = csrf_token()
+    response = client.post(
+        '/api/ai/optimize-logistics',
+        json={'date': jour.isoformat()},
+        headers={'X-CSRF-Token': token} if token else None
+    )
+    assert response.status_code == 200
+    plan = response.get_json()['tournees'][0]
+    assert plan['non_planifies'] == [{'prestation_id': prestations[3], 'raison': 'Lieu non géocodé'}]
+    tournees = [tour for vehicule in plan['vehicules'] for tour in vehicule['tournees'] if tour['local_id'] == depot_id]
+    assert sorted(tour['type'] for tour in tournees) == ['livraison', 'reprise']
+    annexe_tours = [tour for vehicule in plan['vehicules'] for tour in vehicule['tournees'] if tour['local_id'] == annexe_id]
+    assert sorted(tour['type'] for tour in annexe_tours) == ['livraison', 'reprise']
+    for tour in annexe_tours:
+        assert [arret['prestation_id'] for arret in tour['arrets']] == [prestations[0]]
+        assert tour['chargement'] == 3
+    for tour in tournees:
+        assert sorted(arret['prestation_id'] for arret in tour['arrets']) == sorted(prestations[:3])
+        assert tour['chargement'] == 6 and tour['estimation'] is True
+        # Les deux salles lyonnaises sont desservies à la suite
+        lyon = [arret['prestation_id'] for arret in tour['arrets'] if arret['prestation_id'] != prestations[1]]
+        ordre = [arret['prestation_id'] for arret in tour['arrets']]
+        assert abs(ordre.index(lyon[0]) - ordre.index(lyon[1])) == 1
+
+    with app_instance.app_context():
+        MaterielPresta.query.filter(MaterielPresta.materiel_id.in_([materiel_id, eclairage_id])).delete(synchronize_session=False)
+        Prestation.query.filter(Prestation.id.in_(prestations)).delete(synchronize_session=False)
+        db.session.delete(db.session.get(Materiel, materiel_id))
+        db.session.delete(db.session.get(Materiel, eclairage_id))
+        db.session.delete(db.session.get(Local, depot_id))
+        db.session.delete(db.session.get(Local, annexe_id))
+        db.session.commit()
+        vider_cache_distances()
@@ -0,0 +1,254 @@
+from datetime import date, time
+
+from sqlalchemy import event
+
+from app import (
+    db, DJ, Local, Materiel, MaterielPresta, Prestation, User,
+    verifier_disponibilite_materiel, verifier_disponibilite_materiels,
+)
+
+JOUR = date(2031, 3, 10)
+
+
+def _creer_prestation(dj, admin, heure_debut, heure_fin, statut='confirmee'):
+    prestation = Prestation(
+        date_debut=JOUR,
+        date_fin=JOUR,
+        heure_debut=heure_debut,
+        heure_fin=heure_fin,
+        client="Client Dispo",
+        lieu="Salle Dispo",
+        dj_id=dj.id,
+        createur_id=admin.id,
+        statut=statut,
+    )
+    db.session.add(prestation)
+    db.session.flush()
+    return prestation
+
+
+def test_bulk_matches_single_and_uses_fixed_queries(app_instance):
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        dj = DJ.query.first()
+        local = Local.query.first()
+        materiels = [
+            Materiel(nom=f"Bulk {i}", local_id=local.id, quantite=3, statut='disponible')
+            for i in range(6)
+        ]
+        db.session.add_all(materiels)
+        db.session.flush()
+        soiree = _creer_prestation(dj, admin, time(20, 0), time(23, 0))
+        apres_midi = _creer_prestation(dj, admin, time(14, 0), time(18, 0))
+        for materiel in materiels[:3]:
+            db.session.add(MaterielPresta(materiel_id=materiel.id, prestation_id=soiree.id, quantite=2))
+            db.session.add(MaterielPresta(materiel_id=materiel.id, prestation_id=apres_midi.id, quantite=1))
+        db.session.commit()
+
+        ids = [m.id for m in materiels]
+        statements = []
+
+        def _count(*args, **kwargs):
+            statements.append(1)
+
+        event.listen(db.engine, 'before_cursor_execute', _count)
+        try:
+            bulk = verifier_disponibilite_materiels(ids, JOUR, JOUR, time(19, 0), time(21, 0), quantites=2)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', _count)
+
+        assert len(statements) <= 6
+        for materiel in materiels:
+            single = verifier_disponibilite_materiel(materiel.id, 2, JOUR, JOUR, time(19, 0), time(21, 0))
+            assert bulk[materiel.id]['quantite_disponible'] == single['quantite_disponible']
+            assert bulk[materiel.id]['disponible'] == single['disponible']
+
+        # Les buffers logistiques (12h par défaut) font se chevaucher les deux prestations
+        assert bulk[materiels[0].id]['quantite_utilisee'] == 3
+        assert bulk[materiels[0].id]['disponible'] is False
+        assert bulk[materiels[5].id]['quantite_disponible'] == 3
+
+        for materiel in materiels:
+            MaterielPresta.query.filter_by(materiel_id=materiel.id).delete()
+            db.session.delete(materiel)
+        db.session.delete(soiree)
+        db.session.delete(apres_midi)
+        db.session.commit()
+
+
+def test_bulk_reports_unknown_and_maintenance(app_instance):
+    with app_instance.app_context():
+        local = Local.query.first()
+        materiel = Materiel(nom="En panne", local_id=local.id, quantite=1, statut='maintenance')
+        db.session.add(materiel)
+        db.session.commit()
+
+        resultats = verifier_disponibilite_materiels([materiel.id, 987654], JOUR, JOUR)
+        assert resultats[987654]['erreur'] == 'Matériel introuvable'
+        assert resultats[materiel.id]['disponible'] is False
+        assert 'maintenance' in resultats[materiel.id]['erreur']
+
+        db.session.delete(materiel)
+        db.session.commit()
+
+
+def test_occupation_timeline_follows_changes(app_instance):
+    from app import MaterielOccupation, ParametresEntreprise
+
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        dj = DJ.query.first()
+        local = Local.query.first()
+        materiel = Materiel(nom="Timeline", local_id=local.id, quantite=2, statut='disponible')
+        db.session.add(materiel)
+        db.session.flush()
+        prestation = _creer_prestation(dj, admin, time(20, 0), time(23, 0))
+        db.session.add(MaterielPresta(materiel_id=materiel.id, prestation_id=prestation.id, quantite=2))
+        db.session.commit()
+
+        occupation = MaterielOccupation.query.filter_by(materiel_id=materiel.id).one()
+        assert occupation.source_type == 'prestation'
+        assert occupation.quantite == 2
+        assert occupation.debut.hour == 8 and occupation.fin.day == JOUR.day + 1
+
+        params = ParametresEntreprise.query.first()
+        params.materiel_sortie_avant_heures = 2
+        db.session.commit()
+        occupation = MaterielOccupation.query.filter_by(materiel_id=materiel.id).one()
+        assert occupation.debut.hour == 18
+
+        MaterielPresta.query.filter_by(prestation_id=prestation.id).delete()
+        db.session.commit()
+        assert MaterielOccupation.query.filter_by(materiel_id=materiel.id).count() == 0
+        assert verifier_disponibilite_materiel(materiel.id, 2, JOUR, JOUR, time(20, 0), time(21, 0))['disponible']
+
+        params.materiel_sortie_avant_heures = None
+        db.session.delete(prestation)
+        db.session.delete(materiel)
+        db.session.commit()
+
+
+
+def test_occupation_update_failure_fails_the_transaction(app_instance, monkeypatch):
+    import pytest
+    import app as app_module
+    from app import MaterielOccupation
+
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        dj = DJ.query.first()
+        local = Local.query.first()
+        materiel = Materiel(nom="Timeline en échec", local_id=local.id, quantite=1, statut='disponible')
+        db.session.add(materiel)
+        db.session.commit()
+
+        def _echec(*args, **kwargs):
+            raise RuntimeError("timeline indisponible")
+
+        monkeypatch.setattr(app_module, '_reconstruire_occupations', _echec)
+        prestation = Prestation(
+            date_debut=JOUR, date_fin=JOUR, heure_debut=time(20, 0), heure_fin=time(23, 0),
+            client="Client Échec", lieu="Salle", dj_id=dj.id, createur_id=admin.id, statut='confirmee',
+        )
+        db.session.add(prestation)
+        with pytest.raises(RuntimeError):
+            db.session.flush()
+        db.session.rollback()
+        existante = Prestation.query.first()
+        with pytest.raises(RuntimeError):
+            Prestation.query.filter_by(id=existante.id).update({'notes': 'bulk'})
+        db.session.rollback()
+        monkeypatch.undo()
+
+        assert Prestation.query.filter_by(client="Client Échec").count() == 0
+        assert MaterielOccupation.query.filter_by(materiel_id=materiel.id).count() == 0
+        db.session.delete(db.session.get(Materiel, materiel.id))
+        db.session.commit()
+
+
+def test_soldes_mouvements_follow_movements(app_instance):
+    from app import MouvementMateriel, SoldeMaterielPrestation, get_solde_mouvement, verifier_soldes_materiel
+
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        dj = DJ.query.first()
+        local = Local.query.first()
+        materiel = Materiel(nom="Solde", local_id=local.id, quantite=4, statut='disponible')
+        db.session.add(materiel)
+        db.session.flush()
+        prestation = _creer_prestation(dj, admin, time(20, 0), time(23, 0), statut='en_cours')
+        db.session.add(MaterielPresta(materiel_id=materiel.id, prestation_id=prestation.id, quantite=4))
+        sortie = MouvementMateriel(materiel_id=materiel.id, prestation_id=prestation.id,
+                                   type_mouvement='sortie', quantite=3, utilisateur_id=admin.id)
+        retour = MouvementMateriel(materiel_id=materiel.id, prestation_id=prestation.id,
+                                   type_mouvement='retour', quantite=1, utilisateur_id=admin.id)
+        db.session.add_all([sortie, retour])
+        db.session.commit()
+
+        assert get_solde_mouvement(prestation.id, materiel.id) == (3, 1)
+        valide, _ = prestation.valider_transition_statut('terminee')
+        assert valide is False
+
+        sortie.quantite = 2
+        db.session.commit()
+        assert get_solde_mouvement(prestation.id, materiel.id) == (2, 1)
+
+        db.session.delete(retour)
+        db.session.commit()
+        assert get_solde_mouvement(prestation.id, materiel.id) == (2, 0)
+        assert verifier_soldes_materiel() == []
+
+        SoldeMaterielPrestation.query.filter_by(prestation_id=prestation.id).update({'quantite_sortie': 9})
+        db.session.commit()
+        assert len(verifier_soldes_materiel(reparer=True)) == 1
+        assert get_solde_mouvement(prestation.id, materiel.id) == (2, 0)
+
+        db.session.delete(sortie)
+        db.session.commit()
+        valide, _ = prestation.valider_transition_statut('terminee')
+        assert valide is True
+
+        MaterielPresta.query.filter_by(prestation_id=prestation.id).delete()
+        db.session.delete(prestation)
+        db.session.delete(materiel)
+        db.session.commit()
+
+
+def test_disponibilite_cache_invalidated_on_change(app_instance):
+    from app import get_cache_disponibilite_stats
+
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        dj = DJ.query.first()
+        local = Local.query.first()
+        materiel = Materiel(nom="Cache", local_id=local.id, quantite=4, statut='disponible')
+        db.session.add(materiel)
+        db.session.flush()
+        prestation = _creer_prestation(dj, admin, time(20, 0), time(23, 0))
+        db.session.commit()
+
+        premier = verifier_disponibilite_materiel(materiel.id, 1, JOUR, JOUR, time(21, 0), time(22, 0))
+        hits = get_cache_disponibilite_stats()['hits']
+        second = verifier_disponibilite_materiel(materiel.id, 1, JOUR, JOUR, time(21, 0), time(22, 0))
+        assert get_cache_disponibilite_stats()['hits'] == hits + 1
+        assert premier == second and premier['quantite_disponible'] == 4
+
+        assignation = MaterielPresta(materiel_id=materiel.id, prestation_id=prestation.id, quantite=3)
+        db.session.add(assignation)
+        db.session.commit()
+        assert verifier_disponibilite_materiel(materiel.id, 1, JOUR, JOUR, time(21, 0), time(22, 0))['quantite_disponible'] == 1
+
+        assignation.quantite = 1
+        db.session.flush()
+        avant = get_cache_disponibilite_stats()
+        assert verifier_disponibilite_materiel(materiel.id, 1, JOUR, JOUR, time(21, 0), time(22, 0))['quantite_disponible'] == 3
+        # Calculé sur des occupations non validées : ni lu ni mis en cache
+        apres = get_cache_disponibilite_stats()
+        assert (apres['hits'], apres['misses'], apres['taille']) == (avant['hits'], avant['misses'], avant['taille'])
+        db.session.rollback()
+        assert verifier_disponibilite_materiel(materiel.id, 1, JOUR, JOUR, time(21, 0), time(22, 0))['quantite_disponible'] == 1
+
+        MaterielPresta.query.filter_by(prestation_id=prestation.id).delete()
+        db.session.delete(prestation)
+        db.session.delete(materiel)
+        db.session.commit()
@@ -0,0 +1,84 @@
+import pytest
+
+from app import (
+    app, db, DistanceCache, compute_distance_km, haversine_km, matrice_distances,
+    register_distance_router, vider_cache_distances,
+)
+
+LYON = (45.7640, 4.8357)
+GRENOBLE = (45.1885, 5.7245)
+ANNECY = (45.8992, 6.1294)
+VALENCE = (44.9334, 4.8924)
+
+
+@pytest.fixture
+def routeur(app_instance, monkeypatch):
+    from app import _routeur_stub
+
+    appels = []
+
+    def _routeur(sources, destinations, timeout):
+        appels.append((len(sources), len(destinations)))
+        return _routeur_stub(sources, destinations, timeout)
+
+    register_distance_router('compteur', _routeur)
+    monkeypatch.setitem(app.config, 'USE_OSRM_DISTANCE', True)
+    monkeypatch.setitem(app.config, 'DISTANCE_ROUTER', 'compteur')
+    with app_instance.app_context():
+        vider_cache_distances()
+        yield appels
+        vider_cache_distances()
+
+
+def test_matrix_fills_misses_in_one_router_call(routeur):
+    matrice = matrice_distances([LYON, GRENOBLE], [ANNECY, VALENCE, LYON])
+    assert routeur == [(2, 3)]
+    assert matrice[0][2] == (0.0, 0.0, 'route')
+    km, minutes, source = matrice[1][0]
+    assert source == 'route'
+    assert km == pytest.approx(haversine_km(*GRENOBLE, *ANNECY) * 1.25, rel=1e-3)
+    # Écrites dans la table par le commit suivant
+    assert DistanceCache.query.count() == 0
+    db.session.commit()
+    assert DistanceCache.query.count() == 5
+
+    # Deuxième passage (mémoire), puis nouveau worker (table) : aucun appel au moteur
+    assert matrice_distances([LYON, GRENOBLE], [ANNECY, VALENCE, LYON]) == matrice
+    vider_cache_distances(memoire_seulement=True)
+    assert matrice_distances([GRENOBLE], [ANNECY])[0][0] == matrice[1][0]
+    assert len(routeur) == 1
+
+    # Coordonnées arrondies : un point à quelques mètres réutilise le trajet
+    assert compute_distance_km(LYON[0] + 0.00001, LYON[1], *VALENCE) == (round(matrice[0][1][0], 2), 'route')
+    assert len(routeur) == 1
+
+
+def test_matrix_falls_back_to_calibrated_estimate(routeur, monkeypatch):
+    matrice_distances([LYON, GRENOBLE, ANNECY], [VALENCE, LYON, GRENOBLE])
+    db.session.commit()
+
+    def _hors_service(sources, destinations, timeout):
+        raise OSError("moteur indisponible")
+
+    register_distance_router('hors_service', _hors_service)
+    monkeypatch.setitem(app.config, 'DISTANCE_ROUTER', 'hors_service')
+    monkeypatch.setitem(app.config, 'DISTANCE_DETOUR_MIN_SAMPLES', 3)
+    km, source = compute_distance_km(*VALENCE, *ANNECY)
+    assert source == 'estimation'
+    # Facteur calibré sur les trajets mémorisés (détour du routeur : 25 %)
+    assert km == pytest.approx(haversine_km(*VALENCE, *ANNECY) * 1.25, rel=1e-2)
+    assert DistanceCache.query.filter_by(distance_km=km).count() == 0
+
+
+def test_matrix_without_router_uses_cache_and_estimates(routeur):
+    matrice_distances([LYON], [VALENCE])
+    assert len(routeur) == 1
+
+    matrice = matrice_distances([LYON, GRENOBLE], [VALENCE, ANNECY], moteur=False)
+    assert len(routeur) == 1
+    assert matrice[0][0][2] == 'route'
+    assert {cellule[2] for cellule in matrice[0][1:] + matrice[1]} == {'estimation'}
+
+    # Estimations non mémorisées : un appel normal interroge le moteur
+    assert matrice_distances([GRENOBLE], [ANNECY])[0][0][2] == 'route'
+    assert len(routeur) == 2
@@ -13,3 +13,44 @@ def test_dj_detail(client, app_instance, login_as):
         dj = DJ.query.first()
     response = client.get(f'/djs/{dj.id}')
     assert response.status_code == 200
+
+
+def test_staff_availability_batch(client, app_instance, login_as):
+    from datetime import date, time
+    from app import db, Prestation, User, check_staff_availability, check_staff_availability_batch
+
+    jour = date(2032, 5, 14)
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        dj = DJ.query.first()
+        prestation = Prestation(
+            date_debut=jour, date_fin=jour, heure_debut=time(22, 0), heure_fin=time(3, 0),
+            client="Client Staff", lieu="Salle Staff", dj_id=dj.id, createur_id=admin.id,
+            statut='confirmee',
+        )
+        db.session.add(prestation)
+        db.session.commit()
+        assert prestation.fin_dt.day == 15 and prestation.fin_dt.hour == 3
+
+        resultats = check_staff_availability_batch('dj', [dj.id, 424242], jour, jour, time(23, 0), time(23, 30))
+        assert resultats[dj.id][0] is False
+        assert resultats[424242] == (True, "Disponible")
+        # Fin à 3h le lendemain : libre à partir de 3h
+        ok, _ = check_staff_availability('dj', dj.id, date(2032, 5, 15), date(2032, 5, 15), time(3, 0), time(5, 0))
+        assert ok
+        ok, _ = check_staff_availability('dj', dj.id, jour, jour, time(23, 0), time(23, 30), prestation.id)
+        assert ok
+        dj_id = dj.id
+        prestation_id = prestation.id
+
+    login_as('admin')
+    response = client.post('/api/staff/disponibilites', json={
+        'staff_type': 'dj', 'staff_ids': [dj_id],
+        'date_debut': '2032-05-14', 'heure_debut': '21:00', 'heure_fin': '23:00',
+    })
+    assert response.status_code == 200
+    assert response.get_json()['disponibles'] == []
+
+    with app_instance.app_context():
+        db.session.delete(db.session.get(Prestation, prestation_id))
+        db.session.commit()
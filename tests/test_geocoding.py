@@ -0,0 +1,144 @@
+import pytest
+
+import outbound_http
+from app import app, db, GeocodeCache, geocode_address, register_geocoding_provider, vider_cache_geocodage
+
+
+@pytest.fixture(autouse=True)
+def _disjoncteur_ferme():
+    # Hors ligne, d'autres tests ont pu ouvrir le disjoncteur du géocodage réel
+    outbound_http.reset('geocoding')
+
+
+def _compteur(appels, erreur_reseau=False):
+    from app import _geocoder_stub
+
+    def _fournisseur(address, contact_email, timeout):
+        appels.append(address)
+        if erreur_reseau:
+            raise OSError("réseau indisponible")
+        return _geocoder_stub(address, contact_email, timeout)
+    return _fournisseur
+
+
+def test_geocode_cache_memory_and_database(app_instance, monkeypatch):
+    appels = []
+    register_geocoding_provider('compteur', _compteur(appels))
+    monkeypatch.setitem(app.config, 'GEOCODING_PROVIDER', 'compteur')
+    with app_instance.app_context():
+        vider_cache_geocodage()
+        geo, err = geocode_address("12 Rue de l'Église, Lyon")
+        assert err is None and geo['provider'] == 'stub'
+        # Même adresse normalisée (casse, accents, ponctuation) : aucun nouvel appel
+        assert geocode_address("12 rue de l eglise  LYON")[0] == geo
+        assert len(appels) == 1
+        # Écrit dans la table par le commit suivant
+        db.session.commit()
+
+        # Mémoire vidée (nouveau worker) : servi depuis la table
+        vider_cache_geocodage(memoire_seulement=True)
+        assert geocode_address("12 Rue de l'Église, Lyon")[0] == geo
+        assert len(appels) == 1
+        db.session.commit()
+        assert GeocodeCache.query.one().hits == 1
+
+        # Résultat négatif mis en cache
+        assert geocode_address("Rue Introuvable")[1] == "Adresse introuvable"
+        assert geocode_address("rue introuvable")[0] is None
+        assert len(appels) == 2
+        vider_cache_geocodage()
+
+
+def test_geocode_cache_skips_transient_errors_and_evicts(app_instance, monkeypatch):
+    appels = []
+    register_geocoding_provider('hors_ligne', _compteur(appels, erreur_reseau=True))
+    register_geocoding_provider('compteur', _compteur(appels))
+    monkeypatch.setitem(app.config, 'GEOCODING_PROVIDER', 'hors_ligne')
+    monkeypatch.setitem(app.config, 'GEOCODE_CACHE_MAX', 2)
+    with app_instance.app_context():
+        vider_cache_geocodage()
+        assert geocode_address("1 avenue Foch, Paris")[0] is None
+        assert geocode_address("1 avenue Foch, Paris")[0] is None
+        assert len(appels) == 2
+        db.session.commit()
+        assert GeocodeCache.query.count() == 0
+
+        monkeypatch.setitem(app.config, 'GEOCODING_PROVIDER', 'compteur')
+        for numero in range(4):
+            assert geocode_address(f"{numero} avenue Foch, Paris")[0] is not None
+        db.session.commit()
+        assert GeocodeCache.query.count() == 2
+        assert {e.cle for e in GeocodeCache.query.all()} == {"2 avenue foch paris", "3 avenue foch paris"}
+        vider_cache_geocodage()
+
+
+def test_stored_coordinates_filled_by_background_job(client, app_instance, login_as, monkeypatch):
+    from app import Local, Materiel, GEOCODE_A_FAIRE, GEOCODE_OK, GEOCODE_INTROUVABLE, geocoder_adresses_en_attente
+
+    appels = []
+    register_geocoding_provider('compteur', _compteur(appels))
+    monkeypatch.setitem(app.config, 'GEOCODING_PROVIDER', 'compteur')
+    monkeypatch.setitem(app.config, 'ADDRESS_VALIDATION_ENABLED', True)
+    monkeypatch.setitem(app.config, 'USE_OSRM_DISTANCE', False)
+    with app_instance.app_context():
+        vider_cache_geocodage()
+        local = Local(nom="Dépôt Nord", adresse="5 rue des Entrepôts, Lille")
+        perdu = Local(nom="Dépôt perdu", adresse="Chemin introuvable")
+        db.session.add_all([local, perdu])
+        db.session.flush()
+        db.session.add(Materiel(nom="Caisson Nord", local_id=local.id, quantite=2, statut='disponible'))
+        db.session.commit()
+        assert local.adresse_geocode_statut == GEOCODE_A_FAIRE and local.adresse_lat is None
+        assert appels == []
+
+        assert geocoder_adresses_en_attente() >= 2
+        db.session.refresh(local)
+        db.session.refresh(perdu)
+        assert local.adresse_geocode_statut == GEOCODE_OK and local.adresse_lat is not None
+        assert perdu.adresse_geocode_statut == GEOCODE_INTROUVABLE
+        local_id, perdu_id = local.id, perdu.id
+
+    login_as('admin')
+    appels.clear()
+    response = client.post('/api/materiels/available', json={
+        'date_debut': '2034-01-10', 'date_fin': '2034-01-10',
+        'heure_debut': '20:00', 'heure_fin': '23:00', 'lieu': '8 place du Marché, Arras',
+    })
+    data = response.get_json()
+    # Seul le lieu saisi est géocodé : les locaux utilisent leurs coordonnées stockées
+    assert appels == ['8 place du Marché, Arras']
+    caisson = next(m for m in data['available'] if m['nom'] == "Caisson Nord")
+    assert caisson['distance_km'] > 0
+
+    with app_instance.app_context():
+        local = db.session.get(Local, local_id)
+        local.adresse = "7 rue des Entrepôts, Lille"
+        db.session.commit()
+        assert local.adresse_geocode_statut == GEOCODE_A_FAIRE and local.adresse_lat is None
+        Materiel.query.filter_by(local_id=local_id).delete()
+        db.session.delete(local)
+        db.session.delete(db.session.get(Local, perdu_id))
+        db.session.commit()
+        vider_cache_geocodage()
+
+
+def test_geocoding_thread_stops_by_itself_under_test_configuration(app_instance, monkeypatch):
+    import app as app_module
+
+    appels = []
+    register_geocoding_provider('compteur', _compteur(appels))
+    monkeypatch.setitem(app.config, 'GEOCODING_PROVIDER', 'compteur')
+    monkeypatch.setitem(app.config, 'ADDRESS_VALIDATION_ENABLED', True)
+    monkeypatch.setitem(app.config, 'GEOCODE_JOB_INTERVAL', 3600)
+    monkeypatch.setitem(app.config, 'TESTING', False)
+    app_module.start_geocoding_service()
+    thread = app_module._geocodage_thread
+    assert thread is not None and thread.is_alive()
+
+    # Configuration de test appliquée après le démarrage : le thread se termine au réveil suivant
+    app.config['TESTING'] = True
+    app_module._geocodage_evenement.set()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    app_module.stop_geocoding_service()
+    assert app_module._geocodage_thread is None
@@ -13,3 +13,86 @@ def test_local_affichage(client, app_instance, login_as):
         local = Local.query.first()
     response = client.get(f'/local/{local.id}/affichage')
     assert response.status_code == 200
+
+
+def test_statut_materiels_local_fixed_queries(client, app_instance, login_as):
+    from datetime import date, time, timedelta
+    from sqlalchemy import event
+    from app import db, DJ, Materiel, MaterielPresta, MouvementMateriel, Prestation, User, statut_materiels_local
+
+    aujourdhui = date.today()
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        dj = DJ.query.first()
+        local = Local(nom="Entrepôt statut", adresse="1 rue du Stock")
+        db.session.add(local)
+        db.session.flush()
+        sono, lumiere, panne = [
+            Materiel(nom=nom, local_id=local.id, quantite=3, statut=statut)
+            for nom, statut in (("Sono", 'disponible'), ("Lumière", 'disponible'), ("Panne", 'maintenance'))
+        ]
+        db.session.add_all([sono, lumiere, panne])
+        db.session.flush()
+
+        def _prestation(client, debut, fin, statut):
+            prestation = Prestation(
+                date_debut=debut, date_fin=fin, heure_debut=time(0, 0), heure_fin=time(23, 59),
+                client=client, lieu="Salle", dj_id=dj.id, createur_id=admin.id, statut=statut,
+            )
+            db.session.add(prestation)
+            db.session.flush()
+            return prestation
+
+        en_cours = _prestation("Mariage en cours", aujourdhui - timedelta(days=1), aujourdhui + timedelta(days=1), 'en_cours')
+        future = _prestation("Gala futur", aujourdhui + timedelta(days=60), aujourdhui + timedelta(days=60), 'confirmee')
+        passee = _prestation("Soirée passée", aujourdhui - timedelta(days=40), aujourdhui - timedelta(days=40), 'terminee')
+        db.session.add_all([
+            MaterielPresta(materiel_id=sono.id, prestation_id=en_cours.id, quantite=2),
+            MaterielPresta(materiel_id=lumiere.id, prestation_id=future.id, quantite=1),
+            MaterielPresta(materiel_id=lumiere.id, prestation_id=passee.id, quantite=1),
+            MouvementMateriel(materiel_id=sono.id, prestation_id=en_cours.id, type_mouvement='sortie',
+                              quantite=2, utilisateur_id=admin.id),
+            MouvementMateriel(materiel_id=lumiere.id, prestation_id=passee.id, type_mouvement='sortie',
+                              quantite=1, utilisateur_id=admin.id),
+        ])
+        db.session.commit()
+        local_id, sono_id, lumiere_id = local.id, sono.id, lumiere.id
+        prestation_ids = [en_cours.id, future.id, passee.id]
+
+        statements = []
+
+        def _count(*args, **kwargs):
+            statements.append(1)
+
+        event.listen(db.engine, 'before_cursor_execute', _count)
+        try:
+            etat = statut_materiels_local(local_id)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', _count)
+        assert len(statements) == 4
+
+        lignes = {ligne['id']: ligne for ligne in etat['materiels']}
+        assert lignes[sono_id]['statut_affichage'] == 'partiel'
+        assert lignes[sono_id]['prestation'] == "Mariage en cours"
+        assert lignes[sono_id]['quantite_dehors'] == 2
+        assert lignes[sono_id]['retour_manquant'] is False
+        assert lignes[lumiere_id]['statut_affichage'] == 'disponible'
+        assert lignes[lumiere_id]['retour_manquant'] is True
+        assert lignes[lumiere_id]['prochaine_reservation']['nom'] == "Gala futur"
+        assert etat['totaux']['partiel'] == 1 and etat['totaux']['maintenance'] == 1
+        assert etat['totaux']['quantite_dehors'] == 3 and etat['totaux']['retours_manquants'] == 1
+
+    login_as('admin')
+    data = client.get(f'/api/materiels/local/{local_id}').get_json()
+    assert data['success'] is True
+    assert data['totaux']['disponible'] == 1
+    assert client.get(f'/local/{local_id}/affichage').status_code == 200
+
+    with app_instance.app_context():
+        for prestation_id in prestation_ids:
+            MouvementMateriel.query.filter_by(prestation_id=prestation_id).delete()
+            MaterielPresta.query.filter_by(prestation_id=prestation_id).delete()
+            db.session.delete(db.session.get(Prestation, prestation_id))
+        Materiel.query.filter_by(local_id=local_id).delete()
+        db.session.delete(db.session.get(Local, local_id))
+        db.session.commit()
@@ -37,3 +37,153 @@ def test_materiel_mouvements_page(client, login_as):
     login_as('admin')
     response = client.get('/materiels/mouvements')
     assert response.status_code == 200
+
+
+def test_materiels_heatmap_matches_verifier(client, app_instance, login_as):
+    from datetime import date, time
+    from app import db, DJ, Local, MaterielPresta, Prestation, User, verifier_disponibilite_materiel
+
+    jour = date(2033, 6, 1)
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        local = Local.query.first()
+        materiel = Materiel(nom="Heatmap", local_id=local.id, quantite=5, statut='disponible')
+        db.session.add(materiel)
+        db.session.flush()
+        prestation = Prestation(
+            date_debut=jour, date_fin=jour, heure_debut=time(20, 0), heure_fin=time(2, 0),
+            client="Client Heatmap", lieu="Salle", dj_id=DJ.query.first().id,
+            createur_id=admin.id, statut='confirmee',
+        )
+        db.session.add(prestation)
+        db.session.flush()
+        db.session.add(MaterielPresta(materiel_id=materiel.id, prestation_id=prestation.id, quantite=3))
+        db.session.commit()
+        materiel_id, prestation_id, local_id = materiel.id, prestation.id, local.id
+        attendu = verifier_disponibilite_materiel(materiel_id, 1, jour, jour, time(0, 0), time(23, 59))
+
+    login_as('admin')
+    response = client.get(f'/api/materiels/heatmap?date_debut=2033-05-31&date_fin=2033-06-03&local_id={local_id}')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['colonnes'][0] == '2033-05-31'
+    ligne = [m['id'] for m in data['materiels']].index(materiel_id)
+    assert data['disponible'][ligne][1] == attendu['quantite_disponible'] == 2
+    # Buffers par défaut (12h) : occupé du 01/06 8h au 02/06 14h
+    assert data['utilise'][ligne] == [0, 3, 3, 0]
+
+    response = client.get('/api/materiels/heatmap?date_debut=2033-06-01&date_fin=2033-06-01&granularite=heure')
+    data = response.get_json()
+    ligne = [m['id'] for m in data['materiels']].index(materiel_id)
+    assert data['utilise'][ligne][7] == 0 and data['utilise'][ligne][8] == 3
+
+    with app_instance.app_context():
+        MaterielPresta.query.filter_by(prestation_id=prestation_id).delete()
+        db.session.delete(db.session.get(Prestation, prestation_id))
+        db.session.delete(db.session.get(Materiel, materiel_id))
+        db.session.commit()
+
+
+def test_materiels_disponibilites_stream_sends_deltas(client, app_instance, login_as):
+    from app import db, Local, _dispo_stream_abonnes
+
+    with app_instance.app_context():
+        local = Local.query.first()
+        materiel = Materiel(nom="Flux", local_id=local.id, quantite=4, statut='disponible')
+        db.session.add(materiel)
+        db.session.commit()
+        materiel_id = materiel.id
+
+    login_as('admin')
+    response = client.get('/api/materiels/disponibilites/stream', buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    flux = iter(response.response)
+    try:
+        premier = next(flux)
+        premier = premier.decode() if isinstance(premier, bytes) else premier
+        assert premier.startswith('event: snapshot')
+        assert '"Flux"' in premier
+
+        with app_instance.app_context():
+            db.session.get(Materiel, materiel_id).statut = 'maintenance'
+            db.session.commit()
+
+        delta = next(flux)
+        delta = delta.decode() if isinstance(delta, bytes) else delta
+        assert delta.startswith('event: delta')
+        assert f'"id": {materiel_id}' in delta and '"maintenance": 4' in delta
+    finally:
+        response.close()
+    assert not _dispo_stream_abonnes
+
+    with app_instance.app_context():
+        db.session.delete(db.session.get(Materiel, materiel_id))
+        db.session.commit()
+
+
+def test_materiels_disponibilites_stream_slot_released_without_reading(client, app_instance, login_as, monkeypatch):
+    from app import _dispo_stream_abonnes
+
+    monkeypatch.setitem(app_instance.config, 'SERVER_THREADS', 2)
+    monkeypatch.setitem(app_instance.config, 'DISPO_STREAM_MAX_CLIENTS', 4)
+    login_as('admin')
+    response = client.get('/api/materiels/disponibilites/stream', buffered=False)
+    assert response.status_code == 200
+    # Plafond ramené à la moitié des threads du serveur
+    assert client.get('/api/materiels/disponibilites/stream', buffered=False).status_code == 503
+    # Client déconnecté avant le premier envoi : le générateur n'a jamais démarré
+    response.close()
+    assert not _dispo_stream_abonnes
+
+
+def test_locaux_proches_ranks_by_distance_and_quantity(client, app_instance, login_as, csrf_token):
+    from datetime import date
+    from app import db, Local, locaux_pouvant_fournir
+    from geo_ranking import rank_by_distance
+
+    ordre, distances = rank_by_distance(45.76, 4.83, [48.85, 45.75, 43.30], [2.35, 4.85, 5.37], k=2)
+    assert list(ordre) == [1, 2] and distances[0] < 2
+
+    jour = date(2034, 5, 20)
+    with app_instance.app_context():
+        lyon = Local(nom="Local Lyon", adresse="Lyon", adresse_lat=45.75, adresse_lng=4.85)
+        marseille = Local(nom="Local Marseille", adresse="Marseille", adresse_lat=43.30, adresse_lng=5.37)
+        paris = Local(nom="Local Paris", adresse="Paris", adresse_lat=48.85, adresse_lng=2.35)
+        db.session.add_all([lyon, marseille, paris])
+        db.session.flush()
+        fiches = [
+            Materiel(nom="Sub 18 Proches", local_id=lyon.id, quantite=1, statut='disponible'),
+            Materiel(nom="sub 18 proches", local_id=marseille.id, quantite=4, statut='disponible'),
+            Materiel(nom="Sub 18 Proches", local_id=paris.id, quantite=2, statut='disponible'),
+            Materiel(nom="Sub 18 Proches", local_id=paris.id, quantite=2, statut='disponible'),
+            Materiel(nom="Sub 18 Proches", local_id=lyon.id, quantite=9, statut='maintenance'),
+        ]
+        db.session.add_all(fiches)
+        db.session.commit()
+        ids = {'lyon': lyon.id, 'marseille': marseille.id, 'paris': paris.id}
+        reference = fiches[0].id
+        fiche_ids = [f.id for f in fiches]
+
+        # Lyon ne peut fournir que 1 : Marseille puis Paris (fiches cumulées)
+        locaux = locaux_pouvant_fournir(reference, 3, (45.76, 4.83), jour, jour, k=2)
+        assert [l['local_id'] for l in locaux] == [ids['marseille'], ids['paris']]
+        assert locaux[1]['quantite_disponible'] == 4 and len(locaux[1]['materiel_ids']) == 2
+        assert 250 < locaux[0]['distance_km'] < 600
+        assert [l['local_id'] for l in locaux_pouvant_fournir(reference, 1, (45.76, 4.83), jour, jour, k=1)] == [ids['lyon']]
+
+    login_as('admin')
+    token = csrf_token()
+    response = client.post(
+        f'/api/materiels/{reference}/locaux-proches',
+        json={'quantite': 4, 'date_debut': jour.isoformat()},
+        headers={'X-CSRF-Token': token} if token else None
+    )
+    data = response.get_json()
+    assert response.status_code == 200 and data['success']
+    assert {l['local_id'] for l in data['locaux']} == {ids['marseille'], ids['paris']}
+
+    with app_instance.app_context():
+        Materiel.query.filter(Materiel.id.in_(fiche_ids)).delete(synchronize_session=False)
+        Local.query.filter(Local.id.in_(ids.values())).delete(synchronize_session=False)
+        db.session.commit()
@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+
+import outbound_http
+from app import app, geocode_address, register_geocoding_provider, vider_cache_geocodage, GEOCODE_ERREUR_RESEAU
+
+
+def _echouer(service):
+    with pytest.raises(OSError):
+        with outbound_http.call(service):
+            raise OSError("timeout")
+
+
+def test_breaker_opens_then_half_opens(monkeypatch):
+    outbound_http.configure('test_disjoncteur', failure_threshold=2, reset_timeout=30)
+    outbound_http.reset('test_disjoncteur')
+    horloge = [1000.0]
+    monkeypatch.setattr(outbound_http.time, 'monotonic', lambda: horloge[0])
+
+    _echouer('test_disjoncteur')
+    _echouer('test_disjoncteur')
+    with pytest.raises(outbound_http.OutboundUnavailable) as refus:
+        with outbound_http.call('test_disjoncteur'):
+            pass
+    assert refus.value.raison == 'disjoncteur'
+
+    # Après reset_timeout : un seul appel d'essai, qui referme le disjoncteur
+    horloge[0] += 31
+    with outbound_http.call('test_disjoncteur'):
+        pass
+    metriques = outbound_http.get_metrics()['test_disjoncteur']
+    assert metriques['etat'] == outbound_http.FERME
+    assert metriques['ouvertures'] == 1 and metriques['refus_disjoncteur'] == 1
+
+
+def test_bulkhead_and_budget():
+    outbound_http.configure('test_cloison', max_concurrent=1, timeout=5)
+    outbound_http.reset('test_cloison')
+    entre, libere = threading.Event(), threading.Event()
+
+    def _appel_lent():
+        with outbound_http.call('test_cloison'):
+            entre.set()
+            libere.wait(5)
+
+    fil = threading.Thread(target=_appel_lent)
+    fil.start()
+    entre.wait(5)
+    with pytest.raises(outbound_http.OutboundUnavailable) as refus:
+        with outbound_http.call('test_cloison'):
+            pass
+    assert refus.value.raison == 'cloison'
+    libere.set()
+    fil.join()
+
+    # Le timeout est borné par le budget restant, puis l'appel n'est plus tenté
+    token = outbound_http.start_budget(2)
+    try:
+        with outbound_http.call('test_cloison') as timeout:
+            assert timeout <= 2
+        outbound_http.start_budget(0.1)
+        with pytest.raises(outbound_http.OutboundUnavailable) as refus:
+            with outbound_http.call('test_cloison'):
+                pass
+        assert refus.value.raison == 'budget'
+    finally:
+        outbound_http.end_budget(token)
+    assert outbound_http.remaining_budget() is None
+
+
+def test_stripe_and_google_timeouts_follow_each_call_budget():
+    import httplib2
+    import stripe
+    from google_calendar_config import GoogleCalendarManager
+    from stripe_service import _appel_stripe, _client_http_borne
+
+    outbound_http.reset('stripe')
+    outbound_http.reset('google_calendar')
+    client = _client_http_borne(stripe.RequestsClient)(timeout=80)
+    http = httplib2.Http(timeout=10)
+
+    class _Requete:
+        def __init__(self):
+            self.http = http
+
+        def execute(self, num_retries=0):
+            return http.timeout
+
+    token = outbound_http.start_budget(2)
+    try:
+        with _appel_stripe():
+            assert client._timeout <= 2
+        assert GoogleCalendarManager()._executer(_Requete()) <= 2
+    finally:
+        outbound_http.end_budget(token)
+    assert client._timeout == outbound_http.timeout_for('stripe')
+    assert GoogleCalendarManager()._executer(_Requete()) == outbound_http.timeout_for('google_calendar')
+
+
+def test_geocode_degrades_when_breaker_open(app_instance, monkeypatch):
+    appels = []
+
+    def _fournisseur(address, contact_email, timeout):
+        appels.append(address)
+        raise OSError("réseau indisponible")
+
+    register_geocoding_provider('panne', _fournisseur)
+    monkeypatch.setitem(app.config, 'GEOCODING_PROVIDER', 'panne')
+    outbound_http.reset('geocoding')
+    seuil = outbound_http.get_metrics()['geocoding']['failure_threshold']
+    with app_instance.app_context():
+        vider_cache_geocodage()
+        for numero in range(seuil + 3):
+            assert geocode_address(f"{numero} rue de la Panne, Lille") == (None, GEOCODE_ERREUR_RESEAU)
+        # Disjoncteur ouvert : le fournisseur n'est plus sollicité
+        assert len(appels) == seuil
+        assert outbound_http.get_metrics()['geocoding']['etat'] == outbound_http.OUVERT
+        vider_cache_geocodage()
+    outbound_http.reset('geocoding')
@@ -0,0 +1,204 @@
+import io
+import os
+import secrets
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import plf_storage
+from plf_storage import (
+    HEADER_SIZE_V2, JOURNAL_SUFFIX, NONCE_SIZE, PLF_MAGIC, TAG_SIZE, chunk_offset, chunk_record_size,
+    decrypt_bytes, decrypt_plf_to_sqlite, encrypt_bytes, plf_version, update_plf_from_sqlite,
+    write_plf_from_sqlite,
+)
+
+
+def test_v2_round_trip_streams_fixed_size_chunks(tmp_path):
+    donnees = secrets.token_bytes(3 * 4096 + 123)
+    sqlite_path = tmp_path / "base.db"
+    sqlite_path.write_bytes(donnees)
+    plf_path = tmp_path / "base.plf"
+
+    write_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", chunk_size=4096)
+    assert plf_version(str(plf_path)) == 2
+    assert plf_path.stat().st_size == chunk_offset(4096, 3) + NONCE_SIZE + 123 + TAG_SIZE
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith('.tmp')] == []
+
+    sortie = tmp_path / "sortie.db"
+    decrypt_plf_to_sqlite(str(plf_path), str(sortie), "secret")
+    assert sortie.read_bytes() == donnees
+
+    # Aucune lecture ne dépasse un bloc
+    lectures = []
+
+    class _Source(io.BytesIO):
+        def read(self, n=-1):
+            lectures.append(n)
+            return super().read(n)
+
+    plf_storage.decrypt_stream(_Source(plf_path.read_bytes()), io.BytesIO(), "secret")
+    assert max(lectures) <= max(HEADER_SIZE_V2, chunk_record_size(4096))
+    assert decrypt_bytes(encrypt_bytes(b"", "secret"), "secret") == b""
+
+
+def test_v1_files_still_load(tmp_path):
+    salt, nonce = secrets.token_bytes(16), secrets.token_bytes(12)
+    cle = plf_storage._derive_key("secret", salt)
+    donnees = secrets.token_bytes(5000)
+    v1 = PLF_MAGIC + salt + nonce + AESGCM(cle).encrypt(nonce, donnees, None)
+    assert decrypt_bytes(v1, "secret") == donnees
+
+    plf_path = tmp_path / "ancien.plf"
+    plf_path.write_bytes(v1)
+    sortie = tmp_path / "ancien.db"
+    decrypt_plf_to_sqlite(str(plf_path), str(sortie), "secret")
+    assert sortie.read_bytes() == donnees
+
+    plf_path.write_bytes(v1[:-1] + bytes([v1[-1] ^ 1]))
+    with pytest.raises(InvalidTag):
+        decrypt_plf_to_sqlite(str(plf_path), str(tmp_path / "rejet.db"), "secret")
+    assert not (tmp_path / "rejet.db").exists()
+
+
+def test_tampered_reordered_or_truncated_chunks_are_rejected(tmp_path):
+    donnees = secrets.token_bytes(4 * 4096)
+    chiffre = encrypt_bytes(donnees, "secret", chunk_size=4096)
+    taille = chunk_record_size(4096)
+    blocs = [chiffre[chunk_offset(4096, i):chunk_offset(4096, i) + taille] for i in range(4)]
+    entete = chiffre[:HEADER_SIZE_V2]
+
+    altere = bytearray(chiffre)
+    altere[chunk_offset(4096, 2) + 100] ^= 1
+    inverse = entete + blocs[1] + blocs[0] + blocs[2] + blocs[3]
+    tronque = chiffre[:chunk_offset(4096, 3)]
+    autre = encrypt_bytes(donnees, "secret", chunk_size=4096)
+    melange = entete + blocs[0] + autre[chunk_offset(4096, 1):]
+    for invalide in (bytes(altere), inverse, tronque, melange):
+        with pytest.raises((InvalidTag, ValueError)):
+            decrypt_bytes(invalide, "secret")
+    with pytest.raises(InvalidTag):
+        decrypt_bytes(chiffre, "autre")
+
+    # Échec d'écriture : le fichier existant est conservé intact
+    plf_path = tmp_path / "base.plf"
+    plf_path.write_bytes(chiffre)
+    with pytest.raises(FileNotFoundError):
+        write_plf_from_sqlite(str(tmp_path / "absente.db"), str(plf_path), "secret")
+    assert plf_path.read_bytes() == chiffre
+    assert os.listdir(tmp_path) == ["base.plf"]
+
+
+def _dechiffrer(plf_path, tmp_path):
+    sortie = tmp_path / "lecture.db"
+    decrypt_plf_to_sqlite(str(plf_path), str(sortie), "secret")
+    return sortie.read_bytes()
+
+
+def test_incremental_save_rewrites_only_changed_chunks(tmp_path):
+    sqlite_path, plf_path = tmp_path / "base.db", tmp_path / "base.plf"
+    donnees = bytearray(secrets.token_bytes(8 * 4096))
+    sqlite_path.write_bytes(donnees)
+    etat, reecrits = update_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", chunk_size=4096)
+    assert reecrits == 8
+    avant = plf_path.read_bytes()
+
+    assert update_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", etat, chunk_size=4096)[1] == 0
+    donnees[5 * 4096 + 10] ^= 0xFF
+    sqlite_path.write_bytes(donnees)
+    etat, reecrits = update_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", etat, chunk_size=4096)
+    assert reecrits == 1
+    apres = plf_path.read_bytes()
+    differents = [i for i in range(8) if avant[chunk_offset(4096, i):chunk_offset(4096, i + 1)]
+                  != apres[chunk_offset(4096, i):chunk_offset(4096, i + 1)]]
+    assert differents == [5] and _dechiffrer(plf_path, tmp_path) == donnees
+
+    # Croissance puis réduction de la base
+    donnees += secrets.token_bytes(4096 + 7)
+    sqlite_path.write_bytes(donnees)
+    etat, reecrits = update_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", etat, chunk_size=4096)
+    assert reecrits == 2 and _dechiffrer(plf_path, tmp_path) == donnees
+    del donnees[6 * 4096:]
+    sqlite_path.write_bytes(donnees)
+    etat, reecrits = update_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", etat, chunk_size=4096)
+    assert reecrits == 0 and _dechiffrer(plf_path, tmp_path) == donnees
+
+    # Fichier remplacé entre-temps : réécriture complète
+    write_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", chunk_size=4096)
+    assert update_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", etat, chunk_size=4096)[1] == 6
+
+
+def test_interrupted_incremental_save_is_replayed_or_discarded(tmp_path, monkeypatch):
+    sqlite_path, plf_path = tmp_path / "base.db", tmp_path / "base.plf"
+    ancien = secrets.token_bytes(4 * 4096)
+    sqlite_path.write_bytes(ancien)
+    etat, _ = update_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", chunk_size=4096)
+    nouveau = ancien[:4096] + secrets.token_bytes(4096) + ancien[2 * 4096:] + b"fin"
+    sqlite_path.write_bytes(nouveau)
+
+    # Coupure après l'écriture du journal, avant son application au fichier
+    appels = []
+    reprise = plf_storage.recover_plf
+
+    def _coupure(path):
+        appels.append(path)
+        if len(appels) == 2:
+            raise RuntimeError("coupure")
+        return reprise(path)
+
+    monkeypatch.setattr(plf_storage, "recover_plf", _coupure)
+    with pytest.raises(RuntimeError):
+        update_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", etat, chunk_size=4096)
+    monkeypatch.undo()
+    journal = tmp_path / ("base.plf" + JOURNAL_SUFFIX)
+    assert journal.exists()
+    contenu = journal.read_bytes()
+    assert _dechiffrer(plf_path, tmp_path) == nouveau and not journal.exists()
+
+    # Journal incomplet : ignoré, le fichier est resté dans son état précédent
+    fichier = plf_path.read_bytes()
+    journal.write_bytes(contenu[:-1])
+    assert plf_storage.recover_plf(str(plf_path)) is False
+    assert plf_path.read_bytes() == fichier and not journal.exists()
+
+
+def test_live_database_is_encrypted_from_a_consistent_snapshot(tmp_path, monkeypatch):
+    import sqlite3
+
+    sqlite_path, plf_path = tmp_path / "live.db", tmp_path / "live.plf"
+    connexion = sqlite3.connect(str(sqlite_path))
+    connexion.execute("PRAGMA journal_mode=WAL")
+    connexion.execute("PRAGMA wal_autocheckpoint=0")
+    connexion.execute("CREATE TABLE lignes (id INTEGER PRIMARY KEY, valeur TEXT)")
+    connexion.executemany("INSERT INTO lignes (valeur) VALUES (?)", [("x" * 500,)] * 200)
+    connexion.commit()
+
+    # Lignes validées encore dans le WAL : présentes dans le fichier chiffré
+    etat, _ = update_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", chunk_size=4096)
+    sortie = tmp_path / "lecture.db"
+    decrypt_plf_to_sqlite(str(plf_path), str(sortie), "secret")
+    with sqlite3.connect(str(sortie)) as lecture:
+        assert lecture.execute("SELECT count(*) FROM lignes").fetchone()[0] == 200
+
+    # Commit concurrent pendant la lecture des blocs : l'instantané n'est pas déchiré
+    empreinte = plf_storage._empreinte_bloc
+    appels = []
+
+    def _commit_concurrent(bloc):
+        if not appels:
+            connexion.executemany("INSERT INTO lignes (valeur) VALUES (?)", [("y" * 500,)] * 200)
+            connexion.execute("DELETE FROM lignes WHERE id <= 100")
+            connexion.commit()
+            connexion.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        appels.append(bloc)
+        return empreinte(bloc)
+
+    monkeypatch.setattr(plf_storage, "_empreinte_bloc", _commit_concurrent)
+    update_plf_from_sqlite(str(sqlite_path), str(plf_path), "secret", etat, chunk_size=4096)
+    monkeypatch.undo()
+    connexion.close()
+    decrypt_plf_to_sqlite(str(plf_path), str(sortie), "secret")
+    with sqlite3.connect(str(sortie)) as lecture:
+        assert lecture.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+        assert lecture.execute("SELECT count(*) FROM lignes").fetchone()[0] == 200
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith('.tmp')] == []
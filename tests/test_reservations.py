@@ -45,3 +45,47 @@ def test_public_reservation_api_success(client, monkeypatch):
     assert response.status_code == 200
     data = response.get_json()
     assert data.get('success') is True
+
+
+def test_evaluer_creneaux_ranks_windows(client, app_instance, login_as):
+    from datetime import date, time
+    from app import db, DJ, Local, Materiel, MaterielPresta, Prestation, User
+
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        dj = DJ.query.first()
+        materiel = Materiel(nom="Creneaux", local_id=Local.query.first().id, quantite=2, statut='disponible')
+        db.session.add(materiel)
+        db.session.flush()
+        prestation = Prestation(
+            date_debut=date(2034, 7, 5), date_fin=date(2034, 7, 5), heure_debut=time(20, 0),
+            heure_fin=time(23, 0), client="Client Creneaux", lieu="Salle", dj_id=dj.id,
+            createur_id=admin.id, statut='confirmee',
+        )
+        db.session.add(prestation)
+        db.session.flush()
+        db.session.add(MaterielPresta(materiel_id=materiel.id, prestation_id=prestation.id, quantite=2))
+        db.session.commit()
+        materiel_id, dj_id, prestation_id = materiel.id, dj.id, prestation.id
+
+    login_as('admin')
+    response = client.post('/api/creneaux/evaluer', json={
+        'creneaux': [
+            {'date_debut': '2034-07-05', 'heure_debut': '21:00', 'heure_fin': '23:00'},
+            {'date_debut': '2034-07-20', 'heure_debut': '21:00', 'heure_fin': '23:00'},
+        ],
+        'materiels': [{'materiel_id': materiel_id, 'quantite': 1}],
+        'dj_ids': [dj_id],
+    })
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['faisables'] == 1
+    premier, second = data['creneaux']
+    assert premier['index'] == 1 and premier['faisable'] and premier['djs_disponibles'] == [dj_id]
+    assert second['index'] == 0 and second['manque_total'] == 1 and 'Aucun DJ disponible' in second['erreurs']
+
+    with app_instance.app_context():
+        MaterielPresta.query.filter_by(prestation_id=prestation_id).delete()
+        db.session.delete(db.session.get(Prestation, prestation_id))
+        db.session.delete(db.session.get(Materiel, materiel_id))
+        db.session.commit()
@@ -56,3 +56,43 @@ def test_groq_key_update_and_clear(client, app_instance, login_as, csrf_token, m
     with app_instance.app_context():
         params = ParametresEntreprise.query.first()
         assert params.groq_api_key is None
+
+
+def test_parametres_cache_invalidated_on_commit(app_instance):
+    from sqlalchemy import event
+    from app import db, ParametresEntreprise, get_parametres_entreprise
+
+    with app_instance.app_context():
+        get_parametres_entreprise()
+        engine = db.engine
+
+    statements = []
+
+    def _count(conn, cursor, statement, *args):
+        if 'parametres_entreprise' in statement:
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', _count)
+    try:
+        with app_instance.app_context():
+            params = get_parametres_entreprise()
+            assert get_parametres_entreprise() is params
+            slogan_initial = params.slogan
+        with app_instance.app_context():
+            assert get_parametres_entreprise().slogan == slogan_initial
+    finally:
+        event.remove(engine, 'before_cursor_execute', _count)
+    assert statements == []
+
+    with app_instance.app_context():
+        params = get_parametres_entreprise()
+        params.slogan = 'Slogan en cache'
+        db.session.commit()
+    with app_instance.app_context():
+        assert get_parametres_entreprise().slogan == 'Slogan en cache'
+        ParametresEntreprise.query.update({'slogan': 'Slogan en masse'})
+        db.session.commit()
+    with app_instance.app_context():
+        assert get_parametres_entreprise().slogan == 'Slogan en masse'
+        get_parametres_entreprise().slogan = slogan_initial
+        db.session.commit()
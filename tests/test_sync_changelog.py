@@ -0,0 +1,261 @@
+import json
+from datetime import date, time, timedelta
+
+from app import (
+    db, Devis, DJ, Local, SyncChangeLog, SyncConfig, User, coalescer_changements_sync, ensure_sync_config,
+    lire_changements_sync, maintenance_journal_sync, utcnow
+)
+
+
+def _changements_en_attente():
+    return [
+        (c.entity_type, c.entity_id, c.operation, json.loads(c.payload or '{}'))
+        for c in SyncChangeLog.query.filter_by(status='pending').order_by(SyncChangeLog.id.asc()).all()
+    ]
+
+
+def _appliquer(changements):
+    """Etat d'un serveur distant qui rejoue les changements dans l'ordre."""
+    etat = {}
+    for entity_type, entity_id, operation, payload in changements:
+        cle = (entity_type, entity_id)
+        if operation == 'delete':
+            etat.pop(cle, None)
+        else:
+            etat.setdefault(cle, {}).update(payload)
+    return etat
+
+
+def test_coalescing_keeps_remote_state_and_shrinks_payload(app_instance):
+    with app_instance.app_context():
+        admin = User.query.filter_by(username='admin').first()
+        dj = DJ.query.first()
+        devis = []
+        for numero in range(5):
+            d = Devis(numero=f"DV-COAL-{numero}", client_nom="Client Coalescence", prestation_titre="Soirée",
+                      date_prestation=date(2033, 4, 2), heure_debut=time(20, 0), heure_fin=time(23, 0),
+                      lieu="Salle Coalescence", dj_id=dj.id, createur_id=admin.id)
+            db.session.add(d)
+            db.session.commit()
+            devis.append(d)
+        for tour in range(10):
+            for d in devis:
+                d.prestation_titre = f"Soirée v{tour}"
+                db.session.commit()
+        ephemere = Local(nom="Local éphémère", adresse="1 rue Brève")
+        db.session.add(ephemere)
+        db.session.commit()
+        ephemere.nom = "Local éphémère bis"
+        db.session.commit()
+        db.session.delete(ephemere)
+        db.session.delete(devis[4])
+        db.session.commit()
+
+        avant = _changements_en_attente()
+        stats = coalescer_changements_sync()
+        apres = _changements_en_attente()
+
+        assert _appliquer(apres) == _appliquer(avant)
+        # Les modifications ne journalisent que les colonnes changées : le gain porte sur le nombre de lignes
+        assert stats['apres'] * 10 <= stats['avant']
+        assert stats['octets_apres'] < stats['octets_avant']
+        par_entite = {}
+        for entity_type, entity_id, operation, _ in apres:
+            par_entite.setdefault((entity_type, entity_id), []).append(operation)
+        assert all(len(operations) == 1 for operations in par_entite.values())
+        assert par_entite[('Devis', devis[0].id)] == ['insert']
+        assert ('Local', ephemere.id) not in par_entite
+        # Coalescence idempotente
+        assert coalescer_changements_sync()['avant'] == 0
+
+        for d in devis[:4]:
+            db.session.delete(d)
+        db.session.commit()
+
+
+def _journal(entity_id, operation, anciennete, payload, status='pending'):
+    moment = utcnow() - timedelta(days=anciennete)
+    ligne = SyncChangeLog(entity_type='Local', entity_id=entity_id, operation=operation, changed_at=moment,
+                          device_id='dev-retention', changed_fields=json.dumps(list(payload)),
+                          payload=json.dumps(payload), status=status,
+                          sent_at=moment if status == 'sent' else None)
+    db.session.add(ligne)
+    db.session.commit()
+    return ligne.id
+
+
+def test_coalescing_leaves_changes_already_pushed_untouched(app_instance):
+    with app_instance.app_context():
+        coalescer_changements_sync()
+        # Envoi tenté sans acquittement reçu : le serveur a pu enregistrer ce change_id
+        envoye = _journal(7300, 'insert', 0, {'id': 7300, 'nom': 'Dépôt', 'adresse': '1 rue A'})
+        db.session.get(SyncChangeLog, envoye).push_attempted_at = utcnow()
+        db.session.commit()
+        _journal(7300, 'update', 0, {'nom': 'Dépôt B'})
+        dernier = _journal(7300, 'update', 0, {'adresse': '2 rue B'})
+
+        stats = coalescer_changements_sync()
+
+        assert stats['avant'] == 2 and stats['apres'] == 1
+        lignes = SyncChangeLog.query.filter_by(entity_id=7300).order_by(SyncChangeLog.id.asc()).all()
+        assert [(l.id, l.operation) for l in lignes] == [(envoye, 'insert'), (dernier, 'update')]
+        assert json.loads(lignes[0].payload) == {'id': 7300, 'nom': 'Dépôt', 'adresse': '1 rue A'}
+        assert json.loads(lignes[1].payload) == {'nom': 'Dépôt B', 'adresse': '2 rue B'}
+        SyncChangeLog.query.filter_by(entity_id=7300).delete()
+        db.session.commit()
+
+
+def test_retention_prunes_acknowledged_changes_on_device(app_instance):
+    with app_instance.app_context():
+        _journal(7000, 'update', 60, {'nom': 'x' * 2000}, status='sent')
+        recent = _journal(7000, 'update', 1, {'nom': 'y'}, status='sent')
+        en_attente = _journal(7001, 'update', 60, {'nom': 'z'})
+
+        rapport = maintenance_journal_sync()
+
+        restants = {c.id for c in SyncChangeLog.query.filter(SyncChangeLog.entity_id.in_([7000, 7001]))}
+        assert restants == {recent, en_attente}
+        assert rapport['mode'] == 'appareil' and rapport['changements_supprimes'] >= 1
+        assert rapport['octets_recuperes'] >= 0 and rapport['octets_apres'] > 0
+        SyncChangeLog.query.filter(SyncChangeLog.id.in_([recent, en_attente])).delete(synchronize_session=False)
+        db.session.commit()
+
+
+def test_retention_keeps_highest_change_id_on_device(app_instance):
+    with app_instance.app_context():
+        ancien = _journal(7002, 'update', 60, {'nom': 'a'}, status='sent')
+        dernier = _journal(7002, 'update', 50, {'nom': 'b'}, status='sent')
+
+        maintenance_journal_sync()
+
+        restants = {c.id for c in SyncChangeLog.query.filter_by(entity_id=7002)}
+        assert restants == {dernier}
+        # Les ids ne repartent pas en arrière : pas de collision avec les change_id déjà envoyés
+        assert _journal(7002, 'update', 0, {'nom': 'c'}) > dernier
+        SyncChangeLog.query.filter_by(entity_id=7002).delete()
+        db.session.commit()
+
+
+def test_server_compacts_old_history_and_requires_resync_past_purged_deletes(app_instance, monkeypatch):
+    monkeypatch.setitem(app_instance.config, 'SYNC_SERVER_MODE', True)
+    with app_instance.app_context():
+        ensure_sync_config()
+        creation = _journal(7100, 'insert', 200, {'id': 7100, 'nom': 'Dépôt', 'adresse': '1 rue A'})
+        modification = _journal(7100, 'update', 190, {'id': 7100, 'nom': 'Dépôt Sud', 'adresse': '1 rue A'})
+        _journal(7101, 'insert', 200, {'id': 7101, 'nom': 'Éphémère'})
+        suppression = _journal(7101, 'delete', 195, {'id': 7101, 'nom': 'Éphémère'})
+        ancien = _journal(7102, 'update', 40, {'nom': 'Ancien'})
+        recent = _journal(7102, 'update', 1, {'nom': 'Récent'})
+
+        rapport = maintenance_journal_sync(vacuum_complet=True)
+
+        lignes = {
+            c.id: (c.entity_id, c.operation, json.loads(c.payload))
+            for c in SyncChangeLog.query.filter(SyncChangeLog.entity_id.in_([7100, 7101, 7102]))
+        }
+        # Etat final à la position du dernier changement, suppression effacée après sa propre rétention
+        assert lignes == {
+            modification: (7100, 'insert', {'id': 7100, 'nom': 'Dépôt Sud', 'adresse': '1 rue A'}),
+            ancien: (7102, 'update', {'nom': 'Ancien'}),
+            recent: (7102, 'update', {'nom': 'Récent'}),
+        }
+        assert rapport['changements_compactes'] >= 1 and rapport['changements_supprimes'] >= 1
+        assert db.session.execute(db.text("PRAGMA auto_vacuum")).scalar() == 2
+
+        assert db.session.get(SyncConfig, 1).log_purged_through >= suppression
+        resync = lire_changements_sync(creation, 100)
+        assert resync['resync_required'] is True
+        # Identifiants présents : l'appareil en déduit les suppressions effacées
+        assert Local.query.filter_by(nom='Local Test').one().id in resync['live_ids']['Local']
+        complet = lire_changements_sync(0, 100000)
+        assert 'resync_required' not in complet
+        assert {c['entity_id'] for c in complet['changes']} >= {7100, 7102}
+
+        db.session.get(SyncConfig, 1).log_purged_through = None
+        SyncChangeLog.query.filter(SyncChangeLog.id.in_(list(lignes))).delete(synchronize_session=False)
+        db.session.commit()
+
+
+def test_resync_deletes_entities_missing_on_server(app_instance):
+    from app import _supprimer_entites_absentes_sync
+
+    with app_instance.app_context():
+        db.session.add_all([Local(id=7200, nom='Supprimé sur le serveur', adresse='1 rue A'),
+                            Local(id=7201, nom='Modifié hors ligne', adresse='2 rue B')])
+        db.session.commit()
+        SyncChangeLog.query.filter(
+            SyncChangeLog.entity_type == 'Local', SyncChangeLog.entity_id.in_([7200, 7201])
+        ).update({'status': 'sent'}, synchronize_session=False)
+        db.session.get(Local, 7201).nom = 'Modifié hors ligne (local)'
+        db.session.commit()
+        avant = SyncChangeLog.query.count()
+
+        vivants = [l.id for l in Local.query if l.id not in (7200, 7201)]
+        assert _supprimer_entites_absentes_sync({'Local': vivants, 'Inconnu': [1]}) == 1
+        db.session.commit()
+        assert db.session.get(Local, 7200) is None
+        # Modification locale non envoyée : l'entité est conservée et sera poussée
+        assert db.session.get(Local, 7201).nom == 'Modifié hors ligne (local)'
+        assert SyncChangeLog.query.count() == avant
+
+        db.session.delete(db.session.get(Local, 7201))
+        db.session.commit()
+        SyncChangeLog.query.filter(
+            SyncChangeLog.entity_type == 'Local', SyncChangeLog.entity_id.in_([7200, 7201])
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+
+def test_failed_vacuum_is_recorded_and_not_retried(app_instance, monkeypatch):
+    import app as app_module
+
+    appels = []
+
+    def _echec(complet):
+        appels.append(complet)
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(app_module, '_vacuum_base', _echec)
+    monkeypatch.setattr(app_module, '_dans_fenetre_maintenance', lambda instant: True)
+    monkeypatch.setattr(app_module, '_sync_maintenance_rapport', None)
+    with app_instance.app_context():
+        rapport = app_module.maintenance_journal_sync_si_due()
+        assert rapport['vacuum_erreur'] == 'database is locked'
+        assert app_module.maintenance_journal_sync_si_due() is None
+        assert appels == [True]
+
+
+def test_capture_buffers_changed_columns_until_commit(app_instance):
+    with app_instance.app_context():
+        local = Local(nom="Local tampon", adresse="1 rue du Tampon")
+        db.session.add(local)
+        db.session.flush()
+        local_id = local.id
+        # Rien n'est écrit avant le commit
+        assert SyncChangeLog.query.filter_by(entity_type='Local', entity_id=local_id).count() == 0
+        db.session.commit()
+
+        local.adresse = "2 rue du Tampon"
+        db.session.commit()
+        try:
+            with db.session.begin_nested():
+                local.nom = "Annulé"
+                db.session.flush()
+                raise RuntimeError("savepoint annulé")
+        except RuntimeError:
+            pass
+        db.session.commit()
+
+        lignes = SyncChangeLog.query.filter_by(entity_type='Local', entity_id=local_id).order_by(SyncChangeLog.id).all()
+        assert [c.operation for c in lignes] == ['insert', 'update']
+        assert json.loads(lignes[0].payload)['nom'] == "Local tampon"
+        # Colonnes modifiées seulement (l'adresse et son géocodage remis à zéro), pas le nom annulé
+        champs = json.loads(lignes[1].changed_fields)
+        payload = json.loads(lignes[1].payload)
+        assert 'adresse' in champs and 'nom' not in champs
+        assert set(payload) == set(champs) | {'id'} and payload['adresse'] == "2 rue du Tampon"
+
+        db.session.delete(local)
+        db.session.commit()
+        SyncChangeLog.query.filter_by(entity_type='Local', entity_id=local_id).delete(synchronize_session=False)
+        db.session.commit()
@@ -0,0 +1,36 @@
+from sync_merge import REGLE_PLUS_RECENT, REGLE_RECALCUL, champs_modifies, fusionner
+
+
+def test_disjoint_fields_merge_and_same_field_collides():
+    local = {'id': 1, 'nom': 'Dépôt (local)', 'adresse': '1 rue', 'capacite': 10}
+    distant = {'nom': 'Dépôt (distant)', 'adresse': '2 rue'}
+
+    resultat = fusionner(local, distant, ['capacite'], ['adresse'])
+    assert resultat.appliquer == {'adresse': '2 rue'} and resultat.automatique
+
+    resultat = fusionner(local, distant, ['nom', 'capacite'], ['nom', 'adresse'])
+    assert resultat.appliquer == {'adresse': '2 rue'}
+    assert resultat.collisions == {'nom': {'local': 'Dépôt (local)', 'distant': 'Dépôt (distant)'}}
+
+    # Même valeur des deux côtés : pas de conflit
+    resultat = fusionner(dict(local, nom='Dépôt (distant)'), distant, ['nom'], ['nom'])
+    assert resultat.appliquer == {} and resultat.automatique
+
+
+def test_field_rules_and_changed_fields_against_base():
+    regles = {'statut': REGLE_PLUS_RECENT, 'montant_ttc': REGLE_RECALCUL}
+    local = {'statut': 'envoye', 'remise_pourcentage': 5, 'montant_ttc': 95.0}
+    distant = {'statut': 'accepte', 'frais_transport': 20, 'montant_ttc': 120.0}
+    champs_local = ['statut', 'remise_pourcentage', 'montant_ttc']
+    champs_distant = ['statut', 'frais_transport', 'montant_ttc']
+
+    resultat = fusionner(local, distant, champs_local, champs_distant, regles, distant_plus_recent=True)
+    assert resultat.appliquer == {'statut': 'accepte', 'frais_transport': 20}
+    assert resultat.gagnes_distant == {'statut'} and resultat.recalcul and resultat.automatique
+
+    resultat = fusionner(local, distant, champs_local, champs_distant, regles, distant_plus_recent=False)
+    assert resultat.appliquer == {'frais_transport': 20} and resultat.gagnes_local == {'statut'}
+
+    base = {'id': 3, 'nom': 'A', 'adresse': '1 rue'}
+    assert champs_modifies(base, {'id': 3, 'nom': 'A', 'adresse': '2 rue'}) == {'adresse'}
+    assert champs_modifies(None, {'id': 3, 'nom': 'A'}) == {'nom'}
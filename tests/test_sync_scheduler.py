@@ -0,0 +1,98 @@
+from sync_scheduler import SyncScheduler
+
+
+class _Horloge:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+
+def _scheduler(statuts, horloge, **kwargs):
+    appels = []
+
+    def run():
+        appels.append(horloge.t)
+        statut = statuts.pop(0) if statuts else 'no_changes'
+        if isinstance(statut, Exception):
+            raise statut
+        return statut
+
+    options = dict(debounce=1.0, max_delay=5.0, idle_min=20, idle_max=160,
+                   backoff_base=5, backoff_max=60, jitter=0.2, rand=lambda: 1.0)
+    options.update(kwargs)
+    return SyncScheduler(run, clock=horloge, **options), appels
+
+
+def test_burst_of_commits_is_debounced_into_one_cycle():
+    horloge = _Horloge()
+    scheduler, appels = _scheduler(['synced'], horloge)
+    for _ in range(10):
+        scheduler.notify()
+        horloge.t += 0.3
+        assert scheduler.step() > 0
+    horloge.t += 1.0
+    scheduler.step()
+    assert len(appels) == 1
+
+    # Rafale continue : le cycle part au plus max_delay après la première notification
+    debut = horloge.t
+    while not appels[1:]:
+        scheduler.notify()
+        horloge.t += 0.5
+        scheduler.step()
+    assert appels[1] - debut <= 5.0
+    assert scheduler.snapshot()['cycles_changements'] == 2
+
+
+def test_idle_interval_grows_and_failures_back_off_with_jitter():
+    horloge = _Horloge()
+    scheduler, appels = _scheduler([], horloge)
+    # Sans activité : 20, 40, 80, 160, 160 s entre deux relèves
+    for _ in range(6):
+        horloge.t += scheduler.step()
+    assert [round(b - a) for a, b in zip(appels, appels[1:])] == [40, 80, 160, 160]
+
+    horloge = _Horloge()
+    scheduler, appels = _scheduler([RuntimeError('réseau'), 'failed', 'failed', 'synced'], horloge)
+    scheduler.notify()
+    horloge.t += 1.0
+    delais = [scheduler.step()]
+    # Repli 5, 10, 20 s (+20 % de gigue) ; une notification n'écourte pas le repli
+    scheduler.notify()
+    for _ in range(3):
+        horloge.t += delais[-1]
+        delais.append(scheduler.step())
+    assert [round(d, 1) for d in delais] == [6.0, 12.0, 24.0, 20.0]
+    etat = scheduler.snapshot()
+    assert etat['echecs'] == 3 and etat['echecs_consecutifs'] == 0 and not etat['en_repli']
+
+
+def test_commit_with_changelog_wakes_the_scheduler(app_instance, monkeypatch):
+    import app as app_module
+    from app import db, Local
+
+    class _Espion:
+        notifications = 0
+
+        def notify(self):
+            self.notifications += 1
+
+        def snapshot(self):
+            return {'notifications': self.notifications}
+
+    espion = _Espion()
+    monkeypatch.setattr(app_module, '_sync_scheduler', espion)
+    with app_instance.app_context():
+        local = Local(nom="Local réveil", adresse="1 rue du Réveil")
+        db.session.add(local)
+        db.session.commit()
+        assert espion.notifications == 1
+        # Un commit sans changement journalisé ne réveille pas la synchronisation
+        db.session.commit()
+        assert espion.notifications == 1
+        stats = app_module.get_sync_scheduler_stats()
+        assert stats['file_attente'] >= 1 and stats['retard_secondes'] >= 0
+        db.session.delete(local)
+        db.session.commit()
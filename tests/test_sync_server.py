@@ -1,11 +1,12 @@
+import json
 import os
 from app import db, SyncIncomingLog
 
 
-def test_sync_push_server_mode(app_instance):
+def test_sync_push_server_mode(app_instance, monkeypatch):
     app_instance.config['TESTING'] = True
-    app_instance.config['SYNC_SERVER_MODE'] = True
-    app_instance.config['SYNC_SERVER_TOKEN'] = 'test-token'
+    monkeypatch.setitem(app_instance.config, 'SYNC_SERVER_MODE', True)
+    monkeypatch.setitem(app_instance.config, 'SYNC_SERVER_TOKEN', 'test-token')
     os.environ['SYNC_SERVER_MODE'] = '1'
     os.environ['SYNC_SERVER_TOKEN'] = 'test-token'
     os.environ['FLASK_ENV'] = 'testing'
@@ -37,3 +38,289 @@ def test_sync_push_server_mode(app_instance):
         db.session.commit()
     os.environ.pop('SYNC_SERVER_MODE', None)
     os.environ.pop('SYNC_SERVER_TOKEN', None)
+
+
+def test_sync_hub_push_pull_cursor_and_conflicts(app_instance, monkeypatch):
+    from app import Local, SyncChangeLog
+    from sync_transport import NDJSON, compress, encode_ndjson
+
+    monkeypatch.setitem(app_instance.config, 'SYNC_SERVER_MODE', True)
+    monkeypatch.setitem(app_instance.config, 'SYNC_SERVER_TOKEN', 'hub-token')
+    client = app_instance.test_client()
+    auth = {'Authorization': 'Bearer hub-token'}
+
+    def pull(cursor, device_id, limit=100):
+        resp = client.get(f'/api/sync/pull?cursor={cursor}&limit={limit}&device_id={device_id}', headers=auth)
+        assert resp.status_code == 200
+        return resp.get_json()
+
+    with app_instance.app_context():
+        depart = db.session.query(db.func.max(SyncChangeLog.id)).scalar() or 0
+
+    assert client.get('/api/sync/pull?cursor=0', headers={'Authorization': 'Bearer faux'}).status_code == 401
+
+    # Push NDJSON compressé : création puis modification du même local
+    changements = [
+        {'change_id': 1, 'entity_type': 'Local', 'entity_id': 9001, 'operation': 'insert',
+         'payload': {'id': 9001, 'nom': 'Dépôt Nord', 'adresse': '1 rue du Nord'}},
+        {'change_id': 2, 'entity_type': 'Local', 'entity_id': 9001, 'operation': 'update',
+         'changed_fields': ['nom'], 'payload': {'nom': 'Dépôt Nord bis', 'adresse': 'ignorée'}},
+        {'change_id': 3, 'entity_type': 'Inconnu', 'entity_id': 1, 'operation': 'insert', 'payload': {}},
+    ]
+    corps = compress(encode_ndjson({'device_id': 'dev-1', 'cursor': depart}, changements), 'gzip')
+    resp = client.post('/api/sync/push', data=corps,
+                       headers=dict(auth, **{'Content-Type': NDJSON, 'Content-Encoding': 'gzip'}))
+    data = resp.get_json()
+    assert data['accepted_ids'] == [1, 2]
+    assert [e['change_id'] for e in data['errors']] == [3]
+    with app_instance.app_context():
+        local = db.session.get(Local, 9001)
+        assert (local.nom, local.adresse) == ('Dépôt Nord bis', '1 rue du Nord')
+
+    # Renvoi du même lot : acquitté sans être réappliqué ni rejournalisé
+    resp = client.post('/api/sync/push', json={'device_id': 'dev-1', 'changes': changements[:2]}, headers=auth)
+    assert resp.get_json()['accepted_ids'] == [1, 2]
+    with app_instance.app_context():
+        assert SyncIncomingLog.query.filter_by(device_id='dev-1').count() == 2
+
+    # Pull : les deux changements arrivent compactés en une création ; l'émetteur ne les relit pas
+    page = pull(depart, 'dev-2')
+    assert page['has_more'] is False
+    assert [(c['entity_id'], c['operation'], c['payload']['nom']) for c in page['changes']] == [
+        (9001, 'insert', 'Dépôt Nord bis')
+    ]
+    propre = pull(depart, 'dev-1')
+    assert propre['changes'] == [] and propre['cursor'] == page['cursor']
+    assert pull(depart, 'dev-2', limit=1)['has_more'] is True
+
+    # Modification sur le serveur : un appareil qui ne l'a pas reçue est en conflit
+    curseur_dev2 = page['cursor']
+    with app_instance.app_context():
+        db.session.get(Local, 9001).nom = 'Dépôt Nord (serveur)'
+        db.session.commit()
+    modif = {'change_id': 10, 'entity_type': 'Local', 'entity_id': 9001, 'operation': 'update',
+             'changed_fields': ['nom'], 'payload': {'nom': 'Dépôt Nord (dev-2)'}}
+    data = client.post('/api/sync/push', json={'device_id': 'dev-2', 'cursor': curseur_dev2, 'changes': [modif]},
+                       headers=auth).get_json()
+    assert data['accepted_ids'] == [] and data['conflicts'][0]['change_id'] == 10
+
+    page = pull(curseur_dev2, 'dev-2')
+    assert [c['payload']['nom'] for c in page['changes']] == ['Dépôt Nord (serveur)']
+    modif['change_id'] = 11
+    data = client.post('/api/sync/push', json={'device_id': 'dev-2', 'cursor': page['cursor'], 'changes': [modif]},
+                       headers=auth).get_json()
+    assert data['accepted_ids'] == [11]
+
+    with app_instance.app_context():
+        assert db.session.get(Local, 9001).nom == 'Dépôt Nord (dev-2)'
+        db.session.delete(db.session.get(Local, 9001))
+        db.session.query(SyncIncomingLog).delete()
+        db.session.commit()
+
+
+def test_pulled_changes_are_applied_without_journal(app_instance):
+    from app import Local, SyncChangeLog, _SYNC_SANS_JOURNAL, appliquer_changements_distants
+
+    with app_instance.app_context():
+        local = Local.query.filter_by(nom='Local Test').first()
+        local_id = local.id
+        avant = SyncChangeLog.query.count()
+        resultats = appliquer_changements_distants([
+            {'change_id': 1, 'entity_type': 'Local', 'entity_id': local_id, 'operation': 'update',
+             'changed_fields': ['adresse'], 'payload': {'nom': 'ignoré', 'adresse': '2 rue du Serveur'}},
+            {'change_id': 2, 'entity_type': 'Local', 'entity_id': 9002, 'operation': 'insert',
+             'payload': {'nom': 'Sans adresse'}},
+        ], origine=_SYNC_SANS_JOURNAL)
+        db.session.commit()
+        assert resultats[1] == ('applied', None) and resultats[2][0] == 'error'
+        local = db.session.get(Local, local_id)
+        assert (local.nom, local.adresse) == ('Local Test', '2 rue du Serveur')
+        assert db.session.get(Local, 9002) is None
+        assert SyncChangeLog.query.count() == avant
+
+        local.adresse = '1 rue du Test'
+        db.session.commit()
+
+
+def test_hub_merges_concurrent_changes_on_distinct_fields(app_instance, monkeypatch):
+    from app import Local, SyncChangeLog
+
+    monkeypatch.setitem(app_instance.config, 'SYNC_SERVER_MODE', True)
+    monkeypatch.setitem(app_instance.config, 'SYNC_SERVER_TOKEN', 'hub-token')
+    client = app_instance.test_client()
+    auth = {'Authorization': 'Bearer hub-token'}
+
+    with app_instance.app_context():
+        db.session.add(Local(id=9003, nom='Dépôt Est', adresse='3 rue de l\'Est'))
+        db.session.commit()
+        curseur = db.session.query(db.func.max(SyncChangeLog.id)).scalar()
+        db.session.get(Local, 9003).nom = 'Dépôt Est (serveur)'
+        db.session.commit()
+
+    # L'appareil n'a pas vu le renommage : sa modification de l'adresse est fusionnée
+    modif = {'change_id': 20, 'entity_type': 'Local', 'entity_id': 9003, 'operation': 'update',
+             'changed_fields': ['adresse'], 'payload': {'adresse': '30 rue de l\'Est'}}
+    data = client.post('/api/sync/push', json={'device_id': 'dev-3', 'cursor': curseur, 'changes': [modif]},
+                       headers=auth).get_json()
+    assert data['accepted_ids'] == [20] and data['merged'] == [20] and data['conflicts'] == []
+
+    # Le même champ modifié des deux côtés reste un conflit, avec les deux valeurs
+    collision = {'change_id': 21, 'entity_type': 'Local', 'entity_id': 9003, 'operation': 'update',
+                 'changed_fields': ['nom'], 'payload': {'nom': 'Dépôt Est (dev-3)'}}
+    data = client.post('/api/sync/push', json={'device_id': 'dev-3', 'cursor': curseur, 'changes': [collision]},
+                       headers=auth).get_json()
+    assert data['accepted_ids'] == []
+    assert data['conflicts'][0]['fields'] == {'nom': {'local': 'Dépôt Est (serveur)', 'distant': 'Dépôt Est (dev-3)'}}
+
+    with app_instance.app_context():
+        local = db.session.get(Local, 9003)
+        assert (local.nom, local.adresse) == ('Dépôt Est (serveur)', '30 rue de l\'Est')
+        # Le résultat de la fusion est republié, y compris à l'émetteur
+        page = client.get(f'/api/sync/pull?cursor={curseur}&device_id=dev-3', headers=auth).get_json()
+        assert [c['payload'].get('adresse') for c in page['changes'] if c['entity_id'] == 9003] == ['30 rue de l\'Est']
+        assert SyncIncomingLog.query.filter_by(device_id='dev-3', change_id=20).one().status == 'merged'
+        db.session.delete(local)
+        db.session.query(SyncIncomingLog).delete()
+        db.session.commit()
+
+
+def test_pulled_change_is_merged_with_pending_local_edits(app_instance):
+    from app import (Devis, Local, SyncBaseVersion, SyncChangeLog, SyncConflict,
+                     _fusionner_changement_serveur, _model_to_payload)
+
+    with app_instance.app_context():
+        local = Local(id=9004, nom='Dépôt Ouest', adresse='4 rue de l\'Ouest')
+        db.session.add(local)
+        db.session.commit()
+        SyncChangeLog.query.filter_by(entity_type='Local', entity_id=9004).update({'status': 'sent'})
+        db.session.add(SyncBaseVersion(entity_type='Local', entity_id=9004,
+                                       payload='{"nom": "Dépôt Ouest", "adresse": "4 rue de l\'Ouest"}'))
+        local.nom = 'Dépôt Ouest (local)'
+        db.session.commit()
+        lignes = SyncChangeLog.query.filter_by(entity_type='Local', entity_id=9004, status='pending').all()
+        assert len(lignes) == 1
+
+        distant = {'change_id': 500, 'entity_type': 'Local', 'entity_id': 9004, 'operation': 'update',
+                   'changed_at': '2000-01-01T00:00:00', 'changed_fields': ['adresse'],
+                   'payload': {'adresse': '40 rue de l\'Ouest'}}
+        resultat = _fusionner_changement_serveur(distant, lignes)
+        db.session.commit()
+        assert resultat.appliquer == {'adresse': '40 rue de l\'Ouest'} and resultat.automatique
+        local = db.session.get(Local, 9004)
+        assert (local.nom, local.adresse) == ('Dépôt Ouest (local)', '40 rue de l\'Ouest')
+        # Le champ distant n'est pas rejournalisé : seul le renommage local reste à envoyer
+        ligne = SyncChangeLog.query.filter_by(entity_type='Local', entity_id=9004, status='pending').one()
+        assert 'adresse' not in ligne.changed_fields
+        assert SyncConflict.query.filter_by(entity_type='Local', entity_id=9004).count() == 0
+
+        # Montants d'un devis : jamais en conflit, recalculés et renvoyés au serveur
+        devis = Devis.query.first()
+        SyncChangeLog.query.filter_by(entity_type='Devis', entity_id=devis.id).update({'status': 'sent'})
+        db.session.add(SyncBaseVersion(entity_type='Devis', entity_id=devis.id,
+                                       payload=json.dumps(_model_to_payload(devis), default=str)))
+        devis.remise_pourcentage = 10
+        devis.calculer_totaux()
+        db.session.commit()
+        lignes = SyncChangeLog.query.filter_by(entity_type='Devis', entity_id=devis.id, status='pending').all()
+        distant = {'change_id': 501, 'entity_type': 'Devis', 'entity_id': devis.id, 'operation': 'update',
+                   'changed_at': '2000-01-01T00:00:00', 'changed_fields': ['frais_transport', 'montant_ttc'],
+                   'payload': {'frais_transport': (devis.frais_transport or 0) + 50, 'montant_ttc': 1.0}}
+        resultat = _fusionner_changement_serveur(distant, lignes)
+        db.session.commit()
+        assert resultat.automatique and resultat.recalcul
+        devis = db.session.get(Devis, devis.id)
+        assert devis.montant_ttc != 1.0
+        en_attente = SyncChangeLog.query.filter_by(entity_type='Devis', entity_id=devis.id, status='pending').all()
+        assert any('montant_ttc' in (l.changed_fields or '') for l in en_attente)
+
+        db.session.delete(local)
+        SyncBaseVersion.query.delete()
+        db.session.commit()
+
+
+def test_pulled_collision_holds_back_pending_local_edits(app_instance):
+    from app import Local, SyncBaseVersion, SyncChangeLog, SyncConflict, _fusionner_changement_serveur
+
+    with app_instance.app_context():
+        local = Local(id=9005, nom='Dépôt Centre', adresse='5 rue du Centre')
+        db.session.add(local)
+        db.session.commit()
+        SyncChangeLog.query.filter_by(entity_type='Local', entity_id=9005).update({'status': 'sent'})
+        db.session.add(SyncBaseVersion(entity_type='Local', entity_id=9005,
+                                       payload='{"nom": "Dépôt Centre", "adresse": "5 rue du Centre"}'))
+        local.nom = 'Dépôt Centre (local)'
+        db.session.commit()
+        local.adresse = '50 rue du Centre'
+        db.session.commit()
+        lignes = SyncChangeLog.query.filter_by(entity_type='Local', entity_id=9005, status='pending').all()
+        assert len(lignes) == 2
+
+        # Même champ renommé sur un autre appareil : collision
+        distant = {'change_id': 502, 'entity_type': 'Local', 'entity_id': 9005, 'operation': 'update',
+                   'changed_at': '2000-01-01T00:00:00', 'changed_fields': ['nom'],
+                   'payload': {'nom': 'Dépôt Centre (dev-4)'}}
+        resultat = _fusionner_changement_serveur(distant, lignes)
+        db.session.commit()
+        assert resultat.collisions == {'nom': {'local': 'Dépôt Centre (local)', 'distant': 'Dépôt Centre (dev-4)'}}
+        assert db.session.get(Local, 9005).nom == 'Dépôt Centre (local)'
+        # Le renommage local n'est plus envoyé avant résolution ; l'adresse part normalement
+        non_envoyes = SyncChangeLog.query.filter_by(entity_type='Local', entity_id=9005).filter(
+            SyncChangeLog.status != 'sent'
+        ).all()
+        assert sorted((l.status, 'nom' in json.loads(l.changed_fields)) for l in non_envoyes) == [
+            ('conflict', True), ('pending', False)
+        ]
+        assert SyncConflict.query.filter_by(entity_type='Local', entity_id=9005).count() == 1
+
+        db.session.delete(db.session.get(Local, 9005))
+        SyncConflict.query.filter_by(entity_type='Local', entity_id=9005).delete()
+        SyncBaseVersion.query.delete()
+        db.session.commit()
+
+
+def test_pulled_changes_kept_for_conflicts_and_retried_after_errors(app_instance):
+    from app import (Local, SyncChangeLog, SyncConflict, _SYNC_EMETTEUR_SERVEUR,
+                     _rejouer_changements_serveur, _traiter_changements_serveur)
+
+    with app_instance.app_context():
+        db.session.add(Local(id=9006, nom='Dépôt Sud', adresse='6 rue du Sud'))
+        db.session.commit()
+        SyncChangeLog.query.filter_by(entity_type='Local', entity_id=9006).update({'status': 'conflict'})
+        db.session.commit()
+
+        # Entité en conflit local : le changement distant est consigné, pas perdu
+        distant = {'change_id': 600, 'entity_type': 'Local', 'entity_id': 9006, 'operation': 'update',
+                   'changed_fields': ['nom'], 'payload': {'nom': 'Dépôt Sud (dev-5)'}}
+        assert _traiter_changements_serveur([distant]) == []
+        db.session.commit()
+        conflit = SyncConflict.query.filter_by(entity_type='Local', entity_id=9006).one()
+        assert json.loads(conflit.details)['distant']['payload'] == {'nom': 'Dépôt Sud (dev-5)'}
+        assert db.session.get(Local, 9006).nom == 'Dépôt Sud'
+
+        # Changement en erreur : mis de côté, le suivant sur la même entité attend derrière lui
+        creation = {'change_id': 601, 'entity_type': 'Local', 'entity_id': 9007, 'operation': 'insert',
+                    'payload': {'nom': 'Dépôt Nord-Est'}}
+        _traiter_changements_serveur([creation])
+        db.session.commit()
+        suite = {'change_id': 602, 'entity_type': 'Local', 'entity_id': 9007, 'operation': 'update',
+                 'changed_fields': ['nom'], 'payload': {'nom': 'Dépôt Nord-Est (renommé)'}}
+        assert _traiter_changements_serveur([suite]) == [suite]
+        db.session.commit()
+        file = SyncIncomingLog.query.filter_by(device_id=_SYNC_EMETTEUR_SERVEUR).order_by(SyncIncomingLog.id)
+        assert [l.change_id for l in file] == [601, 602]
+
+        assert _rejouer_changements_serveur() == 0
+        assert [l.change_id for l in file] == [601, 602]
+        # Cause de l'échec levée : les deux changements passent, dans l'ordre
+        ligne = file.first()
+        ligne.payload = json.dumps(dict(creation, payload={'nom': 'Dépôt Nord-Est', 'adresse': '7 rue du Nord'}))
+        db.session.commit()
+        assert _rejouer_changements_serveur() == 2
+        assert db.session.get(Local, 9007).nom == 'Dépôt Nord-Est (renommé)'
+        assert file.count() == 0
+
+        db.session.delete(db.session.get(Local, 9006))
+        db.session.delete(db.session.get(Local, 9007))
+        SyncConflict.query.filter_by(entity_type='Local', entity_id=9006).delete()
+        SyncChangeLog.query.filter(SyncChangeLog.entity_id.in_([9006, 9007])).delete(synchronize_session=False)
+        db.session.commit()
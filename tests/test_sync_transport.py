@@ -0,0 +1,94 @@
+from datetime import timedelta
+
+import pytest
+
+import outbound_http
+from sync_standin_server import StandInSyncServer
+from sync_transport import SyncTransport
+
+
+@pytest.fixture
+def serveur():
+    serveur = StandInSyncServer().start()
+    yield serveur
+    serveur.stop()
+
+
+def _changements(debut, nombre):
+    return [
+        {'change_id': i, 'entity_type': 'Local', 'entity_id': i, 'operation': 'update',
+         'payload': {'nom': f"Local {i}", 'notes': 'n' * 100}}
+        for i in range(debut, debut + nombre)
+    ]
+
+
+def test_transport_compresses_reuses_connection_and_adapts(serveur):
+    transport = SyncTransport(serveur.url, compression='gzip', initial_batch=50, min_batch=10, max_batch=1000)
+    for lot in range(5):
+        reponse = transport.push({'device_id': 'dev-t'}, _changements(lot * 50 + 1, 50))
+        assert reponse['accepted_ids'] == list(range(lot * 50 + 1, lot * 50 + 51))
+    metriques = transport.snapshot()
+    assert len(serveur.connexions) == 1 and serveur.requetes == 5
+    assert metriques['format'] == 'ndjson' and metriques['octets_envoyes'] * 5 < metriques['octets_bruts']
+    # Serveur rapide : la taille de lot augmente
+    assert transport.batch_size > 50
+    transport.close()
+
+    # Serveur injoignable : la taille de lot est divisée
+    taille = transport.batch_size
+    serveur.stop()
+    with pytest.raises(OSError):
+        transport.push({'device_id': 'dev-t'}, _changements(1, 5), timeout=1)
+    assert transport.batch_size == max(10, taille // 2)
+
+
+def test_transport_falls_back_to_json_for_legacy_server():
+    serveur = StandInSyncServer(accept_ndjson=False).start()
+    try:
+        transport = SyncTransport(serveur.url)
+        assert transport.push({'device_id': 'dev-h'}, _changements(1, 3))['accepted_ids'] == [1, 2, 3]
+        assert transport.snapshot()['format'] == 'json'
+    finally:
+        serveur.stop()
+
+
+def test_sync_push_resumes_partially_acknowledged_batches(app_instance, monkeypatch):
+    import app as app_module
+    from app import (
+        app, db, Local, SyncChangeLog, SyncConfig, _sync_push_changes, coalescer_changements_sync, ensure_sync_config
+    )
+
+    serveur = StandInSyncServer(max_accept=7).start()
+    monkeypatch.setitem(app.config, 'SYNC_ALLOW_INSECURE', True)
+    monkeypatch.setitem(app.config, 'SYNC_MAX_BATCHES_PER_CYCLE', 10000)
+    outbound_http.reset('sync')
+    try:
+        with app_instance.app_context():
+            ensure_sync_config()
+            for numero in range(30):
+                db.session.add(Local(nom=f"Local sync {numero}", adresse=f"{numero} rue du Lot"))
+            db.session.commit()
+            coalescer_changements_sync()
+            en_attente = SyncChangeLog.query.filter_by(status='pending').count()
+            assert en_attente >= 30
+
+            cfg = db.session.get(SyncConfig, 1)
+            cfg.server_url = serveur.url
+            cfg.access_token = 'jeton-test'
+            cfg.token_expires_at = app_module.utcnow() + timedelta(hours=1)
+            db.session.commit()
+
+            assert _sync_push_changes(cfg) == 'synced'
+            assert SyncChangeLog.query.filter_by(status='pending').count() == 0
+            assert len(serveur.recus) == en_attente
+            assert len(serveur.connexions) == 1
+
+            cfg.server_url = None
+            cfg.access_token = None
+            Local.query.filter(Local.nom.like('Local sync %')).delete(synchronize_session=False)
+            db.session.commit()
+    finally:
+        if app_module._sync_transport is not None:
+            app_module._sync_transport.close()
+        app_module._sync_transport = None
+        serveur.stop()